@@ -9,12 +9,11 @@ from __future__ import absolute_import, print_function, division
 
 import sys
 import time
-import pp
 import numpy as np
 
 from deepmedicEN.logging.accuracyMonitor import AccuracyOfEpochMonitorSegmentation
 from deepmedicEN.neuralnet.wrappers import CnnWrapperForSampling
-from deepmedicEN.dataManagement.sampling import getSampledDataAndLabelsForSubepoch, getTDSampledDataAndLabelsForSubepoch
+from deepmedicEN.dataManagement.sampling import getSampledDataAndLabelsForSubepoch, getTDSampledDataAndLabelsForSubepoch, terminate_sampling_pool_of_process
 from deepmedicEN.routines.testing import performInferenceOnWholeVolumes
 
 from deepmedicEN.logging.utils import datetimeNowAsStr
@@ -224,7 +223,8 @@ def do_training(sessionTf,
                 listOfNamesToGiveToFmVisualisationsIfSaving,
                 
                 #-------- Others --------
-                run_input_checks
+                run_input_checks,
+                num_parallel_proc
                 ):
     start_training_time = time.time()
     # Used because I cannot pass cnn3d to the sampling function.
@@ -232,8 +232,7 @@ def do_training(sessionTf,
     cnn3dWrapper = CnnWrapperForSampling(cnn3d) 
     
     #---------To run PARALLEL the extraction of parts for the next subepoch---
-    ppservers = () # tuple of all parallel python servers to connect with
-    job_server = pp.Server(ncpus=1, ppservers=ppservers) # Creates jobserver with automatically detected number of workers
+    # The samplers are called with inBackground=True. Their jobs run in the sampling pool of this process, while it trains. See SamplingOfSubepoch.
     
     ##======================================================================##
 
@@ -262,7 +261,8 @@ def do_training(sessionTf,
                                     
                                     padInputImagesBool,
                                     doIntAugm_shiftMuStd_multiMuStd,
-                                    reflectImageWithHalfProbDuringTraining
+                                    reflectImageWithHalfProbDuringTraining,
+                                    num_parallel_proc
                                     )
     ##========================================================================================##
     TDtupleWithParametersForTraining = (log,
@@ -290,7 +290,8 @@ def do_training(sessionTf,
                                     
                                     padInputImagesBool,
                                     doIntAugm_shiftMuStd_multiMuStd,
-                                    reflectImageWithHalfProbDuringTraining
+                                    reflectImageWithHalfProbDuringTraining,
+                                    num_parallel_proc
                                     )
 
    
@@ -320,7 +321,8 @@ def do_training(sessionTf,
                                     
                                     padInputImagesBool,
                                     [0, -1,-1,-1], #don't perform intensity-augmentation during validation.
-                                    [0,0,0] #don't perform reflection-augmentation during validation.
+                                    [0,0,0], #don't perform reflection-augmentation during validation.
+                                    num_parallel_proc
                                     )
     ##======================================================================================================##
     TDtupleWithParametersForValidation = (log,
@@ -348,14 +350,12 @@ def do_training(sessionTf,
                                     
                                     padInputImagesBool,
                                     [0, -1,-1,-1], #don't perform intensity-augmentation during validation.
-                                    [0,0,0] #don't perform reflection-augmentation during validation.
+                                    [0,0,0], #don't perform reflection-augmentation during validation.
+                                    num_parallel_proc
                                     )
 
 ##===============================================================================================================##
-    tupleWithLocalFunctionsThatWillBeCalledByTheMainJob = ( )
-    tupleWithModulesToImportWhichAreUsedByTheJobFunctions = ( "from __future__ import absolute_import, print_function, division",
-                "time", "numpy as np", "from deepmedicEN.dataManagement.sampling import *" )
-    boolItIsTheVeryFirstSubepochOfThisProcess = True #to know so that in the very first I sequencially load the data for it.
+    boolItIsTheVeryFirstSubepochOfThisProcess = True #to know so that in the very first I wait for the data of it, as nothing was submitted before.
     #------End for parallel------
     
     model_num_epochs_trained = trainer.get_num_epochs_trained_tfv().eval(session=sessionTf)
@@ -405,8 +405,10 @@ def do_training(sessionTf,
                                                                         
                                                                         padInputImagesBool,
                                                                         doIntAugm_shiftMuStd_multiMuStd=[False,[],[]],
-                                                                        reflectImageWithHalfProbDuringTraining = [0,0,0]
-                                                                        )
+                                                                        reflectImageWithHalfProbDuringTraining = [0,0,0],
+                                                                        num_parallel_proc = num_parallel_proc,
+                                                                        inBackground = True
+                                                                        ).get()
                     boolItIsTheVeryFirstSubepochOfThisProcess = False
 
                     ##===================================================================================##
@@ -436,15 +438,17 @@ def do_training(sessionTf,
                                                                         
                                                                         padInputImagesBool,
                                                                         doIntAugm_shiftMuStd_multiMuStd=[False,[],[]],
-                                                                        reflectImageWithHalfProbDuringTraining = [0,0,0]
-                                                                        )
+                                                                        reflectImageWithHalfProbDuringTraining = [0,0,0],
+                                                                        num_parallel_proc = num_parallel_proc,
+                                                                        inBackground = True
+                                                                        ).get()
                     ##===================================================================================##
                 else : #It was done in parallel with the training of the previous epoch, just grab the results...
                     [channsOfSegmentsForSubepPerPathwayVal,
-                    labelsForCentralOfSegmentsForSubepVal] = parallelJobToGetDataForNextValidation() #fromParallelProcessing that had started from last loop when it was submitted.
+                    labelsForCentralOfSegmentsForSubepVal] = parallelJobToGetDataForNextValidation.get() #fromParallelProcessing that had started from last loop when it was submitted.
                 ##=====================================================================================##
                     [TDchannsOfSegmentsForSubepPerPathwayVal,
-                    TDlabelsForCentralOfSegmentsForSubepVal] = TDparallelJobToGetDataForNextValidation() #fromParallelProcessing that had started from last loop when it was submitted.
+                    TDlabelsForCentralOfSegmentsForSubepVal] = TDparallelJobToGetDataForNextValidation.get() #fromParallelProcessing that had started from last loop when it was submitted.
                 
                 ##==========================================================================================##
 
@@ -455,15 +459,9 @@ def do_training(sessionTf,
                 #------------------------SUBMIT PARALLEL JOB TO GET TRAINING DATA FOR NEXT TRAINING-----------------
                 #submit the parallel job
                 log.print3("PARALLEL: Before Validation in subepoch #" +str(subepoch) + ", the parallel job for extracting Segments for the next Training is submitted.")
-                parallelJobToGetDataForNextTraining = job_server.submit(getSampledDataAndLabelsForSubepoch, #local function to call and execute in parallel.
-                                                                        tupleWithParametersForTraining, #tuple with the arguments required
-                                                                        tupleWithLocalFunctionsThatWillBeCalledByTheMainJob, #tuple of local functions that I need to call
-                                                                        tupleWithModulesToImportWhichAreUsedByTheJobFunctions) #tuple of the external modules that I need, of which I am calling functions (not the mods of the ext-functions).
+                parallelJobToGetDataForNextTraining = getSampledDataAndLabelsForSubepoch(*tupleWithParametersForTraining, inBackground=True)
                 ##============================================================================================================================##
-                TDparallelJobToGetDataForNextTraining = job_server.submit(getTDSampledDataAndLabelsForSubepoch, #local function to call and execute in parallel.
-                                                                        TDtupleWithParametersForTraining, #tuple with the arguments required
-                                                                        tupleWithLocalFunctionsThatWillBeCalledByTheMainJob, 
-                                                                        tupleWithModulesToImportWhichAreUsedByTheJobFunctions) 
+                TDparallelJobToGetDataForNextTraining = getTDSampledDataAndLabelsForSubepoch(*TDtupleWithParametersForTraining, inBackground=True)
 
     
                 ##=========================================================================================================================##
@@ -517,8 +515,10 @@ TDlabelsForCentralOfSegmentsForSubepVal)
                                                                         
                                                                         padInputImagesBool,
                                                                         doIntAugm_shiftMuStd_multiMuStd,
-                                                                        reflectImageWithHalfProbDuringTraining
-                                                                        )
+                                                                        reflectImageWithHalfProbDuringTraining,
+                                                                        num_parallel_proc = num_parallel_proc,
+                                                                        inBackground = True
+                                                                        ).get()
                 boolItIsTheVeryFirstSubepochOfThisProcess = False
                 ##==============================================================================================================================##
                 [TDchannsOfSegmentsForSubepPerPathwayTrain,
@@ -546,8 +546,10 @@ TDlabelsForCentralOfSegmentsForSubepVal)
                                                                         
                                                                         padInputImagesBool,
                                                                         doIntAugm_shiftMuStd_multiMuStd,
-                                                                        reflectImageWithHalfProbDuringTraining
-                                                                        )
+                                                                        reflectImageWithHalfProbDuringTraining,
+                                                                        num_parallel_proc = num_parallel_proc,
+                                                                        inBackground = True
+                                                                        ).get()
 
 
                 
@@ -555,11 +557,11 @@ TDlabelsForCentralOfSegmentsForSubepVal)
             else :
                 #It was done in parallel with the validation (or with previous training iteration, in case I am not performing validation).
                 [channsOfSegmentsForSubepPerPathwayTrain,
-                labelsForCentralOfSegmentsForSubepTrain] = parallelJobToGetDataForNextTraining() #fromParallelProcessing that had started from last loop when it was submitted.
+                labelsForCentralOfSegmentsForSubepTrain] = parallelJobToGetDataForNextTraining.get() #fromParallelProcessing that had started from last loop when it was submitted.
 
                 ##==================================================================##
                 [TDchannsOfSegmentsForSubepPerPathwayTrain,
-                TDlabelsForCentralOfSegmentsForSubepTrain] = TDparallelJobToGetDataForNextTraining()
+                TDlabelsForCentralOfSegmentsForSubepTrain] = TDparallelJobToGetDataForNextTraining.get()
 
                 
                 ##================================================================================##
@@ -571,30 +573,18 @@ TDlabelsForCentralOfSegmentsForSubepVal)
             if performValidationOnSamplesDuringTrainingProcessBool :
                 #submit the parallel job
                 log.print3("PARALLEL: Before Training in subepoch #" +str(subepoch) + ", submitting the parallel job for extracting Segments for the next Validation.")
-                parallelJobToGetDataForNextValidation = job_server.submit(getSampledDataAndLabelsForSubepoch, #local function to call and execute in parallel.
-                                                                            tupleWithParametersForValidation, #tuple with the arguments required
-                                                                            tupleWithLocalFunctionsThatWillBeCalledByTheMainJob, #tuple of local functions that I need to call
-                                                                            tupleWithModulesToImportWhichAreUsedByTheJobFunctions) #tuple of the external modules that I need, of which I am calling functions (not the mods of the ext-functions).
+                parallelJobToGetDataForNextValidation = getSampledDataAndLabelsForSubepoch(*tupleWithParametersForValidation, inBackground=True)
                 
                 ##====================================================================================================================###
-                TDparallelJobToGetDataForNextValidation = job_server.submit(getTDSampledDataAndLabelsForSubepoch, 
-                                                                            TDtupleWithParametersForValidation, 
-                                                                            tupleWithLocalFunctionsThatWillBeCalledByTheMainJob, 
-                                                                            tupleWithModulesToImportWhichAreUsedByTheJobFunctions)
+                TDparallelJobToGetDataForNextValidation = getTDSampledDataAndLabelsForSubepoch(*TDtupleWithParametersForValidation, inBackground=True)
 
               
                 ##=============================================================================================================================##
             else : #extract in parallel the samples for the next subepoch's training.
                 log.print3("PARALLEL: Before Training in subepoch #" +str(subepoch) + ", submitting the parallel job for extracting Segments for the next Training.")
-                parallelJobToGetDataForNextTraining = job_server.submit(getSampledDataAndLabelsForSubepoch, #local function to call and execute in parallel.
-                                                                            tupleWithParametersForTraining, #tuple with the arguments required
-                                                                            tupleWithLocalFunctionsThatWillBeCalledByTheMainJob, #tuple of local functions that I need to call
-                                                                            tupleWithModulesToImportWhichAreUsedByTheJobFunctions) #tuple of the external modules that I need, of which I am calling
+                parallelJobToGetDataForNextTraining = getSampledDataAndLabelsForSubepoch(*tupleWithParametersForTraining, inBackground=True)
                 ##===================================================================================================================================================##
-                TDparallelJobToGetDataForNextTraining = job_server.submit(getTDSampledDataAndLabelsForSubepoch, #local function to call and execute in parallel.
-                                                                            TDtupleWithParametersForTraining, #tuple with the arguments required
-                                                                            tupleWithLocalFunctionsThatWillBeCalledByTheMainJob, #tuple of local functions that I need to call
-                                                                            tupleWithModulesToImportWhichAreUsedByTheJobFunctions)
+                TDparallelJobToGetDataForNextTraining = getTDSampledDataAndLabelsForSubepoch(*TDtupleWithParametersForTraining, inBackground=True)
                 ##=====================================================================================================================================================##
             #-------------------------------START TRAINING IN BATCHES------------------------------
             log.print3("-T-T-T-T-T- Now Training for this subepoch... This may take a few minutes... -T-T-T-T-T-")
@@ -675,6 +665,7 @@ TDlabelsForCentralOfSegmentsForSubepTrain)
                                     listOfNamesToGiveToFmVisualisationsIfSaving=listOfNamesToGiveToFmVisualisationsIfSaving
                                     )
         
+    terminate_sampling_pool_of_process() # Do not leave its processes behind.
     end_training_time = time.time()
     log.print3("TIMING: Training process took time: "+str(end_training_time-start_training_time)+"(s)")
     log.print3("The whole do_training() function has finished.")
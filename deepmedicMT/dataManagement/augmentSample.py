@@ -0,0 +1,126 @@
+# Copyright (c) 2016, Konstantinos Kamnitsas
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the BSD license. See the accompanying LICENSE file
+# or read the terms at https://opensource.org/licenses/BSD-3-Clause.
+
+from __future__ import absolute_import, print_function, division
+
+import numpy as np
+
+from deepmedicMT.dataManagement.samplerRng import get_sampler_rng
+
+# Augmentation of the segments of a whole subepoch at once, in place, rather than one segment (or case) at a time.
+# All random parameters are drawn up front as arrays, one per segment. Each transform is then applied with one broadcasted operation...
+# ... per pathway (intensities), or one per pathway and distinct outcome (flips: per axis, rotations: per plane and number of 90 degree turns).
+# The number of numpy calls depends on the number of pathways and transforms, not on the number of segments.
+# Segments of all pathways are centred on the same voxel, so flips and rotations about the centre of each segment keep them aligned.
+
+def augment_sample(channels, gt_lbls, prms, samplerRng=None):
+    # channels: list (x pathways) of np arrays [segments, channels, x, y, z]. The segments of the subepoch. Modified in place.
+    # gt_lbls: np array [segments, x, y, z], or None (unlabeled segments).
+    # prms: None or Dictionary, with parameters of each augmentation type. None for a type disables it.
+    # samplerRng: SamplerRNG to draw the parameters from. None draws from the global random state.
+    if prms is not None:
+        samplerRng = get_sampler_rng(samplerRng)
+        channels = random_histogram_distortion(channels, prms['hist_dist'], samplerRng)
+        channels, gt_lbls = random_flip(channels, gt_lbls, prms['reflect'], samplerRng)
+        channels, gt_lbls = random_rotation_90(channels, gt_lbls, prms['rotate90'], samplerRng)
+
+    return channels, gt_lbls
+
+def random_histogram_distortion(channels, prms, samplerRng=None):
+    # Shift and scale the histogram of each channel of each segment.
+    # prms: { 'shift': {'mu': 0.0, 'std':0.}, 'scale':{'mu': 1.0, 'std': '0.'} }
+    if prms is None or len(channels) == 0:
+        return channels
+    samplerRng = get_sampler_rng(samplerRng)
+
+    [n_segms, n_channs] = channels[0].shape[:2]
+    if prms['shift'] is None:
+        shift_per_chan = np.zeros([n_segms, n_channs, 1, 1, 1], dtype="float32")
+    elif prms['shift']['std'] != 0: # np.random.normal does not work for an std==0.
+        shift_per_chan = samplerRng.normal( prms['shift']['mu'], prms['shift']['std'], [n_segms, n_channs, 1, 1, 1]).astype("float32")
+    else:
+        shift_per_chan = np.ones([n_segms, n_channs, 1, 1, 1], dtype="float32") * prms['shift']['mu']
+
+    if prms['scale'] is None:
+        scale_per_chan = np.ones([n_segms, n_channs, 1, 1, 1], dtype="float32")
+    elif prms['scale']['std'] != 0:
+        scale_per_chan = samplerRng.normal(prms['scale']['mu'], prms['scale']['std'], [n_segms, n_channs, 1, 1, 1]).astype("float32")
+    else:
+        scale_per_chan = np.ones([n_segms, n_channs, 1, 1, 1], dtype="float32") * prms['scale']['mu']
+
+    # Same shift/scale of a channel of a segment for all pathways, as they see the same image.
+    for path_idx in range(len(channels)):
+        channels[path_idx] += shift_per_chan.astype(channels[path_idx].dtype)
+        channels[path_idx] *= scale_per_chan.astype(channels[path_idx].dtype)
+
+    return channels
+
+
+def random_flip(channels, gt_lbls, probs_flip_axes=[0.5, 0.5, 0.5], samplerRng=None):
+    # Flip (reflect) each segment along each axis, with the probability of the axis.
+    # probs_flip_axes: list of probabilities, one per axis.
+    if probs_flip_axes is None or len(channels) == 0:
+        return channels, gt_lbls
+    samplerRng = get_sampler_rng(samplerRng)
+
+    n_segms = channels[0].shape[0]
+    flip_per_segm_and_axis = samplerRng.uniform(0., 1., [n_segms, 3]) < np.asarray(probs_flip_axes, dtype="float64") # Bool (segments, 3)
+    for axis_idx in range(3):
+        segms_to_flip = np.nonzero(flip_per_segm_and_axis[:, axis_idx])[0]
+        if len(segms_to_flip) == 0:
+            continue
+        for path_idx in range(len(channels)):
+            channels[path_idx][segms_to_flip] = np.flip(channels[path_idx][segms_to_flip], axis=axis_idx+2) # + 2 because dims [0,1] are segments, channels.
+        if gt_lbls is not None:
+            gt_lbls[segms_to_flip] = np.flip(gt_lbls[segms_to_flip], axis=axis_idx+1)
+
+    return channels, gt_lbls
+
+
+def random_rotation_90(channels, gt_lbls, probs_rot_90=None, samplerRng=None):
+    # Rotate each segment by 0/90/180/270 degrees, in each plane.
+    # probs_rot_90: {'xy': {'0': fl, '90': fl, '180': fl, '270': fl},
+    #                'yz': {'0': fl, '90': fl, '180': fl, '270': fl},
+    #                'xz': {'0': fl, '90': fl, '180': fl, '270': fl} }
+    if probs_rot_90 is None or len(channels) == 0:
+        return channels, gt_lbls
+    samplerRng = get_sampler_rng(samplerRng)
+
+    n_segms = channels[0].shape[0]
+    for key, plane_axes in zip( ['xy', 'yz', 'xz'], [(0,1), (1,2), (0,2)] ) :
+        probs_plane = probs_rot_90[key]
+
+        if probs_plane is None:
+            continue
+
+        assert len(probs_plane) == 4 # rotation 0, rotation 90 degrees, 180, 270.
+        p_rot_90_x0123 = np.asarray( [ probs_plane['0'], probs_plane['90'], probs_plane['180'], probs_plane['270'] ], dtype="float64" )
+        sum_p = np.sum(p_rot_90_x0123)
+        if sum_p == 0:
+            continue
+        p_rot_90_x0123 /= sum_p # normalize p to 1. Not in place of prms, that are reused every subepoch.
+
+        # 90 and 270 degrees swap the two axes of the plane. The segments (and labels) of every pathway must be isotropic in it.
+        if p_rot_90_x0123[1] + p_rot_90_x0123[3] > 0 :
+            for array in channels + ([gt_lbls] if gt_lbls is not None else []) :
+                shape_of_segm = array.shape[-3:]
+                if shape_of_segm[plane_axes[0]] != shape_of_segm[plane_axes[1]] :
+                    raise ValueError("ERROR: Rotation by 90 degrees in plane [" + key + "] was requested, but segments of shape " + str(list(shape_of_segm)) +\
+                                     " are not isotropic in it. Set the probabilities of '90' and '270' of the plane to 0.")
+
+        rot_90_xtimes_per_segm = samplerRng.choice(4, size=n_segms, p=p_rot_90_x0123)
+        for rot_90_xtimes in (1, 2, 3):
+            segms_to_rot = np.nonzero(rot_90_xtimes_per_segm == rot_90_xtimes)[0]
+            if len(segms_to_rot) == 0:
+                continue
+            for path_idx in range(len(channels)):
+                channels[path_idx][segms_to_rot] = np.rot90(channels[path_idx][segms_to_rot], k=rot_90_xtimes, axes = [axis+2 for axis in plane_axes]) # + 2 cause [0,1] are segments, channels.
+            if gt_lbls is not None:
+                gt_lbls[segms_to_rot] = np.rot90(gt_lbls[segms_to_rot], k=rot_90_xtimes, axes = [axis+1 for axis in plane_axes])
+
+    return channels, gt_lbls
+
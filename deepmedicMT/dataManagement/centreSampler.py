@@ -0,0 +1,98 @@
+# Copyright (c) 2016, Konstantinos Kamnitsas
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the BSD license. See the accompanying LICENSE file
+# or read the terms at https://opensource.org/licenses/BSD-3-Clause.
+
+from __future__ import absolute_import, print_function, division
+
+import numpy as np
+
+from deepmedicMT.dataManagement.samplerRng import get_sampler_rng
+
+
+def getHalfSegmentBoundaries(dimsOfSegmentRcz) :
+    # Returns array (3, 2): per axis, how many voxels the segment extends to the left/right of its "central" voxel.
+    # If a dimension is even, the "central" voxel is 1 voxel closer to the beginning of the axis.
+    halfImagePartBoundaries = np.zeros( (len(dimsOfSegmentRcz), 2) , dtype='int32')
+    for rcz_i in range( len(dimsOfSegmentRcz) ) :
+        if dimsOfSegmentRcz[rcz_i]%2 == 0: #even
+            dimensionDividedByTwo = dimsOfSegmentRcz[rcz_i]//2
+            halfImagePartBoundaries[rcz_i] = [dimensionDividedByTwo - 1, dimensionDividedByTwo]
+        else: #odd
+            halfImagePartBoundaries[rcz_i] = [dimsOfSegmentRcz[rcz_i]//2, dimsOfSegmentRcz[rcz_i]//2]
+    return halfImagePartBoundaries
+
+
+class CentreSampler(object):
+    # The voxels that can be the central voxel of a segment, for one category of a case: their flat indices in the (reflected/padded) volume,...
+    # ... already constrained so that segments centred on them are within the volume. And the cumulative sum of their weights, if not all equal.
+    # Drawing a centre is then a random int (binary map), or a binary search in the cumulative weights. Independent of the size of the volume.
+
+    def __init__(self, flatIndicesOfCandidates, shapeOfVolume, weightsOfCandidates=None) :
+        self.shapeOfVolume = tuple(shapeOfVolume)
+        self._flatIndices = flatIndicesOfCandidates
+        self._cumulativeWeights = None
+        if weightsOfCandidates is not None and len(weightsOfCandidates) > 0 and np.any(weightsOfCandidates != weightsOfCandidates[0]) :
+            self._cumulativeWeights = np.cumsum(weightsOfCandidates, dtype="float64")
+        self.nbytes = self._flatIndices.nbytes + (self._cumulativeWeights.nbytes if self._cumulativeWeights is not None else 0) # For caches.
+
+    def getNumberOfCandidates(self) :
+        return len(self._flatIndices)
+
+    def isEmpty(self) :
+        return len(self._flatIndices) == 0
+
+    def sample(self, numberOfCentres, samplerRng=None) :
+        # Returns the coordinates of the sampled centres, array of shape 3(rcz) x numberOfCentres. With replacement, as np.random.choice was.
+        samplerRng = get_sampler_rng(samplerRng)
+        if self._cumulativeWeights is None :
+            indicesOfPicked = samplerRng.integers(0, len(self._flatIndices), size=numberOfCentres)
+        else :
+            indicesOfPicked = np.searchsorted(self._cumulativeWeights, samplerRng.uniform(0, self._cumulativeWeights[-1], size=numberOfCentres), side="right")
+            indicesOfPicked = np.minimum(indicesOfPicked, len(self._flatIndices) - 1) # Guards against rounding at the top end.
+        return np.asarray( np.unravel_index(self._flatIndices[indicesOfPicked], self.shapeOfVolume) )
+
+
+def makeCentreSamplerFromWeightMap(weightMapToSampleFrom, dimsOfSegmentRcz) :
+    # weightMapToSampleFrom: 3D array (binary mask or non-negative weights), in the space of the loaded (reflected/padded) volumes.
+    # Only the inner box, where centres keep the segment within the volume, is scanned. Once per case and category.
+    shapeOfVolume = weightMapToSampleFrom.shape
+    halfImagePartBoundaries = getHalfSegmentBoundaries(dimsOfSegmentRcz)
+    lowOfInnerBox = [ halfImagePartBoundaries[axis_i][0] for axis_i in range(3) ]
+    highOfInnerBox = [ shapeOfVolume[axis_i] - halfImagePartBoundaries[axis_i][1] for axis_i in range(3) ]
+    innerBox = weightMapToSampleFrom[ lowOfInnerBox[0] : highOfInnerBox[0], lowOfInnerBox[1] : highOfInnerBox[1], lowOfInnerBox[2] : highOfInnerBox[2] ]
+    coordsInInnerBox = np.nonzero(innerBox > 0)
+    weightsOfCandidates = innerBox[coordsInInnerBox] if innerBox.dtype.kind == 'f' else None # Integer maps are masks.
+    flatIndices = np.ravel_multi_index( tuple( [coordsInInnerBox[axis_i] + lowOfInnerBox[axis_i] for axis_i in range(3)] ), shapeOfVolume )
+    return CentreSampler(flatIndices, shapeOfVolume, weightsOfCandidates)
+
+
+def makeCentreSamplerFromIndices(flatIndicesInRecordVolume, shapeInRecord, reflectFlags, tupleOfPaddingPerAxesLeftRight, dimsOfSegmentRcz) :
+    # Same candidates as makeCentreSamplerFromWeightMap() would give for the binary map of the given voxels, after the map is reflected and...
+    # ... reflect-padded as in load_imgs_of_single_case(). But made from the indices of the voxels (eg from a dataset manifest), without a map.
+    # Voxels close to a border also appear mirrored in the padding, as they would in the padded map. Assumes padding < size of the volume per axis.
+    coordsRcz = list( np.unravel_index(np.asarray(flatIndicesInRecordVolume, dtype="int64"), shapeInRecord) )
+    shapeOfVolume = []
+    for axis_i in range(3) :
+        n = shapeInRecord[axis_i]
+        (padLeft, padRight) = tupleOfPaddingPerAxesLeftRight[axis_i]
+        if reflectFlags[axis_i] :
+            coordsRcz[axis_i] = n - 1 - coordsRcz[axis_i]
+        coordsOfAxis = coordsRcz[axis_i]
+        # Which voxels reappear in the left/right padding, and where. np.pad's 'reflect' does not repeat the edge voxel.
+        mirroredLeft = np.flatnonzero( (coordsOfAxis >= 1) & (coordsOfAxis <= padLeft) )
+        mirroredRight = np.flatnonzero( (coordsOfAxis >= n - 1 - padRight) & (coordsOfAxis <= n - 2) )
+        newCoordsOfAxis = np.concatenate( [ coordsOfAxis + padLeft, padLeft - coordsOfAxis[mirroredLeft], padLeft + 2*(n-1) - coordsOfAxis[mirroredRight] ] )
+        selectOfAll = np.concatenate( [ np.arange(len(coordsOfAxis)), mirroredLeft, mirroredRight ] )
+        coordsRcz = [ coords[selectOfAll] for coords in coordsRcz ]
+        coordsRcz[axis_i] = newCoordsOfAxis
+        shapeOfVolume.append(n + padLeft + padRight)
+    halfImagePartBoundaries = getHalfSegmentBoundaries(dimsOfSegmentRcz)
+    withinBoundaries = np.ones(len(coordsRcz[0]), dtype=bool)
+    for axis_i in range(3) :
+        withinBoundaries &= (coordsRcz[axis_i] >= halfImagePartBoundaries[axis_i][0]) & (coordsRcz[axis_i] < shapeOfVolume[axis_i] - halfImagePartBoundaries[axis_i][1])
+    flatIndices = np.ravel_multi_index( tuple( [coords[withinBoundaries] for coords in coordsRcz] ), shapeOfVolume )
+    return CentreSampler(flatIndices, shapeOfVolume)
+
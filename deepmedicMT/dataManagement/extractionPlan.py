@@ -0,0 +1,78 @@
+# Copyright (c) 2016, Konstantinos Kamnitsas
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the BSD license. See the accompanying LICENSE file
+# or read the terms at https://opensource.org/licenses/BSD-3-Clause.
+
+from __future__ import absolute_import, print_function, division
+
+import math
+import numpy as np
+
+from deepmedicMT.neuralnet.pathwayTypes import PathwayTypes as pt
+from deepmedicMT.image.processing import calculateTheZeroIntensityOf3dImage
+
+
+class GeometryOfPathway(object):
+    # Where the segment of a pathway lies, relative to the segment of the primary pathway. See ExtractionPlan.
+
+    def __init__(self, pType, subSamplingFactor, inputShapeRcz, recFieldCnn, dimsOfPrimarySegment) :
+        self.pType = pType
+        self.subSamplingFactor = np.asarray(subSamplingFactor, dtype="int64")
+        self.inputShapeRcz = [ int(dim) for dim in inputShapeRcz ]
+        self.positionsPerAxis = [ np.arange(dim) for dim in self.inputShapeRcz ]
+        if pType == pt.NORM :
+            return
+        # Subsampled pathways. Same as getImagePartFromSubsampledImageForTraining() computes per segment, see there for the reasoning:
+        # From the beginning of the primary segment, go forward to the "central" voxel of the subsampled area, then back the slots of previous patches.
+        self.offsetOfLowFromPrimarySegment = np.zeros(3, dtype="int64")
+        self.spanNonIncl = np.zeros(3, dtype="int64") # highNonIncl - low, in voxels of the (not subsampled) image.
+        for axis_i in range(3) :
+            factor = int(self.subSamplingFactor[axis_i])
+            numberOfCentralVoxelsClassified = dimsOfPrimarySegment[axis_i] - recFieldCnn[axis_i] + 1
+            slotsPreviously = ((factor-1)//2)*recFieldCnn[axis_i] if factor%2==1 else (factor-2)//2*recFieldCnn[axis_i] + recFieldCnn[axis_i]//2
+            toCentralVoxelOfAnAveragedArea = factor//2 if factor%2==1 else (factor//2 - 1) #one closer to the beginning of the dim.
+            self.offsetOfLowFromPrimarySegment[axis_i] = toCentralVoxelOfAnAveragedArea - slotsPreviously
+            self.spanNonIncl[axis_i] = factor*recFieldCnn[axis_i] + (int(math.ceil((numberOfCentralVoxelsClassified*1.0)/factor)) - 1) * factor
+
+
+class ExtractionPlan(object):
+    # The shapes and offsets needed to extract segments for a model, computed once, instead of for every segment.
+    # One GeometryOfPathway per pathway that requires input, in the order of cnn3d.pathways. And the shape/offset of the labels of the classified part.
+    # train_val_test: The stage, whose input shapes are used.
+
+    def __init__(self, cnn3d, train_val_test) :
+        self.train_val_test = train_val_test
+        self.recFieldCnn = cnn3d.recFieldCnn
+        dimsOfPrimarySegment = cnn3d.pathways[0].getShapeOfInput(train_val_test)[2:] # Primary pathway (NORMAL) should be the first one in .pathways.
+        self.geometriesPerPathway = []
+        for pathway in cnn3d.pathways :
+            if pathway.pType() == pt.FC :
+                continue
+            inputShapeRcz = pathway.getShapeOfInput(train_val_test)[2:]
+            # NOTE: Training/validation has always given the input shape of the subsampled pathway as the dims of the primary segment. Testing gives...
+            # ... the ones of the primary pathway. They are kept as they were, so that the segments are the same as before.
+            dimsOfPrimarySegmentForGeometry = dimsOfPrimarySegment if train_val_test == "test" else inputShapeRcz
+            self.geometriesPerPathway.append( GeometryOfPathway(pathway.pType(), pathway.subsFactor(), inputShapeRcz, cnn3d.recFieldCnn, dimsOfPrimarySegmentForGeometry) )
+        self.dimsOfPrimarySegment = list(dimsOfPrimarySegment)
+        # Left boundary of the primary segment, from its "central" voxel (1 voxel closer to the beginning, if even).
+        self.offsetOfPrimarySegmentFromCentre = np.asarray( [ (dim-1)//2 for dim in dimsOfPrimarySegment ], dtype="int64" )
+        if train_val_test != "test" :
+            self.shapeOfLabelsOfSegment = list(cnn3d.finalTargetLayer_outputShape[train_val_test][2:])
+            self.offsetOfLabelsFromCentre = np.asarray( [ (dim-1)//2 for dim in self.shapeOfLabelsOfSegment ], dtype="int64" )
+
+    def getNumberOfPathways(self) :
+        return len(self.geometriesPerPathway)
+
+    def getShapesOfSegmentPerPathway(self, numberOfChannels) :
+        return [ [numberOfChannels] + geometry.inputShapeRcz for geometry in self.geometriesPerPathway ]
+
+
+def getIntensitiesOfZeroOfChannels(channels) :
+    # The intensity of the "zero" (background) of each channel of a case, to fill what is out of the image. Computed once per case.
+    # Returns None if no channels are given (eg "placeholderNothing" when there are no subsampled pathways).
+    if isinstance(channels, str) :
+        return None
+    return np.asarray([ calculateTheZeroIntensityOf3dImage(channels[channel_i]) for channel_i in range(len(channels)) ], dtype="float32")
+
@@ -0,0 +1,110 @@
+# Copyright (c) 2016, Konstantinos Kamnitsas
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the BSD license. See the accompanying LICENSE file
+# or read the terms at https://opensource.org/licenses/BSD-3-Clause.
+
+from __future__ import absolute_import, print_function, division
+
+import numpy as np
+
+from deepmedicMT.dataManagement.centreSampler import makeCentreSamplerFromWeightMap
+
+STRING_OF_HARD_EXAMPLES_CATEGORY = "Hard-Examples"
+
+
+class HardExampleMap(object):
+    # Coarse map of the training loss over the labeled cases. Each case is cut in cells of sizeOfCellsRcz voxels. A cell keeps the running...
+    # ... average of the cost of the training segments that were centred in it. A fraction of the segments of each subepoch is then sampled...
+    # ... as an extra category ("Hard-Examples"), with centres drawn proportionally to the loss of their cell. The rest of the segments are...
+    # ... sampled by the categories of the SamplingType, as without the map. They also keep updating it, including in cells not yet visited.
+    # Cells are in the coordinates of the case as read from disk (not reflected, not padded), so they are the same every subepoch.
+    # Lives in the training process, updated after every batch. A copy is given to the sampler of each subepoch, which may run in another...
+    # ... process. The segments sampled with it are thus one subepoch behind the updates, as the next subepoch is sampled while training.
+
+    def __init__(self, log, fractionOfSegments, sizeOfCellsRcz, momentum) :
+        self.fractionOfSegments = fractionOfSegments
+        self.sizeOfCellsRcz = np.asarray(sizeOfCellsRcz, dtype="int32")
+        self.momentum = momentum # new = momentum * old + (1 - momentum) * cost of segment.
+        self._lossPerCellOfCase = {} # index_of_case -> { (r, c, z) of cell : running average of the cost }
+        self._sumOfCostsSinceReport = 0.
+        self._numberOfSegmentsSinceReport = 0
+        log.print3("HARD EXAMPLES: [" + str(round(100. * fractionOfSegments, 1)) + "%] of the training segments are centred proportionally to the loss in "+\
+                   "cells of " + str(list(sizeOfCellsRcz)) + " voxels, updated with momentum [" + str(momentum) + "].")
+
+    def get_percentages_of_categories(self, percentOfSamplesPerCategoryToSample) :
+        # The percentages of the SamplingType, scaled to make room for the hard-examples category, appended last.
+        percentages = np.asarray(percentOfSamplesPerCategoryToSample, dtype="float32") * (1. - self.fractionOfSegments)
+        return np.concatenate( [ percentages, np.asarray([self.fractionOfSegments], dtype="float32") ] )
+
+    def update(self, originsOfSegments, costPerSegment) :
+        # originsOfSegments: array (N, 4) of [index of case, r, c, z of the central voxel], as given by getSampledDataAndLabelsForSubepoch().
+        # costPerSegment: array (N,), the cost of each segment in the training step.
+        cellsOfSegments = originsOfSegments[:, 1:] // self.sizeOfCellsRcz
+        for (index_of_case, cell, cost) in zip(originsOfSegments[:, 0], cellsOfSegments, costPerSegment) :
+            lossPerCell = self._lossPerCellOfCase.setdefault(int(index_of_case), {})
+            keyOfCell = tuple( int(c) for c in cell )
+            lossPerCell[keyOfCell] = self.momentum * lossPerCell[keyOfCell] + (1. - self.momentum) * cost if keyOfCell in lossPerCell else float(cost)
+        self._sumOfCostsSinceReport += float(np.sum(costPerSegment))
+        self._numberOfSegmentsSinceReport += len(costPerSegment)
+
+    def get_mean_loss(self) :
+        # Over all the cells visited. None if none yet.
+        losses = [ loss for lossPerCell in self._lossPerCellOfCase.values() for loss in lossPerCell.values() ]
+        return np.mean(losses) if len(losses) > 0 else None
+
+    def make_centre_sampler_of_case(self,
+                                    index_of_case,
+                                    dimensionsOfImageChannel, # Of the loaded volumes (reflected, padded).
+                                    dimsOfSegmentRcz,
+                                    reflectFlags, # As the loaded volumes were reflected.
+                                    tupleOfPaddingPerAxesLeftRight, # As the loaded volumes were padded.
+                                    roiMask) : # Array, or a placeholder if no ROI.
+        # CentreSampler of the hard-examples category of the case: weights per voxel given by the loss of its cell. Cells of the case not visited...
+        # ... yet get the mean loss of the visited ones (of the case, else of all cases), so that they are explored. Uniform if nothing is known.
+        lossPerCell = self._lossPerCellOfCase.get(index_of_case, {})
+        priorLoss = np.mean(list(lossPerCell.values())) if len(lossPerCell) > 0 else self.get_mean_loss()
+        shapeInCase = [ dimensionsOfImageChannel[axis_i] - sum(tupleOfPaddingPerAxesLeftRight[axis_i]) for axis_i in range(3) ]
+        shapeOfGrid = [ int(np.ceil(shapeInCase[axis_i] * 1.0 / self.sizeOfCellsRcz[axis_i])) for axis_i in range(3) ]
+        gridOfLosses = np.ones(shapeOfGrid, dtype="float32") * (priorLoss if priorLoss is not None else 1.)
+        for (keyOfCell, loss) in lossPerCell.items() :
+            if all( keyOfCell[axis_i] < shapeOfGrid[axis_i] for axis_i in range(3) ) :
+                gridOfLosses[keyOfCell] = loss
+        # To voxels, in the space of the loaded volumes.
+        weightMap = gridOfLosses
+        for axis_i in range(3) :
+            weightMap = np.repeat(weightMap, self.sizeOfCellsRcz[axis_i], axis=axis_i)
+        weightMap = weightMap[ :shapeInCase[0], :shapeInCase[1], :shapeInCase[2] ]
+        for axis_i in range(3) :
+            if reflectFlags[axis_i] :
+                weightMap = np.flip(weightMap, axis=axis_i)
+        if any( sum(padOfAxis) > 0 for padOfAxis in tupleOfPaddingPerAxesLeftRight ) :
+            weightMap = np.pad(weightMap, tupleOfPaddingPerAxesLeftRight, mode="reflect") # As the volumes.
+        weightMap = np.maximum(weightMap, 0.).astype("float32") # Float, so that makeCentreSamplerFromWeightMap() uses it as weights.
+        if isinstance(roiMask, np.ndarray) :
+            weightMap *= (roiMask > 0)
+        return makeCentreSamplerFromWeightMap(weightMap, dimsOfSegmentRcz)
+
+    def report_and_reset_stats(self, log, epoch) :
+        numberOfCells = sum( [ len(lossPerCell) for lossPerCell in self._lossPerCellOfCase.values() ] )
+        meanCost = self._sumOfCostsSinceReport / max(1, self._numberOfSegmentsSinceReport)
+        log.print3("HARD EXAMPLES: In epoch #" + str(epoch) + ", the map was updated with [" + str(self._numberOfSegmentsSinceReport) + "] segments, of mean cost " +\
+                   str(round(meanCost, 4)) + ". It has [" + str(numberOfCells) + "] cells visited, in [" + str(len(self._lossPerCellOfCase)) + "] cases.")
+        self._sumOfCostsSinceReport = 0.
+        self._numberOfSegmentsSinceReport = 0
+
+
+def get_coords_in_case_of_centres(coordsOfCentres, # array (N, 3(rcz)), in the space of the loaded volumes.
+                                  dimensionsOfImageChannel, # Of the loaded volumes (reflected, padded).
+                                  reflectFlags,
+                                  tupleOfPaddingPerAxesLeftRight) :
+    # Back to the coordinates of the case as read from disk. Centres in the padding are clipped to the nearest voxel of the case.
+    coordsInCase = np.array(coordsOfCentres, dtype="int32")
+    for axis_i in range(3) :
+        (padLeft, padRight) = tupleOfPaddingPerAxesLeftRight[axis_i]
+        sizeInCase = dimensionsOfImageChannel[axis_i] - padLeft - padRight
+        coordsInCase[:, axis_i] = np.clip(coordsInCase[:, axis_i] - padLeft, 0, sizeInCase - 1)
+        if reflectFlags[axis_i] :
+            coordsInCase[:, axis_i] = sizeInCase - 1 - coordsInCase[:, axis_i]
+    return coordsInCase
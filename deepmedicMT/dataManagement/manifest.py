@@ -0,0 +1,210 @@
+# Copyright (c) 2016, Konstantinos Kamnitsas
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the BSD license. See the accompanying LICENSE file
+# or read the terms at https://opensource.org/licenses/BSD-3-Clause.
+
+from __future__ import absolute_import, print_function, division
+
+import os
+import json
+import hashlib
+import numpy as np
+
+from deepmedicMT.image.io import loadVolume, getAffineAndZoomsOfVolume
+from deepmedicMT.image.processing import reflectImageArrayIfNeeded
+
+#################################################################
+#                       Dataset manifest                        #
+#################################################################
+# A manifest is made once for a dataset by deepMedicBuildManifest, and holds a record per case:
+# shape, voxel spacing, bounding box of the ROI, histogram of the GT labels, a checksum of GT and ROI,
+# and the (flat, C-order) indices of the voxels of each sampling category, in the volume as stored on disk (not reflected/padded).
+# The samplers then make the sampling maps from these, instead of comparing the whole GT and ROI every time a case is sampled.
+# Stored as one .npz: the records as json under KEY_OF_RECORDS, and the index arrays as "case<i>__<category>".
+# Records are keyed by the absolute filepath of the first channel of the case.
+
+MANIFEST_VERSION = 1
+KEY_OF_RECORDS = "manifest_json"
+
+CAT_FOREGROUND = "foreground" # GT > 0
+CAT_ROI_MINUS_FOREGROUND = "roi_minus_foreground" # ROI > 0 and GT == 0. Only if ROI is given.
+# "class_<k>" : GT == k, for each k > 0 that exists in the GT. Class 0 is the complement of the foreground.
+
+def get_category_of_class(class_i) :
+    return "class_" + str(class_i)
+
+
+def get_version_of_file(filepath) :
+    # Cheap check of whether a file changed since the manifest was made.
+    statOfFile = os.stat(filepath)
+    return [repr(statOfFile.st_mtime), statOfFile.st_size]
+
+
+def get_checksum_of_files(filepaths) :
+    sha1 = hashlib.sha1()
+    for filepath in filepaths :
+        with open(filepath, "rb") as fileIn :
+            for block in iter(lambda : fileIn.read(1 << 20), b"") :
+                sha1.update(block)
+    return sha1.hexdigest()
+
+
+def get_bounding_box_of_mask(mask) :
+    # Returns [[low, highNonIncl] per axis], or None if the mask is empty.
+    boundingBox = []
+    for axis_i in range(3) :
+        otherAxes = tuple( [ax for ax in range(3) if ax != axis_i] )
+        nonZeroAlongAxis = np.flatnonzero( np.any(mask, axis=otherAxes) )
+        if len(nonZeroAlongAxis) == 0 :
+            return None
+        boundingBox.append( [int(nonZeroAlongAxis[0]), int(nonZeroAlongAxis[-1]) + 1] )
+    return boundingBox
+
+
+def build_record_of_case(filepathsOfChannels, filepathOfGt, filepathOfRoi) :
+    # Returns [record (json-able dict), dict category -> array of flat indices].
+    gtLabels = loadVolume(filepathOfGt) if filepathOfGt is not None else None
+    roiMask = (loadVolume(filepathOfRoi) > 0) if filepathOfRoi is not None else None
+    filepathOfFirstChannel = [ filepath for filepath in filepathsOfChannels if filepath != "-" ][0]
+    if gtLabels is not None :
+        shapeOfCase = gtLabels.shape
+    elif roiMask is not None :
+        shapeOfCase = roiMask.shape
+    else :
+        shapeOfCase = loadVolume(filepathOfFirstChannel).shape
+    (_, zooms) = getAffineAndZoomsOfVolume(filepathOfFirstChannel)
+
+    indicesPerCategory = {}
+    labelHistogram = None
+    if gtLabels is not None :
+        if gtLabels.dtype.kind not in ['i','u'] :
+            gtLabels = np.rint(gtLabels).astype("int32")
+        if np.min(gtLabels) < 0 :
+            raise ValueError("ERROR: GT labels of [" + str(filepathOfGt) + "] include negative values.")
+        gtLabelsFlat = gtLabels.ravel()
+        labelHistogram = np.bincount(gtLabelsFlat).tolist()
+        indicesPerCategory[CAT_FOREGROUND] = np.flatnonzero(gtLabelsFlat > 0).astype("uint32")
+        for class_i in range(1, len(labelHistogram)) :
+            if labelHistogram[class_i] > 0 :
+                indicesPerCategory[get_category_of_class(class_i)] = np.flatnonzero(gtLabelsFlat == class_i).astype("uint32")
+        if roiMask is not None :
+            indicesPerCategory[CAT_ROI_MINUS_FOREGROUND] = np.flatnonzero( roiMask.ravel() * (gtLabelsFlat == 0) ).astype("uint32")
+
+    filepathsChecked = [ filepath for filepath in [filepathOfGt, filepathOfRoi] if filepath is not None ]
+    record = {  "channels": [ os.path.abspath(filepath) if filepath != "-" else filepath for filepath in filepathsOfChannels ],
+                "gt": os.path.abspath(filepathOfGt) if filepathOfGt is not None else None,
+                "roi": os.path.abspath(filepathOfRoi) if filepathOfRoi is not None else None,
+                "shape": [int(dim) for dim in shapeOfCase],
+                "spacing": [float(zoom) for zoom in zooms[:3]],
+                "roi_bbox": get_bounding_box_of_mask(roiMask) if roiMask is not None else None,
+                "label_histogram": labelHistogram,
+                "checksum": get_checksum_of_files(filepathsChecked),
+                "versions": dict( [ (os.path.abspath(filepath), get_version_of_file(filepath)) for filepath in filepathsChecked ] ),
+                "categories": sorted(indicesPerCategory.keys()) }
+    return [record, indicesPerCategory]
+
+
+def save_manifest(filepathOfManifest, records, indicesPerCategoryOfEachRecord) :
+    # records: dict key -> record. indicesPerCategoryOfEachRecord: dict key -> (dict category -> indices).
+    keys = sorted(records.keys())
+    arrays = {}
+    for (case_i, key) in enumerate(keys) :
+        records[key]["index"] = case_i
+        for category in records[key]["categories"] :
+            arrays["case" + str(case_i) + "__" + category] = indicesPerCategoryOfEachRecord[key][category]
+    recordsJson = json.dumps( {"version": MANIFEST_VERSION, "records": records} ).encode("utf-8")
+    arrays[KEY_OF_RECORDS] = np.frombuffer(recordsJson, dtype=np.uint8)
+    filepathTemp = filepathOfManifest + ".tmp" + str(os.getpid()) + ".npz"
+    np.savez(filepathTemp, **arrays)
+    os.rename(filepathTemp, filepathOfManifest)
+
+
+class DatasetManifest(object):
+    # Read access to a manifest. The index arrays are read from the file only when a case is sampled.
+
+    def __init__(self, filepathOfManifest) :
+        self.filepath = filepathOfManifest
+        self._npz = np.load(filepathOfManifest)
+        content = json.loads( self._npz[KEY_OF_RECORDS].tobytes().decode("utf-8") )
+        if content["version"] != MANIFEST_VERSION :
+            raise ValueError("ERROR: Manifest [" + str(filepathOfManifest) + "] is of version [" + str(content["version"]) + "], but version [" +\
+                             str(MANIFEST_VERSION) + "] is expected. Please make it again with deepMedicBuildManifest.")
+        self._records = content["records"]
+        self._warnedForKeys = set()
+
+    def get_all_records_and_indices(self) :
+        # For extending an existing manifest.
+        indicesPerCategoryOfEachRecord = {}
+        for (key, record) in self._records.items() :
+            indicesPerCategoryOfEachRecord[key] = dict( [ (category, self.get_indices(record, category)) for category in record["categories"] ] )
+        return [self._records, indicesPerCategoryOfEachRecord]
+
+    def get_record_of_case(self, filepathsOfChannels, filepathOfGt, filepathOfRoi, log=None) :
+        # Returns the record, or None if the case is not in the manifest or its GT/ROI changed since. Then the caller computes things as usual.
+        filepathsGiven = [ filepath for filepath in filepathsOfChannels if filepath != "-" ]
+        if len(filepathsGiven) == 0 :
+            return None
+        key = os.path.abspath(filepathsGiven[0])
+        record = self._records.get(key, None)
+        if record is None :
+            return None
+        isValid = True
+        for (filepathGiven, filepathInRecord) in [(filepathOfGt, record["gt"]), (filepathOfRoi, record["roi"])] :
+            if filepathGiven is None : # Not used in this session.
+                continue
+            if filepathInRecord is None or os.path.abspath(filepathGiven) != filepathInRecord or \
+                    get_version_of_file(filepathInRecord) != record["versions"][filepathInRecord] :
+                isValid = False
+        if not isValid :
+            if log is not None and key not in self._warnedForKeys :
+                log.print3("WARN: The record of the case with first channel [" + key + "] in the manifest does not match its given GT/ROI, "+\
+                           "or these changed since the manifest was made. It will not be used for this case. Consider making the manifest again.")
+                self._warnedForKeys.add(key)
+            return None
+        return record
+
+    def get_indices(self, record, category) :
+        # Flat indices (in the volume as stored) of the voxels of a sampling category. Empty if the category has no voxels.
+        if category not in record["categories"] :
+            return np.zeros([0], dtype="uint32")
+        return self._npz["case" + str(record["index"]) + "__" + category]
+
+
+# One manifest per process, read once and kept across subepochs. Same reasoning as get_subject_cache_of_process().
+_manifestOfProcess = None
+
+def get_manifest_of_process(filepathOfManifest) :
+    # Returns None if no manifest is given.
+    global _manifestOfProcess
+    if filepathOfManifest is None :
+        return None
+    if _manifestOfProcess is None or _manifestOfProcess.filepath != filepathOfManifest :
+        _manifestOfProcess = DatasetManifest(filepathOfManifest)
+    return _manifestOfProcess
+
+
+def check_record_vs_num_classes(log, record, num_classes) :
+    # As check_gt_vs_num_classes(), but from the histogram of labels in the record, without scanning the GT.
+    maxLabel = len(record["label_histogram"]) - 1
+    if maxLabel > num_classes - 1 :
+        message = "ERROR:\t GT labels of [" + str(record["gt"]) + "] included a label value ["+str(maxLabel)+"] that is greater than what the cnn expects."+\
+                "\n\t In model-config the number of classes was specified as ["+str(num_classes)+"]. (From the dataset manifest.)"
+        log.print3(message)
+        raise ValueError(message)
+
+
+def make_map_from_indices(indices, shapeOfVolumeInRecord, reflectFlags, tupleOfPaddingPerAxesLeftRight, complement=False) :
+    # Makes a binary (uint8) map of the voxels with the given indices, in the space of the loaded volumes (reflected and padded).
+    # complement: If True, the map is 1 everywhere in the (unpadded) volume, except at the indices.
+    mapOfVolume = np.zeros(shapeOfVolumeInRecord, dtype="uint8")
+    if complement :
+        mapOfVolume[...] = 1
+    mapOfVolume.ravel()[indices] = 0 if complement else 1
+    # Same reflection and padding as the GT/ROI get in load_imgs_of_single_case().
+    mapOfVolume = reflectImageArrayIfNeeded(reflectFlags, mapOfVolume)
+    if sum([ sum(paddingOfAxis) for paddingOfAxis in tupleOfPaddingPerAxesLeftRight ]) > 0 :
+        mapOfVolume = np.lib.pad(mapOfVolume, tupleOfPaddingPerAxesLeftRight, 'reflect')
+    return mapOfVolume
+
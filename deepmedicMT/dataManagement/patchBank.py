@@ -0,0 +1,118 @@
+# Copyright (c) 2016, Konstantinos Kamnitsas
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the BSD license. See the accompanying LICENSE file
+# or read the terms at https://opensource.org/licenses/BSD-3-Clause.
+
+from __future__ import absolute_import, print_function, division
+
+import os
+import json
+import numpy as np
+
+#################################################################
+#                          Patch bank                           #
+#################################################################
+# A patch bank holds the segments of a number of training subepochs, sampled once by deepMedicBuildPatchBank, to be replayed by training...
+# ... sessions (patchBankFolder in the train config) instead of sampling. For quick experiments on losses and optimisation, where the cost of...
+# ... sampling dominates, and the exact samples do not matter much. Reading is then limited by the disk, not by decoding and extraction.
+# A folder with one shard per subepoch: per pathway, the labeled and the unlabeled segments (segments, channels, r, c, z), and the labels...
+# ... of the labeled ones (segments, r', c', z'). Each as a .npy file, memory-mapped when read. Plus an index (json) of the shards and shapes.
+
+PATCH_BANK_VERSION = 1
+FILENAME_OF_INDEX = "patchBank.json"
+
+
+def get_filename_of_array_of_shard(shard_i, nameOfArray) :
+    return "shard" + str(shard_i) + "_" + nameOfArray + ".npy"
+
+
+def get_names_of_arrays_of_shard(numberOfPathways) :
+    return [ "labeled_pathway" + str(pathway_i) for pathway_i in range(numberOfPathways) ] + ["labels"] +\
+           [ "unlabeled_pathway" + str(pathway_i) for pathway_i in range(numberOfPathways) ]
+
+
+class PatchBankWriter(object):
+    # Adds shards to a bank. If the folder has a bank already, its shards are kept and new ones are added, if the shapes of segments match.
+
+    def __init__(self, folderOfBank, shapesOfSegmentPerPathway, shapeOfLabelsOfSegment, dtypeOfIntensities) :
+        self.folder = folderOfBank
+        if not os.path.isdir(folderOfBank) :
+            os.makedirs(folderOfBank)
+        self._index = { "version": PATCH_BANK_VERSION,
+                        "shapesOfSegmentPerPathway": [ [int(dim) for dim in shape] for shape in shapesOfSegmentPerPathway ],
+                        "shapeOfLabelsOfSegment": [ int(dim) for dim in shapeOfLabelsOfSegment ],
+                        "dtypeOfIntensities": str(np.dtype(dtypeOfIntensities)),
+                        "shards": [] }
+        if os.path.isfile(os.path.join(folderOfBank, FILENAME_OF_INDEX)) :
+            existingBank = PatchBank(folderOfBank)
+            existingBank.check_shapes_of_segments(self._index["shapesOfSegmentPerPathway"], self._index["shapeOfLabelsOfSegment"])
+            self._index["shards"] = existingBank.get_records_of_shards()
+
+    def get_number_of_shards(self) :
+        return len(self._index["shards"])
+
+    def write_shard(self, channelsOfSegmentsPerPathway, gtLabelsOfSegments, TDchannelsOfSegmentsPerPathway) :
+        # The returns of getSampledDataAndLabelsForSubepoch() and getTDSampledDataAndLabelsForSubepoch() for a subepoch.
+        shard_i = len(self._index["shards"])
+        arrays = list(channelsOfSegmentsPerPathway) + [gtLabelsOfSegments] + list(TDchannelsOfSegmentsPerPathway)
+        for (nameOfArray, array) in zip(get_names_of_arrays_of_shard(len(channelsOfSegmentsPerPathway)), arrays) :
+            np.save( os.path.join(self.folder, get_filename_of_array_of_shard(shard_i, nameOfArray)), np.asarray(array) )
+        self._index["shards"].append( { "numberOfLabeledSegments": int(len(gtLabelsOfSegments)),
+                                        "numberOfUnlabeledSegments": int(len(TDchannelsOfSegmentsPerPathway[0])) } )
+        # Index last, so that a bank interrupted while writing a shard does not list it.
+        filepathOfIndex = os.path.join(self.folder, FILENAME_OF_INDEX)
+        filepathTemp = filepathOfIndex + ".tmp" + str(os.getpid())
+        with open(filepathTemp, "w") as fileOut :
+            json.dump(self._index, fileOut, indent=1)
+        os.rename(filepathTemp, filepathOfIndex)
+
+
+class PatchBank(object):
+    # Read access to a bank. Shards are replayed in turn, one per subepoch, and are memory-mapped rather than loaded.
+
+    def __init__(self, folderOfBank) :
+        self.folder = folderOfBank
+        filepathOfIndex = os.path.join(folderOfBank, FILENAME_OF_INDEX)
+        if not os.path.isfile(filepathOfIndex) :
+            raise ValueError("ERROR: No patch bank found in [" + str(folderOfBank) + "] (missing " + FILENAME_OF_INDEX + "). Please make it with deepMedicBuildPatchBank.")
+        with open(filepathOfIndex, "r") as fileIn :
+            self._index = json.load(fileIn)
+        if self._index["version"] != PATCH_BANK_VERSION :
+            raise ValueError("ERROR: Patch bank [" + str(folderOfBank) + "] is of version [" + str(self._index["version"]) + "], but version [" +\
+                             str(PATCH_BANK_VERSION) + "] is expected. Please make it again with deepMedicBuildPatchBank.")
+        if len(self._index["shards"]) == 0 :
+            raise ValueError("ERROR: Patch bank [" + str(folderOfBank) + "] has no shards. Please make it again with deepMedicBuildPatchBank.")
+        self._numberOfShardsRead = 0
+
+    def get_number_of_shards(self) :
+        return len(self._index["shards"])
+
+    def get_records_of_shards(self) :
+        return list(self._index["shards"])
+
+    def check_shapes_of_segments(self, shapesOfSegmentPerPathway, shapeOfLabelsOfSegment) :
+        # The bank is only usable by models with the same segments (channels, pathways, input and output shapes).
+        shapesGiven = [ [ int(dim) for dim in shape ] for shape in shapesOfSegmentPerPathway ]
+        shapeOfLabelsGiven = [ int(dim) for dim in shapeOfLabelsOfSegment ]
+        if shapesGiven != self._index["shapesOfSegmentPerPathway"] or shapeOfLabelsGiven != self._index["shapeOfLabelsOfSegment"] :
+            raise ValueError("ERROR: The segments of patch bank [" + str(self.folder) + "] are of shapes (channels,r,c,z) per pathway " + str(self._index["shapesOfSegmentPerPathway"]) +\
+                             " with labels of shape " + str(self._index["shapeOfLabelsOfSegment"]) + ", but the model requires " + str(shapesGiven) + " and " + str(shapeOfLabelsGiven) +\
+                             ". Please make the bank with the model config of this session.")
+
+    def get_shard(self, shard_i) :
+        # Returns [ list of labeled segments per pathway, their labels, list of unlabeled segments per pathway ]. Memory-mapped, read only.
+        numberOfPathways = len(self._index["shapesOfSegmentPerPathway"])
+        arrays = [ np.load( os.path.join(self.folder, get_filename_of_array_of_shard(shard_i, nameOfArray)), mmap_mode="r" )
+                   for nameOfArray in get_names_of_arrays_of_shard(numberOfPathways) ]
+        return [ arrays[:numberOfPathways], arrays[numberOfPathways], arrays[numberOfPathways+1:] ]
+
+    def get_next_shard(self, log) :
+        # The shards in turn, from the first again after the last.
+        shard_i = self._numberOfShardsRead % self.get_number_of_shards()
+        self._numberOfShardsRead += 1
+        log.print3("PATCH BANK: Reading the segments of shard #" + str(shard_i) + "/" + str(self.get_number_of_shards()) + " (replay #" +\
+                   str((self._numberOfShardsRead - 1) // self.get_number_of_shards()) + ") of the bank, instead of sampling.")
+        return self.get_shard(shard_i)
+
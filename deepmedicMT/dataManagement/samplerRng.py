@@ -0,0 +1,81 @@
+# Copyright (c) 2016, Konstantinos Kamnitsas
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the BSD license. See the accompanying LICENSE file
+# or read the terms at https://opensource.org/licenses/BSD-3-Clause.
+
+from __future__ import absolute_import, print_function, division
+
+import random
+import numpy as np
+
+# Keys of the streams of the session, one per sampler. See SamplerRNG.spawn_next().
+STREAM_TRAIN = 0
+STREAM_TRAIN_UNLABELED = 1
+STREAM_VAL = 2
+STREAM_STREAMING = 3
+STREAM_UNLABELED_POOL = 4
+
+
+class SamplerRNG(object):
+    # The random numbers of the samplers (choice of cases, numbers of segments per case, reflection, centres, intensity augmentation, shuffling).
+    # Passed explicitly, instead of using the global states of random and np.random, which depend on which process runs what and when.
+    # Streams are derived with np.random.SeedSequence from the seed and a key. The key names what is sampled (sampler, call, case),...
+    # ... not which process samples it. So a case is sampled the same whether the cases of a subepoch are sampled in parallel or sequentially.
+    # seed None: Not seeded. Draws from the global states, as without it. Spawned streams are then not seeded either.
+
+    def __init__(self, seed=None, keyOfStream=()) :
+        self.seed = seed
+        self.keyOfStream = tuple(keyOfStream)
+        self._numberOfCallsPerKey = {} # For spawn_next().
+        self._generator = None
+        if seed is not None :
+            self._generator = np.random.Generator( np.random.PCG64( np.random.SeedSequence(entropy=seed, spawn_key=self.keyOfStream) ) )
+
+    def isSeeded(self) :
+        return self.seed is not None
+
+    def spawn(self, *keys) :
+        # Independent stream, given by the key of this stream plus keys (ints). The same keys give the same stream, whatever was drawn from this one.
+        return SamplerRNG(self.seed, self.keyOfStream + tuple([ int(key) for key in keys ]))
+
+    def spawn_next(self, key) :
+        # Stream for the next call of whatever key stands for (eg a sampler of the session). The n-th call gets the same stream in every run.
+        numberOfCalls = self._numberOfCallsPerKey.get(key, 0)
+        self._numberOfCallsPerKey[key] = numberOfCalls + 1
+        return self.spawn(key, numberOfCalls)
+
+    # Draws. Same semantics as the functions of random/np.random they replace.
+    def randint(self, low, high) :
+        # Inclusive high, as random.randint.
+        return random.randint(low, high) if self._generator is None else int(self._generator.integers(low, high + 1))
+
+    def integers(self, low, high, size=None) :
+        # Exclusive high, as np.random.randint.
+        return np.random.randint(low, high, size=size) if self._generator is None else self._generator.integers(low, high, size=size)
+
+    def uniform(self, low, high, size=None) :
+        return np.random.uniform(low, high, size=size) if self._generator is None else self._generator.uniform(low, high, size=size)
+
+    def normal(self, loc, scale, size=None) :
+        return np.random.normal(loc, scale, size=size) if self._generator is None else self._generator.normal(loc, scale, size=size)
+
+    def choice(self, a, size=None, replace=True, p=None) :
+        return np.random.choice(a, size=size, replace=replace, p=p) if self._generator is None else self._generator.choice(a, size=size, replace=replace, p=p)
+
+    def permutation(self, n) :
+        return np.random.permutation(n) if self._generator is None else self._generator.permutation(n)
+
+    def shuffle(self, listToShuffle) :
+        # In place. Lists, as random.shuffle.
+        if self._generator is None :
+            random.shuffle(listToShuffle)
+        else :
+            self._generator.shuffle(listToShuffle)
+
+
+def get_sampler_rng(samplerRng) :
+    # For functions with an optional samplerRng. None draws from the global states, as before.
+    return samplerRng if samplerRng is not None else SamplerRNG(None)
+
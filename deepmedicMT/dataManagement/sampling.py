@@ -7,15 +7,30 @@
 
 from __future__ import absolute_import, print_function, division
 
+import os
 import time
+import pickle
+import tempfile
 import numpy as np
-import math
 import random
+import signal
+import traceback
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 from deepmedicMT.image.io import loadVolume
-from deepmedicMT.image.processing import reflectImageArrayIfNeeded, calculateTheZeroIntensityOf3dImage, padCnnInputs
+from deepmedicMT.image.chunkedVolume import isChunkedVolumeFile, ChunkedVolume, StackOfVolumes
+from deepmedicMT.dataManagement.subjectCache import get_subject_cache_of_process, StatsOfSubjectCaches
+from deepmedicMT.dataManagement.manifest import get_manifest_of_process, check_record_vs_num_classes
+from deepmedicMT.dataManagement.centreSampler import getHalfSegmentBoundaries, makeCentreSamplerFromWeightMap
+from deepmedicMT.dataManagement.hardExamples import STRING_OF_HARD_EXAMPLES_CATEGORY, get_coords_in_case_of_centres
+from deepmedicMT.dataManagement.extractionPlan import ExtractionPlan, getIntensitiesOfZeroOfChannels
+from deepmedicMT.dataManagement.samplerRng import get_sampler_rng
+from deepmedicMT.image.pyramid import SubsampledPyramid
+from deepmedicMT.image.processing import reflectImageArrayIfNeeded, padCnnInputs, getPaddingForCnnInputs, ReflectPaddedVolume
 from deepmedicMT.neuralnet.pathwayTypes import PathwayTypes as pt
-from deepmedicMT.dataManagement.augmentImage import augment_images_of_case
+from deepmedicMT.dataManagement.augmentImage import augment_images_of_case, AugmenterAffineParams, get_random_affine_transformation_of_case, get_source_coords_of_segments, interpolate_segments
 from deepmedicMT.dataManagement.augmentSample import augment_sample
 
 class Checks(object):
@@ -25,11 +40,15 @@ class Checks(object):
 # getSampledDataAndLabelsForSubepoch
 #    get_random_ind_of_cases_to_train_subep
 #    getNumberOfSegmentsToExtractPerCategoryFromEachSubject
-#    load_imgs_of_single_case
-#    sampleImageParts
-#    extractDataOfASegmentFromImagesUsingSampledSliceCoords
-#        getImagePartFromSubsampledImageForTraining
-#    shuffleTheSegmentsForThisSubepoch
+#    run_sampling_jobs (sequentially, or in the processes of get_sampling_pool_of_process)
+#        load_subj_and_get_samples (one job per case)
+#            load_imgs_of_single_case
+#            sampleImageParts
+#            extractDataOfSegmentsFromImagesUsingSampledCentres (with the ExtractionPlan made once per call)
+#                gatherSegmentsFromChannels
+#                gatherSegmentsFromSubsampledChannels
+#                    copyRegionsOfChannels
+#        SubepochBuffers (in shared memory when sampled in parallel. Jobs write their segments there, at positions given by the parent)
 
 # Main sampling process during training. Executed in parallel while training on a batch on the GPU.
 # Called from training.do_training()
@@ -55,9 +74,23 @@ def getSampledDataAndLabelsForSubepoch(log,
                                         
                                         padInputImagesBool,
                                         doIntAugm_shiftMuStd_multiMuStd,
-                                        reflectImageWithHalfProbDuringTraining
+                                        reflectImageWithHalfProbDuringTraining,
+                                        
+                                        decodedVolumesCacheFolder=None, # If given, decoded volumes are cached there as .npy and memory-mapped.
+                                        subjectStore=None, # SubjectStore in shared memory. If given, volumes are loaded once and shared by all samplers.
+                                        numThreadsForLoading=1, # Threads reading the files of each case in parallel.
+                                        subjectCacheSizeGB=0, # Memory budget of the in-RAM cache of loaded volumes of this process. 0 disables it.
+                                        dtypeOfIntensities="float32", # Dtype of the intensities of the extracted segments. float32 or float16.
+                                        filepathOfManifest=None, # Dataset manifest (.npz). If given, sampling maps are made from its records.
+                                        typeOfSubsampledPyramid=None, # None, "strided" or "averaged". See SubsampledPyramid.
+                                        num_parallel_proc=0, # Processes that sample from the cases in parallel. 0 for sequentially.
+                                        affineAugmentationPrms=None, # Dictionary of AugmenterAffineParams. If given, training segments are affinely augmented, patch-locally.
+                                        samplerRng=None, # SamplerRNG of this call. Each case is sampled with a stream spawned from it. None draws from the global random states.
+                                        hardExampleMap=None, # HardExampleMap. If given, a fraction of the segments is centred by it, and their origins are also returned.
+                                        inBackground=False # If True, returns a SamplingOfSubepoch at once. The cases are sampled in the sampling pool meanwhile.
                                         ):
-    start_getAllImageParts_time = time.clock()
+    samplerRng = get_sampler_rng(samplerRng)
+    numberOfProcesses = get_number_of_sampling_processes(num_parallel_proc, inBackground)
     
     training_or_validation_str = "Training" if train_or_val == "train" else "Validation"
     Checks.run_input_checks = run_input_checks
@@ -68,156 +101,92 @@ def getSampledDataAndLabelsForSubepoch(log,
     randomIndicesList_for_gpu = get_random_ind_of_cases_to_train_subep(total_number_of_subjects = total_number_of_subjects,
                                                                         max_subjects_on_gpu_for_subepoch = maxNumSubjectsLoadedPerSubepoch,
                                                                         get_max_subjects_for_gpu_even_if_total_less = False,
-                                                                        log=log)
+                                                                        log=log,
+                                                                        samplerRng=samplerRng)
     #log.print3("Out of [" + str(total_number_of_subjects) + "] subjects given for [" + training_or_validation_str + "], it was specified to extract Segments from maximum [" + str(maxNumSubjectsLoadedPerSubepoch) + "] per subepoch.")
     #log.print3("Shuffled indices of subjects that were randomly chosen: "+str(randomIndicesList_for_gpu))
     
-    #This is x. Will end up with dimensions: numberOfPathwaysThatTakeInput, partImagesLoadedPerSubepoch, channels, r,c,z, but flattened.
-    imagePartsChannelsToLoadOnGpuForSubepochPerPathway = [ [] for i in range(cnn3d.getNumPathwaysThatRequireInput()) ]
-    gtLabelsForTheCentralPredictedPartOfSegmentsInGpUForSubepoch = [] # Labels only for the central/predicted part of segments.
     numOfSubjectsLoadingThisSubepochForSampling = len(randomIndicesList_for_gpu) #Can be different than maxNumSubjectsLoadedPerSubepoch, cause of available images number.
     
-    dimsOfPrimeSegmentRcz=cnn3d.pathways[0].getShapeOfInput(train_or_val)[2:]
-    
     # This is to separate each sampling category (fore/background, uniform, full-image, weighted-classes)
-    stringsPerCategoryToSample = samplingTypeInstance.getStringsPerCategoryToSample()
-    numberOfCategoriesToSample = samplingTypeInstance.getNumberOfCategoriesToSample()
     percentOfSamplesPerCategoryToSample = samplingTypeInstance.getPercentOfSamplesPerCategoryToSample()
+    if hardExampleMap is not None : # The hard-examples category is last.
+        percentOfSamplesPerCategoryToSample = hardExampleMap.get_percentages_of_categories(percentOfSamplesPerCategoryToSample)
     arrayNumberOfSegmentsToExtractPerSamplingCategoryAndSubject = getNumberOfSegmentsToExtractPerCategoryFromEachSubject(numberOfImagePartsToLoadInGpuPerSubepoch,
                                                                                                                         percentOfSamplesPerCategoryToSample,
-                                                                                                                        numOfSubjectsLoadingThisSubepochForSampling)
+                                                                                                                        numOfSubjectsLoadingThisSubepochForSampling,
+                                                                                                                        samplerRng)
     numOfInpChannelsForPrimaryPath = len(listOfFilepathsToEachChannelOfEachPatient[0])
-    
-    #log.print3("SAMPLING: Starting iterations to extract Segments from each subject for next " + training_or_validation_str + "...")
-    
-    for index_for_vector_with_images_on_gpu in range(0, numOfSubjectsLoadingThisSubepochForSampling) :
-        #log.print3("SAMPLING: Going to load the images and extract segments from the subject #" + str(index_for_vector_with_images_on_gpu + 1) + "/" +str(numOfSubjectsLoadingThisSubepochForSampling))
-        
-        [allChannelsOfPatientInNpArray, #a nparray(channels,dim0,dim1,dim2)
-        gtLabelsImage,
-        roiMask,
-        arrayWithWeightMapsWhereToSampleForEachCategory, #can be returned "placeholderNothing" if it's testing phase or not "provided weighted maps". In this case, I will sample from GT/ROI.
-        allSubsampledChannelsOfPatientInNpArray,  #a nparray(channels,dim0,dim1,dim2)
-        tupleOfPaddingPerAxesLeftRight #( (padLeftR, padRightR), (padLeftC,padRightC), (padLeftZ,padRightZ)). All 0s when no padding.
-        ] = load_imgs_of_single_case(
-                                        log,
-                                        train_or_val,
-                                        
-                                        randomIndicesList_for_gpu[index_for_vector_with_images_on_gpu],
-                                        
-                                        listOfFilepathsToEachChannelOfEachPatient,
-                                        
-                                        providedGtLabelsBool=True, # If this getTheArr function is called (training), gtLabels should already been provided.
-                                        listOfFilepathsToGtLabelsOfEachPatient=listOfFilepathsToGtLabelsOfEachPatientTrainOrVal, 
-                                        num_classes = cnn3d.num_classes,
-                                        
-                                        providedWeightMapsToSampleForEachCategory = providedWeightMapsToSampleForEachCategory, # Says if weightMaps are provided. If true, must provide all. Placeholder in testing.
-                                        forEachSamplingCategory_aListOfFilepathsToWeightMapsOfEachPatient = forEachSamplingCategory_aListOfFilepathsToWeightMapsOfEachPatient, # Placeholder in testing.
-                                        
-                                        providedRoiMaskBool = providedRoiMaskBool,
-                                        listOfFilepathsToRoiMaskOfEachPatient = listOfFilepathsToRoiMaskOfEachPatient,
-                                        
-                                        useSameSubChannelsAsSingleScale=useSameSubChannelsAsSingleScale,
-                                        
-                                        usingSubsampledPathways=cnn3d.numSubsPaths > 0,
-                                        listOfFilepathsToEachSubsampledChannelOfEachPatient=listOfFilepathsToEachSubsampledChannelOfEachPatient,
-                                        
-                                        padInputImagesBool=padInputImagesBool,
-                                        cnnReceptiveField=cnn3d.recFieldCnn, # only used if padInputsBool
-                                        dimsOfPrimeSegmentRcz=dimsOfPrimeSegmentRcz, # only used if padInputsBool
-                                        
-                                        reflectImageWithHalfProb = reflectImageWithHalfProbDuringTraining
-                                    )
-        #log.print3("DEBUG: Index of this case in the original user-defined list of subjects: " + str(randomIndicesList_for_gpu[index_for_vector_with_images_on_gpu]))
-        #log.print3("Images for subject loaded.")
-        
-        dimensionsOfImageChannel = allChannelsOfPatientInNpArray[0].shape
-        finalWeightMapsToSampleFromPerCategoryForSubject = samplingTypeInstance.logicDecidingAndGivingFinalSamplingMapsForEachCategory(
-                                                                                                providedWeightMapsToSampleForEachCategory,
-                                                                                                arrayWithWeightMapsWhereToSampleForEachCategory,
-                                                                                                
-                                                                                                True, #providedGtLabelsBool. True both for training and for validation. Prerequisite from user-interface.
-                                                                                                gtLabelsImage,
-                                                                                                
-                                                                                                providedRoiMaskBool,
-                                                                                                roiMask,
-                                                                                                
-                                                                                                dimensionsOfImageChannel)
-        #THE number of imageParts in memory per subepoch does not need to be constant. The batch_size does.
-        #But I could have less batches per subepoch if some images dont have lesions I guess. Anyway.
-        
-        for cat_i in range(numberOfCategoriesToSample) :
-            catString = stringsPerCategoryToSample[cat_i]
-            numOfSegmsToExtractForThisCatFromThisSubject = arrayNumberOfSegmentsToExtractPerSamplingCategoryAndSubject[cat_i][index_for_vector_with_images_on_gpu]
-            finalWeightMapToSampleFromForThisCat = finalWeightMapsToSampleFromPerCategoryForSubject[cat_i]
-            
-            # Check if the weight map is fully-zeros. In this case, don't call the sampling function, just continue.
-            # Note that this way, the data loaded on GPU will not be as much as I initially wanted. Thus calculate number-of-batches from this actual number of extracted segments.
-            if np.sum(finalWeightMapToSampleFromForThisCat>0) == 0 :
-                #log.print3("WARN: The sampling mask/map was found just zeros! No [" + catString + "] image parts were sampled for this subject!")
-                #continue
-                finalWeightMapToSampleFromForThisCat = roiMask
-            
-            #log.print3("From subject #"+str(index_for_vector_with_images_on_gpu)+", sampling that many segments of Category [" + catString + "] : " + str(numOfSegmsToExtractForThisCatFromThisSubject) )
-            imagePartsSampled = sampleImageParts(log = log,
-                                                numOfSegmentsToExtractForThisSubject = numOfSegmsToExtractForThisCatFromThisSubject,
-                                                dimsOfSegmentRcz = dimsOfPrimeSegmentRcz,
-                                                dimensionsOfImageChannel = dimensionsOfImageChannel, #image dimensions for this subject. All images should have the same.
-                                                weightMapToSampleFrom=finalWeightMapToSampleFromForThisCat)
-            #log.print3("Finished sampling segments of Category [" + catString + "]. Number sampled: " + str( len(imagePartsSampled[0][0]) ) )
-            
-            # Use the just sampled coordinates of slices to actually extract the segments (data) from the subject's images. 
-            for image_part_i in range(len(imagePartsSampled[0][0])) :
-                coordsOfCentralVoxelOfThisImPart = imagePartsSampled[0][:,image_part_i]
-                #sliceCoordsOfThisImagePart = imagePartsSampled[1][:,image_part_i,:] #[0] is the central voxel coords.
-                
-                [ channelsForThisImagePartPerPathway,
-                gtLabelsForTheCentralClassifiedPartOfThisImagePart # used to be gtLabelsForThisImagePart, before extracting only for the central voxels.
-                ] = extractDataOfASegmentFromImagesUsingSampledSliceCoords(
-                                                                        train_or_val,
-                                                                        
-                                                                        cnn3d,
-                                                                        
-                                                                        coordsOfCentralVoxelOfThisImPart,
-                                                                        numOfInpChannelsForPrimaryPath,
-                                                                        
-                                                                        allChannelsOfPatientInNpArray,
-                                                                        allSubsampledChannelsOfPatientInNpArray,
-                                                                        gtLabelsImage,
-                                                                        
-                                                                        # Intensity Augmentation
-                                                                        doIntAugm_shiftMuStd_multiMuStd
-                                                                        )
-                for pathway_i in range(cnn3d.getNumPathwaysThatRequireInput()) :
-                    imagePartsChannelsToLoadOnGpuForSubepochPerPathway[pathway_i].append(channelsForThisImagePartPerPathway[pathway_i])
-                gtLabelsForTheCentralPredictedPartOfSegmentsInGpUForSubepoch.append(gtLabelsForTheCentralClassifiedPartOfThisImagePart)
+    extractionPlan = ExtractionPlan(cnn3d, train_or_val) # Shapes and offsets of the segments of each pathway. Once, rather than per segment.
+    if numberOfProcesses > 0 : # Made before the buffers, so that its processes, if forked now, do not keep a mapping of them.
+        get_sampling_pool_of_process(log, numberOfProcesses)
+    # Where the segments are written. Dimensions: numberOfPathwaysThatTakeInput, partImagesLoadedPerSubepoch, channels, r,c,z. Labels only for the central/predicted part of segments.
+    subepochBuffers = SubepochBuffers(  numberOfSegmentsToExtract = np.sum(arrayNumberOfSegmentsToExtractPerSamplingCategoryAndSubject),
+                                        shapesOfSegmentPerPathway = extractionPlan.getShapesOfSegmentPerPathway(numOfInpChannelsForPrimaryPath),
+                                        shapeOfLabelsOfSegment = extractionPlan.shapeOfLabelsOfSegment,
+                                        dtypeOfIntensities = dtypeOfIntensities,
+                                        dtypeOfLabels = get_dtype_of_labels(cnn3d.num_classes),
+                                        inSharedMemory = numberOfProcesses > 0,
+                                        samplerRng = samplerRng,
+                                        recordOrigins = hardExampleMap is not None )
+    
+    # One job per case: load it and extract its segments. In the sampling pool if numberOfProcesses > 0. Each job writes its segments in the buffers.
+    argsOfSamplingJob = [log, train_or_val, run_input_checks, cnn3d, samplingTypeInstance, extractionPlan,
+                        randomIndicesList_for_gpu, arrayNumberOfSegmentsToExtractPerSamplingCategoryAndSubject,
+                        listOfFilepathsToEachChannelOfEachPatient, listOfFilepathsToGtLabelsOfEachPatientTrainOrVal,
+                        providedRoiMaskBool, listOfFilepathsToRoiMaskOfEachPatient,
+                        providedWeightMapsToSampleForEachCategory, forEachSamplingCategory_aListOfFilepathsToWeightMapsOfEachPatient,
+                        useSameSubChannelsAsSingleScale, listOfFilepathsToEachSubsampledChannelOfEachPatient,
+                        padInputImagesBool, doIntAugm_shiftMuStd_multiMuStd, reflectImageWithHalfProbDuringTraining,
+                        True, # extractGtLabels
+                        decodedVolumesCacheFolder, subjectStore, numThreadsForLoading, subjectCacheSizeGB, dtypeOfIntensities, filepathOfManifest, typeOfSubsampledPyramid,
+                        affineAugmentationPrms, samplerRng, hardExampleMap]
+    positionsPerJob = [ subepochBuffers.reserve(numberOfSegmentsOfJob) for numberOfSegmentsOfJob in np.sum(arrayNumberOfSegmentsToExtractPerSamplingCategoryAndSubject, axis=0) ]
+    jobsInPool = submit_sampling_jobs(log, numberOfProcesses, argsOfSamplingJob, positionsPerJob, subepochBuffers) if numberOfProcesses > 0 else None
+    argsToFinish = [log, train_or_val, numberOfProcesses, argsOfSamplingJob, positionsPerJob, subepochBuffers, jobsInPool, samplerRng, hardExampleMap]
+    if inBackground :
+        return SamplingOfSubepoch(finishSampledDataAndLabelsForSubepoch, argsToFinish)
+    return finishSampledDataAndLabelsForSubepoch(*argsToFinish)
+
+
+def finishSampledDataAndLabelsForSubepoch(log, train_or_val, numberOfProcesses, argsOfSamplingJob, positionsPerJob, subepochBuffers, jobsInPool, samplerRng, hardExampleMap) :
+    # Second part of getSampledDataAndLabelsForSubepoch(), once its jobs are submitted. Runs or collects them, and returns the augmented segments.
+    start_getAllImageParts_time = time.perf_counter()
+    training_or_validation_str = "Training" if train_or_val == "train" else "Validation"
+    [_, statsOfSubjectCaches] = run_sampling_jobs(log, numberOfProcesses, argsOfSamplingJob, positionsPerJob, subepochBuffers, jobsInPool)
 
     ##======================================================Added For Sample Augmentation==11.11.2019======================================================##
-    
-    augm_sample_prms = { 'hist_dist': {'shift': {'mu': 0., 'std': 0.05}, 'scale': {'mu': 1., 'std': 0.01} },
-                        'reflect':   (0.5, 0., 0.),
+    # Applied to all the segments of the subepoch at once, in place. None disables a type. 'hist_dist' and 'reflect' were disabled in augment_sample()...
+    # ... when applied per case. Example values: 'hist_dist': {'shift': {'mu': 0., 'std': 0.05}, 'scale': {'mu': 1., 'std': 0.01} }, 'reflect': (0.5, 0., 0.)
+    augm_sample_prms = { 'hist_dist': None,
+                        'reflect':   None,
                         'rotate90':  {'xy': {'0': 0., '90': 0., '180': 0., '270': 0.},
                                       'yz': {'0': 0., '90': 0., '180': 0., '270': 0.},
                                       'xz': {'0': 0., '90': 0., '180': 0., '270': 0.} } }
-    (imagePartsChannelsToLoadOnGpuForSubepochPerPathway,
-    gtLabelsForTheCentralPredictedPartOfSegmentsInGpUForSubepoch ) = augment_sample(imagePartsChannelsToLoadOnGpuForSubepochPerPathway, 
-                                                                        gtLabelsForTheCentralPredictedPartOfSegmentsInGpUForSubepoch, 
-                                                                        augm_sample_prms)  
+    [imagePartsChannelsToLoadOnGpuForSubepochPerPathway,
+    gtLabelsForTheCentralPredictedPartOfSegmentsInGpUForSubepoch ] = subepochBuffers.get_segments_and_labels() # Already shuffled.
+    if train_or_val == "train" :
+        (imagePartsChannelsToLoadOnGpuForSubepochPerPathway,
+        gtLabelsForTheCentralPredictedPartOfSegmentsInGpUForSubepoch ) = augment_sample(imagePartsChannelsToLoadOnGpuForSubepochPerPathway, 
+                                                                            gtLabelsForTheCentralPredictedPartOfSegmentsInGpUForSubepoch, 
+                                                                            augm_sample_prms,
+                                                                            samplerRng)
                                                                  
     ##=================================================================================================================##
-    #I need to shuffle them, together imageParts and lesionParts!
-    [imagePartsChannelsToLoadOnGpuForSubepochPerPathway,
-    gtLabelsForTheCentralPredictedPartOfSegmentsInGpUForSubepoch ] = shuffleTheSegmentsForThisSubepoch( imagePartsChannelsToLoadOnGpuForSubepochPerPathway,
-                                                                                                gtLabelsForTheCentralPredictedPartOfSegmentsInGpUForSubepoch )
+    #No need to shuffle them, the segments were written at random positions of the buffers.
     
-    end_getAllImageParts_time = time.clock()
+    end_getAllImageParts_time = time.perf_counter()
     #log.print3("TIMING: Extracting all the Segments for next " + training_or_validation_str + " took time: "+str(end_getAllImageParts_time-start_getAllImageParts_time)+"(s)")
     
     log.print3(":=:=:=:=:=:=:=:=: Finished extracting Segments from the labeled images for next " + training_or_validation_str + ". :=:=:=:=:=:=:=:=:")
-    
-    imagePartsChannelsToLoadOnGpuForSubepochPerPathwayArrays = [ np.asarray(imPartsForPathwayi, dtype="float32") for imPartsForPathwayi in imagePartsChannelsToLoadOnGpuForSubepochPerPathway ]
-    return [imagePartsChannelsToLoadOnGpuForSubepochPerPathwayArrays,
-            np.asarray(gtLabelsForTheCentralPredictedPartOfSegmentsInGpUForSubepoch, dtype="int32") ] # This could be int16 or less to save RAM.
+    statsOfSubjectCaches.report_and_reset_stats(log, training_or_validation_str)
+    
+    if hardExampleMap is not None : # To update the map with the cost of each segment, when trained on.
+        return [imagePartsChannelsToLoadOnGpuForSubepochPerPathway,
+                gtLabelsForTheCentralPredictedPartOfSegmentsInGpUForSubepoch,
+                subepochBuffers.get_origins_of_segments() ] # Array (segments, 4): [index of case, r, c, z of the central voxel in the case].
+    return [imagePartsChannelsToLoadOnGpuForSubepochPerPathway, # Arrays (segments, channels, r, c, z), of dtypeOfIntensities.
+            gtLabelsForTheCentralPredictedPartOfSegmentsInGpUForSubepoch ] # Of dtype get_dtype_of_labels(). Cast to the network's dtypes when fed.
 
 
 ##==============================================Get segments from Target Domain===========================##
@@ -244,9 +213,24 @@ def getTDSampledDataAndLabelsForSubepoch(log,
                                         
                                         padInputImagesBool,
                                         doIntAugm_shiftMuStd_multiMuStd,
-                                        reflectImageWithHalfProbDuringTraining
+                                        reflectImageWithHalfProbDuringTraining,
+                                        
+                                        decodedVolumesCacheFolder=None, # If given, decoded volumes are cached there as .npy and memory-mapped.
+                                        subjectStore=None, # SubjectStore in shared memory. If given, volumes are loaded once and shared by all samplers.
+                                        numThreadsForLoading=1, # Threads reading the files of each case in parallel.
+                                        subjectCacheSizeGB=0, # Memory budget of the in-RAM cache of loaded volumes of this process. 0 disables it.
+                                        dtypeOfIntensities="float32", # Dtype of the intensities of the extracted segments. float32 or float16.
+                                        filepathOfManifest=None, # Dataset manifest (.npz). If given, sampling maps are made from its records.
+                                        typeOfSubsampledPyramid=None, # None, "strided" or "averaged". See SubsampledPyramid.
+                                        num_parallel_proc=0, # Processes that sample from the cases in parallel. 0 for sequentially.
+                                        affineAugmentationPrms=None, # Dictionary of AugmenterAffineParams. If given, training segments are affinely augmented, patch-locally.
+                                        samplerRng=None, # SamplerRNG of this call. Each case is sampled with a stream spawned from it. None draws from the global random states.
+                                        indicesOfCasesOfWindow=None, # Cases to sample from, given by WindowsOfUnlabeledPool. If None, maxNumSubjectsLoadedPerSubepoch random cases.
+                                        inBackground=False # If True, returns a SamplingOfSubepoch at once. The cases are sampled in the sampling pool meanwhile.
                                         ):
-    start_getAllImageParts_time = time.clock()
+    timeOfStart = time.time() # For the throughput. Compared with the time the last job ended, as reported from the process that ran it.
+    samplerRng = get_sampler_rng(samplerRng)
+    numberOfProcesses = get_number_of_sampling_processes(num_parallel_proc, inBackground)
     
     training_or_validation_str = "Training" if train_or_val == "train" else "Validation"
     Checks.run_input_checks = run_input_checks
@@ -254,182 +238,431 @@ def getTDSampledDataAndLabelsForSubepoch(log,
     log.print3(":=:=:=:=:=:=:=:=: Starting to extract Segments from the Target domain images for next " + training_or_validation_str + "... :=:=:=:=:=:=:=:=:")
     
     total_number_of_subjects = len(listOfFilepathsToEachChannelOfEachPatient)
-    randomIndicesList_for_gpu = get_random_ind_of_cases_to_train_subep(total_number_of_subjects = total_number_of_subjects,
-                                                                        max_subjects_on_gpu_for_subepoch = maxNumSubjectsLoadedPerSubepoch,
-                                                                        get_max_subjects_for_gpu_even_if_total_less = False,
-                                                                        log=log)
+    if indicesOfCasesOfWindow is not None :
+        randomIndicesList_for_gpu = list(indicesOfCasesOfWindow)
+    else :
+        randomIndicesList_for_gpu = get_random_ind_of_cases_to_train_subep(total_number_of_subjects = total_number_of_subjects,
+                                                                            max_subjects_on_gpu_for_subepoch = maxNumSubjectsLoadedPerSubepoch,
+                                                                            get_max_subjects_for_gpu_even_if_total_less = False,
+                                                                            log=log,
+                                                                            samplerRng=samplerRng)
     #log.print3("Out of [" + str(total_number_of_subjects) + "] subjects given for [" + training_or_validation_str + "], it was specified to extract Segments from maximum [" + str(maxNumSubjectsLoadedPerSubepoch) + "] per subepoch.")
     #log.print3("Shuffled indices of subjects that were randomly chosen: "+str(randomIndicesList_for_gpu))
     
-    #This is x. Will end up with dimensions: numberOfPathwaysThatTakeInput, partImagesLoadedPerSubepoch, channels, r,c,z, but flattened.
-    imagePartsChannelsToLoadOnGpuForSubepochPerPathway = [ [] for i in range(cnn3d.getNumPathwaysThatRequireInput()) ]
-    gtLabelsForTheCentralPredictedPartOfSegmentsInGpUForSubepoch = [] # Labels only for the central/predicted part of segments.
     numOfSubjectsLoadingThisSubepochForSampling = len(randomIndicesList_for_gpu) #Can be different than maxNumSubjectsLoadedPerSubepoch, cause of available images number.
     
-    dimsOfPrimeSegmentRcz=cnn3d.pathways[0].getShapeOfInput(train_or_val)[2:]
-    
     # This is to separate each sampling category (fore/background, uniform, full-image, weighted-classes)
-    stringsPerCategoryToSample = samplingTypeInstance.getStringsPerCategoryToSample()
-    numberOfCategoriesToSample = samplingTypeInstance.getNumberOfCategoriesToSample()
     percentOfSamplesPerCategoryToSample = samplingTypeInstance.getPercentOfSamplesPerCategoryToSample()
     arrayNumberOfSegmentsToExtractPerSamplingCategoryAndSubject = getNumberOfSegmentsToExtractPerCategoryFromEachSubject(numberOfImagePartsToLoadInGpuPerSubepoch,
                                                                                                                         percentOfSamplesPerCategoryToSample,
-                                                                                                                        numOfSubjectsLoadingThisSubepochForSampling)
+                                                                                                                        numOfSubjectsLoadingThisSubepochForSampling,
+                                                                                                                        samplerRng)
     numOfInpChannelsForPrimaryPath = len(listOfFilepathsToEachChannelOfEachPatient[0])
-    
-    #log.print3("SAMPLINGTD: Starting iterations to extract Segments from each subject for next " + training_or_validation_str + "...")
-    
-    for index_for_vector_with_images_on_gpu in range(0, numOfSubjectsLoadingThisSubepochForSampling) :
-        #log.print3("SAMPLINGTD: Going to load the images and extract segments from the subject #" + str(index_for_vector_with_images_on_gpu + 1) + "/" +str(numOfSubjectsLoadingThisSubepochForSampling))
-        
-        [allChannelsOfPatientInNpArray, #a nparray(channels,dim0,dim1,dim2)
-        gtLabelsImage,
-        roiMask,
-        arrayWithWeightMapsWhereToSampleForEachCategory, #can be returned "placeholderNothing" if it's testing phase or not "provided weighted maps". In this case, I will sample from GT/ROI.
-        allSubsampledChannelsOfPatientInNpArray,  #a nparray(channels,dim0,dim1,dim2)
-        tupleOfPaddingPerAxesLeftRight #( (padLeftR, padRightR), (padLeftC,padRightC), (padLeftZ,padRightZ)). All 0s when no padding.
-        ] = load_imgs_of_single_case(
-                                        log,
-                                        train_or_val,
-                                        
-                                        randomIndicesList_for_gpu[index_for_vector_with_images_on_gpu],
-                                        
-                                        listOfFilepathsToEachChannelOfEachPatient,
-                                        
-                                        providedGtLabelsBool=True, # If this getTheArr function is called (training), gtLabels should already been provided.
-                                        listOfFilepathsToGtLabelsOfEachPatient=listOfFilepathsToGtLabelsOfEachPatientTrainOrVal, 
-                                        num_classes = cnn3d.num_classes,
-                                        
-                                        providedWeightMapsToSampleForEachCategory = providedWeightMapsToSampleForEachCategory, # Says if weightMaps are provided. If true, must provide all. Placeholder in testing.
-                                        forEachSamplingCategory_aListOfFilepathsToWeightMapsOfEachPatient = forEachSamplingCategory_aListOfFilepathsToWeightMapsOfEachPatient, # Placeholder in testing.
-                                        
-                                        providedRoiMaskBool = providedRoiMaskBool,
-                                        listOfFilepathsToRoiMaskOfEachPatient = listOfFilepathsToRoiMaskOfEachPatient,
-                                        
-                                        useSameSubChannelsAsSingleScale=useSameSubChannelsAsSingleScale,
-                                        
-                                        usingSubsampledPathways=cnn3d.numSubsPaths > 0,
-                                        listOfFilepathsToEachSubsampledChannelOfEachPatient=listOfFilepathsToEachSubsampledChannelOfEachPatient,
-                                        
-                                        padInputImagesBool=padInputImagesBool,
-                                        cnnReceptiveField=cnn3d.recFieldCnn, # only used if padInputsBool
-                                        dimsOfPrimeSegmentRcz=dimsOfPrimeSegmentRcz, # only used if padInputsBool
-                                        
-                                        reflectImageWithHalfProb = reflectImageWithHalfProbDuringTraining
-                                    )
-        #log.print3("DEBUG: Index of this case in the original user-defined list of subjects: " + str(randomIndicesList_for_gpu[index_for_vector_with_images_on_gpu]))
-        #log.print3("Images for subject loaded.")
-        
-        dimensionsOfImageChannel = allChannelsOfPatientInNpArray[0].shape
-        finalWeightMapsToSampleFromPerCategoryForSubject = samplingTypeInstance.logicDecidingAndGivingFinalSamplingMapsForEachCategory(
-                                                                                                providedWeightMapsToSampleForEachCategory,
-                                                                                                arrayWithWeightMapsWhereToSampleForEachCategory,
-                                                                                                
-                                                                                                True, #providedGtLabelsBool. True both for training and for validation. Prerequisite from user-interface.
-                                                                                                gtLabelsImage,
-                                                                                                
-                                                                                                providedRoiMaskBool,
-                                                                                                roiMask,
-                                                                                                
-                                                                                                dimensionsOfImageChannel)
-        #THE number of imageParts in memory per subepoch does not need to be constant. The batch_size does.
-        #But I could have less batches per subepoch if some images dont have lesions I guess. Anyway.
-        
-        for cat_i in range(numberOfCategoriesToSample) :
-            catString = stringsPerCategoryToSample[cat_i]
-            numOfSegmsToExtractForThisCatFromThisSubject = arrayNumberOfSegmentsToExtractPerSamplingCategoryAndSubject[cat_i][index_for_vector_with_images_on_gpu]
-            finalWeightMapToSampleFromForThisCat = finalWeightMapsToSampleFromPerCategoryForSubject[cat_i]
-            
-            # Check if the weight map is fully-zeros. In this case, don't call the sampling function, just continue.
-            # Note that this way, the data loaded on GPU will not be as much as I initially wanted. Thus calculate number-of-batches from this actual number of extracted segments.
-            if np.sum(finalWeightMapToSampleFromForThisCat>0) == 0 :
-                #log.print3("WARN: The sampling mask/map was found just zeros! No [" + catString + "] image parts were sampled for this subject!")
-                #continue
-                ##=======================================Added2019.10.05=========================================##
-                finalWeightMapToSampleFromForThisCat = roiMask
-                ##===============================================================================================##
-            
-            #log.print3("From subject #"+str(index_for_vector_with_images_on_gpu)+", sampling that many segments of Category [" + catString + "] : " + str(numOfSegmsToExtractForThisCatFromThisSubject) )
-            imagePartsSampled = sampleImageParts(log = log,
-                                                numOfSegmentsToExtractForThisSubject = numOfSegmsToExtractForThisCatFromThisSubject,
-                                                dimsOfSegmentRcz = dimsOfPrimeSegmentRcz,
-                                                dimensionsOfImageChannel = dimensionsOfImageChannel, #image dimensions for this subject. All images should have the same.
-                                                weightMapToSampleFrom=finalWeightMapToSampleFromForThisCat)
-            #log.print3("Finished sampling segments of Category [" + catString + "]. Number sampled: " + str( len(imagePartsSampled[0][0]) ) )
-            
-            # Use the just sampled coordinates of slices to actually extract the segments (data) from the subject's images. 
-            for image_part_i in range(len(imagePartsSampled[0][0])) :
-                coordsOfCentralVoxelOfThisImPart = imagePartsSampled[0][:,image_part_i]
-                #sliceCoordsOfThisImagePart = imagePartsSampled[1][:,image_part_i,:] #[0] is the central voxel coords.
-                
-                [ channelsForThisImagePartPerPathway,
-                gtLabelsForTheCentralClassifiedPartOfThisImagePart # used to be gtLabelsForThisImagePart, before extracting only for the central voxels.
-                ] = extractTDDataOfASegmentFromImagesUsingSampledSliceCoords(
-                                                                        train_or_val,
-                                                                        
-                                                                        cnn3d,
-                                                                        
-                                                                        coordsOfCentralVoxelOfThisImPart,
-                                                                        numOfInpChannelsForPrimaryPath,
-                                                                        
-                                                                        allChannelsOfPatientInNpArray,
-                                                                        allSubsampledChannelsOfPatientInNpArray,
-                                                                        gtLabelsImage,
-                                                                        
-                                                                        # Intensity Augmentation
-                                                                        doIntAugm_shiftMuStd_multiMuStd
-                                                                        )
-                for pathway_i in range(cnn3d.getNumPathwaysThatRequireInput()) :
-                    imagePartsChannelsToLoadOnGpuForSubepochPerPathway[pathway_i].append(channelsForThisImagePartPerPathway[pathway_i])
-                gtLabelsForTheCentralPredictedPartOfSegmentsInGpUForSubepoch.append(gtLabelsForTheCentralClassifiedPartOfThisImagePart)
+    extractionPlan = ExtractionPlan(cnn3d, train_or_val) # Shapes and offsets of the segments of each pathway. Once, rather than per segment.
+    if numberOfProcesses > 0 : # Made before the buffers, so that its processes, if forked now, do not keep a mapping of them.
+        get_sampling_pool_of_process(log, numberOfProcesses)
+    # Where the segments are written. Dimensions: numberOfPathwaysThatTakeInput, partImagesLoadedPerSubepoch, channels, r,c,z. Labels only for the central/predicted part of segments.
+    subepochBuffers = SubepochBuffers(  numberOfSegmentsToExtract = np.sum(arrayNumberOfSegmentsToExtractPerSamplingCategoryAndSubject),
+                                        shapesOfSegmentPerPathway = extractionPlan.getShapesOfSegmentPerPathway(numOfInpChannelsForPrimaryPath),
+                                        shapeOfLabelsOfSegment = None, # No GT labels for the unlabeled cases.
+                                        dtypeOfIntensities = dtypeOfIntensities,
+                                        dtypeOfLabels = None,
+                                        inSharedMemory = numberOfProcesses > 0,
+                                        samplerRng = samplerRng )
+    
+    # One job per case: load it and extract its segments. In the sampling pool if numberOfProcesses > 0. Each job writes its segments in the buffers.
+    argsOfSamplingJob = [log, train_or_val, run_input_checks, cnn3d, samplingTypeInstance, extractionPlan,
+                        randomIndicesList_for_gpu, arrayNumberOfSegmentsToExtractPerSamplingCategoryAndSubject,
+                        listOfFilepathsToEachChannelOfEachPatient, listOfFilepathsToGtLabelsOfEachPatientTrainOrVal,
+                        providedRoiMaskBool, listOfFilepathsToRoiMaskOfEachPatient,
+                        providedWeightMapsToSampleForEachCategory, forEachSamplingCategory_aListOfFilepathsToWeightMapsOfEachPatient,
+                        useSameSubChannelsAsSingleScale, listOfFilepathsToEachSubsampledChannelOfEachPatient,
+                        padInputImagesBool, doIntAugm_shiftMuStd_multiMuStd, reflectImageWithHalfProbDuringTraining,
+                        False, # extractGtLabels. No GT labels for the unlabeled cases.
+                        decodedVolumesCacheFolder, subjectStore, numThreadsForLoading, subjectCacheSizeGB, dtypeOfIntensities, filepathOfManifest, typeOfSubsampledPyramid,
+                        affineAugmentationPrms, samplerRng, None]
+    positionsPerJob = [ subepochBuffers.reserve(numberOfSegmentsOfJob) for numberOfSegmentsOfJob in np.sum(arrayNumberOfSegmentsToExtractPerSamplingCategoryAndSubject, axis=0) ]
+    jobsInPool = submit_sampling_jobs(log, numberOfProcesses, argsOfSamplingJob, positionsPerJob, subepochBuffers) if numberOfProcesses > 0 else None
+    argsToFinish = [log, train_or_val, numberOfProcesses, argsOfSamplingJob, positionsPerJob, subepochBuffers, jobsInPool, samplerRng, timeOfStart]
+    if inBackground :
+        return SamplingOfSubepoch(finishTDSampledDataAndLabelsForSubepoch, argsToFinish)
+    return finishTDSampledDataAndLabelsForSubepoch(*argsToFinish)
+
+
+def finishTDSampledDataAndLabelsForSubepoch(log, train_or_val, numberOfProcesses, argsOfSamplingJob, positionsPerJob, subepochBuffers, jobsInPool, samplerRng, timeOfStart) :
+    # Second part of getTDSampledDataAndLabelsForSubepoch(), once its jobs are submitted. Runs or collects them, and returns the augmented segments.
+    start_getAllImageParts_time = time.perf_counter()
+    training_or_validation_str = "Training" if train_or_val == "train" else "Validation"
+    [timeLastJobEnded, statsOfSubjectCaches] = run_sampling_jobs(log, numberOfProcesses, argsOfSamplingJob, positionsPerJob, subepochBuffers, jobsInPool)
 
     ##======================================================Added For Sample Augmentation 11.11.2019========================================================##
-    augm_sample_prms = { 'hist_dist': {'shift': {'mu': 0., 'std': 0.05}, 'scale': {'mu': 1., 'std': 0.01} },
-                        'reflect':   (0.5, 0., 0.),
+    # As for the labeled segments. See getSampledDataAndLabelsForSubepoch().
+    augm_sample_prms = { 'hist_dist': None,
+                        'reflect':   None,
                         'rotate90':  {'xy': {'0': 0., '90': 0., '180': 0., '270': 0.},
                                       'yz': {'0': 0., '90': 0., '180': 0., '270': 0.},
                                       'xz': {'0': 0., '90': 0., '180': 0., '270': 0.} } }
-    (imagePartsChannelsToLoadOnGpuForSubepochPerPathway,
-    gtLabelsForTheCentralPredictedPartOfSegmentsInGpUForSubepoch ) = augment_sample(imagePartsChannelsToLoadOnGpuForSubepochPerPathway, 
-                                                                        gtLabelsForTheCentralPredictedPartOfSegmentsInGpUForSubepoch, 
-                                                                        augm_sample_prms)  
+    [imagePartsChannelsToLoadOnGpuForSubepochPerPathway, _ ] = subepochBuffers.get_segments_and_labels() # Already shuffled. No GT labels for the unlabeled cases.
+    if train_or_val == "train" :
+        (imagePartsChannelsToLoadOnGpuForSubepochPerPathway, _ ) = augment_sample(imagePartsChannelsToLoadOnGpuForSubepochPerPathway, None, augm_sample_prms, samplerRng)
+    gtLabelsForTheCentralPredictedPartOfSegmentsInGpUForSubepoch = [ "placeholder" ] * len(imagePartsChannelsToLoadOnGpuForSubepochPerPathway[0])
                                                                         
                                                                        
     ##=================================================================================================================##
                 
-    #I need to shuffle them, together imageParts and lesionParts!
-    [imagePartsChannelsToLoadOnGpuForSubepochPerPathway,
-    gtLabelsForTheCentralPredictedPartOfSegmentsInGpUForSubepoch ] = shuffleTheSegmentsForThisSubepoch( imagePartsChannelsToLoadOnGpuForSubepochPerPathway,
-                                                                                                gtLabelsForTheCentralPredictedPartOfSegmentsInGpUForSubepoch )
+    #No need to shuffle them, the segments were written at random positions of the buffers.
     
-    end_getAllImageParts_time = time.clock()
+    end_getAllImageParts_time = time.perf_counter()
     #log.print3("TIMING: Extracting all the Segments for next " + training_or_validation_str + " took time: "+str(end_getAllImageParts_time-start_getAllImageParts_time)+"(s)")
     
+    secsOfSampling = max(timeLastJobEnded - timeOfStart, 0.) # If in the background, the jobs may have waited in the pool for others, submitted earlier.
+    numberOfUnlabeledSegments = len(imagePartsChannelsToLoadOnGpuForSubepochPerPathway[0])
+    log.print3("THROUGHPUT: Extracted [" + str(numberOfUnlabeledSegments) + "] unlabeled segments from [" + str(len(positionsPerJob)) + "] cases in " +\
+               str(round(secsOfSampling, 2)) + "(s): " + str(round(numberOfUnlabeledSegments / max(secsOfSampling, 1e-6), 1)) + " unlabeled segments/s.")
     log.print3(":=:=:=:=:=:=:=:=: Finished extracting Segments from the unlabeled images for next " + training_or_validation_str + ". :=:=:=:=:=:=:=:=:")
+    statsOfSubjectCaches.report_and_reset_stats(log, "Unlabeled " + training_or_validation_str)
     
-    imagePartsChannelsToLoadOnGpuForSubepochPerPathwayArrays = [ np.asarray(imPartsForPathwayi, dtype="float32") for imPartsForPathwayi in imagePartsChannelsToLoadOnGpuForSubepochPerPathway ]
-    return [imagePartsChannelsToLoadOnGpuForSubepochPerPathwayArrays,
+    return [imagePartsChannelsToLoadOnGpuForSubepochPerPathway, # Arrays (segments, channels, r, c, z), of dtypeOfIntensities.
             gtLabelsForTheCentralPredictedPartOfSegmentsInGpUForSubepoch ] 
 
 
 
+TIMEOUT_OF_SAMPLING_JOB_SECS = 600 # In case a process of the pool never started the job (happens in py3). The job is then resubmitted.
+
+def get_number_of_sampling_processes(num_parallel_proc, inBackground) :
+    # Processes of the sampling pool that run the jobs of a call of a sampler. 0 for sequentially, in the calling process. At least 1 in the background.
+    return max(num_parallel_proc, 1) if inBackground else num_parallel_proc
+
+class SamplingOfSubepoch(object):
+    # Returned by the samplers when called with inBackground=True, by the training process. Their jobs were submitted to its sampling pool, and run...
+    # ... while it trains on the previous subepoch. get() waits for them and returns what the sampler returns otherwise. Call it once.
+    def __init__(self, functionToFinish, argsOfFunctionToFinish) :
+        self._functionToFinish = functionToFinish
+        self._argsOfFunctionToFinish = argsOfFunctionToFinish
+        
+    def get(self) :
+        return self._functionToFinish(*self._argsOfFunctionToFinish)
+    
+def submit_sampling_jobs(log, numberOfProcesses, argsOfSamplingJob, positionsPerJob, subepochBuffers, jobsToSubmit=None) :
+    # Submits load_subj_and_get_samples() for each of jobsToSubmit (default all) to the sampling pool of this process. Returns immediately.
+    # Returns [generation of the pool, OrderedDict job_i -> AsyncResult], for run_sampling_jobs() to collect them.
+    workerPool = get_sampling_pool_of_process(log, numberOfProcesses)
+    # Pickled now, once for all jobs. The pool pickles them later, in its own thread, while the caller may be changing them (eg the HardExampleMap, while training).
+    argsOfSamplingJobPickled = pickle.dumps(argsOfSamplingJob, protocol=pickle.HIGHEST_PROTOCOL)
+    jobs = collections.OrderedDict()
+    for job_i in (jobsToSubmit if jobsToSubmit is not None else range(len(positionsPerJob))) :
+        jobs[job_i] = workerPool.apply_async( run_pickled_sampling_job, [job_i, subepochBuffers, positionsPerJob[job_i], argsOfSamplingJobPickled] )
+    return [_generationOfSamplingPool, jobs]
+
+def run_pickled_sampling_job(job_i, subepochBuffers, positionsOfJob, argsOfSamplingJobPickled) :
+    return load_subj_and_get_samples( *([job_i, subepochBuffers, positionsOfJob] + pickle.loads(argsOfSamplingJobPickled)) )
+
+def run_sampling_jobs(log, numberOfProcesses, argsOfSamplingJob, positionsPerJob, subepochBuffers, jobsInPool=None) :
+    # Runs load_subj_and_get_samples() for each case of the subepoch. Each job writes its segments in the subepochBuffers, at positionsPerJob[job_i].
+    # numberOfProcesses <= 0: Sequentially, in this process. Otherwise in the sampling pool of this process, so that cases are loaded and sampled in parallel.
+    # In the latter case the buffers are in shared memory. Jobs return only how many segments they wrote, not the segments.
+    # jobsInPool: As returned by submit_sampling_jobs(), if the jobs were submitted earlier. They are resubmitted if the pool was restarted since.
+    # Returns [the time.time() the last job ended, StatsOfSubjectCaches of the processes that ran the jobs].
+    jobsToDo = list(range(len(positionsPerJob)))
+    timesJobsEnded = [ 0. ] # Of the processes that ran them. Not when collected here, as these may have ended while the caller went on.
+    statsOfSubjectCaches = StatsOfSubjectCaches()
+    if numberOfProcesses <= 0 :
+        for job_i in jobsToDo :
+            [numberOfSegmentsWritten, timeJobEnded, statsOfCache] = load_subj_and_get_samples( *([job_i, subepochBuffers, positionsPerJob[job_i]] + argsOfSamplingJob) )
+            subepochBuffers.mark_filled(positionsPerJob[job_i][:numberOfSegmentsWritten])
+            timesJobsEnded.append(timeJobEnded)
+            statsOfSubjectCaches.add(statsOfCache, timeJobEnded)
+        return [max(timesJobsEnded), statsOfSubjectCaches]
+    
+    try :
+        while len(jobsToDo) > 0 :
+            if jobsInPool is None or jobsInPool[0] != _generationOfSamplingPool : # Not submitted, or the pool was restarted after a timeout, maybe by another call.
+                jobsInPool = submit_sampling_jobs(log, numberOfProcesses, argsOfSamplingJob, positionsPerJob, subepochBuffers, jobsToDo)
+            jobs = jobsInPool[1]
+            for job_i in list(jobsToDo) : # Copy, as jobs are removed while looping.
+                try :
+                    [numberOfSegmentsWritten, timeJobEnded, statsOfCache] = jobs[job_i].get(timeout=TIMEOUT_OF_SAMPLING_JOB_SECS)
+                except multiprocessing.TimeoutError :
+                    log.print3("WARN: MULTIPROC: Sampling job #" + str(job_i) + " did not return within " + str(TIMEOUT_OF_SAMPLING_JOB_SECS) + " secs. "+\
+                               "Restarting the sampling processes and resubmitting the [" + str(len(jobsToDo)) + "] remaining jobs.")
+                    terminate_sampling_pool_of_process()
+                    break # A resubmitted job writes again at the same positions.
+                subepochBuffers.mark_filled(positionsPerJob[job_i][:numberOfSegmentsWritten])
+                timesJobsEnded.append(timeJobEnded)
+                statsOfSubjectCaches.add(statsOfCache, timeJobEnded)
+                jobsToDo.remove(job_i)
+    except (Exception, KeyboardInterrupt) :
+        log.print3("ERROR: MULTIPROC: Caught exception while sampling in parallel processes:\n" + traceback.format_exc())
+        terminate_sampling_pool_of_process()
+        raise
+    finally :
+        subepochBuffers.remove_files_of_shared_memory() # All jobs are done (or were terminated). The mapping of this process is kept.
+    return [max(timesJobsEnded), statsOfSubjectCaches]
+            
+            
+# One pool of sampling processes per process that runs the samplers (the training process, a streaming producer, or the main process).
+# Kept across subepochs, so that the in-RAM subject caches and manifests of its processes are kept too. Recreated if a job times out.
+# The generation changes whenever the pool does, so that jobs submitted to a previous pool, in the background, are resubmitted.
+_samplingPoolOfProcess = None
+_numProcessesOfSamplingPool = 0
+_generationOfSamplingPool = 0
+
+def get_sampling_pool_of_process(log, num_parallel_proc) :
+    global _samplingPoolOfProcess, _numProcessesOfSamplingPool, _generationOfSamplingPool
+    numWorkers = min(num_parallel_proc, multiprocessing.cpu_count())
+    if _samplingPoolOfProcess is None or _numProcessesOfSamplingPool != numWorkers :
+        terminate_sampling_pool_of_process()
+        log.print3("MULTIPROC: Number of CPUs detected: " + str(multiprocessing.cpu_count()) + ". Requested to use max: [" + str(num_parallel_proc) + "]. "+\
+                   "Spawning [" + str(numWorkers) + "] processes to load cases and sample.")
+        _samplingPoolOfProcess = multiprocessing.Pool(processes=numWorkers, initializer=init_sampling_proc)
+        _numProcessesOfSamplingPool = numWorkers
+        _generationOfSamplingPool += 1
+    return _samplingPoolOfProcess
+
+def terminate_sampling_pool_of_process() :
+    global _samplingPoolOfProcess, _numProcessesOfSamplingPool, _generationOfSamplingPool
+    if _samplingPoolOfProcess is not None :
+        _samplingPoolOfProcess.terminate() # Also stops processes that hang. close() does not.
+        _samplingPoolOfProcess.join()
+        _generationOfSamplingPool += 1
+    _samplingPoolOfProcess = None
+    _numProcessesOfSamplingPool = 0
+
+def init_sampling_proc() :
+    # Children ignore KeyboardInterrupt (SIGINT). The parent handles it and terminates the pool.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Forked processes start with the random state of the parent. Reseed, otherwise all sample the same centres/augmentations.
+    np.random.seed()
+    random.seed()
+
+
+def load_subj_and_get_samples(job_i,
+                            subepochBuffers, # SubepochBuffers to write the segments in. In shared memory if this runs in the sampling pool.
+                            positionsOfJob, # Positions of the buffers reserved for the segments of this job.
+                            log,
+                            train_or_val,
+                            run_input_checks,
+                            cnn3d,
+                            samplingTypeInstance,
+                            extractionPlan,
+                            indicesOfCasesForSubepoch,
+                            arrayNumberOfSegmentsToExtractPerSamplingCategoryAndSubject,
+                            
+                            listOfFilepathsToEachChannelOfEachPatient,
+                            listOfFilepathsToGtLabelsOfEachPatientTrainOrVal,
+                            providedRoiMaskBool,
+                            listOfFilepathsToRoiMaskOfEachPatient,
+                            providedWeightMapsToSampleForEachCategory,
+                            forEachSamplingCategory_aListOfFilepathsToWeightMapsOfEachPatient,
+                            useSameSubChannelsAsSingleScale,
+                            listOfFilepathsToEachSubsampledChannelOfEachPatient,
+                            
+                            padInputImagesBool,
+                            doIntAugm_shiftMuStd_multiMuStd,
+                            reflectImageWithHalfProbDuringTraining,
+                            extractGtLabels, # False for the unlabeled cases.
+                            
+                            decodedVolumesCacheFolder,
+                            subjectStore,
+                            numThreadsForLoading,
+                            subjectCacheSizeGB,
+                            dtypeOfIntensities,
+                            filepathOfManifest,
+                            typeOfSubsampledPyramid,
+                            affineAugmentationPrms, # None, or dictionary of AugmenterAffineParams. Used for training only.
+                            samplerRng, # Of the call of the sampler. The job draws from the stream spawned for job_i, whichever process runs it.
+                            hardExampleMap # None, or HardExampleMap. Its category is sampled last, and the origins of the segments are written.
+                            ) :
+    # Loads the case of job_i of the subepoch and extracts its segments, for every sampling category. Run in this process, or in one of the sampling pool.
+    # The segments are written in the subepochBuffers, at the first of positionsOfJob.
+    # Returns [how many were written, time.time() the job ended, stats of the subject cache of the process for this job (None if disabled)].
+    subjectCache = get_subject_cache_of_process(subjectCacheSizeGB) # Of the process that runs the job.
+    if subjectCache is not None : # Its stats are returned for this job only. A process runs one job at a time.
+        subjectCache.reset_stats()
+    manifest = get_manifest_of_process(filepathOfManifest)
+    Checks.run_input_checks = run_input_checks
+    
+    dimsOfPrimeSegmentRcz = cnn3d.pathways[0].getShapeOfInput(train_or_val)[2:]
+    stringsPerCategoryToSample = samplingTypeInstance.getStringsPerCategoryToSample() + ([STRING_OF_HARD_EXAMPLES_CATEGORY] if hardExampleMap is not None else [])
+    numberOfCategoriesToSample = len(stringsPerCategoryToSample)
+    numOfInpChannelsForPrimaryPath = len(listOfFilepathsToEachChannelOfEachPatient[0])
+    numberOfSegmentsWritten = 0
+    rngOfJob = samplerRng.spawn(job_i)
+    
+    index_of_case = indicesOfCasesForSubepoch[job_i]
+    recordOfCase = manifest.get_record_of_case( listOfFilepathsToEachChannelOfEachPatient[index_of_case],
+                                                listOfFilepathsToGtLabelsOfEachPatientTrainOrVal[index_of_case],
+                                                listOfFilepathsToRoiMaskOfEachPatient[index_of_case] if providedRoiMaskBool else None,
+                                                log ) if manifest is not None else None
+    reflectFlags = get_random_reflect_flags(reflectImageWithHalfProbDuringTraining, rngOfJob) # Decided here, to make the sampling maps from the manifest the same way.
+    
+    [allChannelsOfPatientInNpArray, #a nparray(channels,dim0,dim1,dim2)
+    gtLabelsImage,
+    roiMask,
+    arrayWithWeightMapsWhereToSampleForEachCategory, #can be returned "placeholderNothing" if it's testing phase or not "provided weighted maps". In this case, I will sample from GT/ROI.
+    allSubsampledChannelsOfPatientInNpArray,  #a nparray(channels,dim0,dim1,dim2)
+    tupleOfPaddingPerAxesLeftRight #( (padLeftR, padRightR), (padLeftC,padRightC), (padLeftZ,padRightZ)). All 0s when no padding.
+    ] = load_imgs_of_single_case(
+                                    log,
+                                    train_or_val,
+                                    
+                                    index_of_case,
+                                    
+                                    listOfFilepathsToEachChannelOfEachPatient,
+                                    
+                                    providedGtLabelsBool=True, # If this getTheArr function is called (training), gtLabels should already been provided.
+                                    listOfFilepathsToGtLabelsOfEachPatient=listOfFilepathsToGtLabelsOfEachPatientTrainOrVal, 
+                                    num_classes = cnn3d.num_classes,
+                                    
+                                    providedWeightMapsToSampleForEachCategory = providedWeightMapsToSampleForEachCategory, # Says if weightMaps are provided. If true, must provide all. Placeholder in testing.
+                                    forEachSamplingCategory_aListOfFilepathsToWeightMapsOfEachPatient = forEachSamplingCategory_aListOfFilepathsToWeightMapsOfEachPatient, # Placeholder in testing.
+                                    
+                                    providedRoiMaskBool = providedRoiMaskBool,
+                                    listOfFilepathsToRoiMaskOfEachPatient = listOfFilepathsToRoiMaskOfEachPatient,
+                                    
+                                    useSameSubChannelsAsSingleScale=useSameSubChannelsAsSingleScale,
+                                    
+                                    usingSubsampledPathways=cnn3d.numSubsPaths > 0,
+                                    listOfFilepathsToEachSubsampledChannelOfEachPatient=listOfFilepathsToEachSubsampledChannelOfEachPatient,
+                                    
+                                    padInputImagesBool=padInputImagesBool,
+                                    cnnReceptiveField=cnn3d.recFieldCnn, # only used if padInputsBool
+                                    dimsOfPrimeSegmentRcz=dimsOfPrimeSegmentRcz, # only used if padInputsBool
+                                    
+                                    reflectImageWithHalfProb = reflectImageWithHalfProbDuringTraining,
+                                    
+                                    decodedVolumesCacheFolder = decodedVolumesCacheFolder,
+                                    subjectStore = subjectStore,
+                                    numThreadsForLoading = numThreadsForLoading,
+                                    subjectCache = subjectCache,
+                                    dtypeOfIntensities = dtypeOfIntensities,
+                                    reflectFlags = reflectFlags,
+                                    recordOfCase = recordOfCase
+                                )
+    #log.print3("Images for subject loaded.")
+    
+    dimensionsOfImageChannel = allChannelsOfPatientInNpArray[0].shape
+    intensitiesOfZeroOfSubsampledChannels = getIntensitiesOfZeroOfChannels(allSubsampledChannelsOfPatientInNpArray) # To fill out of the image. Once per case.
+    subsampledPyramid = make_subsampled_pyramid_of_case(extractionPlan, allSubsampledChannelsOfPatientInNpArray, typeOfSubsampledPyramid)
+    centreSamplersPerCategory = get_centre_samplers_of_case(log,
+                                                            samplingTypeInstance,
+                                                            manifest,
+                                                            recordOfCase,
+                                                            
+                                                            providedWeightMapsToSampleForEachCategory,
+                                                            arrayWithWeightMapsWhereToSampleForEachCategory,
+                                                            gtLabelsImage,
+                                                            providedRoiMaskBool,
+                                                            roiMask,
+                                                            
+                                                            dimensionsOfImageChannel,
+                                                            dimsOfPrimeSegmentRcz,
+                                                            reflectFlags,
+                                                            tupleOfPaddingPerAxesLeftRight,
+                                                            
+                                                            keyOfCase = get_key_of_case_for_caches(index_of_case,
+                                                                                                    listOfFilepathsToEachChannelOfEachPatient,
+                                                                                                    listOfFilepathsToGtLabelsOfEachPatientTrainOrVal,
+                                                                                                    listOfFilepathsToRoiMaskOfEachPatient if providedRoiMaskBool else None,
+                                                                                                    forEachSamplingCategory_aListOfFilepathsToWeightMapsOfEachPatient if providedWeightMapsToSampleForEachCategory else None),
+                                                            subjectCache = subjectCache)
+    if hardExampleMap is not None : # Not cached, the map changes every subepoch.
+        centreSamplersPerCategory = centreSamplersPerCategory + [ hardExampleMap.make_centre_sampler_of_case(index_of_case,
+                                                                                                            dimensionsOfImageChannel,
+                                                                                                            dimsOfPrimeSegmentRcz,
+                                                                                                            reflectFlags,
+                                                                                                            tupleOfPaddingPerAxesLeftRight,
+                                                                                                            roiMask) ]
+    # Affine augmentation: One random transformation per case, applied to its segments only, once their centres are sampled on the untransformed volumes.
+    # Drawn from its own stream of the case, so that the rest of the sampling draws the same whether it is enabled or not.
+    if affineAugmentationPrms is not None and train_or_val == "train" :
+        affineAugmentationPrms = AugmenterAffineParams(affineAugmentationPrms)
+        affineTransformOfCase = get_random_affine_transformation_of_case(affineAugmentationPrms, rngOfJob.spawn(0))
+    else :
+        affineTransformOfCase = None
+    
+    #THE number of imageParts in memory per subepoch does not need to be constant. The batch_size does.
+    #But I could have less batches per subepoch if some images dont have lesions I guess. Anyway.
+    
+    for cat_i in range(numberOfCategoriesToSample) :
+        catString = stringsPerCategoryToSample[cat_i]
+        numOfSegmsToExtractForThisCatFromThisSubject = arrayNumberOfSegmentsToExtractPerSamplingCategoryAndSubject[cat_i][job_i]
+        
+        #log.print3("From subject #"+str(job_i)+", sampling that many segments of Category [" + catString + "] : " + str(numOfSegmsToExtractForThisCatFromThisSubject) )
+        imagePartsSampled = sampleImageParts(log = log,
+                                            numOfSegmentsToExtractForThisSubject = numOfSegmsToExtractForThisCatFromThisSubject,
+                                            dimsOfSegmentRcz = dimsOfPrimeSegmentRcz,
+                                            dimensionsOfImageChannel = dimensionsOfImageChannel, #image dimensions for this subject. All images should have the same.
+                                            weightMapToSampleFrom = None,
+                                            centreSampler = centreSamplersPerCategory[cat_i],
+                                            samplerRng = rngOfJob)
+        #log.print3("Finished sampling segments of Category [" + catString + "]. Number sampled: " + str( len(imagePartsSampled[0][0]) ) )
+        
+        # Use the just sampled coordinates of the central voxels to actually extract the segments (data) from the subject's images. All at once.
+        numberOfSegmentsSampled = len(imagePartsSampled[0][0])
+        if numberOfSegmentsSampled == 0 :
+            continue
+        [ channelsOfSegmentsPerPathway, # list with an array (N, channels, r, c, z) per pathway.
+        gtLabelsOfCentralPartOfSegments # array (N, r', c', z'). Only the central voxels, that are classified.
+        ] = extractDataOfSegmentsFromImagesUsingSampledCentres(
+                                                                train_or_val,
+                                                                
+                                                                extractionPlan,
+                                                                
+                                                                np.transpose(imagePartsSampled[0]), # (N, 3)
+                                                                numOfInpChannelsForPrimaryPath,
+                                                                
+                                                                allChannelsOfPatientInNpArray,
+                                                                allSubsampledChannelsOfPatientInNpArray,
+                                                                intensitiesOfZeroOfSubsampledChannels,
+                                                                gtLabelsImage,
+                                                                
+                                                                # Intensity Augmentation
+                                                                doIntAugm_shiftMuStd_multiMuStd,
+                                                                
+                                                                dtypeOfIntensities,
+                                                                extractGtLabels = extractGtLabels,
+                                                                subsampledPyramid = subsampledPyramid,
+                                                                samplerRng = rngOfJob,
+                                                                affineTransform = affineTransformOfCase,
+                                                                affineAugmentationPrms = affineAugmentationPrms
+                                                                )
+        if numberOfSegmentsWritten + numberOfSegmentsSampled > len(positionsOfJob) :
+            raise ValueError("ERROR: More segments were extracted from case #" + str(index_of_case) + " [" + str(numberOfSegmentsWritten + numberOfSegmentsSampled) + "] "+\
+                             "than were reserved for it in the buffers of the subepoch [" + str(len(positionsOfJob)) + "].")
+        if hardExampleMap is not None :
+            originsOfSegments = np.zeros([numberOfSegmentsSampled, 4], dtype="int32")
+            originsOfSegments[:, 0] = index_of_case
+            originsOfSegments[:, 1:] = get_coords_in_case_of_centres(np.transpose(imagePartsSampled[0]), dimensionsOfImageChannel, reflectFlags, tupleOfPaddingPerAxesLeftRight)
+        else :
+            originsOfSegments = None
+        subepochBuffers.write( positionsOfJob[numberOfSegmentsWritten : numberOfSegmentsWritten + numberOfSegmentsSampled],
+                               channelsOfSegmentsPerPathway,
+                               gtLabelsOfCentralPartOfSegments,
+                               originsOfSegments )
+        numberOfSegmentsWritten += numberOfSegmentsSampled
+    return [numberOfSegmentsWritten, time.time(), subjectCache.get_and_reset_stats() if subjectCache is not None else None]
+
+
+
     
 def get_random_ind_of_cases_to_train_subep(total_number_of_subjects, 
                                             max_subjects_on_gpu_for_subepoch, 
                                             get_max_subjects_for_gpu_even_if_total_less=False,
-                                            log=None):
-    
+                                            log=None,
+                                            samplerRng=None):
+    samplerRng = get_sampler_rng(samplerRng)
     subjects_indices = list(range(total_number_of_subjects)) #list() for python3 compatibility, as range cannot get assignment in shuffle()
     random_order_chosen_subjects=[]
     
-    random.shuffle(subjects_indices) #does it in place. Now they are shuffled
+    samplerRng.shuffle(subjects_indices) #does it in place. Now they are shuffled
     
     if max_subjects_on_gpu_for_subepoch>=total_number_of_subjects:
         random_order_chosen_subjects += subjects_indices
         
         if get_max_subjects_for_gpu_even_if_total_less : #This is if I want to have a certain amount on GPU, even if total subjects are less.
             while (len(random_order_chosen_subjects)<max_subjects_on_gpu_for_subepoch):
-                random.shuffle(subjects_indices)
+                samplerRng.shuffle(subjects_indices)
                 number_of_extra_subjects_to_get_to_fill_gpu = min(max_subjects_on_gpu_for_subepoch - len(random_order_chosen_subjects), total_number_of_subjects)
                 random_order_chosen_subjects += (subjects_indices[:number_of_extra_subjects_to_get_to_fill_gpu])
             if len(random_order_chosen_subjects)!=max_subjects_on_gpu_for_subepoch :
@@ -448,7 +681,9 @@ def get_random_ind_of_cases_to_train_subep(total_number_of_subjects,
 
 def getNumberOfSegmentsToExtractPerCategoryFromEachSubject( numberOfImagePartsToLoadInGpuPerSubepoch,
                                                             percentOfSamplesPerCategoryToSample, # list with a percentage for each type of category to sample
-                                                            numOfSubjectsLoadingThisSubepochForSampling ) :
+                                                            numOfSubjectsLoadingThisSubepochForSampling,
+                                                            samplerRng=None ) :
+    samplerRng = get_sampler_rng(samplerRng)
     numberOfSamplingCategories = len(percentOfSamplesPerCategoryToSample)
     # [numForCat1,..., numForCatN]
     arrayNumberOfSegmentsToExtractPerSamplingCategory = np.zeros( numberOfSamplingCategories, dtype="int32" )
@@ -462,7 +697,7 @@ def getNumberOfSegmentsToExtractPerCategoryFromEachSubject( numberOfImagePartsTo
         numberOfSamplesDistributedInTheCategories += numberOfSamplesFromThisCategoryPerSubepoch
     # Distribute samples that were left from the rounding error of integer division.
     numOfUndistributedSamples = numberOfImagePartsToLoadInGpuPerSubepoch - numberOfSamplesDistributedInTheCategories
-    indicesOfCategoriesToGiveUndistrSamples = np.random.choice(numberOfSamplingCategories, size=numOfUndistributedSamples, replace=True, p=percentOfSamplesPerCategoryToSample)
+    indicesOfCategoriesToGiveUndistrSamples = samplerRng.choice(numberOfSamplingCategories, size=numOfUndistributedSamples, replace=True, p=percentOfSamplesPerCategoryToSample)
     for cat_i in indicesOfCategoriesToGiveUndistrSamples : # they will be as many as the undistributed samples
         arrayNumberOfSegmentsToExtractPerSamplingCategory[cat_i] += 1
         
@@ -471,12 +706,89 @@ def getNumberOfSegmentsToExtractPerCategoryFromEachSubject( numberOfImagePartsTo
         arrayNumberOfSegmentsToExtractPerSamplingCategoryAndSubject[cat_i] += numberOfSamplesFromThisCategoryPerSubepochPerImage
         numberOfSamplesFromThisCategoryPerSubepochLeftUnevenly = arrayNumberOfSegmentsToExtractPerSamplingCategory[cat_i] % numOfSubjectsLoadingThisSubepochForSampling
         for i_unevenSampleFromThisCat in range(numberOfSamplesFromThisCategoryPerSubepochLeftUnevenly):
-            arrayNumberOfSegmentsToExtractPerSamplingCategoryAndSubject[cat_i, random.randint(0, numOfSubjectsLoadingThisSubepochForSampling-1)] += 1
+            arrayNumberOfSegmentsToExtractPerSamplingCategoryAndSubject[cat_i, samplerRng.randint(0, numOfSubjectsLoadingThisSubepochForSampling-1)] += 1
             
     return arrayNumberOfSegmentsToExtractPerSamplingCategoryAndSubject
 
     
     
+def load_volume_for_case(filepath, decodedVolumesCacheFolder, subjectStore, preloadedVolumes=None, subjectCache=None) :
+    # From the shared-memory SubjectStore if given (read-only view, loaded once for all samplers). Otherwise from disk, or the cache of decoded volumes.
+    # preloadedVolumes: dict filepath -> volume, as returned by load_volumes_of_case_in_parallel(). Checked first.
+    # subjectCache: in-RAM LRU SubjectCache of this process. Checked before disk. Not used with a SubjectStore, which keeps everything anyway.
+    if preloadedVolumes is not None and filepath in preloadedVolumes :
+        return preloadedVolumes[filepath]
+    if subjectStore is not None :
+        return subjectStore.get_volume(filepath)
+    if subjectCache is not None :
+        volume = subjectCache.get(filepath)
+        if volume is None :
+            volume = subjectCache.put(filepath, loadVolume(filepath, decodedVolumesCacheFolder))
+        return volume
+    return loadVolume(filepath, decodedVolumesCacheFolder)
+    
+    
+def load_volumes_of_case_in_parallel(filepathsToLoad, decodedVolumesCacheFolder, subjectStore, numThreadsForLoading, subjectCache=None) :
+    # Loads all the given files of a case at the same time, with a pool of threads. Reading and zlib-inflating release the GIL.
+    # Returns a dict filepath -> volume, to be given to load_volume_for_case(). Empty if loading should be done sequentially.
+    filepathsToLoadUnique = []
+    for filepath in filepathsToLoad :
+        if filepath not in ["-", None] and filepath not in filepathsToLoadUnique :
+            filepathsToLoadUnique.append(filepath)
+    if numThreadsForLoading <= 1 or len(filepathsToLoadUnique) <= 1 :
+        return {}
+    
+    threadPool = ThreadPool( min(numThreadsForLoading, len(filepathsToLoadUnique)) )
+    try :
+        loadedVolumes = threadPool.map(lambda filepath : load_volume_for_case(filepath, decodedVolumesCacheFolder, subjectStore, None, subjectCache), filepathsToLoadUnique)
+    finally :
+        threadPool.close()
+        threadPool.join()
+    return dict(zip(filepathsToLoadUnique, loadedVolumes))
+    
+    
+def get_random_reflect_flags(reflectImageWithHalfProb, samplerRng=None) :
+    # For each axis, whether to reflect the images of a case. With 50% prob, for the axes that reflection is enabled.
+    samplerRng = get_sampler_rng(samplerRng)
+    reflectFlags = []
+    for reflectImageWithHalfProb_dimi in range(0, len(reflectImageWithHalfProb)) :
+        reflectFlags.append(reflectImageWithHalfProb[reflectImageWithHalfProb_dimi] * samplerRng.randint(0,1))
+    return reflectFlags
+    
+    
+def get_dtype_of_labels(num_classes) :
+    # Labels (and the masks made from them) are kept as uint8, unless there are too many classes.
+    return "uint8" if num_classes <= 256 else "int32"
+    
+    
+def make_subsampled_pyramid_of_case(extractionPlan, allSubsampledChannelsOfPatientInNpArray, typeOfSubsampledPyramid) :
+    # Returns a SubsampledPyramid with the factors of the subsampled pathways, or None if not enabled or there are no subsampled pathways.
+    subSamplingFactors = [ geometry.subSamplingFactor for geometry in extractionPlan.geometriesPerPathway if geometry.pType != pt.NORM ]
+    if typeOfSubsampledPyramid is None or len(subSamplingFactors) == 0 :
+        return None
+    return SubsampledPyramid(allSubsampledChannelsOfPatientInNpArray, subSamplingFactors, typeOfSubsampledPyramid)
+    
+    
+def can_keep_channels_chunked(filepathsOfChannelsOfCase, subjectStore) :
+    # Channels stored in the chunked format (.cvol) are read lazily, per segment. Reflection and padding are then done by views on them.
+    # With a SubjectStore, the whole volume is anyway loaded once and shared.
+    if subjectStore is not None :
+        return False
+    for filepath in filepathsOfChannelsOfCase :
+        if filepath == "-" or not isChunkedVolumeFile(filepath) :
+            return False
+    return True
+    
+    
+def get_reflected_and_padded_views_of_channels(listOfChannels, reflectFlags, padInputImagesBool, cnnReceptiveField, dimsOfPrimeSegmentRcz) :
+    # Instead of copying each channel to a reflected and padded array, wrap it in a view that reflects/pads only the segments sliced from it.
+    # Returns [ StackOfVolumes (channels, r, c, z), tupleOfPaddingPerAxesLeftRight ]. Same padding as padCnnInputs() gives to GT/ROI/weight-maps.
+    tupleOfPaddingPerAxesLeftRight = getPaddingForCnnInputs(listOfChannels[0].shape, cnnReceptiveField, dimsOfPrimeSegmentRcz) if padInputImagesBool else ((0,0), (0,0), (0,0))
+    if padInputImagesBool or sum(reflectFlags) > 0 :
+        listOfChannels = [ ReflectPaddedVolume(channel, tupleOfPaddingPerAxesLeftRight, reflectFlags) for channel in listOfChannels ]
+    return [ StackOfVolumes(listOfChannels), tupleOfPaddingPerAxesLeftRight ]
+    
+    
 # roi_mask_filename and roiMinusLesion_mask_filename can be passed "no". In this case, the corresponding return result is nothing.
 # This is so because: the do_training() function only needs the roiMinusLesion_mask, whereas the do_testing() only needs the roi_mask.        
 def load_imgs_of_single_case(log,
@@ -504,7 +816,15 @@ def load_imgs_of_single_case(log,
                              cnnReceptiveField, # only used if padInputImagesBool
                              dimsOfPrimeSegmentRcz,
                              
-                             reflectImageWithHalfProb
+                             reflectImageWithHalfProb,
+                             
+                             decodedVolumesCacheFolder=None,
+                             subjectStore=None,
+                             numThreadsForLoading=1, # If > 1, all files of the case are read at the same time, and then reflected/padded.
+                             subjectCache=None, # In-RAM LRU cache of loaded volumes, kept across subepochs. See subjectCache.py
+                             dtypeOfIntensities="float32", # Dtype of channels that are copied in an array. Labels and ROI are returned as uint8.
+                             reflectFlags=None, # Per axis, whether to reflect the images. If None, drawn here from reflectImageWithHalfProb.
+                             recordOfCase=None # Record of the case in the dataset manifest. If given, GT labels are checked from it, without scanning them.
                              ):
     #listOfNiiFilepathNames: should be a list of lists. Each sublist corresponds to one certain patient-case.
     #...Each sublist should have as many elements(strings-filenamePaths) as numberOfChannels, point to the channels of this patient.
@@ -519,15 +839,32 @@ def load_imgs_of_single_case(log,
     numberOfNormalScaleChannels = len(listOfFilepathsToEachChannelOfEachPatient[0])
     
     #reflect Image with 50% prob, for each axis:
-    reflectFlags = []
-    for reflectImageWithHalfProb_dimi in range(0, len(reflectImageWithHalfProb)) :
-        reflectFlags.append(reflectImageWithHalfProb[reflectImageWithHalfProb_dimi] * random.randint(0,1))
+    if reflectFlags is None :
+        reflectFlags = get_random_reflect_flags(reflectImageWithHalfProb)
     
     tupleOfPaddingPerAxesLeftRight = ((0,0), (0,0), (0,0)) #This will be given a proper value if padding is performed.
     
+    keepChannelsChunked = can_keep_channels_chunked(listOfFilepathsToEachChannelOfEachPatient[index_of_wanted_image], subjectStore)
+    keepSubsampledChannelsChunked = usingSubsampledPathways and not useSameSubChannelsAsSingleScale and \
+                                    can_keep_channels_chunked(listOfFilepathsToEachSubsampledChannelOfEachPatient[index_of_wanted_image], subjectStore)
+    # Read all the files of the case in parallel, if asked. The below then only picks them up.
+    filepathsToLoad = []
+    if providedRoiMaskBool :
+        filepathsToLoad.append(listOfFilepathsToRoiMaskOfEachPatient[index_of_wanted_image])
+    if not keepChannelsChunked :
+        filepathsToLoad += listOfFilepathsToEachChannelOfEachPatient[index_of_wanted_image]
+    if providedGtLabelsBool :
+        filepathsToLoad.append(listOfFilepathsToGtLabelsOfEachPatient[index_of_wanted_image])
+    if train_val_or_test != "test" and providedWeightMapsToSampleForEachCategory==True :
+        filepathsToLoad += [ filepathsOfCat[index_of_wanted_image] for filepathsOfCat in forEachSamplingCategory_aListOfFilepathsToWeightMapsOfEachPatient ]
+    if usingSubsampledPathways and not useSameSubChannelsAsSingleScale and not keepSubsampledChannelsChunked :
+        filepathsToLoad += listOfFilepathsToEachSubsampledChannelOfEachPatient[index_of_wanted_image]
+    preloadedVolumes = load_volumes_of_case_in_parallel(filepathsToLoad, decodedVolumesCacheFolder, subjectStore, numThreadsForLoading, subjectCache)
+    
     if providedRoiMaskBool :
         fullFilenamePathOfRoiMask = listOfFilepathsToRoiMaskOfEachPatient[index_of_wanted_image]
-        roiMask = loadVolume(fullFilenamePathOfRoiMask)
+        roiMask = load_volume_for_case(fullFilenamePathOfRoiMask, decodedVolumesCacheFolder, subjectStore, preloadedVolumes, subjectCache)
+        roiMask = roiMask if roiMask.dtype == np.uint8 else (roiMask > 0).astype("uint8")
         
         roiMask = reflectImageArrayIfNeeded(reflectFlags, roiMask)
         [roiMask, tupleOfPaddingPerAxesLeftRight] = padCnnInputs(roiMask, cnnReceptiveField, dimsOfPrimeSegmentRcz) if padInputImagesBool else [roiMask, tupleOfPaddingPerAxesLeftRight]
@@ -539,35 +876,48 @@ def load_imgs_of_single_case(log,
     allChannelsOfPatientInNpArray = None
     #The below has dimensions (channels, 2). Holds per channel: [value to add per voxel for mean norm, value to multiply for std renorm]
     howMuchToAddAndMultiplyForNormalizationAugmentationForEachChannel = np.ones( (numberOfNormalScaleChannels, 2), dtype="float32")
-    for channel_i in range(numberOfNormalScaleChannels):
-        fullFilenamePathOfChannel = listOfFilepathsToEachChannelOfEachPatient[index_of_wanted_image][channel_i]
-        if fullFilenamePathOfChannel != "-" : #normal case, filepath was given.
-            channelData = loadVolume(fullFilenamePathOfChannel)
+    if "-" not in listOfFilepathsToEachChannelOfEachPatient[index_of_wanted_image] :
+        # Channels are not reflected/padded/copied as a whole. Segments are later sliced from views that reflect/pad only them.
+        if keepChannelsChunked : # Not even loaded. Only the chunks that the segments touch are decompressed.
+            channelsOfCase = [ ChunkedVolume(filepath) for filepath in listOfFilepathsToEachChannelOfEachPatient[index_of_wanted_image] ]
+        else :
+            channelsOfCase = [ load_volume_for_case(filepath, decodedVolumesCacheFolder, subjectStore, preloadedVolumes, subjectCache) for filepath in listOfFilepathsToEachChannelOfEachPatient[index_of_wanted_image] ]
+        [allChannelsOfPatientInNpArray, tupleOfPaddingPerAxesLeftRight] = get_reflected_and_padded_views_of_channels(channelsOfCase, reflectFlags, padInputImagesBool, cnnReceptiveField, dimsOfPrimeSegmentRcz)
+        niiDimensions = list(allChannelsOfPatientInNpArray.shape[1:])
+    else :
+        for channel_i in range(numberOfNormalScaleChannels):
+            fullFilenamePathOfChannel = listOfFilepathsToEachChannelOfEachPatient[index_of_wanted_image][channel_i]
+            if fullFilenamePathOfChannel != "-" : #normal case, filepath was given.
+                channelData = load_volume_for_case(fullFilenamePathOfChannel, decodedVolumesCacheFolder, subjectStore, preloadedVolumes, subjectCache)
                 
-            channelData = reflectImageArrayIfNeeded(reflectFlags, channelData) #reflect if flag ==1 .
-            [channelData, tupleOfPaddingPerAxesLeftRight] = padCnnInputs(channelData, cnnReceptiveField, dimsOfPrimeSegmentRcz) if padInputImagesBool else [channelData, tupleOfPaddingPerAxesLeftRight]
+                channelData = reflectImageArrayIfNeeded(reflectFlags, channelData) #reflect if flag ==1 .
+                [channelData, tupleOfPaddingPerAxesLeftRight] = padCnnInputs(channelData, cnnReceptiveField, dimsOfPrimeSegmentRcz) if padInputImagesBool else [channelData, tupleOfPaddingPerAxesLeftRight]
             
-            if not isinstance(allChannelsOfPatientInNpArray, (np.ndarray)) :
-                #Initialize the array in which all the channels for the patient will be placed.
-                niiDimensions = list(channelData.shape)
-                allChannelsOfPatientInNpArray = np.zeros( (numberOfNormalScaleChannels, niiDimensions[0], niiDimensions[1], niiDimensions[2]))
+                if not isinstance(allChannelsOfPatientInNpArray, (np.ndarray)) :
+                    #Initialize the array in which all the channels for the patient will be placed.
+                    niiDimensions = list(channelData.shape)
+                    allChannelsOfPatientInNpArray = np.zeros( (numberOfNormalScaleChannels, niiDimensions[0], niiDimensions[1], niiDimensions[2]), dtype=dtypeOfIntensities)
                 
-            allChannelsOfPatientInNpArray[channel_i] = channelData
-        else : # "-" was given in the config-listing file. Do Min-fill!
-            log.print3("DEBUG: Zero-filling modality with index [" + str(channel_i) +"].")
-            allChannelsOfPatientInNpArray[channel_i] = -4.0
+                allChannelsOfPatientInNpArray[channel_i] = channelData
+            else : # "-" was given in the config-listing file. Do Min-fill!
+                log.print3("DEBUG: Zero-filling modality with index [" + str(channel_i) +"].")
+                allChannelsOfPatientInNpArray[channel_i] = -4.0
             
         
             
     #Load the class labels.
     if providedGtLabelsBool : #For training (exact target labels) or validation on samples labels.
         fullFilenamePathOfGtLabels = listOfFilepathsToGtLabelsOfEachPatient[index_of_wanted_image]
-        imageGtLabels = loadVolume(fullFilenamePathOfGtLabels)
+        imageGtLabels = load_volume_for_case(fullFilenamePathOfGtLabels, decodedVolumesCacheFolder, subjectStore, preloadedVolumes, subjectCache)
         
         if imageGtLabels.dtype.kind not in ['i','u']:
             #log.print3("WARN: GT labels were found of dtype=["+str(imageGtLabels.dtype)+"]. Rounding and casting them to int!")
             imageGtLabels = np.rint(imageGtLabels).astype("int32")
-        check_gt_vs_num_classes(log, imageGtLabels, num_classes)
+        if recordOfCase is not None and recordOfCase["label_histogram"] is not None and list(imageGtLabels.shape) == recordOfCase["shape"] :
+            check_record_vs_num_classes(log, recordOfCase, num_classes)
+        else :
+            check_gt_vs_num_classes(log, imageGtLabels, num_classes)
+        imageGtLabels = imageGtLabels.astype(get_dtype_of_labels(num_classes), copy=False)
         
         imageGtLabels = reflectImageArrayIfNeeded(reflectFlags, imageGtLabels) #reflect if flag ==1 .
         
@@ -581,7 +931,7 @@ def load_imgs_of_single_case(log,
         for cat_i in range( numberOfSamplingCategories ) :
             filepathsToTheWeightMapsOfAllPatientsForThisCategory = forEachSamplingCategory_aListOfFilepathsToWeightMapsOfEachPatient[cat_i]
             filepathToTheWeightMapOfThisPatientForThisCategory = filepathsToTheWeightMapsOfAllPatientsForThisCategory[index_of_wanted_image]
-            weightedMapForThisCatData = loadVolume(filepathToTheWeightMapOfThisPatientForThisCategory)
+            weightedMapForThisCatData = load_volume_for_case(filepathToTheWeightMapOfThisPatientForThisCategory, decodedVolumesCacheFolder, subjectStore, preloadedVolumes, subjectCache)
             
             weightedMapForThisCatData = reflectImageArrayIfNeeded(reflectFlags, weightedMapForThisCatData)
             [weightedMapForThisCatData, tupleOfPaddingPerAxesLeftRight] = padCnnInputs(weightedMapForThisCatData, cnnReceptiveField, dimsOfPrimeSegmentRcz) if padInputImagesBool else [weightedMapForThisCatData, tupleOfPaddingPerAxesLeftRight]
@@ -595,12 +945,18 @@ def load_imgs_of_single_case(log,
         allSubsampledChannelsOfPatientInNpArray = "placeholderNothing"
     elif useSameSubChannelsAsSingleScale : #Pass this in the configuration file, instead of a list of channel names, to use the same channels as the normal res.
         allSubsampledChannelsOfPatientInNpArray = allChannelsOfPatientInNpArray #np.asarray(allChannelsOfPatientInNpArray, dtype="float32") #Hope this works, to win time in loading. Without copying it did not work.
+    elif "-" not in listOfFilepathsToEachSubsampledChannelOfEachPatient[index_of_wanted_image] :
+        if keepSubsampledChannelsChunked :
+            subsampledChannelsOfCase = [ ChunkedVolume(filepath) for filepath in listOfFilepathsToEachSubsampledChannelOfEachPatient[index_of_wanted_image] ]
+        else :
+            subsampledChannelsOfCase = [ load_volume_for_case(filepath, decodedVolumesCacheFolder, subjectStore, preloadedVolumes, subjectCache) for filepath in listOfFilepathsToEachSubsampledChannelOfEachPatient[index_of_wanted_image] ]
+        [allSubsampledChannelsOfPatientInNpArray, _] = get_reflected_and_padded_views_of_channels(subsampledChannelsOfCase, reflectFlags, padInputImagesBool, cnnReceptiveField, dimsOfPrimeSegmentRcz)
     else :
         numberOfSubsampledScaleChannels = len(listOfFilepathsToEachSubsampledChannelOfEachPatient[0])
-        allSubsampledChannelsOfPatientInNpArray = np.zeros( (numberOfSubsampledScaleChannels, niiDimensions[0], niiDimensions[1], niiDimensions[2]))
+        allSubsampledChannelsOfPatientInNpArray = np.zeros( (numberOfSubsampledScaleChannels, niiDimensions[0], niiDimensions[1], niiDimensions[2]), dtype=dtypeOfIntensities)
         for channel_i in range(numberOfSubsampledScaleChannels):
             fullFilenamePathOfChannel = listOfFilepathsToEachSubsampledChannelOfEachPatient[index_of_wanted_image][channel_i]
-            channelData = loadVolume(fullFilenamePathOfChannel)
+            channelData = load_volume_for_case(fullFilenamePathOfChannel, decodedVolumesCacheFolder, subjectStore, preloadedVolumes, subjectCache)
             
             channelData = reflectImageArrayIfNeeded(reflectFlags, channelData)
             [channelData, tupleOfPaddingPerAxesLeftRight] = padCnnInputs(channelData, cnnReceptiveField, dimsOfPrimeSegmentRcz) if padInputImagesBool else [channelData, tupleOfPaddingPerAxesLeftRight]
@@ -619,7 +975,9 @@ def sampleImageParts(   log,
                         numOfSegmentsToExtractForThisSubject,
                         dimsOfSegmentRcz,
                         dimensionsOfImageChannel,# the dimensions of the images of this subject. All channels etc should have the same dimensions
-                        weightMapToSampleFrom
+                        weightMapToSampleFrom,
+                        centreSampler=None, # CentreSampler of the case and category. If given, weightMapToSampleFrom is not used.
+                        samplerRng=None # SamplerRNG to draw the centres with. None draws from the global random state.
                         ) :
     """
     This function returns the coordinates (index) of the "central" voxel of sampled image parts (1voxel to the left if even part-dimension).
@@ -632,140 +990,25 @@ def sampleImageParts(   log,
     > sliceCoordsOfImagePartsSampled : 3(rcz) x NumberOfImagePartSamples x 2. The last dimension has [0] for the lower boundary of the slice, and [1] for the higher boundary. INCLUSIVE BOTH SIDES.
         Example: [ r-sliceCoordsOfImagePart, c-sliceCoordsOfImagePart, z-sliceCoordsOfImagePart ]
     """
-    # Check if the weight map is fully-zeros. In this case, return no element.
-    # Note: Currently, the caller function is checking this case already and does not let this being called. Which is still fine.
-    if np.sum(weightMapToSampleFrom>0) == 0 :
-        log.print3("WARN: The sampling mask/map was found just zeros! No image parts were sampled for this subject!")
-        return [ [[],[],[]], [[],[],[]] ]
-    
-    imagePartsSampled = []
-    
-    #Now out of these, I need to randomly select one, which will be an ImagePart's central voxel.
-    #But I need to be CAREFUL and get one that IS NOT closer to the image boundaries than the dimensions of the ImagePart permit.
-    
-    #I look for lesions that are not closer to the image boundaries than the ImagePart dimensions allow.
+    #The central voxels are drawn only among the voxels that are not closer to the image boundaries than the ImagePart dimensions allow.
     #KernelDim is always odd. BUT ImagePart dimensions can be odd or even.
     #If odd, ok, floor(dim/2) from central.
     #If even, dim/2-1 voxels towards the begining of the axis and dim/2 towards the end. Ie, "central" imagePart voxel is 1 closer to begining.
     #BTW imagePartDim takes kernel into account (ie if I want 9^3 voxels classified per imagePart with kernel 5x5, I want 13 dim ImagePart)
+    #The candidates (within boundaries, and with weight > 0) are found by the CentreSampler once. Drawing from them does not depend on the volume's size.
+    if centreSampler is None :
+        centreSampler = makeCentreSamplerFromWeightMap(weightMapToSampleFrom, dimsOfSegmentRcz)
     
-    halfImagePartBoundaries = np.zeros( (len(dimsOfSegmentRcz), 2) , dtype='int32') #dim1: 1 row per r,c,z. Dim2: left/right width not to sample from (=half segment).
-    
-    #The below starts all zero. Will be Multiplied by other true-false arrays expressing if the relevant voxels are within boundaries.
-    #In the end, the final vector will be true only for the indices of lesions that are within all boundaries.
-    booleanNpArray_voxelsToCentraliseImPartsWithinBoundaries = np.zeros(weightMapToSampleFrom.shape, dtype="int32")
-    
-    #The following loop leads to booleanNpArray_voxelsToCentraliseImPartsWithinBoundaries to be true for the indices that allow you to get an image part CENTERED on them, and be safely within image boundaries. Note that if the imagePart is of even dimension, the "central" voxel is one voxel to the left.
-    for rcz_i in range( len(dimsOfSegmentRcz) ) :
-        if dimsOfSegmentRcz[rcz_i]%2 == 0: #even
-            dimensionDividedByTwo = dimsOfSegmentRcz[rcz_i]//2
-            halfImagePartBoundaries[rcz_i] = [dimensionDividedByTwo - 1, dimensionDividedByTwo] #central of ImagePart is 1 vox closer to begining of axes.
-        else: #odd
-            dimensionDividedByTwoFloor = math.floor(dimsOfSegmentRcz[rcz_i]//2) #eg 5/2 = 2, with the 3rd voxel being the "central"
-            halfImagePartBoundaries[rcz_i] = [dimensionDividedByTwoFloor, dimensionDividedByTwoFloor] 
-    #used to be [halfImagePartBoundaries[0][0]: -halfImagePartBoundaries[0][1]], but in 2D case halfImagePartBoundaries might be ==0, causes problem and you get a null slice.
-    booleanNpArray_voxelsToCentraliseImPartsWithinBoundaries[halfImagePartBoundaries[0][0]: dimensionsOfImageChannel[0] - halfImagePartBoundaries[0][1],
-                                                            halfImagePartBoundaries[1][0]: dimensionsOfImageChannel[1] - halfImagePartBoundaries[1][1],
-                                                            halfImagePartBoundaries[2][0]: dimensionsOfImageChannel[2] - halfImagePartBoundaries[2][1]] = 1
-                                                            
-    constrainedWithImageBoundariesMaskToSample = weightMapToSampleFrom * booleanNpArray_voxelsToCentraliseImPartsWithinBoundaries
-    #normalize the probabilities to sum to 1, cause the function needs it as so.
-    constrainedWithImageBoundariesMaskToSample = constrainedWithImageBoundariesMaskToSample / (1.0* np.sum(constrainedWithImageBoundariesMaskToSample))
-    
-    flattenedConstrainedWithImageBoundariesMaskToSample = constrainedWithImageBoundariesMaskToSample.flatten()
-    
-    #This is going to be a 3xNumberOfImagePartSamples array.
-    indicesInTheFlattenArrayThatWereSampledAsCentralVoxelsOfImageParts = np.random.choice(  constrainedWithImageBoundariesMaskToSample.size,
-                                                                                            size = numOfSegmentsToExtractForThisSubject,
-                                                                                            replace=True,
-                                                                                            p=flattenedConstrainedWithImageBoundariesMaskToSample)
-    #np.unravel_index([listOfIndicesInFlattened], dims) returns a tuple of arrays (eg 3 of them if 3 dimImage), where each of the array in the tuple has the same shape as the listOfIndices. They have the r/c/z coords that correspond to the index of the flattened version.
-    #So, coordsOfCentralVoxelsOfPartsSampled will end up being an array with shape: 3(rcz) x numOfSegmentsToExtractForThisSubject.
-    coordsOfCentralVoxelsOfPartsSampled = np.asarray(np.unravel_index(indicesInTheFlattenArrayThatWereSampledAsCentralVoxelsOfImageParts,
-                                                                    constrainedWithImageBoundariesMaskToSample.shape #the shape of the roiMask/scan.
-                                                                    )
-                                                    )
-    #Array with shape: 3(rcz) x NumberOfImagePartSamples x 2. The last dimension has [0] for the lower boundary of the slice, and [1] for the higher boundary. INCLUSIVE BOTH SIDES.
-    sliceCoordsOfImagePartsSampled = np.zeros(list(coordsOfCentralVoxelsOfPartsSampled.shape) + [2], dtype="int32")
-    sliceCoordsOfImagePartsSampled[:,:,0] = coordsOfCentralVoxelsOfPartsSampled - halfImagePartBoundaries[ :, np.newaxis, 0 ] #np.newaxis broadcasts. To broadcast the -+.
-    sliceCoordsOfImagePartsSampled[:,:,1] = coordsOfCentralVoxelsOfPartsSampled + halfImagePartBoundaries[ :, np.newaxis, 1 ]
-    """
-    The slice coordinates returned are INCLUSIVE BOTH sides.
-    """
-    #coordsOfCentralVoxelsOfPartsSampled: Array of dimensions 3(rcz) x NumberOfImagePartSamples.
-    #sliceCoordsOfImagePartsSampled: Array of dimensions 3(rcz) x NumberOfImagePartSamples x 2. The last dim has [0] for the lower boundary of the slice, and [1] for the higher boundary. INCLUSIVE BOTH SIDES.
-    imagePartsSampled = [coordsOfCentralVoxelsOfPartsSampled, sliceCoordsOfImagePartsSampled]
-    return imagePartsSampled
-
-
-def TDsampleImageParts(   log,
-                        numOfSegmentsToExtractForThisSubject,
-                        dimsOfSegmentRcz,
-                        dimensionsOfImageChannel,# the dimensions of the images of this subject. All channels etc should have the same dimensions
-                        weightMapToSampleFrom
-                        ) :
-    """
-    This function returns the coordinates (index) of the "central" voxel of sampled image parts (1voxel to the left if even part-dimension).
-    It also returns the indices of the image parts, left and right indices, INCLUSIVE BOTH SIDES.
-    
-    Return value: [ rcz-coordsOfCentralVoxelsOfPartsSampled, rcz-sliceCoordsOfImagePartsSampled ]
-    > coordsOfCentralVoxelsOfPartsSampled : an array with shape: 3(rcz) x numOfSegmentsToExtractForThisSubject. 
-        Example: [ rCoordsForCentralVoxelOfEachPart, cCoordsForCentralVoxelOfEachPart, zCoordsForCentralVoxelOfEachPart ]
-        >> r/c/z-CoordsForCentralVoxelOfEachPart : A 1-dim array with numOfSegmentsToExtractForThisSubject, that holds the r-index within the image of each sampled part.
-    > sliceCoordsOfImagePartsSampled : 3(rcz) x NumberOfImagePartSamples x 2. The last dimension has [0] for the lower boundary of the slice, and [1] for the higher boundary. INCLUSIVE BOTH SIDES.
-        Example: [ r-sliceCoordsOfImagePart, c-sliceCoordsOfImagePart, z-sliceCoordsOfImagePart ]
-    """
-    # Check if the weight map is fully-zeros. In this case, return no element.
-    # Note: Currently, the caller function is checking this case already and does not let this being called. Which is still fine.
-    
-    
-    imagePartsSampled = []
+    # Check if there is no voxel to sample from. In this case, return no element.
+    # Note: Currently, the caller function is falling back to the ROI in this case already, see get_centre_samplers_of_case(). Which is still fine.
+    if centreSampler.isEmpty() :
+        log.print3("WARN: The sampling mask/map was found just zeros! No image parts were sampled for this subject!")
+        return [ [[],[],[]], [[],[],[]] ]
     
-    #Now out of these, I need to randomly select one, which will be an ImagePart's central voxel.
-    #But I need to be CAREFUL and get one that IS NOT closer to the image boundaries than the dimensions of the ImagePart permit.
+    #coordsOfCentralVoxelsOfPartsSampled will be an array with shape: 3(rcz) x numOfSegmentsToExtractForThisSubject.
+    coordsOfCentralVoxelsOfPartsSampled = centreSampler.sample(numOfSegmentsToExtractForThisSubject, samplerRng)
     
-    #I look for lesions that are not closer to the image boundaries than the ImagePart dimensions allow.
-    #KernelDim is always odd. BUT ImagePart dimensions can be odd or even.
-    #If odd, ok, floor(dim/2) from central.
-    #If even, dim/2-1 voxels towards the begining of the axis and dim/2 towards the end. Ie, "central" imagePart voxel is 1 closer to begining.
-    #BTW imagePartDim takes kernel into account (ie if I want 9^3 voxels classified per imagePart with kernel 5x5, I want 13 dim ImagePart)
-    
-    halfImagePartBoundaries = np.zeros( (len(dimsOfSegmentRcz), 2) , dtype='int32') #dim1: 1 row per r,c,z. Dim2: left/right width not to sample from (=half segment).
-    
-    #The below starts all zero. Will be Multiplied by other true-false arrays expressing if the relevant voxels are within boundaries.
-    #In the end, the final vector will be true only for the indices of lesions that are within all boundaries.
-    booleanNpArray_voxelsToCentraliseImPartsWithinBoundaries = np.zeros(weightMapToSampleFrom.shape, dtype="int32")
-    
-    #The following loop leads to booleanNpArray_voxelsToCentraliseImPartsWithinBoundaries to be true for the indices that allow you to get an image part CENTERED on them, and be safely within image boundaries. Note that if the imagePart is of even dimension, the "central" voxel is one voxel to the left.
-    for rcz_i in range( len(dimsOfSegmentRcz) ) :
-        if dimsOfSegmentRcz[rcz_i]%2 == 0: #even
-            dimensionDividedByTwo = dimsOfSegmentRcz[rcz_i]//2
-            halfImagePartBoundaries[rcz_i] = [dimensionDividedByTwo - 1, dimensionDividedByTwo] #central of ImagePart is 1 vox closer to begining of axes.
-        else: #odd
-            dimensionDividedByTwoFloor = math.floor(dimsOfSegmentRcz[rcz_i]//2) #eg 5/2 = 2, with the 3rd voxel being the "central"
-            halfImagePartBoundaries[rcz_i] = [dimensionDividedByTwoFloor, dimensionDividedByTwoFloor] 
-    #used to be [halfImagePartBoundaries[0][0]: -halfImagePartBoundaries[0][1]], but in 2D case halfImagePartBoundaries might be ==0, causes problem and you get a null slice.
-    booleanNpArray_voxelsToCentraliseImPartsWithinBoundaries[halfImagePartBoundaries[0][0]: dimensionsOfImageChannel[0] - halfImagePartBoundaries[0][1],
-                                                            halfImagePartBoundaries[1][0]: dimensionsOfImageChannel[1] - halfImagePartBoundaries[1][1],
-                                                            halfImagePartBoundaries[2][0]: dimensionsOfImageChannel[2] - halfImagePartBoundaries[2][1]] = 1
-                                                            
-    constrainedWithImageBoundariesMaskToSample = weightMapToSampleFrom * booleanNpArray_voxelsToCentraliseImPartsWithinBoundaries
-    #normalize the probabilities to sum to 1, cause the function needs it as so.
-    constrainedWithImageBoundariesMaskToSample = constrainedWithImageBoundariesMaskToSample / (1.0* np.sum(constrainedWithImageBoundariesMaskToSample))
-    
-    flattenedConstrainedWithImageBoundariesMaskToSample = constrainedWithImageBoundariesMaskToSample.flatten()
-    
-    #This is going to be a 3xNumberOfImagePartSamples array.
-    indicesInTheFlattenArrayThatWereSampledAsCentralVoxelsOfImageParts = np.random.choice(  constrainedWithImageBoundariesMaskToSample.size,
-                                                                                            size = numOfSegmentsToExtractForThisSubject,
-                                                                                            replace=True,
-                                                                                            p=flattenedConstrainedWithImageBoundariesMaskToSample)
-    #np.unravel_index([listOfIndicesInFlattened], dims) returns a tuple of arrays (eg 3 of them if 3 dimImage), where each of the array in the tuple has the same shape as the listOfIndices. They have the r/c/z coords that correspond to the index of the flattened version.
-    #So, coordsOfCentralVoxelsOfPartsSampled will end up being an array with shape: 3(rcz) x numOfSegmentsToExtractForThisSubject.
-    coordsOfCentralVoxelsOfPartsSampled = np.asarray(np.unravel_index(indicesInTheFlattenArrayThatWereSampledAsCentralVoxelsOfImageParts,
-                                                                    constrainedWithImageBoundariesMaskToSample.shape #the shape of the roiMask/scan.
-                                                                    )
-                                                    )
+    halfImagePartBoundaries = getHalfSegmentBoundaries(dimsOfSegmentRcz) #dim1: 1 row per r,c,z. Dim2: left/right width not to sample from (=half segment).
     #Array with shape: 3(rcz) x NumberOfImagePartSamples x 2. The last dimension has [0] for the lower boundary of the slice, and [1] for the higher boundary. INCLUSIVE BOTH SIDES.
     sliceCoordsOfImagePartsSampled = np.zeros(list(coordsOfCentralVoxelsOfPartsSampled.shape) + [2], dtype="int32")
     sliceCoordsOfImagePartsSampled[:,:,0] = coordsOfCentralVoxelsOfPartsSampled - halfImagePartBoundaries[ :, np.newaxis, 0 ] #np.newaxis broadcasts. To broadcast the -+.
@@ -779,297 +1022,428 @@ def TDsampleImageParts(   log,
     return imagePartsSampled
 
 
-def getImagePartFromSubsampledImageForTraining( dimsOfPrimarySegment,
-                                                recFieldCnn,
-                                                subsampledImageChannels,
-                                                image_part_slices_coords,
-                                                subSamplingFactor,
-                                                subsampledImagePartDimensions
-                                                ) :
-    """
-    This returns an image part from the sampled data, given the image_part_slices_coords, which has the coordinates where the normal-scale image part starts and ends (inclusive).
-    Actually, in this case, the right (end) part of image_part_slices_coords is not used.
-    
-    The way it works is NOT optimal. From the begining of the normal-resolution part, it goes further to the left 1 image PATCH (depending on subsampling factor) and then forward 3 PATCHES. This stops it from being used with arbitrary size of subsampled-image-part (decoupled by the normal-patch). Now, the subsampled patch has to be of the same size as the normal-scale. In order to change this, I should find where THE FIRST TOP LEFT CENTRAL (predicted) VOXEL is, and do the back-one-(sub)patch + front-3-(sub)patches from there, not from the begining of the patch.
-    
-    Current way it works (correct):
-    If I have eg subsample factor=3 and 9 central-pred-voxels, I get 3 "central" voxels/patches for the subsampled-part. Straightforward. If I have a number of central voxels that is not an exact multiple of the subfactor, eg 10 central-voxels, I get 3+1 central voxels in the subsampled-part. When the cnn is convolving them, they will get repeated to 4(last-layer-neurons)*3(factor) = 12, and will get sliced down to 10, in order to have same dimension with the 1st pathway.
-    """
-    subsampledImageDimensions = subsampledImageChannels[0].shape
-    
-    subsampledChannelsForThisImagePart = np.ones(   (len(subsampledImageChannels), 
-                                                    subsampledImagePartDimensions[0],
-                                                    subsampledImagePartDimensions[1],
-                                                    subsampledImagePartDimensions[2]), 
-                                                dtype = 'float32')
-    
-    numberOfCentralVoxelsClassifiedForEachImagePart_rDim = dimsOfPrimarySegment[0] - recFieldCnn[0] + 1
-    numberOfCentralVoxelsClassifiedForEachImagePart_cDim = dimsOfPrimarySegment[1] - recFieldCnn[1] + 1
-    numberOfCentralVoxelsClassifiedForEachImagePart_zDim = dimsOfPrimarySegment[2] - recFieldCnn[2] + 1
-    
-    #Calculate the slice that I should get, and where I should put it in the imagePart (eg if near the borders, and I cant grab a whole slice-imagePart).
-    rSlotsPreviously = ((subSamplingFactor[0]-1)//2)*recFieldCnn[0] if subSamplingFactor[0]%2==1 \
-                                                else (subSamplingFactor[0]-2)//2*recFieldCnn[0] + recFieldCnn[0]//2
-    cSlotsPreviously = ((subSamplingFactor[1]-1)//2)*recFieldCnn[1] if subSamplingFactor[1]%2==1 \
-                                                else (subSamplingFactor[1]-2)//2*recFieldCnn[1] + recFieldCnn[1]//2
-    zSlotsPreviously = ((subSamplingFactor[2]-1)//2)*recFieldCnn[2] if subSamplingFactor[2]%2==1 \
-                                                else (subSamplingFactor[2]-2)//2*recFieldCnn[2] + recFieldCnn[2]//2
-    #1*17
-    rToCentralVoxelOfAnAveragedArea = subSamplingFactor[0]//2 if subSamplingFactor[0]%2==1 else (subSamplingFactor[0]//2 - 1) #one closer to the beginning of the dim. Same happens when I get parts of image.
-    cToCentralVoxelOfAnAveragedArea = subSamplingFactor[1]//2 if subSamplingFactor[1]%2==1 else (subSamplingFactor[1]//2 - 1)
-    zToCentralVoxelOfAnAveragedArea =  subSamplingFactor[2]//2 if subSamplingFactor[2]%2==1 else (subSamplingFactor[2]//2 - 1)
-    #This is where to start taking voxels from the subsampled image. From the beginning of the imagePart(1 st patch)...
-    #... go forward a few steps to the voxel that is like the "central" in this subsampled (eg 3x3) area. 
-    #...Then go backwards -Patchsize to find the first voxel of the subsampled. 
-    rlow = image_part_slices_coords[0][0] + rToCentralVoxelOfAnAveragedArea - rSlotsPreviously#These indices can run out of image boundaries. I ll correct them afterwards.
-    #If the patch is 17x17, I want a 17x17 subsampled Patch. BUT if the imgPART is 25x25 (9voxClass), I want 3 subsampledPatches in my subsampPart to cover this area!
-    #That is what the last term below is taking care of.
-    #CAST TO INT because ceil returns a float, and later on when computing rHighNonInclToPutTheNotPaddedInSubsampledImPart I need to do INTEGER DIVISION.
-    rhighNonIncl = int(rlow + subSamplingFactor[0]*recFieldCnn[0] + (math.ceil((numberOfCentralVoxelsClassifiedForEachImagePart_rDim*1.0)/subSamplingFactor[0]) - 1) * subSamplingFactor[0]) #not including this index in the image-part
-    clow = image_part_slices_coords[1][0] + cToCentralVoxelOfAnAveragedArea - cSlotsPreviously
-    chighNonIncl = int(clow + subSamplingFactor[1]*recFieldCnn[1] + (math.ceil((numberOfCentralVoxelsClassifiedForEachImagePart_cDim*1.0)/subSamplingFactor[1]) - 1) * subSamplingFactor[1])
-    zlow = image_part_slices_coords[2][0] + zToCentralVoxelOfAnAveragedArea - zSlotsPreviously
-    zhighNonIncl = int(zlow + subSamplingFactor[2]*recFieldCnn[2] + (math.ceil((numberOfCentralVoxelsClassifiedForEachImagePart_zDim*1.0)/subSamplingFactor[2]) - 1) * subSamplingFactor[2])
-        
-    rlowCorrected = max(rlow, 0)
-    clowCorrected = max(clow, 0)
-    zlowCorrected = max(zlow, 0)
-    rhighNonInclCorrected = min(rhighNonIncl, subsampledImageDimensions[0])
-    chighNonInclCorrected = min(chighNonIncl, subsampledImageDimensions[1])
-    zhighNonInclCorrected = min(zhighNonIncl, subsampledImageDimensions[2]) #This gave 7
-    
-    rLowToPutTheNotPaddedInSubsampledImPart = 0 if rlow >= 0 else abs(rlow)//subSamplingFactor[0]
-    cLowToPutTheNotPaddedInSubsampledImPart = 0 if clow >= 0 else abs(clow)//subSamplingFactor[1]
-    zLowToPutTheNotPaddedInSubsampledImPart = 0 if zlow >= 0 else abs(zlow)//subSamplingFactor[2]
-    
-    dimensionsOfTheSliceOfSubsampledImageNotPadded = [  int(math.ceil((rhighNonInclCorrected - rlowCorrected)*1.0/subSamplingFactor[0])),
-                                                        int(math.ceil((chighNonInclCorrected - clowCorrected)*1.0/subSamplingFactor[1])),
-                                                        int(math.ceil((zhighNonInclCorrected - zlowCorrected)*1.0/subSamplingFactor[2]))
-                                                        ]
-    
-    #I now have exactly where to get the slice from and where to put it in the new array.
-    for channel_i in range(len(subsampledImageChannels)) :
-        intensityZeroOfChannel = calculateTheZeroIntensityOf3dImage(subsampledImageChannels[channel_i])        
-        subsampledChannelsForThisImagePart[channel_i] *= intensityZeroOfChannel
-        
-        sliceOfSubsampledImageNotPadded = subsampledImageChannels[channel_i][   rlowCorrected : rhighNonInclCorrected : subSamplingFactor[0],
-                                                                                clowCorrected : chighNonInclCorrected : subSamplingFactor[1],
-                                                                                zlowCorrected : zhighNonInclCorrected : subSamplingFactor[2]
-                                                                            ]
-        subsampledChannelsForThisImagePart[
-            channel_i,
-            rLowToPutTheNotPaddedInSubsampledImPart : rLowToPutTheNotPaddedInSubsampledImPart+dimensionsOfTheSliceOfSubsampledImageNotPadded[0],
-            cLowToPutTheNotPaddedInSubsampledImPart : cLowToPutTheNotPaddedInSubsampledImPart+dimensionsOfTheSliceOfSubsampledImageNotPadded[1],
-            zLowToPutTheNotPaddedInSubsampledImPart : zLowToPutTheNotPaddedInSubsampledImPart+dimensionsOfTheSliceOfSubsampledImageNotPadded[2]] = sliceOfSubsampledImageNotPadded
-            
-    #placeholderReturn = np.ones([3,19,19,19], dtype="float32") #channel, dims 
-    return subsampledChannelsForThisImagePart
+def get_key_of_case_for_caches(index_of_case, listOfFilepathsToEachChannelOfEachPatient, listOfFilepathsToGtLabelsOfEachPatient,
+                                listOfFilepathsToRoiMaskOfEachPatient, forEachSamplingCategory_aListOfFilepathsToWeightMapsOfEachPatient) :
+    # Identifies a case by its files, for what is cached per case in the SubjectCache (other than volumes, which are keyed by their filepath).
+    filepathsOfCase = list(listOfFilepathsToEachChannelOfEachPatient[index_of_case]) + [listOfFilepathsToGtLabelsOfEachPatient[index_of_case]]
+    if listOfFilepathsToRoiMaskOfEachPatient is not None :
+        filepathsOfCase.append(listOfFilepathsToRoiMaskOfEachPatient[index_of_case])
+    if forEachSamplingCategory_aListOfFilepathsToWeightMapsOfEachPatient is not None :
+        filepathsOfCase += [ filepathsOfCat[index_of_case] for filepathsOfCat in forEachSamplingCategory_aListOfFilepathsToWeightMapsOfEachPatient ]
+    return "|".join(filepathsOfCase)
 
 
+def get_centre_samplers_of_case(log,
+                                samplingTypeInstance,
+                                manifest,
+                                recordOfCase,
+                                
+                                providedWeightMapsToSampleForEachCategory,
+                                arrayWithWeightMapsWhereToSampleForEachCategory,
+                                gtLabelsImage,
+                                providedRoiMaskBool,
+                                roiMask,
+                                
+                                dimensionsOfImageChannel,
+                                dimsOfSegmentRcz,
+                                reflectFlags,
+                                tupleOfPaddingPerAxesLeftRight,
+                                
+                                keyOfCase,
+                                subjectCache=None) :
+    # Returns a CentreSampler per sampling category. Kept in the SubjectCache (if enabled) along with the volumes of the case,...
+    # ... for the same reflection, padding and segment size. The next subepochs that sample the case then do no per-voxel work for it.
+    keyInCache = "centreSamplers|" + keyOfCase + "|" + str(samplingTypeInstance.getIntSamplingType()) + "|" + str(list(reflectFlags)) +\
+                 "|" + str([ [int(pad) for pad in padOfAxis] for padOfAxis in tupleOfPaddingPerAxesLeftRight ]) + "|" + str(list(dimsOfSegmentRcz))
+    if subjectCache is not None :
+        centreSamplersOfCase = subjectCache.get(keyInCache)
+        if centreSamplersOfCase is not None :
+            return centreSamplersOfCase.centreSamplersPerCategory
+    
+    shapeOfRecordPadded = [ recordOfCase["shape"][axis_i] + sum(tupleOfPaddingPerAxesLeftRight[axis_i]) for axis_i in range(3) ] if recordOfCase is not None else None
+    recordIsUsable = recordOfCase is not None and recordOfCase["label_histogram"] is not None and shapeOfRecordPadded == list(dimensionsOfImageChannel) and \
+                        (recordOfCase["roi"] is not None or not providedRoiMaskBool)
+    if recordIsUsable and samplingTypeInstance.canGiveSamplingMapsFromManifest(providedWeightMapsToSampleForEachCategory) :
+        centreSamplersPerCategory = samplingTypeInstance.givingCentreSamplersForEachCategoryFromManifest(manifest,
+                                                                                                        recordOfCase,
+                                                                                                        providedRoiMaskBool,
+                                                                                                        reflectFlags,
+                                                                                                        tupleOfPaddingPerAxesLeftRight,
+                                                                                                        dimsOfSegmentRcz)
+    else :
+        finalWeightMapsToSampleFromPerCategoryForSubject = samplingTypeInstance.logicDecidingAndGivingFinalSamplingMapsForEachCategory(
+                                                                                                providedWeightMapsToSampleForEachCategory,
+                                                                                                arrayWithWeightMapsWhereToSampleForEachCategory,
+                                                                                                
+                                                                                                True, #providedGtLabelsBool. True both for training and for validation. Prerequisite from user-interface.
+                                                                                                gtLabelsImage,
+                                                                                                
+                                                                                                providedRoiMaskBool,
+                                                                                                roiMask,
+                                                                                                
+                                                                                                dimensionsOfImageChannel)
+        centreSamplersPerCategory = [ makeCentreSamplerFromWeightMap(weightMap, dimsOfSegmentRcz) for weightMap in finalWeightMapsToSampleFromPerCategoryForSubject ]
+    
+    # If there is nothing to sample for a category, sample from the ROI instead.
+    # Note that this way, the data loaded on GPU will not be as much as I initially wanted. Thus calculate number-of-batches from this actual number of extracted segments.
+    for cat_i in range(len(centreSamplersPerCategory)) :
+        if centreSamplersPerCategory[cat_i].isEmpty() :
+            #log.print3("WARN: The sampling mask/map was found just zeros! No [" + catString + "] image parts were sampled for this subject!")
+            centreSamplersPerCategory[cat_i] = makeCentreSamplerFromWeightMap(roiMask if isinstance(roiMask, np.ndarray) else np.ones(dimensionsOfImageChannel, dtype="uint8"), dimsOfSegmentRcz)
+    
+    if subjectCache is not None :
+        subjectCache.put(keyInCache, CentreSamplersOfCase(centreSamplersPerCategory))
+    return centreSamplersPerCategory
 
-def shuffleTheSegmentsForThisSubepoch(  imagePartsChannelsToLoadOnGpuForSubepochPerPathway,
-                                        gtLabelsForTheCentralPredictedPartOfSegmentsInGpUForSubepoch ) :
-    numOfPathwayWithInput = len(imagePartsChannelsToLoadOnGpuForSubepochPerPathway)
-    inputToZip = [ sublistForPathway for sublistForPathway in imagePartsChannelsToLoadOnGpuForSubepochPerPathway ]
-    inputToZip += [ gtLabelsForTheCentralPredictedPartOfSegmentsInGpUForSubepoch ]
-    
-    combined = list(zip(*inputToZip)) #list() for python3 compatibility, as range cannot get assignment in shuffle()
-    random.shuffle(combined)
-    shuffledInputListsToZip = list(zip(*combined))
-    
-    shuffledImagePartsChannelsToLoadOnGpuForSubepochPerPathway = [ sublistForPathway for sublistForPathway in shuffledInputListsToZip[:numOfPathwayWithInput] ]
-    shuffledGtLabelsForTheCentralPredictedPartOfSegmentsInGpUForSubepoch = shuffledInputListsToZip[numOfPathwayWithInput]
-    
-    return [shuffledImagePartsChannelsToLoadOnGpuForSubepochPerPathway, shuffledGtLabelsForTheCentralPredictedPartOfSegmentsInGpUForSubepoch]
 
+class CentreSamplersOfCase(object):
+    # Holder, to keep the CentreSamplers of a case in the SubjectCache, which needs the size in bytes of what it keeps.
+    def __init__(self, centreSamplersPerCategory) :
+        self.centreSamplersPerCategory = centreSamplersPerCategory
+        self.nbytes = sum([ centreSampler.nbytes for centreSampler in centreSamplersPerCategory ])
 
 
-# I must merge this with function: extractDataOfSegmentsUsingSampledSliceCoords() that is used for Testing! Should be easy!
-# This is used in training/val only.
-def extractDataOfASegmentFromImagesUsingSampledSliceCoords(
-                                                        train_or_val,
-                                                        
-                                                        cnn3d,
-                                                        
-                                                        coordsOfCentralVoxelOfThisImPart,
-                                                        numOfInpChannelsForPrimaryPath,
-                                                        
-                                                        allChannelsOfPatientInNpArray,
-                                                        allSubsampledChannelsOfPatientInNpArray,
-                                                        gtLabelsImage,
-                                                        
-                                                        # Intensity Augmentation
-                                                        doIntAugm_shiftMuStd_multiMuStd
-                                                        ) :
-    channelsForThisImagePartPerPathway = []
+# Arrays in shared memory: np.memmap'ed files in /dev/shm (if available), that other processes map by their paths. Only the paths, shapes and dtypes...
+# ... travel between processes, not the arrays. Used for the SubepochBuffers, and for the batches of the StreamOfBatches.
+# The files made by each process and not removed (or handed over) yet. Eg of a sampler called in the background, never collected.
+# Per pid, as forked processes (eg the producers of the StreamOfBatches) inherit the files of their parent here, which are not theirs to remove.
+_filepathsOfSharedMemoryPerProcess = collections.defaultdict(set)
+
+def make_arrays_in_shared_memory(shapesAndDtypes, prefixOfFiles) :
+    # One file per [shape, dtype]. Shapes must not be empty, np.memmap can not map empty files. Returns [arrays, filepaths].
+    folderOfSharedMemory = "/dev/shm" if os.path.isdir("/dev/shm") else None # Else the default temporary folder. Still shared, via the page cache.
+    filepaths = []
+    for _ in shapesAndDtypes :
+        (fileDescriptor, filepath) = tempfile.mkstemp(prefix=prefixOfFiles + str(os.getpid()) + "_", suffix=".dat", dir=folderOfSharedMemory)
+        os.close(fileDescriptor)
+        filepaths.append(filepath)
+        _filepathsOfSharedMemoryPerProcess[os.getpid()].add(filepath)
+    return [ map_arrays_in_shared_memory(filepaths, shapesAndDtypes, mode="w+"), filepaths ]
+
+def map_arrays_in_shared_memory(filepaths, shapesAndDtypes, mode="r+") :
+    return [ np.memmap(filepath, dtype=dtype, mode=mode, shape=tuple(shape)) for (filepath, [shape, dtype]) in zip(filepaths, shapesAndDtypes) ]
+
+def remove_files_of_shared_memory(filepaths) :
+    # Once no process will map them again. Arrays already mapped stay valid, the memory is freed when they are deleted.
+    for filepath in filepaths :
+        try :
+            os.remove(filepath)
+        except OSError :
+            pass
+        _filepathsOfSharedMemoryPerProcess[os.getpid()].discard(filepath)
+
+def hand_over_files_of_shared_memory(filepaths) :
+    # The process they were sent to removes them, once it maps them. This one does not, even at its end.
+    for filepath in filepaths :
+        _filepathsOfSharedMemoryPerProcess[os.getpid()].discard(filepath)
+
+def remove_files_of_shared_memory_of_process() :
+    # At the end of training, or at exit. /dev/shm is not cleaned when a process exits. Not while jobs of the sampling pool may still map them.
+    remove_files_of_shared_memory(list(_filepathsOfSharedMemoryPerProcess[os.getpid()]))
     
-    # Intensity augmentation
-    if train_or_val == "train" and doIntAugm_shiftMuStd_multiMuStd[0] == True:
-        
-        #Get parameters by how much to renormalize-augment mean and std.
-        muOfGaussToAdd = doIntAugm_shiftMuStd_multiMuStd[1][0]
-        stdOfGaussToAdd = doIntAugm_shiftMuStd_multiMuStd[1][1]
-        if stdOfGaussToAdd != 0 : #np.random.normal does not work for an std==0.
-            howMuchToAddForEachChannel = np.random.normal(muOfGaussToAdd, stdOfGaussToAdd, [numOfInpChannelsForPrimaryPath, 1,1,1])
+
+class SubepochBuffers(object):
+    # The segments of a subepoch, written straight into contiguous arrays (one per pathway, and one for the labels), allocated once...
+    # ... for the number of segments that will be extracted. The subepoch then exists once in memory, instead of as lists of segments plus their copies.
+    # Shuffling: Each segment is written at a random position, given by one permutation of all positions. No separate shuffle (copy) is needed.
+    # inSharedMemory: The arrays are memory-mapped files in shared memory (/dev/shm, if available). The instance is pickled and sent to the...
+    # ... sampling jobs, which map the same files and write their segments in place. Only the paths travel, not the segments.
+    # recordOrigins: Also keeps where each segment was centred, [index of case, r, c, z] in the case as read from disk. For the HardExampleMap.
+    
+    def __init__(self,
+                 numberOfSegmentsToExtract,
+                 shapesOfSegmentPerPathway, # list with the shape (channels, r, c, z) of a segment, for each pathway that requires input.
+                 shapeOfLabelsOfSegment, # (r, c, z) of the central part of a segment that is classified. None if no labels (unlabeled cases).
+                 dtypeOfIntensities,
+                 dtypeOfLabels,
+                 inSharedMemory=False,
+                 samplerRng=None, # SamplerRNG for the shuffling. None draws from the global random state.
+                 recordOrigins=False) :
+        self._numberOfSegments = int(numberOfSegmentsToExtract)
+        self._positionsOfSegments = get_sampler_rng(samplerRng).permutation(self._numberOfSegments)
+        self._numberOfSegmentsReserved = 0
+        self._positionsFilled = [] # Arrays of positions, per job.
+        self._numberOfSegmentsFilled = 0
+        # [shape, dtype] of each array. The first per pathway, the last for the labels (if any).
+        self._shapesAndDtypes = [ [ [self._numberOfSegments] + list(shapeOfSegment), dtypeOfIntensities ] for shapeOfSegment in shapesOfSegmentPerPathway ]
+        if shapeOfLabelsOfSegment is not None :
+            self._shapesAndDtypes.append( [ [self._numberOfSegments] + list(shapeOfLabelsOfSegment), dtypeOfLabels ] )
+        self._recordOrigins = recordOrigins
+        if recordOrigins : # Always the last array.
+            self._shapesAndDtypes.append( [ [self._numberOfSegments, 4], "int32" ] )
+        self._numberOfPathways = len(shapesOfSegmentPerPathway)
+        self._inSharedMemory = inSharedMemory and self._numberOfSegments > 0 # np.memmap can not map empty files.
+        if self._inSharedMemory :
+            [arrays, self._filepathsOfSharedMemory] = make_arrays_in_shared_memory(self._shapesAndDtypes, "dmSubepoch")
         else :
-            howMuchToAddForEachChannel = np.ones([numOfInpChannelsForPrimaryPath, 1,1,1], dtype="float32")*muOfGaussToAdd
+            arrays = [ np.empty(shape, dtype=dtype) for [shape, dtype] in self._shapesAndDtypes ]
+            self._filepathsOfSharedMemory = []
+        self._set_arrays(arrays)
         
-        muOfGaussToMultiply = doIntAugm_shiftMuStd_multiMuStd[2][0]
-        stdOfGaussToMultiply = doIntAugm_shiftMuStd_multiMuStd[2][1]
-        if stdOfGaussToMultiply != 0 :
-            howMuchToMultiplyForEachChannel = np.random.normal(muOfGaussToMultiply, stdOfGaussToMultiply, [numOfInpChannelsForPrimaryPath, 1,1,1])
-        else :
-            howMuchToMultiplyForEachChannel = np.ones([numOfInpChannelsForPrimaryPath, 1,1,1], dtype="float32") * muOfGaussToMultiply
-    
-    # Sampling
-    for pathway in cnn3d.pathways[:1] : #Hack. The rest of this loop can work for the whole .pathways...
-        # ... BUT the loop does not check what happens if boundaries are out of limits, to fill with zeros. This is done in getImagePartFromSubsampledImageForTraining().
-        #... Update it in a nice way to be done here, and then take getImagePartFromSubsampledImageForTraining() out and make loop go for every pathway.
+    def _set_arrays(self, arrays) :
+        self._originsOfSegments = arrays[-1] if self._recordOrigins else None
+        arrays = arrays[:-1] if self._recordOrigins else arrays
+        self._channelsPerPathway = arrays[:self._numberOfPathways]
+        self._gtLabels = arrays[self._numberOfPathways] if len(arrays) > self._numberOfPathways else None
         
-        if pathway.pType() == pt.FC :
-            continue
-        subSamplingFactor = pathway.subsFactor()
-        pathwayInputShapeRcz = pathway.getShapeOfInput(train_or_val)[2:]
-        leftBoundaryRcz = [ coordsOfCentralVoxelOfThisImPart[0] - subSamplingFactor[0]*(pathwayInputShapeRcz[0]-1)//2,
-                            coordsOfCentralVoxelOfThisImPart[1] - subSamplingFactor[1]*(pathwayInputShapeRcz[1]-1)//2,
-                            coordsOfCentralVoxelOfThisImPart[2] - subSamplingFactor[2]*(pathwayInputShapeRcz[2]-1)//2]
-        rightBoundaryRcz = [leftBoundaryRcz[0] + subSamplingFactor[0]*pathwayInputShapeRcz[0],
-                            leftBoundaryRcz[1] + subSamplingFactor[1]*pathwayInputShapeRcz[1],
-                            leftBoundaryRcz[2] + subSamplingFactor[2]*pathwayInputShapeRcz[2]]
-        channelsForThisImagePart = allChannelsOfPatientInNpArray[:,
-                                                                leftBoundaryRcz[0] : rightBoundaryRcz[0] : subSamplingFactor[0],
-                                                                leftBoundaryRcz[1] : rightBoundaryRcz[1] : subSamplingFactor[1],
-                                                                leftBoundaryRcz[2] : rightBoundaryRcz[2] : subSamplingFactor[2]]
-        
-        # Intensity augmentation of the segments.
-        if train_or_val == "train" and doIntAugm_shiftMuStd_multiMuStd[0] == True :
-            channelsForThisImagePart = (channelsForThisImagePart + howMuchToAddForEachChannel) * howMuchToMultiplyForEachChannel
+    def __getstate__(self) :
+        if not self._inSharedMemory :
+            return self.__dict__
+        # The receiving process maps the files again. The arrays and the bookkeeping of the parent are not sent.
+        state = dict(self.__dict__)
+        state.update( { "_channelsPerPathway": None, "_gtLabels": None, "_originsOfSegments": None, "_positionsOfSegments": None, "_positionsFilled": None } )
+        return state
         
-        channelsForThisImagePartPerPathway.append(channelsForThisImagePart)
+    def __setstate__(self, state) :
+        self.__dict__.update(state)
+        if self._inSharedMemory :
+            self._set_arrays(map_arrays_in_shared_memory(self._filepathsOfSharedMemory, self._shapesAndDtypes))
+            
+    def reserve(self, numberOfSegmentsToReserve) :
+        # Returns the next (random) positions, for the segments of one job. Called by the parent, before the jobs run.
+        numberOfSegmentsToReserve = int(numberOfSegmentsToReserve)
+        if self._numberOfSegmentsReserved + numberOfSegmentsToReserve > self._numberOfSegments :
+            raise ValueError("ERROR: More segments were reserved [" + str(self._numberOfSegmentsReserved + numberOfSegmentsToReserve) + "] than the buffers of the subepoch were made for [" + str(self._numberOfSegments) + "].")
+        positions = self._positionsOfSegments[ self._numberOfSegmentsReserved : self._numberOfSegmentsReserved + numberOfSegmentsToReserve ]
+        self._numberOfSegmentsReserved += numberOfSegmentsToReserve
+        return positions
         
-    # Extract the samples for secondary pathways. This whole for can go away, if I update above code to check to slices out of limits.
-    for pathway_i in range(len(cnn3d.pathways)) : # Except Normal 1st, cause that was done already.
-        if cnn3d.pathways[pathway_i].pType() == pt.FC or cnn3d.pathways[pathway_i].pType() == pt.NORM:
-            continue
-        #this datastructure is similar to channelsForThisImagePart, but contains voxels from the subsampled image.
-        dimsOfPrimarySegment = cnn3d.pathways[pathway_i].getShapeOfInput(train_or_val)[2:]
-        slicesCoordsOfSegmForPrimaryPathway = [ [leftBoundaryRcz[0], rightBoundaryRcz[0]-1], [leftBoundaryRcz[1], rightBoundaryRcz[1]-1], [leftBoundaryRcz[2], rightBoundaryRcz[2]-1] ] #the right hand values are placeholders in this case.
-        channsForThisSubsampledPartAndPathway = getImagePartFromSubsampledImageForTraining(dimsOfPrimarySegment=dimsOfPrimarySegment,
-                                                                                        recFieldCnn=cnn3d.recFieldCnn,
-                                                                                        subsampledImageChannels=allSubsampledChannelsOfPatientInNpArray,
-                                                                                        image_part_slices_coords=slicesCoordsOfSegmForPrimaryPathway,
-                                                                                        subSamplingFactor=cnn3d.pathways[pathway_i].subsFactor(),
-                                                                                        subsampledImagePartDimensions=cnn3d.pathways[pathway_i].getShapeOfInput(train_or_val)[2:]
-                                                                                        )
+    def write(self, positions, channelsOfSegmentsPerPathway, gtLabelsOfSegments, originsOfSegments=None) :
+        # channelsOfSegmentsPerPathway: list with an array (N, channels, r, c, z) per pathway. gtLabelsOfSegments: array (N, r, c, z), or None.
+        # originsOfSegments: array (N, 4), if recordOrigins. positions: N of the positions reserved for the job. Called by the job, in whichever process it runs.
+        for pathway_i in range(len(self._channelsPerPathway)) :
+            self._channelsPerPathway[pathway_i][positions] = channelsOfSegmentsPerPathway[pathway_i]
+        if self._gtLabels is not None :
+            self._gtLabels[positions] = gtLabelsOfSegments
+        if self._originsOfSegments is not None :
+            self._originsOfSegments[positions] = originsOfSegments
+            
+    def mark_filled(self, positions) :
+        # Called by the parent, for the positions a job reported written.
+        self._positionsFilled.append(positions)
+        self._numberOfSegmentsFilled += len(positions)
         
-        # Intensity augmentation of the segments.
-        if train_or_val == "train" and doIntAugm_shiftMuStd_multiMuStd[0] == True:
-            channsForThisSubsampledPartAndPathway = (channsForThisSubsampledPartAndPathway + howMuchToAddForEachChannel) * howMuchToMultiplyForEachChannel
+    def remove_files_of_shared_memory(self) :
+        # Once no job will map them again. The arrays of this process stay valid, the memory is freed when they are deleted.
+        remove_files_of_shared_memory(self._filepathsOfSharedMemory)
+        self._filepathsOfSharedMemory = []
         
-        channelsForThisImagePartPerPathway.append(channsForThisSubsampledPartAndPathway)
+    def _get_positions_filled(self) :
+        # None if all are. Else some categories of some cases had nothing to sample. Rare. The unused positions are dropped.
+        if self._numberOfSegmentsFilled == self._numberOfSegments :
+            return None
+        return np.sort(np.concatenate(self._positionsFilled)) if len(self._positionsFilled) > 0 else np.zeros(0, dtype="int64")
         
-
-    numOfCentralVoxelsClassifRcz = cnn3d.finalTargetLayer_outputShape[train_or_val][2:]
-    leftBoundaryRcz = [ coordsOfCentralVoxelOfThisImPart[0] - (numOfCentralVoxelsClassifRcz[0]-1)//2,
-                        coordsOfCentralVoxelOfThisImPart[1] - (numOfCentralVoxelsClassifRcz[1]-1)//2,
-                        coordsOfCentralVoxelOfThisImPart[2] - (numOfCentralVoxelsClassifRcz[2]-1)//2]
-    rightBoundaryRcz = [leftBoundaryRcz[0] + numOfCentralVoxelsClassifRcz[0],
-                        leftBoundaryRcz[1] + numOfCentralVoxelsClassifRcz[1],
-                        leftBoundaryRcz[2] + numOfCentralVoxelsClassifRcz[2]]
-    gtLabelsForTheCentralClassifiedPartOfThisImagePart = gtLabelsImage[ leftBoundaryRcz[0] : rightBoundaryRcz[0],
-                                                                        leftBoundaryRcz[1] : rightBoundaryRcz[1],
-                                                                        leftBoundaryRcz[2] : rightBoundaryRcz[2] ]
-    
-    return [ channelsForThisImagePartPerPathway, gtLabelsForTheCentralClassifiedPartOfThisImagePart ]
-
-
-
-
-def extractTDDataOfASegmentFromImagesUsingSampledSliceCoords(
+    def get_segments_and_labels(self) :
+        # Returns [ list with an array (segments, channels, r, c, z) per pathway, array of labels (segments, r, c, z) or None ].
+        positionsFilled = self._get_positions_filled()
+        if positionsFilled is None :
+            return [ self._channelsPerPathway, self._gtLabels ]
+        return [ [ channels[positionsFilled] for channels in self._channelsPerPathway ],
+                 self._gtLabels[positionsFilled] if self._gtLabels is not None else None ]
+    
+    def get_origins_of_segments(self) :
+        # Array (segments, 4), in the order of get_segments_and_labels(). Requires recordOrigins.
+        positionsFilled = self._get_positions_filled()
+        return np.array(self._originsOfSegments) if positionsFilled is None else self._originsOfSegments[positionsFilled]
+    
+    
+# Extracts all the segments sampled from a case at once, instead of one call per segment.
+# This is used in training/val only. For testing see extractDataOfSegmentsUsingSampledSliceCoords().
+def extractDataOfSegmentsFromImagesUsingSampledCentres(
                                                         train_or_val,
                                                         
-                                                        cnn3d,
+                                                        extractionPlan, # ExtractionPlan of the model for train_or_val. Shapes and offsets of the segments.
                                                         
-                                                        coordsOfCentralVoxelOfThisImPart,
+                                                        coordsOfCentralVoxelsOfImParts, # array (N, 3(rcz)). The "central" voxel of each segment.
                                                         numOfInpChannelsForPrimaryPath,
                                                         
                                                         allChannelsOfPatientInNpArray,
                                                         allSubsampledChannelsOfPatientInNpArray,
+                                                        intensitiesOfZeroOfSubsampledChannels, # From getIntensitiesOfZeroOfChannels(), once per case. None if no subsampled pathways.
                                                         gtLabelsImage,
                                                         
                                                         # Intensity Augmentation
-                                                        doIntAugm_shiftMuStd_multiMuStd
+                                                        doIntAugm_shiftMuStd_multiMuStd,
+                                                        
+                                                        dtypeOfIntensities="float32", # Dtype of the returned segments.
+                                                        extractGtLabels=True, # False for the unlabeled (target domain) cases. Then None is returned for the labels.
+                                                        subsampledPyramid=None, # SubsampledPyramid of the subsampled channels of the case. If given, subsampled pathways read from it.
+                                                        samplerRng=None, # SamplerRNG for the intensity augmentation. None draws from the global random state.
+                                                        affineTransform=None, # (3,3) matrix of the case, from get_random_affine_transformation_of_case(). None for no affine augmentation.
+                                                        affineAugmentationPrms=None # AugmenterAffineParams. Interpolation orders and boundary mode, if affineTransform is given.
                                                         ) :
-    channelsForThisImagePartPerPathway = []
-    
-    # Intensity augmentation
+    # Returns [ channelsOfSegmentsPerPathway, gtLabelsOfCentralPartOfSegments ]
+    # > channelsOfSegmentsPerPathway: list with an array (N, channels, r, c, z) per pathway that requires input.
+    # > gtLabelsOfCentralPartOfSegments: array (N, r', c', z'), of the central part of each segment that is classified.
+    # Same segments as extracting them one by one. The boundaries of all segments are computed as arrays, then each segment is copied with basic...
+    # ... slicing into one preallocated array per pathway.
+    coordsOfCentralVoxelsOfImParts = np.asarray(coordsOfCentralVoxelsOfImParts, dtype="int64").reshape(-1, 3)
+    numberOfSegments = coordsOfCentralVoxelsOfImParts.shape[0]
+    channelsOfSegmentsPerPathway = []
+    samplerRng = get_sampler_rng(samplerRng)
+    
+    # Intensity augmentation. A different shift/scale per segment and channel, as when done one segment at a time.
     if train_or_val == "train" and doIntAugm_shiftMuStd_multiMuStd[0] == True:
         
         #Get parameters by how much to renormalize-augment mean and std.
         muOfGaussToAdd = doIntAugm_shiftMuStd_multiMuStd[1][0]
         stdOfGaussToAdd = doIntAugm_shiftMuStd_multiMuStd[1][1]
         if stdOfGaussToAdd != 0 : #np.random.normal does not work for an std==0.
-            howMuchToAddForEachChannel = np.random.normal(muOfGaussToAdd, stdOfGaussToAdd, [numOfInpChannelsForPrimaryPath, 1,1,1])
+            howMuchToAddForEachChannel = samplerRng.normal(muOfGaussToAdd, stdOfGaussToAdd, [numberOfSegments, numOfInpChannelsForPrimaryPath, 1,1,1]).astype("float32")
         else :
-            howMuchToAddForEachChannel = np.ones([numOfInpChannelsForPrimaryPath, 1,1,1], dtype="float32")*muOfGaussToAdd
+            howMuchToAddForEachChannel = np.ones([numberOfSegments, numOfInpChannelsForPrimaryPath, 1,1,1], dtype="float32")*muOfGaussToAdd
         
         muOfGaussToMultiply = doIntAugm_shiftMuStd_multiMuStd[2][0]
         stdOfGaussToMultiply = doIntAugm_shiftMuStd_multiMuStd[2][1]
         if stdOfGaussToMultiply != 0 :
-            howMuchToMultiplyForEachChannel = np.random.normal(muOfGaussToMultiply, stdOfGaussToMultiply, [numOfInpChannelsForPrimaryPath, 1,1,1])
+            howMuchToMultiplyForEachChannel = samplerRng.normal(muOfGaussToMultiply, stdOfGaussToMultiply, [numberOfSegments, numOfInpChannelsForPrimaryPath, 1,1,1]).astype("float32")
         else :
-            howMuchToMultiplyForEachChannel = np.ones([numOfInpChannelsForPrimaryPath, 1,1,1], dtype="float32") * muOfGaussToMultiply
-    
-    # Sampling
-    for pathway in cnn3d.pathways[:1] : #Hack. The rest of this loop can work for the whole .pathways...
-        # ... BUT the loop does not check what happens if boundaries are out of limits, to fill with zeros. This is done in getImagePartFromSubsampledImageForTraining().
-        #... Update it in a nice way to be done here, and then take getImagePartFromSubsampledImageForTraining() out and make loop go for every pathway.
-        
-        if pathway.pType() == pt.FC :
-            continue
-        subSamplingFactor = pathway.subsFactor()
-        pathwayInputShapeRcz = pathway.getShapeOfInput(train_or_val)[2:]
-        leftBoundaryRcz = [ coordsOfCentralVoxelOfThisImPart[0] - subSamplingFactor[0]*(pathwayInputShapeRcz[0]-1)//2,
-                            coordsOfCentralVoxelOfThisImPart[1] - subSamplingFactor[1]*(pathwayInputShapeRcz[1]-1)//2,
-                            coordsOfCentralVoxelOfThisImPart[2] - subSamplingFactor[2]*(pathwayInputShapeRcz[2]-1)//2]
-        rightBoundaryRcz = [leftBoundaryRcz[0] + subSamplingFactor[0]*pathwayInputShapeRcz[0],
-                            leftBoundaryRcz[1] + subSamplingFactor[1]*pathwayInputShapeRcz[1],
-                            leftBoundaryRcz[2] + subSamplingFactor[2]*pathwayInputShapeRcz[2]]
-        channelsForThisImagePart = allChannelsOfPatientInNpArray[:,
-                                                                leftBoundaryRcz[0] : rightBoundaryRcz[0] : subSamplingFactor[0],
-                                                                leftBoundaryRcz[1] : rightBoundaryRcz[1] : subSamplingFactor[1],
-                                                                leftBoundaryRcz[2] : rightBoundaryRcz[2] : subSamplingFactor[2]]
-        
+            howMuchToMultiplyForEachChannel = np.ones([numberOfSegments, numOfInpChannelsForPrimaryPath, 1,1,1], dtype="float32") * muOfGaussToMultiply
+    
+    leftBoundaryOfPrimarySegments = coordsOfCentralVoxelsOfImParts - extractionPlan.offsetOfPrimarySegmentFromCentre # (N, 3)
+    for geometry in extractionPlan.geometriesPerPathway :
+        if affineTransform is not None :
+            channelsOfSegments = interpolateSegmentsWithAffineTransform(allChannelsOfPatientInNpArray if geometry.pType == pt.NORM else allSubsampledChannelsOfPatientInNpArray,
+                                                                        coordsOfCentralVoxelsOfImParts,
+                                                                        extractionPlan,
+                                                                        geometry,
+                                                                        intensitiesOfZeroOfSubsampledChannels,
+                                                                        affineTransform,
+                                                                        affineAugmentationPrms)
+        elif geometry.pType == pt.NORM :
+            # Within the (padded) image, given how the centres were sampled.
+            channelsOfSegments = gatherSegmentsFromChannels(allChannelsOfPatientInNpArray, leftBoundaryOfPrimarySegments, geometry.inputShapeRcz)
+        else :
+            channelsOfSegments = gatherSegmentsFromSubsampledChannels(allSubsampledChannelsOfPatientInNpArray,
+                                                                      leftBoundaryOfPrimarySegments,
+                                                                      geometry,
+                                                                      intensitiesOfZeroOfSubsampledChannels,
+                                                                      subsampledPyramid)
         # Intensity augmentation of the segments.
         if train_or_val == "train" and doIntAugm_shiftMuStd_multiMuStd[0] == True :
-            channelsForThisImagePart = (channelsForThisImagePart + howMuchToAddForEachChannel) * howMuchToMultiplyForEachChannel
-        
-        channelsForThisImagePartPerPathway.append(channelsForThisImagePart)
-        
-    # Extract the samples for secondary pathways. This whole for can go away, if I update above code to check to slices out of limits.
-    for pathway_i in range(len(cnn3d.pathways)) : # Except Normal 1st, cause that was done already.
-        if cnn3d.pathways[pathway_i].pType() == pt.FC or cnn3d.pathways[pathway_i].pType() == pt.NORM:
-            continue
-        #this datastructure is similar to channelsForThisImagePart, but contains voxels from the subsampled image.
-        dimsOfPrimarySegment = cnn3d.pathways[pathway_i].getShapeOfInput(train_or_val)[2:]
-        slicesCoordsOfSegmForPrimaryPathway = [ [leftBoundaryRcz[0], rightBoundaryRcz[0]-1], [leftBoundaryRcz[1], rightBoundaryRcz[1]-1], [leftBoundaryRcz[2], rightBoundaryRcz[2]-1] ] #the right hand values are placeholders in this case.
-        channsForThisSubsampledPartAndPathway = getImagePartFromSubsampledImageForTraining(dimsOfPrimarySegment=dimsOfPrimarySegment,
-                                                                                        recFieldCnn=cnn3d.recFieldCnn,
-                                                                                        subsampledImageChannels=allSubsampledChannelsOfPatientInNpArray,
-                                                                                        image_part_slices_coords=slicesCoordsOfSegmForPrimaryPathway,
-                                                                                        subSamplingFactor=cnn3d.pathways[pathway_i].subsFactor(),
-                                                                                        subsampledImagePartDimensions=cnn3d.pathways[pathway_i].getShapeOfInput(train_or_val)[2:]
-                                                                                        )
-        
-        # Intensity augmentation of the segments.
-        if train_or_val == "train" and doIntAugm_shiftMuStd_multiMuStd[0] == True:
-            channsForThisSubsampledPartAndPathway = (channsForThisSubsampledPartAndPathway + howMuchToAddForEachChannel) * howMuchToMultiplyForEachChannel
-        
-        channelsForThisImagePartPerPathway.append(channsForThisSubsampledPartAndPathway)
+            channelsOfSegments = (channelsOfSegments + howMuchToAddForEachChannel) * howMuchToMultiplyForEachChannel
         
-    #get GT labels
-    gtLabelsForTheCentralClassifiedPartOfThisImagePart = "placeholder"
-    return [ channelsForThisImagePartPerPathway, gtLabelsForTheCentralClassifiedPartOfThisImagePart ]
+        channelsOfSegmentsPerPathway.append(np.asarray(channelsOfSegments, dtype=dtypeOfIntensities))
+    
+    if not extractGtLabels :
+        return [ channelsOfSegmentsPerPathway, None ]
+    if affineTransform is not None :
+        positionsOfLabelsFromCentre = [ np.arange(extractionPlan.shapeOfLabelsOfSegment[axis_i]) - extractionPlan.offsetOfLabelsFromCentre[axis_i] for axis_i in range(3) ]
+        gtLabelsOfCentralPartOfSegments = interpolate_segments(gtLabelsImage,
+                                                               get_source_coords_of_segments(coordsOfCentralVoxelsOfImParts, positionsOfLabelsFromCentre, affineTransform),
+                                                               affineAugmentationPrms['interp_order_lbls'],
+                                                               'nearest')
+        return [ channelsOfSegmentsPerPathway, np.rint(gtLabelsOfCentralPartOfSegments).astype(gtLabelsImage.dtype) ]
+    gtLabelsOfCentralPartOfSegments = gatherSegmentsFromChannels(gtLabelsImage[np.newaxis],
+                                                                 coordsOfCentralVoxelsOfImParts - extractionPlan.offsetOfLabelsFromCentre,
+                                                                 extractionPlan.shapeOfLabelsOfSegment)[:, 0]
+    
+    return [ channelsOfSegmentsPerPathway, gtLabelsOfCentralPartOfSegments ]
+
+
+def gatherSegmentsFromChannels(channels, lowOfSegments, shapeOfSegment) :
+    # channels: (channels, r, c, z). Array, or a StackOfVolumes (eg of ReflectPaddedVolumes, or of lazily read volumes).
+    # lowOfSegments: array (N, 3(rcz)). First voxel of each segment. Segments are within the volume.
+    # Returns array (N, channels, dimR, dimC, dimZ). Each segment is copied into it with basic slicing.
+    lowOfSegments = np.asarray(lowOfSegments, dtype="int64").reshape(-1, 3)
+    segments = np.empty( [lowOfSegments.shape[0], channels.shape[0]] + list(shapeOfSegment), dtype=channels.dtype )
+    copyRegionsOfChannels(channels, lowOfSegments, np.tile(np.asarray(shapeOfSegment, dtype="int64"), (lowOfSegments.shape[0], 1)), (1,1,1), segments)
+    return segments
+
+
+def copyRegionsOfChannels(channels, lowOfRegions, shapeOfRegions, stepPerAxis, outPerRegion) :
+    # outPerRegion[i][...] = channels[:, low : low + step*shape : step (per axis)], for region i of lowOfRegions/shapeOfRegions (arrays (N, 3)).
+    # Regions are within the volume. Copied with basic slicing, without stacking the channels of a StackOfVolumes first.
+    stepPerAxis = [ int(step) for step in stepPerAxis ]
+    if not isinstance(channels, np.ndarray) and isinstance(channels.getVolumes()[0], ReflectPaddedVolume) :
+        # All channels of a case are reflected and padded the same (see get_reflected_and_padded_views_of_channels()). So one plan per region...
+        # ... for all. Regions within the volume are sliced from it directly. Those reaching into the padding are copied in a few runs of voxels.
+        volumes = channels.getVolumes()
+        for (region_i, planToReadSlices) in enumerate(volumes[0].getPlansToReadRegions(lowOfRegions, shapeOfRegions, stepPerAxis)) :
+            for (channel_i, volume) in enumerate(volumes) :
+                volume.copyWithPlan(planToReadSlices, outPerRegion[region_i][channel_i])
+        return
+    highNonInclOfRegions = np.asarray(lowOfRegions) + (np.asarray(shapeOfRegions) - 1) * np.asarray(stepPerAxis) + 1
+    for (region_i, (low, highNonIncl)) in enumerate(zip(np.asarray(lowOfRegions).tolist(), highNonInclOfRegions.tolist())) :
+        slicesPerAxis = ( slice(low[0], highNonIncl[0], stepPerAxis[0]), slice(low[1], highNonIncl[1], stepPerAxis[1]), slice(low[2], highNonIncl[2], stepPerAxis[2]) )
+        if isinstance(channels, np.ndarray) :
+            outPerRegion[region_i][...] = channels[ (slice(None),) + slicesPerAxis ]
+        else :
+            for (channel_i, volume) in enumerate(channels.getVolumes()) :
+                outPerRegion[region_i][channel_i] = volume[slicesPerAxis]
+
+
+def interpolateSegmentsWithAffineTransform(channels, # Of the pathway. (channels, r, c, z) array, or a StackOfVolumes.
+                                           coordsOfCentralVoxelsOfImParts, # array (N, 3(rcz)). Sampled on the untransformed volumes.
+                                           extractionPlan,
+                                           geometry, # GeometryOfPathway of the pathway.
+                                           intensitiesOfZeroOfSubsampledChannels, # For what is out of the image, in subsampled pathways.
+                                           affineTransform,
+                                           affineAugmentationPrms) :
+    # Returns array (N, channels, r, c, z). The voxels of the segments of the pathway, each at the position the transform maps it to (about its centre).
+    # Same voxels as the gather functions would read, relative to the centres, if affineTransform was the identity. Subsampled pathways read...
+    # ... every subSamplingFactor-th voxel of the subsampled channels (as "strided" pyramids), filling what is out of the image with the "zero" intensity.
+    if geometry.pType == pt.NORM :
+        positionsFromCentrePerAxis = [ geometry.positionsPerAxis[axis_i] - extractionPlan.offsetOfPrimarySegmentFromCentre[axis_i] for axis_i in range(3) ]
+        (boundaryMode, cvals) = (affineAugmentationPrms['boundary_mode'], None)
+    else :
+        positionsFromCentrePerAxis = [ geometry.offsetOfLowFromPrimarySegment[axis_i] - extractionPlan.offsetOfPrimarySegmentFromCentre[axis_i] + \
+                                        geometry.subSamplingFactor[axis_i] * geometry.positionsPerAxis[axis_i] for axis_i in range(3) ]
+        (boundaryMode, cvals) = ('constant', intensitiesOfZeroOfSubsampledChannels)
+    return interpolate_segments(channels,
+                                get_source_coords_of_segments(coordsOfCentralVoxelsOfImParts, positionsFromCentrePerAxis, affineTransform),
+                                affineAugmentationPrms['interp_order_imgs'],
+                                boundaryMode,
+                                cvals)
+
+
+def gatherSegmentsFromSubsampledChannels(subsampledImageChannels,
+                                         leftBoundaryOfPrimarySegments, # array (N, 3(rcz)). Where each segment of the primary pathway starts.
+                                         geometry, # GeometryOfPathway of the subsampled pathway, from the ExtractionPlan.
+                                         intensitiesOfZeroOfChannels, # array (channels,). From getIntensitiesOfZeroOfChannels(), once per case.
+                                         subsampledPyramid=None # SubsampledPyramid of these channels. If given, the voxels are read from it.
+                                         ) :
+    """
+    Returns the parts of the subsampled image for the given segments of the primary pathway. Array (N, channels, r, c, z).
+    From the begining of the normal-resolution segment, it goes further to the left 1 image PATCH (depending on subsampling factor) and then forward 3 PATCHES.
+    If I have eg subsample factor=3 and 9 central-pred-voxels, I get 3 "central" voxels/patches for the subsampled-part. If I have a number of central voxels that is not an exact multiple of the subfactor, eg 10 central-voxels, I get 3+1 central voxels in the subsampled-part. When the cnn is convolving them, they will get repeated to 4(last-layer-neurons)*3(factor) = 12, and will get sliced down to 10, in order to have same dimension with the 1st pathway.
+    Voxels out of the image are filled with the intensity of the "zero" (background) of each channel.
+    """
+    subsampledImageDimensions = subsampledImageChannels[0].shape
+    numberOfSegments = leftBoundaryOfPrimarySegments.shape[0]
+    # Per axis, the part of each segment that is in the image: positions [lowToPut, highToPut) of the segment, read from lowCorrected every factor voxels.
+    lowCorrectedOfSegments = np.zeros((numberOfSegments, 3), dtype="int64")
+    lowToPutOfSegments = np.zeros((numberOfSegments, 3), dtype="int64")
+    highToPutOfSegments = np.zeros((numberOfSegments, 3), dtype="int64")
+    for axis_i in range(3) :
+        factor = geometry.subSamplingFactor[axis_i]
+        low = leftBoundaryOfPrimarySegments[:, axis_i] + geometry.offsetOfLowFromPrimarySegment[axis_i] # (N,) Can run out of image boundaries.
+        lowCorrectedOfSegments[:, axis_i] = np.maximum(low, 0)
+        highNonInclCorrected = np.minimum(low + geometry.spanNonIncl[axis_i], subsampledImageDimensions[axis_i])
+        lowToPutOfSegments[:, axis_i] = np.where(low >= 0, 0, np.abs(low)//factor) # Where the part that is in the image starts in the segment.
+        numberOfVoxelsInImage = np.maximum(-((lowCorrectedOfSegments[:, axis_i] - highNonInclCorrected) // factor), 0) # ceil((high - low) / factor)
+        highToPutOfSegments[:, axis_i] = np.minimum(lowToPutOfSegments[:, axis_i] + numberOfVoxelsInImage, geometry.inputShapeRcz[axis_i])
+    isWholeInImage = np.all(lowToPutOfSegments == 0, axis=1) & np.all(highToPutOfSegments == np.asarray(geometry.inputShapeRcz), axis=1)
+    
+    segments = np.empty( [numberOfSegments, subsampledImageChannels.shape[0]] + list(geometry.inputShapeRcz), dtype="float32" )
+    if not np.all(isWholeInImage) :
+        segments[~isWholeInImage] = intensitiesOfZeroOfChannels[np.newaxis, :, np.newaxis, np.newaxis, np.newaxis]
+    shapeOfRegions = highToPutOfSegments - lowToPutOfSegments
+    segmentsWithRegion = np.flatnonzero(np.all(shapeOfRegions > 0, axis=1))
+    outPerRegion = [ segments[segment_i, :, lowToPutOfSegments[segment_i, 0] : highToPutOfSegments[segment_i, 0],
+                                            lowToPutOfSegments[segment_i, 1] : highToPutOfSegments[segment_i, 1],
+                                            lowToPutOfSegments[segment_i, 2] : highToPutOfSegments[segment_i, 2] ] for segment_i in segmentsWithRegion ]
+    if subsampledPyramid is not None :
+        for (region_i, segment_i) in enumerate(segmentsWithRegion) :
+            outPerRegion[region_i][...] = subsampledPyramid.readSlices(geometry.subSamplingFactor,
+                                                                       tuple([ slice(int(lowCorrectedOfSegments[segment_i, axis_i]),
+                                                                                     int(lowCorrectedOfSegments[segment_i, axis_i] + (shapeOfRegions[segment_i, axis_i] - 1) * geometry.subSamplingFactor[axis_i] + 1),
+                                                                                     int(geometry.subSamplingFactor[axis_i])) for axis_i in range(3) ]))
+    else :
+        copyRegionsOfChannels(subsampledImageChannels, lowCorrectedOfSegments[segmentsWithRegion], shapeOfRegions[segmentsWithRegion], geometry.subSamplingFactor, outPerRegion)
+    return segments
+
 
 
 #################################################################################################################################
@@ -1084,7 +1458,8 @@ def getCoordsOfAllSegmentsOfAnImage(log,
                                     strideOfSegmentsPerDimInVoxels,
                                     batch_size,
                                     channelsOfImageNpArray,#chans,niiDims
-                                    roiMask
+                                    roiMask,
+                                    boundingBoxOfRoi=None # [[low, highNonIncl] per axis] of the ROI, eg from the dataset manifest. Segments outside it are skipped without reading the ROI.
                                     ) :
     log.print3("Starting to (tile) extract Segments from the images of the subject for Segmentation...")
     
@@ -1113,6 +1488,10 @@ def getCoordsOfAllSegmentsOfAnImage(log,
                 rLowBoundaryNext = rLowBoundaryNext + strideOfSegmentsPerDimInVoxels[0]
                 rAxisCentralPartPredicted = False if rFarBoundary < niiDimensions[0] else True
                 
+                if boundingBoxOfRoi is not None and ( rFarBoundary <= boundingBoxOfRoi[0][0] or rLowBoundary >= boundingBoxOfRoi[0][1] or \
+                                                      cFarBoundary <= boundingBoxOfRoi[1][0] or cLowBoundary >= boundingBoxOfRoi[1][1] or \
+                                                      zFarBoundary <= boundingBoxOfRoi[2][0] or zLowBoundary >= boundingBoxOfRoi[2][1] ) :
+                    continue
                 if isinstance(roiMask, (np.ndarray)) : #In case I pass a brain-mask, I ll use it to only predict inside it. Otherwise, whole image.
                     if not np.any(roiMask[rLowBoundary:rFarBoundary,
                                             cLowBoundary:cFarBoundary,
@@ -1138,17 +1517,18 @@ def getCoordsOfAllSegmentsOfAnImage(log,
 
 
 
-# I must merge this with function: extractDataOfASegmentFromImagesUsingSampledSliceCoords() that is used for Training/Validation! Should be easy!
+# I must merge this with function: extractDataOfSegmentsFromImagesUsingSampledCentres() that is used for Training/Validation! Should be easy!
 # This is used in testing only.
-def extractDataOfSegmentsUsingSampledSliceCoords(cnn3d,
+def extractDataOfSegmentsUsingSampledSliceCoords(extractionPlan, # ExtractionPlan of the model for "test".
                                                 sliceCoordsOfSegmentsToExtract,
                                                 channelsOfImageNpArray,#chans,niiDims
                                                 channelsOfSubsampledImageNpArray, #chans,niiDims
-                                                recFieldCnn
+                                                intensitiesOfZeroOfSubsampledChannels, # From getIntensitiesOfZeroOfChannels(), once per case. None if no subsampled pathways.
+                                                subsampledPyramid=None # SubsampledPyramid of the subsampled channels of the case. If given, subsampled pathways read from it.
                                                 ) :
     numberOfSegmentsToExtract = len(sliceCoordsOfSegmentsToExtract)
-    channsForSegmentsPerPathToReturn = [ [] for i in range(cnn3d.getNumPathwaysThatRequireInput()) ] # [pathway, image parts, channels, r, c, z]
-    dimsOfPrimarySegment = cnn3d.pathways[0].getShapeOfInput("test")[2:] # RCZ dims of input to primary pathway (NORMAL). Which should be the first one in .pathways.
+    channsForSegmentsPerPathToReturn = [ [] for i in range(extractionPlan.getNumberOfPathways()) ] # [pathway, image parts, channels, r, c, z]
+    leftBoundaryOfPrimarySegments = np.asarray( [ [ sliceCoordsOfSegmentsToExtract[segment_i][axis_i][0] for axis_i in range(3) ] for segment_i in range(numberOfSegmentsToExtract) ], dtype="int64" ).reshape(-1, 3)
     
     for segment_i in range(numberOfSegmentsToExtract) :
         rLowBoundary = sliceCoordsOfSegmentsToExtract[segment_i][0][0]; rFarBoundary = sliceCoordsOfSegmentsToExtract[segment_i][0][1]
@@ -1162,19 +1542,13 @@ def extractDataOfSegmentsUsingSampledSliceCoords(cnn3d,
                                                                 ]
         channsForSegmentsPerPathToReturn[0].append(channsForPrimaryPathForThisSegm)
         
-        #Subsampled pathways
-        for pathway_i in range(len(cnn3d.pathways)) : # Except Normal 1st, cause that was done already.
-            if cnn3d.pathways[pathway_i].pType() == pt.FC or cnn3d.pathways[pathway_i].pType() == pt.NORM:
-                continue
-            slicesCoordsOfSegmForPrimaryPathway = [ [rLowBoundary, rFarBoundary-1], [cLowBoundary, cFarBoundary-1], [zLowBoundary, zFarBoundary-1] ] #the right hand values are placeholders in this case.
-            channsForThisSubsPathForThisSegm = getImagePartFromSubsampledImageForTraining(  dimsOfPrimarySegment=dimsOfPrimarySegment,
-                                                                                            recFieldCnn=recFieldCnn,
-                                                                                            subsampledImageChannels=channelsOfSubsampledImageNpArray,
-                                                                                            image_part_slices_coords=slicesCoordsOfSegmForPrimaryPathway,
-                                                                                            subSamplingFactor=cnn3d.pathways[pathway_i].subsFactor(),
-                                                                                            subsampledImagePartDimensions=cnn3d.pathways[pathway_i].getShapeOfInput("test")[2:]
-                                                                                            )
-            channsForSegmentsPerPathToReturn[pathway_i].append(channsForThisSubsPathForThisSegm)
+    #Subsampled pathways. All the segments of the batch at once.
+    for pathway_i in range(1, extractionPlan.getNumberOfPathways()) : # Except Normal 1st, cause that was done already.
+        channsForSegmentsPerPathToReturn[pathway_i] = gatherSegmentsFromSubsampledChannels( channelsOfSubsampledImageNpArray,
+                                                                                            leftBoundaryOfPrimarySegments,
+                                                                                            extractionPlan.geometriesPerPathway[pathway_i],
+                                                                                            intensitiesOfZeroOfSubsampledChannels,
+                                                                                            subsampledPyramid )
             
     return [channsForSegmentsPerPathToReturn]
 
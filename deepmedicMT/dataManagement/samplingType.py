@@ -8,6 +8,9 @@
 from __future__ import absolute_import, print_function, division
 import numpy as np
 
+from deepmedicMT.dataManagement.manifest import CAT_FOREGROUND, CAT_ROI_MINUS_FOREGROUND, get_category_of_class, make_map_from_indices
+from deepmedicMT.dataManagement.centreSampler import makeCentreSamplerFromIndices, makeCentreSamplerFromWeightMap
+
 class SamplingType(object) :
     def __init__(self, log, samplingType, numberOfClassesInclBackgr):
         self.log = log
@@ -88,12 +91,12 @@ class SamplingType(object) :
             elif not providedGtLabelsBool:
                 self.log.print3("ERROR: For SamplingType=[" + self.stringOfSamplingType + "], if weighted-maps are not provided, at least Ground Truth labels should be given to extract foreground! Exiting!"); exit(1)
             elif providedRoiMaskBool : # and providedGtLabelsBool
-                maskForForegroundSampling = (gtLabelsImage>0).astype(int)
+                maskForForegroundSampling = (gtLabelsImage>0).astype("uint8")
                 maskForBackgroundSampling_roiMinusGtLabels = (roiMask>0) * (maskForForegroundSampling==0)
                 finalWeightMapsToSampleFromPerCategoryForSubject = [ maskForForegroundSampling, maskForBackgroundSampling_roiMinusGtLabels ] #Foreground / Background (in sequence)
             else : # no weightmaps, gt provided and roi is not provided.
-                maskForForegroundSampling = (gtLabelsImage>0).astype(int)
-                maskForBackgroundSampling_roiMinusGtLabels = np.ones(dimensionsOfImageChannel, dtype="int16") * (maskForForegroundSampling==0)
+                maskForForegroundSampling = (gtLabelsImage>0).astype("uint8")
+                maskForBackgroundSampling_roiMinusGtLabels = np.ones(dimensionsOfImageChannel, dtype="uint8") * (maskForForegroundSampling==0)
                 finalWeightMapsToSampleFromPerCategoryForSubject = [ maskForForegroundSampling, maskForBackgroundSampling_roiMinusGtLabels ] #Foreground / Background (in sequence)
         elif self.samplingType == 1 : # uniform
             if providedWeightMapsToSampleForEachCategory :
@@ -104,7 +107,7 @@ class SamplingType(object) :
             elif providedRoiMaskBool :
                 finalWeightMapsToSampleFromPerCategoryForSubject = [ roiMask ] #Be careful to not change either of the two arrays later or there'll be a problem.
             else :
-                finalWeightMapsToSampleFromPerCategoryForSubject = [ np.ones(dimensionsOfImageChannel, dtype="int16") ]
+                finalWeightMapsToSampleFromPerCategoryForSubject = [ np.ones(dimensionsOfImageChannel, dtype="uint8") ]
         elif self.samplingType == 2 : # full image. SAME AS UNIFORM?
             if providedWeightMapsToSampleForEachCategory :
                 numOfProvidedWeightMaps = len(arrayWithWeightMapsWhereToSampleForEachCategory)
@@ -114,7 +117,7 @@ class SamplingType(object) :
             elif providedRoiMaskBool :
                 finalWeightMapsToSampleFromPerCategoryForSubject = [ roiMask ] #Be careful to not change either of the two arrays later or there'll be a problem.
             else :
-                finalWeightMapsToSampleFromPerCategoryForSubject = [ np.ones(dimensionsOfImageChannel, dtype="int16") ]
+                finalWeightMapsToSampleFromPerCategoryForSubject = [ np.ones(dimensionsOfImageChannel, dtype="uint8") ]
         elif self.samplingType == 3 : # Targetted per class.
             if providedWeightMapsToSampleForEachCategory :
                 numOfProvidedWeightMaps = len(arrayWithWeightMapsWhereToSampleForEachCategory)
@@ -124,7 +127,7 @@ class SamplingType(object) :
             elif providedGtLabelsBool :
                 finalWeightMapsToSampleFromPerCategoryForSubject = []
                 for cat_i in range( self.getNumberOfCategoriesToSample() ) : # Should be the same number as the number of actual classes, including background.
-                    finalWeightMapsToSampleFromPerCategoryForSubject.append( (gtLabelsImage == cat_i).astype(int) )
+                    finalWeightMapsToSampleFromPerCategoryForSubject.append( (gtLabelsImage == cat_i).astype("uint8") )
             else :
                 self.log.print3("ERROR: For SamplingType=TargettedPerClass(3), either weightMaps for each class or GT labels should be given! Exiting!"); exit(1)
         else :
@@ -132,3 +135,43 @@ class SamplingType(object) :
             
         return finalWeightMapsToSampleFromPerCategoryForSubject
     
+    
+    def canGiveSamplingMapsFromManifest(self, providedWeightMapsToSampleForEachCategory) :
+        # Only the categories made from the GT (fore/background and per-class) are in a manifest. Uniform/whole-image use the ROI as loaded.
+        return self.samplingType in [0,3] and not providedWeightMapsToSampleForEachCategory
+    
+    def givingCentreSamplersForEachCategoryFromManifest( self,
+                                                        manifest,
+                                                        recordOfCase, # of the dataset manifest. See manifest.py
+                                                        providedRoiMaskBool,
+                                                        reflectFlags, # As the loaded volumes were reflected.
+                                                        tupleOfPaddingPerAxesLeftRight, # As the loaded volumes were padded.
+                                                        dimsOfSegmentRcz
+                                                        ) :
+        # Same candidate centres as the maps of logicDecidingAndGivingFinalSamplingMapsForEachCategory() give when no weight maps are provided, ...
+        # ... but made from the indices of the voxels of each category in the record, without scanning the GT.
+        # Categories that are the complement of the foreground (background without ROI, class 0) cover most of the volume, so their map is made.
+        shapeOfVolumeInRecord = recordOfCase["shape"]
+        indicesOfForeground = manifest.get_indices(recordOfCase, CAT_FOREGROUND)
+        def fromIndices(indices) :
+            return makeCentreSamplerFromIndices(indices, shapeOfVolumeInRecord, reflectFlags, tupleOfPaddingPerAxesLeftRight, dimsOfSegmentRcz)
+        def fromComplementOfIndices(indices) :
+            mapOfComplement = make_map_from_indices(indices, shapeOfVolumeInRecord, reflectFlags, tupleOfPaddingPerAxesLeftRight, complement=True)
+            return makeCentreSamplerFromWeightMap(mapOfComplement, dimsOfSegmentRcz)
+        
+        if self.samplingType == 0 : # fore/background
+            centreSamplerForeground = fromIndices(indicesOfForeground)
+            if providedRoiMaskBool :
+                centreSamplerBackground = fromIndices(manifest.get_indices(recordOfCase, CAT_ROI_MINUS_FOREGROUND))
+            else :
+                centreSamplerBackground = fromComplementOfIndices(indicesOfForeground)
+            centreSamplersPerCategory = [ centreSamplerForeground, centreSamplerBackground ] #Foreground / Background (in sequence)
+        elif self.samplingType == 3 : # Targetted per class.
+            centreSamplersPerCategory = [ fromComplementOfIndices(indicesOfForeground) ] # class 0
+            for cat_i in range( 1, self.getNumberOfCategoriesToSample() ) :
+                centreSamplersPerCategory.append( fromIndices(manifest.get_indices(recordOfCase, get_category_of_class(cat_i))) )
+        else :
+            self.log.print3("ERROR: Centre samplers can be made from the manifest only for sampling types [0,3], but was [" + str(self.samplingType) + "]. Exiting!"); exit(1)
+            
+        return centreSamplersPerCategory
+    
@@ -0,0 +1,158 @@
+# Copyright (c) 2016, Konstantinos Kamnitsas
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the BSD license. See the accompanying LICENSE file
+# or read the terms at https://opensource.org/licenses/BSD-3-Clause.
+
+from __future__ import absolute_import, print_function, division
+
+import time
+import random
+import traceback
+import multiprocessing
+import numpy as np
+
+try :
+    import queue # Python 3
+except ImportError :
+    import Queue as queue # Python 2
+
+from deepmedicMT.dataManagement.sampling import getSampledDataAndLabelsForSubepoch, getTDSampledDataAndLabelsForSubepoch
+from deepmedicMT.dataManagement.sampling import make_arrays_in_shared_memory, map_arrays_in_shared_memory, remove_files_of_shared_memory, hand_over_files_of_shared_memory, remove_files_of_shared_memory_of_process
+from deepmedicMT.dataManagement.samplerRng import get_sampler_rng
+
+
+class StreamOfBatches(object):
+    # Producer/consumer alternative to sampling a whole subepoch in a parallel job and then training on it.
+    # A pool of processes run the labeled and unlabeled samplers in a loop, for as long as training runs. Each round of sampling is cut into...
+    # ... training batches (one half labeled, one half unlabeled, as trained by the Mean Teacher), which are put in a bounded queue.
+    # Each batch is written in shared memory. Only the paths, shapes and dtypes of its arrays go through the queue. The training process maps...
+    # ... them and removes the files. So batches are not pickled and sent through the pipe of the queue.
+    # Producers block when the queue is full. So at most depthOfQueue batches, plus one round per producer, are in memory.
+    # The training loop pops batches as they are ready. Subepochs are then only points of reporting and of the LR schedule, not data barriers.
+    # The tuples of arguments are the ones given to the parallel jobs of the samplers. The SamplerRNG of each round is appended to them.
+    # samplerRng: Each producer samples from its own stream, spawned from it. What each producer samples is reproducible, the order of their batches in the queue is not.
+
+    SECS_TO_WAIT_PER_TRY = 5 # For checking, while blocked, whether producers are still alive / asked to stop.
+
+    def __init__(self, log, numberOfProducers, depthOfQueue, segmentsPerHalfBatch, tupleWithParametersForTraining, TDtupleWithParametersForTraining, samplerRng=None) :
+        self._log = log
+        self._numberOfProducers = numberOfProducers
+        self._depthOfQueue = depthOfQueue
+        self._segmentsPerHalfBatch = segmentsPerHalfBatch
+        self._tupleWithParametersForTraining = tupleWithParametersForTraining
+        self._TDtupleWithParametersForTraining = TDtupleWithParametersForTraining
+        self._samplerRng = get_sampler_rng(samplerRng)
+        self._queueOfBatches = multiprocessing.Queue(maxsize=depthOfQueue)
+        self._stopEvent = multiprocessing.Event()
+        self._producers = []
+        self._timeWaitedForBatches = 0.
+
+    def start(self) :
+        self._log.print3("STREAMING: Starting [" + str(self._numberOfProducers) + "] processes that sample batches into a queue of depth [" + str(self._depthOfQueue) + "].")
+        for producer_i in range(self._numberOfProducers) :
+            producer = multiprocessing.Process( target=produceBatchesForever,
+                                                args=(producer_i, self._queueOfBatches, self._stopEvent, self._segmentsPerHalfBatch,
+                                                      self._tupleWithParametersForTraining, self._TDtupleWithParametersForTraining, self._samplerRng.spawn(producer_i)) )
+            producer.daemon = False # Producers may start a pool of sampling processes (num_parallel_proc), which daemonic processes can not. Stopped by stop(), also at exit.
+            producer.start()
+            self._producers.append(producer)
+
+    def get_batch(self) :
+        # Returns [channelsOfBatchPerPathway, TDchannelsOfBatchPerPathway, labelsOfBatch] of the labeled and unlabeled halves of a training batch.
+        # Arrays mapped from shared memory, whose files are already removed. Their memory is freed once they are deleted.
+        start_wait_time = time.time()
+        while True :
+            try :
+                batch = self._queueOfBatches.get(timeout=self.SECS_TO_WAIT_PER_TRY)
+                break
+            except queue.Empty :
+                if not any([ producer.is_alive() for producer in self._producers ]) :
+                    self._log.print3("ERROR: All processes of the streaming sampler have exited, and no batches are left in the queue. Exiting."); exit(1)
+        self._timeWaitedForBatches += time.time() - start_wait_time
+        if isinstance(batch, str) : # A producer failed. It sends the traceback.
+            self._log.print3("ERROR: A process of the streaming sampler failed with:\n" + batch); exit(1)
+        arraysOfBatch = get_batch_from_shared_memory(batch)
+        numberOfPathways = (len(arraysOfBatch) - 1) // 2
+        return [ arraysOfBatch[:numberOfPathways], arraysOfBatch[numberOfPathways:-1], arraysOfBatch[-1] ]
+
+    def get_and_reset_time_waited_for_batches(self) :
+        # Time the training loop was blocked, waiting for batches. Near 0 if the producers keep up with training.
+        timeWaited = self._timeWaitedForBatches
+        self._timeWaitedForBatches = 0.
+        return timeWaited
+
+    def stop(self) :
+        if len(self._producers) == 0 :
+            return
+        self._stopEvent.set()
+        # Producers may be blocked on a full queue. Drain it, so that they see the event. The files of the batches drained are removed.
+        for producer in self._producers :
+            while producer.is_alive() :
+                self._remove_batches_in_queue(timeout=0.1)
+                producer.join(timeout=0.1)
+        self._remove_batches_in_queue(timeout=0.1) # Put before the producers exited.
+        self._producers = []
+        self._log.print3("STREAMING: Stopped the processes of the streaming sampler.")
+        
+    def _remove_batches_in_queue(self, timeout) :
+        while True :
+            try :
+                batch = self._queueOfBatches.get(timeout=timeout)
+            except queue.Empty :
+                return
+            if not isinstance(batch, str) :
+                remove_files_of_shared_memory(batch[0])
+
+
+def produceBatchesForever(producer_i, queueOfBatches, stopEvent, segmentsPerHalfBatch, tupleWithParametersForTraining, TDtupleWithParametersForTraining, samplerRngOfProducer) :
+    # Runs in each process of the StreamOfBatches, until stopEvent is set.
+    # Forked processes start with the random state of the parent. Reseed, otherwise all producers sample the same segments (if samplerRng is not seeded).
+    np.random.seed()
+    random.seed()
+    try :
+        while not stopEvent.is_set() :
+            [channsOfSegmentsPerPathway, labelsOfSegments] = getSampledDataAndLabelsForSubepoch( *(tupleWithParametersForTraining + (samplerRngOfProducer.spawn_next(0),)) )
+            [TDchannsOfSegmentsPerPathway, _] = getTDSampledDataAndLabelsForSubepoch( *(TDtupleWithParametersForTraining + (samplerRngOfProducer.spawn_next(1),)) )
+            numberOfBatches = min( len(channsOfSegmentsPerPathway[0]), len(TDchannsOfSegmentsPerPathway[0]) ) // segmentsPerHalfBatch
+            for batch_i in range(numberOfBatches) :
+                segmentsOfBatch = slice(batch_i * segmentsPerHalfBatch, (batch_i + 1) * segmentsPerHalfBatch)
+                batch = put_batch_in_shared_memory( [ channels[segmentsOfBatch] for channels in channsOfSegmentsPerPathway ] +\
+                                                    [ channels[segmentsOfBatch] for channels in TDchannsOfSegmentsPerPathway ] +\
+                                                    [ labelsOfSegments[segmentsOfBatch] ] )
+                if not putUnlessStopped(queueOfBatches, stopEvent, batch) :
+                    remove_files_of_shared_memory(batch[0])
+                    return
+                hand_over_files_of_shared_memory(batch[0])
+    except Exception :
+        putUnlessStopped(queueOfBatches, stopEvent, "Process #" + str(producer_i) + ":\n" + traceback.format_exc())
+    finally :
+        remove_files_of_shared_memory_of_process() # Of its subepoch buffers, if it failed while sampling.
+
+
+def put_batch_in_shared_memory(arraysOfBatch) :
+    # Copies the arrays of a batch in shared memory. Returns [filepaths, shapesAndDtypes], sent through the queue instead of the arrays.
+    shapesAndDtypes = [ [ list(array.shape), array.dtype.str ] for array in arraysOfBatch ]
+    [arraysInSharedMemory, filepaths] = make_arrays_in_shared_memory(shapesAndDtypes, "dmBatch")
+    for (arrayInSharedMemory, array) in zip(arraysInSharedMemory, arraysOfBatch) :
+        arrayInSharedMemory[...] = array
+    return [filepaths, shapesAndDtypes]
+
+def get_batch_from_shared_memory(batch) :
+    # In the training process. Maps the arrays of the batch and removes their files, as no other process maps them.
+    [filepaths, shapesAndDtypes] = batch
+    arraysOfBatch = map_arrays_in_shared_memory(filepaths, shapesAndDtypes)
+    remove_files_of_shared_memory(filepaths)
+    return arraysOfBatch
+
+def putUnlessStopped(queueOfBatches, stopEvent, item) :
+    # Blocks while the queue is full. Returns False if asked to stop meanwhile.
+    while not stopEvent.is_set() :
+        try :
+            queueOfBatches.put(item, timeout=StreamOfBatches.SECS_TO_WAIT_PER_TRY)
+            return True
+        except queue.Full :
+            pass
+    return False
+
@@ -0,0 +1,120 @@
+# Copyright (c) 2016, Konstantinos Kamnitsas
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the BSD license. See the accompanying LICENSE file
+# or read the terms at https://opensource.org/licenses/BSD-3-Clause.
+
+from __future__ import absolute_import, print_function, division
+
+import os
+import threading
+from collections import OrderedDict
+
+
+class SubjectCache(object):
+    # In-RAM cache of loaded volumes, with a memory budget and Least-Recently-Used eviction. Keyed by filepath.
+    # Volumes are kept as loaded from disk, before reflection and padding, which are applied on the returned arrays by the caller.
+    # Returned arrays are read-only, since the same array is given to every later subepoch that samples the case.
+    # It lives in the process that samples, and survives across subepochs. See get_subject_cache_of_process().
+
+    def __init__(self, maxBytes):
+        self._maxBytes = maxBytes
+        self._volumes = OrderedDict() # filepath -> volume. Most recently used last.
+        self._bytesResident = 0
+        self._lock = threading.Lock() # Files of a case may be loaded by multiple threads.
+        self.reset_stats()
+
+    def reset_stats(self):
+        self._numHits = 0
+        self._numMisses = 0
+        self._numEvictions = 0
+
+    def get(self, filepath):
+        # Returns the volume, or None if not in the cache.
+        with self._lock :
+            volume = self._volumes.pop(filepath, None)
+            if volume is None :
+                self._numMisses += 1
+                return None
+            self._volumes[filepath] = volume # Move to the end, as most recently used.
+            self._numHits += 1
+            return volume
+
+    def put(self, filepath, volume):
+        if volume.nbytes > self._maxBytes : # Would evict everything and still not fit.
+            return volume
+        if hasattr(volume, "flags") and volume.flags.writeable : # Other objects cached per case (eg centre samplers) only need .nbytes.
+            volume.flags.writeable = False
+        with self._lock :
+            if filepath in self._volumes :
+                self._bytesResident -= self._volumes.pop(filepath).nbytes
+            while self._bytesResident + volume.nbytes > self._maxBytes and len(self._volumes) > 0 :
+                (_, volumeEvicted) = self._volumes.popitem(last=False)
+                self._bytesResident -= volumeEvicted.nbytes
+                self._numEvictions += 1
+            self._volumes[filepath] = volume
+            self._bytesResident += volume.nbytes
+        return volume
+
+    def get_and_reset_stats(self):
+        # Returns [pid, hits, misses, evictions, volumes resident, bytes resident, max bytes]. The first three since the last reset. For StatsOfSubjectCaches.
+        with self._lock :
+            stats = [os.getpid(), self._numHits, self._numMisses, self._numEvictions, len(self._volumes), self._bytesResident, self._maxBytes]
+        self.reset_stats()
+        return stats
+
+
+class StatsOfSubjectCaches(object):
+    # Stats of the caches of the processes that ran the sampling jobs of a subepoch, from what each job returned. The caches of the...
+    # ... sampling pool are not visible to the process that collects the jobs, so the stats travel with the results.
+    # Hits, misses and evictions are summed over jobs. What is resident is the latest of each process, summed over processes.
+
+    def __init__(self):
+        self.reset_stats()
+
+    def reset_stats(self):
+        self._numHits = 0
+        self._numMisses = 0
+        self._numEvictions = 0
+        self._residentPerProcess = {} # pid -> [time of the job, volumes resident, bytes resident, max bytes]
+
+    def add(self, statsOfJob, timeJobEnded):
+        # statsOfJob: As returned by SubjectCache.get_and_reset_stats(). None if caching is disabled.
+        if statsOfJob is None :
+            return
+        [pid, numHits, numMisses, numEvictions, numVolumesResident, bytesResident, maxBytes] = statsOfJob
+        self._numHits += numHits
+        self._numMisses += numMisses
+        self._numEvictions += numEvictions
+        if pid not in self._residentPerProcess or self._residentPerProcess[pid][0] <= timeJobEnded :
+            self._residentPerProcess[pid] = [timeJobEnded, numVolumesResident, bytesResident, maxBytes]
+
+    def report_and_reset_stats(self, log, nameOfSampler):
+        if len(self._residentPerProcess) == 0 : # Caching disabled.
+            return
+        numRequests = self._numHits + self._numMisses
+        hitRate = self._numHits * 100.0 / numRequests if numRequests > 0 else 0.
+        numVolumesResident = sum([ resident[1] for resident in self._residentPerProcess.values() ])
+        bytesResident = sum([ resident[2] for resident in self._residentPerProcess.values() ])
+        maxBytes = sum([ resident[3] for resident in self._residentPerProcess.values() ])
+        log.print3("SUBJECT CACHE [" + nameOfSampler + "]: Hit rate: " + str(self._numHits) + "/" + str(numRequests) + " (" + "{0:.1f}".format(hitRate) + "%)" +\
+                   ", Evictions: " + str(self._numEvictions) + ", Volumes resident: " + str(numVolumesResident) +\
+                   ", Bytes resident: " + "{0:.2f}".format(bytesResident / 1024.**3) + "/" + "{0:.2f}".format(maxBytes / 1024.**3) + " GB" +\
+                   ("" if len(self._residentPerProcess) == 1 else ", in the caches of [" + str(len(self._residentPerProcess)) + "] processes"))
+        self.reset_stats()
+
+
+# One cache per process. The samplers run their jobs in the processes of the sampling pool of the training process, or in the calling process.
+# The cache can not be pickled and passed along with the sampling job's arguments, so each process keeps its own here, across jobs.
+_subjectCacheOfProcess = None
+
+def get_subject_cache_of_process(subjectCacheSizeGB):
+    # Returns the cache of this process, or None if caching is disabled (size <= 0).
+    global _subjectCacheOfProcess
+    if subjectCacheSizeGB is None or subjectCacheSizeGB <= 0 :
+        return None
+    maxBytes = int(subjectCacheSizeGB * 1024**3)
+    if _subjectCacheOfProcess is None or _subjectCacheOfProcess._maxBytes != maxBytes :
+        _subjectCacheOfProcess = SubjectCache(maxBytes)
+    return _subjectCacheOfProcess
@@ -0,0 +1,137 @@
+# Copyright (c) 2016, Konstantinos Kamnitsas
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the BSD license. See the accompanying LICENSE file
+# or read the terms at https://opensource.org/licenses/BSD-3-Clause.
+
+from __future__ import absolute_import, print_function, division
+
+import os
+import hashlib
+import numpy as np
+
+try :
+    from multiprocessing import shared_memory, resource_tracker # Python >= 3.8
+except ImportError :
+    shared_memory = None; resource_tracker = None
+
+from deepmedicMT.image.io import loadVolume
+
+
+class SubjectStore(object):
+    # Keeps the decoded volumes (channels, GT, ROI masks, weight maps) of subjects in POSIX shared memory.
+    # Each file is loaded only once, by whichever process first asks for it, and is then given as a read-only numpy view
+    # to every process that asks for it again (labeled and unlabeled samplers, the parallel sampling jobs, etc).
+    # Volumes are stored as loaded from disk. Reflection and padding are applied on the returned views by the caller.
+    # The instance is pickled and sent to the sampling jobs. Only the naming prefix travels, attached blocks are per process.
+
+    # Each block: [ready-flag, 1 byte][dtype-and-shape as ascii, padded][data]. The flag is set last, when the data have been written.
+    HEADER_BYTES = 128
+
+    def __init__(self, decodedVolumesCacheFolder=None, prefixOfNames=None):
+        if shared_memory is None :
+            raise ImportError("ERROR: SubjectStore requires multiprocessing.shared_memory (Python 3.8 or later).")
+        self._decodedVolumesCacheFolder = decodedVolumesCacheFolder
+        # Names are made unique per training process, so that two sessions on the same machine do not see each other's blocks.
+        self._prefixOfNames = prefixOfNames if prefixOfNames is not None else "dmSS" + str(os.getpid()) + "_"
+        self._attachedBlocks = {} # name -> (SharedMemory, read-only view). Per process.
+
+    def __getstate__(self):
+        # The attached blocks are not picklable and are per process. The receiving process attaches again by name.
+        return {"_decodedVolumesCacheFolder": self._decodedVolumesCacheFolder, "_prefixOfNames": self._prefixOfNames}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._attachedBlocks = {}
+
+    def _get_name_of_block(self, filepath):
+        return self._prefixOfNames + hashlib.sha1(os.path.abspath(filepath).encode("utf-8")).hexdigest()[:20]
+
+    def _make_view_of_block(self, block):
+        header = bytes(block.buf[1:self.HEADER_BYTES]).decode("ascii").rstrip("\0 ")
+        dtypeStr, shapeStr = header.rsplit("|", 1) # The dtype may contain "|" too, eg "|u1".
+        shape = tuple([int(dim) for dim in shapeStr.split(",")]) if shapeStr != "" else ()
+        view = np.ndarray(shape, dtype=np.dtype(dtypeStr), buffer=block.buf, offset=self.HEADER_BYTES)
+        view.flags.writeable = False
+        return view
+
+    def _untrack(self, block):
+        # Otherwise the resource tracker of each (sampling) process unlinks the block when that process exits.
+        # Blocks are unlinked explicitly by the owner of the store, via unlink_all().
+        try :
+            resource_tracker.unregister(block._name, "shared_memory")
+        except Exception :
+            pass
+
+    def get_volume(self, filepath):
+        # Returns a read-only 3D array of the volume at filepath.
+        nameOfBlock = self._get_name_of_block(filepath)
+        if nameOfBlock in self._attachedBlocks :
+            return self._attachedBlocks[nameOfBlock][1]
+
+        try : # Already loaded by some process?
+            block = shared_memory.SharedMemory(name=nameOfBlock, create=False)
+            self._untrack(block)
+            if block.buf[0] == 1 :
+                view = self._make_view_of_block(block)
+                self._attachedBlocks[nameOfBlock] = (block, view)
+                return view
+            # Another process is still writing it. Dont wait, load privately this time.
+            block.close()
+            return loadVolume(filepath, self._decodedVolumesCacheFolder)
+        except FileNotFoundError :
+            pass
+
+        img = np.ascontiguousarray(loadVolume(filepath, self._decodedVolumesCacheFolder))
+        header = (img.dtype.str + "|" + ",".join([str(dim) for dim in img.shape])).encode("ascii")
+        assert len(header) < self.HEADER_BYTES
+        try :
+            block = shared_memory.SharedMemory(name=nameOfBlock, create=True, size=self.HEADER_BYTES + max(img.nbytes, 1))
+        except FileExistsError : # Created by another process in the meantime. Use the private copy this time.
+            return img
+        self._untrack(block)
+        block.buf[1:1+len(header)] = header
+        view = np.ndarray(img.shape, dtype=img.dtype, buffer=block.buf, offset=self.HEADER_BYTES)
+        view[...] = img
+        view.flags.writeable = False
+        block.buf[0] = 1 # Ready.
+        self._attachedBlocks[nameOfBlock] = (block, view)
+        return view
+
+    def close(self):
+        # Detach this process from the blocks. Views returned by get_volume() must not be used afterwards.
+        for nameOfBlock in list(self._attachedBlocks.keys()) :
+            (block, view) = self._attachedBlocks.pop(nameOfBlock)
+            del view
+            try :
+                block.close()
+            except BufferError : # A view is still referenced somewhere. The mapping goes away when it is collected.
+                pass
+
+    def unlink_all(self, listOfFilepaths):
+        # Called by the owner of the store (the training process) at the end, to free the shared memory of all volumes.
+        self.close()
+        for filepath in listOfFilepaths :
+            if filepath in ["-", None] :
+                continue
+            try :
+                block = shared_memory.SharedMemory(name=self._get_name_of_block(filepath), create=False)
+            except FileNotFoundError :
+                continue
+            block.close() # Not untracked: Attaching registered the block with the resource tracker, unlink() unregisters it.
+            try :
+                block.unlink()
+            except FileNotFoundError :
+                pass
+
+
+def get_all_filepaths_of_cases(*listsOfFilepaths):
+    # Flattens nested lists of filepaths (eg [[case1-ch1, case1-ch2], ...]) into one list, to unlink everything at the end.
+    allFilepaths = []
+    for listOfFilepaths in listsOfFilepaths :
+        if isinstance(listOfFilepaths, str) :
+            allFilepaths.append(listOfFilepaths)
+        elif isinstance(listOfFilepaths, (list, tuple)) :
+            allFilepaths += get_all_filepaths_of_cases(*listOfFilepaths)
+    return allFilepaths
@@ -0,0 +1,79 @@
+# Copyright (c) 2016, Konstantinos Kamnitsas
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the BSD license. See the accompanying LICENSE file
+# or read the terms at https://opensource.org/licenses/BSD-3-Clause.
+
+from __future__ import absolute_import, print_function, division
+
+import math
+import numpy as np
+
+from deepmedicMT.image.io import getShapeOfVolume
+from deepmedicMT.dataManagement.samplerRng import get_sampler_rng
+
+
+class WindowsOfUnlabeledPool(object):
+    # The unlabeled training cases, walked in windows. Each pass over the pool is a new shuffled order of all the cases, cut into windows of...
+    # ... consecutive cases. The unlabeled sampler of each subepoch samples only from the next window. So every case is sampled once per pass...
+    # ... (numberOfWindowsPerPass subepochs), however large the pool, while each subepoch loads only a window of it.
+    # The size of the windows is capped by a memory budget for the loaded volumes of a window, if given.
+    # Lives in the training process. The window of each call is given to the sampler, which may run in another process.
+
+    def __init__(self, log, numberOfCases, casesPerWindow, memoryBudgetGB=0, bytesPerCase=0, samplerRng=None) :
+        self._numberOfCases = numberOfCases
+        self._samplerRng = get_sampler_rng(samplerRng) # Of the pool. Each pass is shuffled with a stream spawned from it.
+        self.casesPerWindow = max(1, min(int(casesPerWindow), numberOfCases))
+        if memoryBudgetGB > 0 and bytesPerCase > 0 :
+            maxCasesInBudget = max(1, int(memoryBudgetGB * 1024**3 // bytesPerCase))
+            if maxCasesInBudget < self.casesPerWindow :
+                log.print3("WARN: UNLABELED POOL: Windows of [" + str(self.casesPerWindow) + "] cases would exceed the memory budget of [" + str(memoryBudgetGB) + "] GB "+\
+                           "(about " + str(round(bytesPerCase / 1024.**2, 1)) + " MB per loaded case). Using windows of [" + str(maxCasesInBudget) + "] cases.")
+                self.casesPerWindow = maxCasesInBudget
+        self.numberOfWindowsPerPass = int(math.ceil(numberOfCases * 1.0 / self.casesPerWindow))
+        self._orderOfCasesInPass = []
+        self._numberOfPassesStarted = 0
+        self._window_i = self.numberOfWindowsPerPass # The first call starts a pass.
+        self._casesGivenInEpoch = set()
+        log.print3("UNLABELED POOL: [" + str(numberOfCases) + "] unlabeled cases, sampled in windows of [" + str(self.casesPerWindow) + "] cases. "+\
+                   "Each case is sampled once every [" + str(self.numberOfWindowsPerPass) + "] subepochs.")
+
+    def next_window(self) :
+        # Returns the indices of the cases of the next window, in random order.
+        if self._window_i >= self.numberOfWindowsPerPass :
+            self._orderOfCasesInPass = list(range(self._numberOfCases))
+            self._samplerRng.spawn(self._numberOfPassesStarted).shuffle(self._orderOfCasesInPass)
+            self._numberOfPassesStarted += 1
+            self._window_i = 0
+        window = self._orderOfCasesInPass[ self._window_i * self.casesPerWindow : (self._window_i + 1) * self.casesPerWindow ]
+        self._window_i += 1
+        self._casesGivenInEpoch.update(window)
+        return window
+
+    def report_and_reset_coverage(self, log, epoch) :
+        # Coverage: The fraction of the pool given to the unlabeled sampler during the epoch.
+        numberOfCasesGiven = len(self._casesGivenInEpoch)
+        log.print3("UNLABELED POOL: In epoch #" + str(epoch) + ", the unlabeled sampler was given [" + str(numberOfCasesGiven) + "/" + str(self._numberOfCases) + "] "+\
+                   "of the unlabeled cases (" + str(round(100. * numberOfCasesGiven / max(1, self._numberOfCases), 1)) + "%). Passes over the pool started: " + str(self._numberOfPassesStarted))
+        self._casesGivenInEpoch = set()
+
+
+def estimate_bytes_of_loaded_case(listOfFilepathsToEachChannelOfEachPatient, dtypeOfIntensities, numberOfCasesToCheck=5) :
+    # Memory of the volumes of a case once loaded: its channels, plus GT/ROI-sized masks (1 byte per voxel each). From the headers only.
+    # The largest of the first few cases. Cases of a pool are assumed of similar size.
+    bytesPerVoxelOfChannels = np.dtype(dtypeOfIntensities).itemsize * len(listOfFilepathsToEachChannelOfEachPatient[0])
+    maxBytes = 0
+    for filepathsOfChannelsOfCase in listOfFilepathsToEachChannelOfEachPatient[:numberOfCasesToCheck] :
+        numberOfVoxels = int(np.prod(getShapeOfVolume(filepathsOfChannelsOfCase[0])))
+        maxBytes = max(maxBytes, numberOfVoxels * (bytesPerVoxelOfChannels + 2))
+    return maxBytes
+
+
+def make_windows_of_unlabeled_pool(log, listOfFilepathsToEachChannelOfEachPatient, numberOfSubepochsToCoverPool, maxNumSubjectsLoadedPerSubepoch,
+                                   memoryBudgetGB, dtypeOfIntensities, samplerRng=None) :
+    # Windows of ceil(numberOfCases / numberOfSubepochsToCoverPool) cases, or of maxNumSubjectsLoadedPerSubepoch if the former is None.
+    numberOfCases = len(listOfFilepathsToEachChannelOfEachPatient)
+    casesPerWindow = int(math.ceil(numberOfCases * 1.0 / numberOfSubepochsToCoverPool)) if numberOfSubepochsToCoverPool is not None else maxNumSubjectsLoadedPerSubepoch
+    bytesPerCase = estimate_bytes_of_loaded_case(listOfFilepathsToEachChannelOfEachPatient, dtypeOfIntensities) if memoryBudgetGB > 0 else 0
+    return WindowsOfUnlabeledPool(log, numberOfCases, casesPerWindow, memoryBudgetGB, bytesPerCase, samplerRng)
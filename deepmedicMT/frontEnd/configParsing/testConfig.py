@@ -42,6 +42,15 @@ class TestConfig(Config):
     INDICES_OF_FMS_TO_SAVE_SUBSAMPLED = "minMaxIndicesOfFmsToSaveFromEachLayerOfSubsampledPathway"
     INDICES_OF_FMS_TO_SAVE_FC = "minMaxIndicesOfFmsToSaveFromEachLayerOfFullyConnectedPathway"
     
+    #Format of the output images.
+    COMPRESS_OUTPUT = "compressOutputImages" # Default True
+    GZIP_LEVEL_OUTPUT = "gzipLevelOfOutputImages"
+    PROBMAPS_AS_UINT8 = "saveProbMapsAsUint8" # Default False
+    NUM_THREADS_WRITING = "numThreadsForWritingOutputs"
+    
+    DATASET_MANIFEST = "datasetManifest"
+    SUBSAMPLED_PYRAMID = "subsampledPyramid"
+    
 
     def __init__(self, abs_path_to_cfg):
         Config.__init__(self, abs_path_to_cfg)
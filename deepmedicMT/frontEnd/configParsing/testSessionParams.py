@@ -8,6 +8,7 @@
 from __future__ import absolute_import, print_function, division
 
 from deepmedicMT.frontEnd.configParsing.utils import getAbsPathEvenIfRelativeIsGiven, parseAbsFileLinesInList, parseFileLinesInList, check_and_adjust_path_to_ckpt
+from deepmedicMT.image.pyramid import PYRAMID_STRIDED, PYRAMID_AVERAGED
 
 class TestSessionParameters(object) :
     #To be called from outside too.
@@ -42,6 +43,7 @@ class TestSessionParameters(object) :
         self.gtLabelsFilepaths = parseAbsFileLinesInList( getAbsPathEvenIfRelativeIsGiven(cfg[cfg.GT_LABELS], abs_path_to_cfg) ) if cfg[cfg.GT_LABELS] is not None else None
         self.providedRoiMasks = True if cfg[cfg.ROI_MASKS] is not None else False
         self.roiMasksFilepaths = parseAbsFileLinesInList( getAbsPathEvenIfRelativeIsGiven(cfg[cfg.ROI_MASKS], abs_path_to_cfg) ) if self.providedRoiMasks else None
+        self.filepathOfManifest = getAbsPathEvenIfRelativeIsGiven(cfg[cfg.DATASET_MANIFEST], abs_path_to_cfg) if cfg[cfg.DATASET_MANIFEST] is not None else None
         
         #Output:
         self.namesToSavePredictionsAndFeatures = parseFileLinesInList( getAbsPathEvenIfRelativeIsGiven(cfg[cfg.NAMES_FOR_PRED_PER_CASE], abs_path_to_cfg) ) if cfg[cfg.NAMES_FOR_PRED_PER_CASE] is not None else None #CAREFUL: different parser! #Optional. Not required if not saving results.
@@ -60,9 +62,19 @@ class TestSessionParameters(object) :
         else:
             self.indices_fms_per_pathtype_per_layer_to_save = None
         self.filepathsToSaveFeaturesForEachPatient = None #Filled by call to self.makeFilepathsForPredictionsAndFeatures()
+        #format of the output images:
+        self.compressOutputImages = cfg[cfg.COMPRESS_OUTPUT] if cfg[cfg.COMPRESS_OUTPUT] is not None else True
+        self.gzipLevelOfOutputImages = cfg[cfg.GZIP_LEVEL_OUTPUT] # None: nibabel's default.
+        if self.gzipLevelOfOutputImages is not None and self.gzipLevelOfOutputImages not in range(1, 10) :
+            self.log.print3("ERROR: Parameter [" + cfg.GZIP_LEVEL_OUTPUT + "] must be an integer from 1 (fastest) to 9 (smallest), but was given: " + str(self.gzipLevelOfOutputImages) + ". Exiting."); exit(1)
+        self.saveProbMapsAsUint8 = cfg[cfg.PROBMAPS_AS_UINT8] if cfg[cfg.PROBMAPS_AS_UINT8] is not None else False
+        self.numThreadsForWritingOutputs = cfg[cfg.NUM_THREADS_WRITING] if cfg[cfg.NUM_THREADS_WRITING] is not None else 2
         
         #Preprocessing
         self.padInputImagesBool = cfg[cfg.PAD_INPUT] if cfg[cfg.PAD_INPUT] is not None else True
+        self.typeOfSubsampledPyramid = cfg[cfg.SUBSAMPLED_PYRAMID] # None: not used.
+        if self.typeOfSubsampledPyramid not in [None, PYRAMID_STRIDED, PYRAMID_AVERAGED] :
+            self.log.print3("ERROR: Parameter [" + cfg.SUBSAMPLED_PYRAMID + "] must be \"" + PYRAMID_STRIDED + "\" or \"" + PYRAMID_AVERAGED + "\", but was given: " + str(self.typeOfSubsampledPyramid) + ". Exiting."); exit(1)
         
         #Others useful internally or for reporting:
         self.numberOfCases = len(self.channelsFilepaths)
@@ -111,6 +123,7 @@ class TestSessionParameters(object) :
         logPrint("Filepaths of the ROI Masks provided per case = " + str(self.roiMasksFilepaths))
         if not self.providedRoiMasks :
             logPrint(">>> WARN: Inference will be performed on whole scan. Consider providing a ROI image for faster results, if possible!")
+        logPrint("Dataset manifest (None if not used) = " + str(self.filepathOfManifest))
             
         logPrint("~~~~~~~~~~~~~~~~~~~OUTPUT~~~~~~~~~~~~~~~")
         logPrint("Path to the main output-folder = " + str(self.mainOutputAbsFolder))
@@ -131,10 +144,17 @@ class TestSessionParameters(object) :
         logPrint("Indices of min/max FMs to save, per type of pathway (normal/subsampled/FC) and per layer = " + str(self.indices_fms_per_pathtype_per_layer_to_save))
         logPrint("Save Feature Maps at = " + str(self.filepathsToSaveFeaturesForEachPatient))
         
+        logPrint("~~~~~~~Format of the output images~~~~~~")
+        logPrint("Compress output images (.nii.gz) = " + str(self.compressOutputImages))
+        logPrint("Gzip level of output images (None = default) = " + str(self.gzipLevelOfOutputImages))
+        logPrint("Save probability maps as uint8, scaled via the header = " + str(self.saveProbMapsAsUint8))
+        logPrint("Number of threads writing the outputs in the background = " + str(self.numThreadsForWritingOutputs))
+        
         logPrint("~~~~~~~ Parameters for Preprocessing ~~~~~~")
         logPrint("Pad Input Images = " + str(self.padInputImagesBool))
         if not self.padInputImagesBool :
             logPrint(">>> WARN: Inference near the borders of the image might be incomplete if not padded! Although some speed is gained if not padded. Task-specific, your choice.")
+        logPrint("Precomputed pyramid for the subsampled pathways (None, strided, averaged) = " + str(self.typeOfSubsampledPyramid))
         logPrint("========== Done with printing session's parameters ==========")
         logPrint("=============================================================\n")
         
@@ -167,7 +187,16 @@ class TestSessionParameters(object) :
                 self.saveIndividualFmImages,
                 self.saveMultidimensionalImageWithAllFms,
                 self.indices_fms_per_pathtype_per_layer_to_save,
-                self.filepathsToSaveFeaturesForEachPatient
+                self.filepathsToSaveFeaturesForEachPatient,
+                
+                self.numThreadsForWritingOutputs,
+                #--------Format of the output images---------
+                self.compressOutputImages,
+                self.gzipLevelOfOutputImages,
+                self.saveProbMapsAsUint8,
+                
+                self.filepathOfManifest,
+                self.typeOfSubsampledPyramid
                 ]
         
         return args
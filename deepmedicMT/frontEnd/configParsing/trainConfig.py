@@ -119,6 +119,27 @@ class TrainConfig(Config):
     PAD_INPUT = "padInputImagesBool"
     RUN_INP_CHECKS = "run_input_checks"
     
+    #~~~~~ Data Loading ~~~~~
+    DECODED_VOLS_CACHE_FOLDER = "folderForDecodedVolumesCache"
+    SHARED_MEM_SUBJECT_STORE = "useSharedMemorySubjectStore"
+    NUM_THREADS_LOADING = "numThreadsForLoadingFilesOfCase"
+    SUBJECT_CACHE_SIZE_GB = "subjectCacheSizeGB"
+    STORAGE_DTYPE_INTENS = "storageDtypeOfIntensities"
+    DATASET_MANIFEST = "datasetManifest"
+    SUBSAMPLED_PYRAMID = "subsampledPyramid"
+    NUM_PROCS_STREAMING = "numProcessesOfStreamingSampler"
+    DEPTH_QUEUE_BATCHES = "depthOfQueueOfBatches"
+    NUM_PARALLEL_PROC = "num_parallel_proc"
+    SEED_OF_SAMPLING = "seedOfSampling"
+    NUM_SUBEP_COVER_UNLABELED = "numberOfSubepochsToCoverUnlabeledPool"
+    MEM_BUDGET_UNLABELED_WINDOW = "memoryBudgetGBOfUnlabeledWindow"
+    AFFINE_AUGM_OF_SEGMENTS = "affineAugmentationOfSegments"
+    PATCH_BANK_FOLDER = "patchBankFolder"
+    HARD_EXAMPLES_FRACTION = "fractionOfHardExampleSegments"
+    HARD_EXAMPLES_CELL_SIZE = "sizeOfCellsOfHardExampleMap"
+    HARD_EXAMPLES_MOMENTUM = "momentumOfHardExampleMap"
+    SCHEDULE_OF_SEGMENTS_TRAIN = "scheduleOfSegmentsTrain"
+    
     SNUM = "NumofSdomainImagesForBadv"
 
     def __init__(self, abs_path_to_cfg):
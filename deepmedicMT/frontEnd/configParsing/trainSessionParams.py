@@ -9,6 +9,7 @@ from __future__ import absolute_import, print_function, division
 
 from deepmedicMT.frontEnd.configParsing.utils import getAbsPathEvenIfRelativeIsGiven, parseAbsFileLinesInList, parseFileLinesInList, check_and_adjust_path_to_ckpt
 from deepmedicMT.dataManagement import samplingType
+from deepmedicMT.image.pyramid import PYRAMID_STRIDED, PYRAMID_AVERAGED
 
 
 class TrainSessionParameters(object) :
@@ -99,6 +100,42 @@ class TrainSessionParameters(object) :
     @staticmethod
     def errorRequireMomNonNorm0Norm1() :
         print("ERROR: The parameter \"momNonNorm0orNormalized1\" must be given 0 or 1. Omit for default. Exiting!"); exit(1)
+    @staticmethod
+    def errorRequireDtypeOfIntensities() :
+        print("ERROR: The parameter \"storageDtypeOfIntensities\" must be given \"float32\" or \"float16\". Omit for default. Exiting!"); exit(1)
+    @staticmethod
+    def errorRequireTypeOfSubsampledPyramid() :
+        print("ERROR: The parameter \"subsampledPyramid\" must be given \"strided\" or \"averaged\". Omit for default (not used). Exiting!"); exit(1)
+    @staticmethod
+    def errorRequireStreamingSamplerParams() :
+        print("ERROR: The parameter \"numProcessesOfStreamingSampler\" must be an integer >= 0 and \"depthOfQueueOfBatches\" an integer >= 1. Omit for defaults. Exiting!"); exit(1)
+    @staticmethod
+    def errorRequireNumParallelProc() :
+        print("ERROR: The parameter \"num_parallel_proc\" must be an integer >= 0. Omit for default (0, sequential sampling). Exiting!"); exit(1)
+    @staticmethod
+    def errorRequireSeedOfSampling() :
+        print("ERROR: The parameter \"seedOfSampling\" must be an integer >= 0. Omit for default (None, not seeded). Exiting!"); exit(1)
+    @staticmethod
+    def errorRequireUnlabeledPoolParams() :
+        print("ERROR: The parameter \"numberOfSubepochsToCoverUnlabeledPool\" must be an integer >= 1 and \"memoryBudgetGBOfUnlabeledWindow\" a number >= 0. Omit for defaults. Exiting!"); exit(1)
+    @staticmethod
+    def errorPatchBankWithStreamingSampler() :
+        print("ERROR: The parameter \"patchBankFolder\" can not be given together with \"numProcessesOfStreamingSampler\" > 0. Training segments are either read from the bank or streamed. Exiting!"); exit(1)
+    @staticmethod
+    def errorRequireAffineAugmentationOfSegments() :
+        print("ERROR: The parameter \"affineAugmentationOfSegments\" must be a dictionary, eg {'prob': 0.5, 'max_rot_xyz': (15., 15., 15.), 'max_scaling': 0.1}, with 0 <= 'prob' <= 1. Omit for default (None). Exiting!"); exit(1)
+    @staticmethod
+    def errorRequireHardExampleParams() :
+        print("ERROR: The parameter \"fractionOfHardExampleSegments\" must be a number in [0, 1), \"sizeOfCellsOfHardExampleMap\" a list of 3 integers >= 1 and \"momentumOfHardExampleMap\" a number in [0, 1). Omit for defaults. Exiting!"); exit(1)
+    @staticmethod
+    def errorHardExamplesWithStreamingOrPatchBank() :
+        print("ERROR: The parameter \"fractionOfHardExampleSegments\" > 0 can not be given together with \"numProcessesOfStreamingSampler\" > 0 or \"patchBankFolder\". The hard-example map needs to know where each trained segment was sampled. Exiting!"); exit(1)
+    @staticmethod
+    def errorRequireScheduleOfSegmentsTrain() :
+        print("ERROR: The parameter \"scheduleOfSegmentsTrain\" must be a list of stages [untilEpoch, [r,c,z], batchSize], eg [ [5, [25,25,19], 48], [15, [31,31,19], 24] ], with increasing integers 0 < untilEpoch < numberOfEpochs and even batch sizes. Omit for default ([]). Exiting!"); exit(1)
+    @staticmethod
+    def errorScheduleOfSegmentsWithPatchBank() :
+        print("ERROR: The parameter \"scheduleOfSegmentsTrain\" can not be given together with \"patchBankFolder\". The segments of a bank have the shapes of the model config. Exiting!"); exit(1)
         
     # Deprecated :
     @staticmethod
@@ -334,6 +371,81 @@ class TrainSessionParameters(object) :
         self.numberOfCasesVal = len(self.channelsFilepathsVal)
         self.run_input_checks = cfg[cfg.RUN_INP_CHECKS] if cfg[cfg.RUN_INP_CHECKS] is not None else True
         
+        #Data Loading
+        # Folder where decoded volumes are cached as .npy, to be memory-mapped instead of re-inflating the .nii.gz every subepoch. None disables caching.
+        self.decodedVolumesCacheFolder = getAbsPathEvenIfRelativeIsGiven(cfg[cfg.DECODED_VOLS_CACHE_FOLDER], abs_path_to_cfg) if cfg[cfg.DECODED_VOLS_CACHE_FOLDER] is not None else None
+        # Keep the loaded volumes in shared memory, loaded once and shared by the labeled, unlabeled and validation samplers.
+        self.useSharedMemorySubjectStore = cfg[cfg.SHARED_MEM_SUBJECT_STORE] if cfg[cfg.SHARED_MEM_SUBJECT_STORE] is not None else False
+        # Number of threads that read the files of a case (channels, GT, ROI, weight-maps) at the same time. 1 loads them one after the other.
+        self.numThreadsForLoadingFilesOfCase = cfg[cfg.NUM_THREADS_LOADING] if cfg[cfg.NUM_THREADS_LOADING] is not None else 1
+        # Memory budget (GB) of the in-RAM cache of loaded volumes, kept across subepochs with LRU eviction. 0 disables it.
+        self.subjectCacheSizeGB = cfg[cfg.SUBJECT_CACHE_SIZE_GB] if cfg[cfg.SUBJECT_CACHE_SIZE_GB] is not None else 0
+        # Dtype in which the samplers keep intensities (channels and segments). Labels, ROI and sampling masks are kept as uint8.
+        self.dtypeOfIntensities = cfg[cfg.STORAGE_DTYPE_INTENS] if cfg[cfg.STORAGE_DTYPE_INTENS] is not None else "float32"
+        if self.dtypeOfIntensities not in ["float32", "float16"] :
+            self.errorRequireDtypeOfIntensities()
+        # Manifest made by deepMedicBuildManifest. If given, sampling maps are made from its records instead of from the whole GT/ROI.
+        self.filepathOfManifest = getAbsPathEvenIfRelativeIsGiven(cfg[cfg.DATASET_MANIFEST], abs_path_to_cfg) if cfg[cfg.DATASET_MANIFEST] is not None else None
+        # Precomputed downsampled copies of the channels for the subsampled pathways, built once per loaded case. None, "strided" or "averaged".
+        self.typeOfSubsampledPyramid = cfg[cfg.SUBSAMPLED_PYRAMID] if cfg[cfg.SUBSAMPLED_PYRAMID] is not None else None
+        if self.typeOfSubsampledPyramid not in [None, PYRAMID_STRIDED, PYRAMID_AVERAGED] :
+            self.errorRequireTypeOfSubsampledPyramid()
+        # Processes that sample batches continuously into a bounded queue, instead of one subepoch at a time. 0 disables streaming.
+        self.numProcessesOfStreamingSampler = cfg[cfg.NUM_PROCS_STREAMING] if cfg[cfg.NUM_PROCS_STREAMING] is not None else 0
+        # Maximum number of ready batches held in the queue of the streaming sampler. Producers block when it is full.
+        self.depthOfQueueOfBatches = cfg[cfg.DEPTH_QUEUE_BATCHES] if cfg[cfg.DEPTH_QUEUE_BATCHES] is not None else 20
+        if not isinstance(self.numProcessesOfStreamingSampler, int) or self.numProcessesOfStreamingSampler < 0 or \
+                not isinstance(self.depthOfQueueOfBatches, int) or self.depthOfQueueOfBatches < 1 :
+            self.errorRequireStreamingSamplerParams()
+        # Processes that load the cases of a subepoch and sample from them in parallel, one job per case. 0 samples them sequentially.
+        self.num_parallel_proc = cfg[cfg.NUM_PARALLEL_PROC] if cfg[cfg.NUM_PARALLEL_PROC] is not None else 0
+        if not isinstance(self.num_parallel_proc, int) or self.num_parallel_proc < 0 :
+            self.errorRequireNumParallelProc()
+        # Seed of the random streams of the samplers (SamplerRNG). The same seed samples the same segments, whether cases are sampled in parallel or not. None: not seeded.
+        self.seedOfSampling = cfg[cfg.SEED_OF_SAMPLING]
+        if self.seedOfSampling is not None and ( not isinstance(self.seedOfSampling, int) or self.seedOfSampling < 0 ) :
+            self.errorRequireSeedOfSampling()
+        # Subepochs over which each pass of the unlabeled sampler covers all the unlabeled cases (WindowsOfUnlabeledPool). None: windows of maxNumSubjectsLoadedPerSubepoch cases.
+        self.numberOfSubepochsToCoverUnlabeledPool = cfg[cfg.NUM_SUBEP_COVER_UNLABELED]
+        # Memory budget (GB) of the loaded volumes of a window of unlabeled cases. Caps the cases per window. 0: no budget.
+        self.memoryBudgetGBOfUnlabeledWindow = cfg[cfg.MEM_BUDGET_UNLABELED_WINDOW] if cfg[cfg.MEM_BUDGET_UNLABELED_WINDOW] is not None else 0
+        if ( self.numberOfSubepochsToCoverUnlabeledPool is not None and ( not isinstance(self.numberOfSubepochsToCoverUnlabeledPool, int) or self.numberOfSubepochsToCoverUnlabeledPool < 1 ) ) or \
+                not isinstance(self.memoryBudgetGBOfUnlabeledWindow, (int, float)) or self.memoryBudgetGBOfUnlabeledWindow < 0 :
+            self.errorRequireUnlabeledPoolParams()
+        # Patch-local affine augmentation of the training segments. None, or dictionary of AugmenterAffineParams (prob, max_rot_xyz, max_scaling, interp_order_*, boundary_mode).
+        self.affineAugmentationOfSegments = cfg[cfg.AFFINE_AUGM_OF_SEGMENTS]
+        if self.affineAugmentationOfSegments is not None and ( not isinstance(self.affineAugmentationOfSegments, dict) or \
+                not 0. <= self.affineAugmentationOfSegments.get('prob', 0.) <= 1. ) :
+            self.errorRequireAffineAugmentationOfSegments()
+        # Folder of a patch bank made by deepMedicBuildPatchBank. If given, training segments are replayed from it instead of sampled.
+        self.patchBankFolder = getAbsPathEvenIfRelativeIsGiven(cfg[cfg.PATCH_BANK_FOLDER], abs_path_to_cfg) if cfg[cfg.PATCH_BANK_FOLDER] is not None else None
+        if self.patchBankFolder is not None and self.numProcessesOfStreamingSampler > 0 :
+            self.errorPatchBankWithStreamingSampler()
+        # Fraction of the training segments centred by the HardExampleMap, proportionally to the loss of coarse cells of the cases. 0 disables it.
+        self.fractionOfHardExampleSegments = cfg[cfg.HARD_EXAMPLES_FRACTION] if cfg[cfg.HARD_EXAMPLES_FRACTION] is not None else 0
+        # Size in voxels (r,c,z) of the cells of the HardExampleMap.
+        self.sizeOfCellsOfHardExampleMap = cfg[cfg.HARD_EXAMPLES_CELL_SIZE] if cfg[cfg.HARD_EXAMPLES_CELL_SIZE] is not None else [10, 10, 10]
+        # Momentum of the running average of the cost in each cell of the HardExampleMap.
+        self.momentumOfHardExampleMap = cfg[cfg.HARD_EXAMPLES_MOMENTUM] if cfg[cfg.HARD_EXAMPLES_MOMENTUM] is not None else 0.7
+        if not isinstance(self.fractionOfHardExampleSegments, (int, float)) or not 0. <= self.fractionOfHardExampleSegments < 1. or \
+                not isinstance(self.sizeOfCellsOfHardExampleMap, list) or len(self.sizeOfCellsOfHardExampleMap) != 3 or \
+                not all( isinstance(size, int) and size >= 1 for size in self.sizeOfCellsOfHardExampleMap ) or \
+                not isinstance(self.momentumOfHardExampleMap, (int, float)) or not 0. <= self.momentumOfHardExampleMap < 1. :
+            self.errorRequireHardExampleParams()
+        if self.fractionOfHardExampleSegments > 0 and ( self.numProcessesOfStreamingSampler > 0 or self.patchBankFolder is not None ) :
+            self.errorHardExamplesWithStreamingOrPatchBank()
+        # Stages [untilEpoch, [r,c,z], batchSize] of smaller training segments and larger batches, before those of the model config. See TrainSession.run_session()
+        self.scheduleOfSegmentsTrain = cfg[cfg.SCHEDULE_OF_SEGMENTS_TRAIN] if cfg[cfg.SCHEDULE_OF_SEGMENTS_TRAIN] is not None else []
+        if not isinstance(self.scheduleOfSegmentsTrain, list) or \
+                not all( isinstance(stage, list) and len(stage) == 3 and isinstance(stage[0], int) and \
+                         isinstance(stage[1], list) and len(stage[1]) == 3 and all( isinstance(dim, int) and dim >= 1 for dim in stage[1] ) and \
+                         isinstance(stage[2], int) and stage[2] >= 2 and stage[2] % 2 == 0 for stage in self.scheduleOfSegmentsTrain ) or \
+                not all( 0 < stage[0] < self.numberOfEpochs for stage in self.scheduleOfSegmentsTrain ) or \
+                not all( self.scheduleOfSegmentsTrain[i][0] < self.scheduleOfSegmentsTrain[i+1][0] for i in range(len(self.scheduleOfSegmentsTrain) - 1) ) :
+            self.errorRequireScheduleOfSegmentsTrain()
+        if len(self.scheduleOfSegmentsTrain) > 0 and self.patchBankFolder is not None :
+            self.errorScheduleOfSegmentsWithPatchBank()
+        
         #HIDDENS, no config allowed for these at the moment:
         self.useSameSubChannelsAsSingleScale = True
         self.subsampledChannelsFilepathsTrain = "placeholder" #List of Lists with filepaths per patient. Only used when above is False.
@@ -527,11 +639,32 @@ class TrainSessionParameters(object) :
         logPrint("Check whether input data has correct format (can slow down process) = " + str(self.run_input_checks))
         logPrint("~~Pre Processing~~")
         logPrint("Pad Input Images = " + str(self.padInputImagesBool))
+        logPrint("~~Data Loading~~")
+        logPrint("Folder to cache decoded volumes (None for no caching) = " + str(self.decodedVolumesCacheFolder))
+        logPrint("Keep loaded volumes in shared memory, shared by all samplers = " + str(self.useSharedMemorySubjectStore))
+        logPrint("Number of threads loading the files of a case in parallel = " + str(self.numThreadsForLoadingFilesOfCase))
+        logPrint("Memory budget of the in-RAM cache of loaded volumes (GB, 0 for no caching) = " + str(self.subjectCacheSizeGB))
+        logPrint("Dtype of intensities in the samplers (labels/masks are uint8) = " + str(self.dtypeOfIntensities))
+        logPrint("Dataset manifest (None if not used) = " + str(self.filepathOfManifest))
+        logPrint("Precomputed pyramid for the subsampled pathways (None, strided, averaged) = " + str(self.typeOfSubsampledPyramid))
+        logPrint("Number of processes of the streaming sampler (0 for sampling per subepoch) = " + str(self.numProcessesOfStreamingSampler))
+        logPrint("Depth of the queue of batches of the streaming sampler = " + str(self.depthOfQueueOfBatches))
+        logPrint("Number of parallel processes for sampling (0 for sequential) = " + str(self.num_parallel_proc))
+        logPrint("Seed of the samplers (None: not seeded) = " + str(self.seedOfSampling))
+        logPrint("Subepochs to cover the unlabeled pool once (None: windows of maxNumSubjectsLoadedPerSubepoch cases) = " + str(self.numberOfSubepochsToCoverUnlabeledPool))
+        logPrint("Memory budget (GB) of a window of unlabeled cases (0: no budget) = " + str(self.memoryBudgetGBOfUnlabeledWindow))
+        logPrint("Patch-local affine augmentation of training segments (None: disabled) = " + str(self.affineAugmentationOfSegments))
+        logPrint("Patch bank to train from, instead of sampling (None: sample) = " + str(self.patchBankFolder))
+        logPrint("Fraction of training segments sampled by the hard-example map (0: disabled) = " + str(self.fractionOfHardExampleSegments))
+        logPrint("Size of the cells of the hard-example map (voxels) = " + str(self.sizeOfCellsOfHardExampleMap))
+        logPrint("Momentum of the running average of the cost per cell of the hard-example map = " + str(self.momentumOfHardExampleMap))
+        logPrint("Schedule of smaller training segments [untilEpoch, [r,c,z], batchSize] ([]: those of the model config) = " + str(self.scheduleOfSegmentsTrain))
         
         logPrint("========== Done with printing session's parameters ==========")
         logPrint("=============================================================\n")
         
-    def get_args_for_train_routine(self) :
+    def get_args_for_train_routine(self, untilEpoch=None) :
+        # untilEpoch: Train until this epoch instead of numberOfEpochs. For the stages of scheduleOfSegmentsTrain.
         
         args = [self.log,
                 self.filepath_to_save_models,
@@ -562,7 +695,7 @@ class TrainSessionParameters(object) :
                 self.providedRoiMasksVal, # also used for fast inf
                 self.roiMasksFilepathsVal, # also used for fast inf and also for uniform sampling of segs.
 
-                self.numberOfEpochs,
+                self.numberOfEpochs if untilEpoch is None else untilEpoch,
                 self.numberOfSubepochs,
                 self.numOfCasesLoadedPerSubepoch,
                 self.segmentsLoadedOnGpuPerSubepochTrain,
@@ -595,7 +728,63 @@ class TrainSessionParameters(object) :
                 self.filepathsToSaveFeaturesForEachPatientVal,
                 
                 #-------- Others --------
-                self.run_input_checks
+                self.run_input_checks,
+                
+                #-------- Data Loading --------
+                self.decodedVolumesCacheFolder,
+                self.useSharedMemorySubjectStore,
+                self.numThreadsForLoadingFilesOfCase,
+                self.subjectCacheSizeGB,
+                self.dtypeOfIntensities,
+                self.filepathOfManifest,
+                self.typeOfSubsampledPyramid,
+                self.numProcessesOfStreamingSampler,
+                self.depthOfQueueOfBatches,
+                self.num_parallel_proc,
+                self.seedOfSampling,
+                self.numberOfSubepochsToCoverUnlabeledPool,
+                self.memoryBudgetGBOfUnlabeledWindow,
+                self.affineAugmentationOfSegments,
+                self.patchBankFolder,
+                self.fractionOfHardExampleSegments,
+                self.sizeOfCellsOfHardExampleMap,
+                self.momentumOfHardExampleMap
+                ]
+        return args
+    
+    def get_args_for_patch_bank(self) :
+        # For deepMedicBuildPatchBank. What the samplers of training segments are given in do_training().
+        args = [self.log,
+                self.channelsFilepathsTrain,
+                self.TDchanelsFilePathsTrain,
+                self.gtLabelsFilepathsTrain,
+                self.TDgtLabelsFilepathsTrain,
+                self.providedWeightMapsToSampleForEachCategoryTraining,
+                self.forEachSamplingCategory_aListOfFilepathsToWeightMapsOfEachPatientTraining,
+                self.providedRoiMasksTrain,
+                self.DDprovidedRoiMasksTrain,
+                self.roiMasksFilepathsTrain,
+                self.DDroiMasksFilepathsTrain,
+                self.numOfCasesLoadedPerSubepoch,
+                self.segmentsLoadedOnGpuPerSubepochTrain,
+                self.samplingTypeInstanceTrain,
+                self.padInputImagesBool,
+                self.doIntAugm_shiftMuStd_multiMuStd,
+                self.reflectImagesPerAxis,
+                self.useSameSubChannelsAsSingleScale,
+                self.subsampledChannelsFilepathsTrain,
+                self.run_input_checks,
+                self.decodedVolumesCacheFolder,
+                self.numThreadsForLoadingFilesOfCase,
+                self.subjectCacheSizeGB,
+                self.dtypeOfIntensities,
+                self.filepathOfManifest,
+                self.typeOfSubsampledPyramid,
+                self.num_parallel_proc,
+                self.seedOfSampling,
+                self.numberOfSubepochsToCoverUnlabeledPool,
+                self.memoryBudgetGBOfUnlabeledWindow,
+                self.affineAugmentationOfSegments
                 ]
         return args
     
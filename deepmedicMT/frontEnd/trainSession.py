@@ -7,6 +7,7 @@
 
 from __future__ import absolute_import, print_function, division
 import os
+import copy
 
 from deepmedicMT.frontEnd.session import Session
 from deepmedicMT.frontEnd.configParsing.utils import getAbsPathEvenIfRelativeIsGiven
@@ -16,8 +17,10 @@ from deepmedicMT.frontEnd.sessHelpers import makeFoldersNeededForTrainingSession
 from deepmedicMT.logging.utils import datetimeNowAsStr
 from deepmedicMT.neuralnet.cnn3d import Cnn3d
 from deepmedicMT.neuralnet.trainer import Trainer
+from deepmedicMT.neuralnet.utils import checkRecFieldVsSegmSize
 
 from deepmedicMT.routines.training import do_training
+from deepmedicMT.routines.buildPatchBank import do_build_patch_bank
 
 import tensorflow as tf
 
@@ -75,6 +78,33 @@ class TrainSession(Session):
          model_params,
          reset_trainer) = args
         
+        # Progressive segments: One stage per entry of scheduleOfSegmentsTrain, then a last one with the segments and batch size of the model config.
+        # The shapes of the train graph are static, so it is rebuilt for each stage. The parameters pass to the next stage via a checkpoint.
+        stages = [ (untilEpoch, segmDim, batchSize) for [untilEpoch, segmDim, batchSize] in self._params.scheduleOfSegmentsTrain ] + \
+                 [ (None, model_params.segmDimNormalTrain, model_params.batchSizeTrain) ]
+        for (_, segmDim, _) in stages :
+            if not checkRecFieldVsSegmSize(model_params.receptiveFieldNormal, segmDim) :
+                model_params.errorSegmDimensionsSmallerThanReceptiveF(model_params.receptiveFieldNormal, segmDim, 0)
+        
+        chkpt_of_prev_stage = None
+        for (stage_i, (untilEpoch, segmDim, batchSize)) in enumerate(stages) :
+            if len(stages) > 1 :
+                self._log.print3("")
+                self._log.print3("=========== Stage [" + str(stage_i+1) + "/" + str(len(stages)) + "] of the schedule of segments: Segments " + str(segmDim) +\
+                                 ", batch size [" + str(batchSize) + "], until epoch [" + str(untilEpoch if untilEpoch is not None else self._params.numberOfEpochs) + "] ===========")
+            model_params_of_stage = copy.copy(model_params)
+            model_params_of_stage.segmDimNormalTrain = segmDim
+            model_params_of_stage.batchSizeTrain = batchSize
+            chkpt_of_prev_stage = self._run_stage_of_training(sess_device, model_params_of_stage, reset_trainer, untilEpoch, chkpt_of_prev_stage)
+            
+        self._log.print3("\n=======================================================")
+        self._log.print3("=========== Training session finished =================")
+        self._log.print3("=======================================================")
+        
+        
+    def _run_stage_of_training(self, sess_device, model_params, reset_trainer, untilEpoch, chkpt_of_prev_stage):
+        # Trains until epoch untilEpoch (None: numberOfEpochs) with the segments of model_params. Returns the checkpoint saved at the end.
+        # chkpt_of_prev_stage: If given, everything (net and trainer) is loaded from it, instead of the model of the config or initialization.
         graphTf = tf.Graph()
         
         with graphTf.as_default():
@@ -143,7 +173,12 @@ class TrainSession(Session):
         with tf.Session( graph=graphTf, config=tf.ConfigProto(log_device_placement=False, device_count={'CPU':999, 'GPU':99}) ) as sessionTf:
             # Load or initialize parameters
             file_to_load_params_from = self._params.get_path_to_load_model_from()
-            if file_to_load_params_from is not None: # Load params
+            if chkpt_of_prev_stage is not None: # Next stage of the schedule of segments.
+                self._log.print3("=========== Loading parameters from the end of the previous stage ===============")
+                self._log.print3("Loading checkpoint file:" + str(chkpt_of_prev_stage))
+                saver_all.restore(sessionTf, chkpt_of_prev_stage)
+                self._log.print3("Network and trainer parameters were loaded.")
+            elif file_to_load_params_from is not None: # Load params
                 self._log.print3("=========== Loading parameters from specified saved model ===============")
                 chkpt_fname = tf.train.latest_checkpoint( file_to_load_params_from ) if os.path.isdir( file_to_load_params_from ) else file_to_load_params_from
                 self._log.print3("Loading checkpoint file:" + str(chkpt_fname))
@@ -179,15 +214,38 @@ class TrainSession(Session):
             self._log.print3("============== Training the CNN model =================")
             self._log.print3("=======================================================\n")
             
-            do_training( *( [sessionTf, saver_all, cnn3d, cnn3dT, trainer, trainerT] + self._params.get_args_for_train_routine() ) )
+            if untilEpoch is None or trainer.get_num_epochs_trained_tfv().eval(session=sessionTf) < untilEpoch :
+                do_training( *( [sessionTf, saver_all, cnn3d, cnn3dT, trainer, trainerT] + self._params.get_args_for_train_routine(untilEpoch) ) )
+            else :
+                self._log.print3("The loaded model was already trained for [" + str(untilEpoch) + "] epochs or more. Skipping this stage.")
             
             # Save the trained model.
-            filename_to_save_with = self._params.filepath_to_save_models + ".final." + datetimeNowAsStr()
-            self._log.print3("Saving the final model at:" + str(filename_to_save_with))
+            filename_to_save_with = self._params.filepath_to_save_models + (".final." if untilEpoch is None else ".endOfStage.") + datetimeNowAsStr()
+            self._log.print3("Saving the " + ("final model" if untilEpoch is None else "model at the end of the stage") + " at:" + str(filename_to_save_with))
             saver_all.save( sessionTf, filename_to_save_with+".model.ckpt", write_meta_graph=False )
             
-            
-        self._log.print3("\n=======================================================")
-        self._log.print3("=========== Training session finished =================")
+        return filename_to_save_with+".model.ckpt"
+        
+        
+        
+    def run_building_of_patch_bank(self, *args):
+        # For deepMedicBuildPatchBank. Only the graph of the CNN is made, for the shapes of its segments. No TF session, trainer or training.
+        (sess_device,
+         model_params,
+         folderOfPatchBank,
+         numberOfSubepochsToBank) = args
+        
+        graphTf = tf.Graph()
+        with graphTf.as_default():
+            with graphTf.device(sess_device):
+                self._log.print3("=========== Making the CNN graph... ===============")
+                cnn3d = Cnn3d()
+                with tf.variable_scope("net"):
+                    cnn3d.make_cnn_model( *model_params.get_args_for_arch() )
+        
+        self._log.print3("")
         self._log.print3("=======================================================")
+        self._log.print3("========= Sampling segments for the patch bank ========")
+        self._log.print3("=======================================================\n")
         
+        do_build_patch_bank( *( [cnn3d, folderOfPatchBank, numberOfSubepochsToBank] + self._params.get_args_for_patch_bank() ) )
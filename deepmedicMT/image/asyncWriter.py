@@ -0,0 +1,104 @@
+# Copyright (c) 2016, Konstantinos Kamnitsas
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the BSD license. See the accompanying LICENSE file
+# or read the terms at https://opensource.org/licenses/BSD-3-Clause.
+
+from __future__ import absolute_import, print_function, division
+
+import threading
+import traceback
+from collections import OrderedDict
+try :
+    import queue
+except ImportError : # python 2
+    import Queue as queue
+
+from deepmedicMT.image.io import getAffineAndZoomsOfVolume, writeImgToNii
+
+
+class AsyncImageWriter(object):
+    # Writes the output images (segmentations, prob maps, feature maps) in background threads, so that the gzip compression...
+    # ... of the outputs of one subject overlaps with the inference on the next. nibabel and zlib release the GIL while compressing.
+    # The queue is bounded, so that if writing falls behind, submit() blocks rather than keeping the outputs of many subjects in memory.
+    # The affine and zooms of the original image are read once per subject and kept, instead of once per output image.
+    # Errors in the threads are kept and raised by the next submit() or by flush(), in the main thread.
+    # compressOutput, gzipLevel: How the images are written. See io.writeImgToNii().
+
+    def __init__(self, log, numThreads=2, maxQueueSize=8, maxNumberOfHeadersKept=4, compressOutput=True, gzipLevel=None) :
+        self._log = log
+        self._compressOutput = compressOutput
+        self._gzipLevel = gzipLevel
+        self._queue = queue.Queue(maxsize=maxQueueSize)
+        self._headers = OrderedDict() # filepath of original image -> (affine, zooms). Most recently used last.
+        self._maxNumberOfHeadersKept = maxNumberOfHeadersKept
+        self._lock = threading.Lock() # For the headers, the log and the error.
+        self._error = None
+        self._threads = []
+        for _ in range(max(1, numThreads)) :
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True # Do not keep the process alive if the main thread exits with an error.
+            thread.start()
+            self._threads.append(thread)
+
+    def _getAffineAndZooms(self, filepathOriginToCopyHeader) :
+        with self._lock :
+            if filepathOriginToCopyHeader in self._headers :
+                affineAndZooms = self._headers.pop(filepathOriginToCopyHeader)
+                self._headers[filepathOriginToCopyHeader] = affineAndZooms
+                return affineAndZooms
+        affineAndZooms = getAffineAndZoomsOfVolume(filepathOriginToCopyHeader) # Outside the lock. Rarely read twice by two threads, harmless.
+        with self._lock :
+            self._headers[filepathOriginToCopyHeader] = affineAndZooms
+            while len(self._headers) > self._maxNumberOfHeadersKept :
+                self._headers.popitem(last=False)
+        return affineAndZooms
+
+    def _work(self) :
+        while True :
+            job = self._queue.get()
+            if job is None : # Sentinel from close()
+                self._queue.task_done()
+                return
+            (imgToSave, filepathTarget, filepathOriginToCopyHeader, npDtype) = job
+            try :
+                if self._error is None : # After an error, drain the queue without writing, so that flush() returns.
+                    (affine, zooms) = self._getAffineAndZooms(filepathOriginToCopyHeader)
+                    filepathSaved = writeImgToNii(imgToSave, filepathTarget, affine, zooms, npDtype, self._compressOutput, self._gzipLevel)
+                    with self._lock :
+                        self._log.print3("Image saved at: " + str(filepathSaved))
+            except Exception as e :
+                with self._lock :
+                    if self._error is None :
+                        self._error = (e, filepathTarget, traceback.format_exc())
+            finally :
+                self._queue.task_done()
+
+    def _raiseErrorIfAny(self) :
+        if self._error is not None :
+            (e, filepathTarget, tracebackStr) = self._error
+            self._log.print3("ERROR: Writing image [" + str(filepathTarget) + "] in the background failed. Traceback of the writer:\n" + tracebackStr)
+            raise e
+
+    def submit(self, imgToSave, filepathTarget, filepathOriginToCopyHeader, npDtype) :
+        # imgToSave is not copied. It should not be modified by the caller after this.
+        self._raiseErrorIfAny()
+        self._queue.put( (imgToSave, filepathTarget, filepathOriginToCopyHeader, npDtype) ) # Blocks if the queue is full.
+
+    def flush(self) :
+        # Waits until every submitted image is written. Raises the first error of the writer threads, if any.
+        self._queue.join()
+        self._raiseErrorIfAny()
+
+    def close(self) :
+        # Flushes and stops the threads.
+        try :
+            self.flush()
+        finally :
+            for _ in self._threads :
+                self._queue.put(None)
+            for thread in self._threads :
+                thread.join()
+            self._threads = []
+
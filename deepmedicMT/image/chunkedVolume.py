@@ -0,0 +1,216 @@
+# Copyright (c) 2016, Konstantinos Kamnitsas
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the BSD license. See the accompanying LICENSE file
+# or read the terms at https://opensource.org/licenses/BSD-3-Clause.
+
+from __future__ import absolute_import, print_function, division
+
+import os
+import json
+import struct
+import zlib
+import numpy as np
+
+#################################################################
+#               Chunked, per-chunk compressed volumes           #
+#################################################################
+# A .cvol file holds a 3D volume split in blocks (default 32^3), each compressed separately, plus an index of where each block is.
+# Reading a segment only decompresses the blocks that the segment touches, instead of the whole volume as with .nii.gz.
+# File layout: [magic, 8 bytes][length of header, uint64][json header][compressed blocks, in C-order of the grid of blocks].
+# The header also keeps the affine and voxel-sizes of the original NIFTI, so that predictions can be saved with them.
+
+CHUNKED_VOLUME_EXTENSION = ".cvol"
+MAGIC_OF_CHUNKED_VOLUME = b"DMCVOL01"
+DEFAULT_CHUNK_SHAPE = [32, 32, 32]
+
+
+def isChunkedVolumeFile(filepath) :
+    return filepath.endswith(CHUNKED_VOLUME_EXTENSION)
+
+
+def saveVolumeAsChunked(img, filepathTarget, affine=None, zooms=None, chunkShape=DEFAULT_CHUNK_SHAPE, compressionLevel=1) :
+    # img: 3D numpy array.
+    img = np.ascontiguousarray(img)
+    assert len(img.shape) == 3
+    numberOfChunksPerAxis = [ int(np.ceil(img.shape[axis_i] * 1.0 / chunkShape[axis_i])) for axis_i in range(3) ]
+
+    compressedChunks = []
+    for r_i in range(numberOfChunksPerAxis[0]) :
+        for c_i in range(numberOfChunksPerAxis[1]) :
+            for z_i in range(numberOfChunksPerAxis[2]) :
+                chunk = img[r_i*chunkShape[0] : (r_i+1)*chunkShape[0],
+                            c_i*chunkShape[1] : (c_i+1)*chunkShape[1],
+                            z_i*chunkShape[2] : (z_i+1)*chunkShape[2]]
+                compressedChunks.append( zlib.compress(np.ascontiguousarray(chunk).tobytes(), compressionLevel) )
+    offsets = [0]
+    for compressedChunk in compressedChunks[:-1] :
+        offsets.append(offsets[-1] + len(compressedChunk))
+
+    header = {  "shape": list(img.shape),
+                "dtype": img.dtype.str,
+                "chunk_shape": list(chunkShape),
+                "offsets": offsets,
+                "sizes": [len(compressedChunk) for compressedChunk in compressedChunks],
+                "affine": np.asarray(affine).tolist() if affine is not None else None,
+                "zooms": [float(zoom) for zoom in zooms] if zooms is not None else None }
+    headerBytes = json.dumps(header).encode("utf-8")
+
+    filepathTemp = filepathTarget + ".tmp" + str(os.getpid())
+    with open(filepathTemp, "wb") as fileOut :
+        fileOut.write(MAGIC_OF_CHUNKED_VOLUME)
+        fileOut.write(struct.pack("<Q", len(headerBytes)))
+        fileOut.write(headerBytes)
+        for compressedChunk in compressedChunks :
+            fileOut.write(compressedChunk)
+    os.rename(filepathTemp, filepathTarget)
+
+
+class ChunkedVolume(object):
+    # Read-only, array-like access to a .cvol file. Supports basic slicing (ints and slices with positive step) in all 3 axes.
+    # Only the touched chunks are read and decompressed. The most recently used chunks are kept, as neighbouring segments share them.
+
+    def __init__(self, filepath, maxNumberOfChunksKept=64) :
+        self.filepath = filepath
+        with open(filepath, "rb") as fileIn :
+            if fileIn.read(len(MAGIC_OF_CHUNKED_VOLUME)) != MAGIC_OF_CHUNKED_VOLUME :
+                raise IOError("ERROR: File [" + str(filepath) + "] is not a chunked volume (" + CHUNKED_VOLUME_EXTENSION + ").")
+            (lengthOfHeader,) = struct.unpack("<Q", fileIn.read(8))
+            header = json.loads(fileIn.read(lengthOfHeader).decode("utf-8"))
+        self._startOfData = len(MAGIC_OF_CHUNKED_VOLUME) + 8 + lengthOfHeader
+
+        self.shape = tuple(header["shape"])
+        self.dtype = np.dtype(header["dtype"])
+        self.ndim = 3
+        self.affine = np.asarray(header["affine"]) if header["affine"] is not None else None
+        self.zooms = header["zooms"]
+        self._chunkShape = header["chunk_shape"]
+        self._offsets = header["offsets"]
+        self._sizes = header["sizes"]
+        self._numberOfChunksPerAxis = [ int(np.ceil(self.shape[axis_i] * 1.0 / self._chunkShape[axis_i])) for axis_i in range(3) ]
+
+        self._maxNumberOfChunksKept = maxNumberOfChunksKept
+        self._chunksKept = {} # flat index of chunk -> decompressed chunk
+        self._orderOfUseOfChunksKept = []
+        self._fileIn = None
+
+    def __getstate__(self) :
+        # Do not pickle the open file and the decompressed chunks.
+        state = self.__dict__.copy()
+        state["_fileIn"] = None; state["_chunksKept"] = {}; state["_orderOfUseOfChunksKept"] = []
+        return state
+
+    def __len__(self) :
+        return self.shape[0]
+
+    def _getChunk(self, r_i, c_i, z_i) :
+        flatIndexOfChunk = (r_i * self._numberOfChunksPerAxis[1] + c_i) * self._numberOfChunksPerAxis[2] + z_i
+        if flatIndexOfChunk in self._chunksKept :
+            self._orderOfUseOfChunksKept.remove(flatIndexOfChunk)
+            self._orderOfUseOfChunksKept.append(flatIndexOfChunk)
+            return self._chunksKept[flatIndexOfChunk]
+
+        if self._fileIn is None :
+            self._fileIn = open(self.filepath, "rb")
+        self._fileIn.seek(self._startOfData + self._offsets[flatIndexOfChunk])
+        chunkBytes = zlib.decompress(self._fileIn.read(self._sizes[flatIndexOfChunk]))
+        shapeOfChunk = [ min(self._chunkShape[0], self.shape[0] - r_i*self._chunkShape[0]),
+                         min(self._chunkShape[1], self.shape[1] - c_i*self._chunkShape[1]),
+                         min(self._chunkShape[2], self.shape[2] - z_i*self._chunkShape[2]) ]
+        chunk = np.frombuffer(chunkBytes, dtype=self.dtype).reshape(shapeOfChunk)
+
+        self._chunksKept[flatIndexOfChunk] = chunk
+        self._orderOfUseOfChunksKept.append(flatIndexOfChunk)
+        if len(self._orderOfUseOfChunksKept) > self._maxNumberOfChunksKept :
+            del self._chunksKept[ self._orderOfUseOfChunksKept.pop(0) ]
+        return chunk
+
+    def _readRegion(self, lowRcz, highNonInclRcz) :
+        # Reads the dense box [low, high) of the volume.
+        region = np.empty([ max(0, highNonInclRcz[axis_i] - lowRcz[axis_i]) for axis_i in range(3) ], dtype=self.dtype)
+        if region.size == 0 :
+            return region
+        firstChunkRcz = [ lowRcz[axis_i] // self._chunkShape[axis_i] for axis_i in range(3) ]
+        lastChunkRcz = [ (highNonInclRcz[axis_i] - 1) // self._chunkShape[axis_i] for axis_i in range(3) ]
+        for r_i in range(firstChunkRcz[0], lastChunkRcz[0] + 1) :
+            for c_i in range(firstChunkRcz[1], lastChunkRcz[1] + 1) :
+                for z_i in range(firstChunkRcz[2], lastChunkRcz[2] + 1) :
+                    chunk = self._getChunk(r_i, c_i, z_i)
+                    startOfChunkRcz = [r_i*self._chunkShape[0], c_i*self._chunkShape[1], z_i*self._chunkShape[2]]
+                    # Intersection of the chunk with the region, in volume coordinates.
+                    lowOfIntersRcz = [ max(lowRcz[axis_i], startOfChunkRcz[axis_i]) for axis_i in range(3) ]
+                    highOfIntersRcz = [ min(highNonInclRcz[axis_i], startOfChunkRcz[axis_i] + chunk.shape[axis_i]) for axis_i in range(3) ]
+                    region[ lowOfIntersRcz[0]-lowRcz[0] : highOfIntersRcz[0]-lowRcz[0],
+                            lowOfIntersRcz[1]-lowRcz[1] : highOfIntersRcz[1]-lowRcz[1],
+                            lowOfIntersRcz[2]-lowRcz[2] : highOfIntersRcz[2]-lowRcz[2] ] = \
+                        chunk[  lowOfIntersRcz[0]-startOfChunkRcz[0] : highOfIntersRcz[0]-startOfChunkRcz[0],
+                                lowOfIntersRcz[1]-startOfChunkRcz[1] : highOfIntersRcz[1]-startOfChunkRcz[1],
+                                lowOfIntersRcz[2]-startOfChunkRcz[2] : highOfIntersRcz[2]-startOfChunkRcz[2] ]
+        return region
+
+    def __getitem__(self, key) :
+        if not isinstance(key, tuple) :
+            key = (key,)
+        if Ellipsis in key :
+            indexOfEllipsis = key.index(Ellipsis)
+            key = key[:indexOfEllipsis] + (slice(None),)*(3 - len(key) + 1) + key[indexOfEllipsis+1:]
+        key = key + (slice(None),)*(3 - len(key))
+
+        lowRcz = []; highNonInclRcz = []; stepsRcz = []; axesToSqueeze = []
+        for axis_i in range(3) :
+            if isinstance(key[axis_i], slice) :
+                (start, stop, step) = key[axis_i].indices(self.shape[axis_i])
+                if step < 0 :
+                    raise IndexError("ERROR: ChunkedVolume does not support negative steps. Reflect the returned array instead.")
+                lowRcz.append(start); highNonInclRcz.append(max(start, stop)); stepsRcz.append(step)
+            else : # integer
+                index = int(key[axis_i])
+                index = index + self.shape[axis_i] if index < 0 else index
+                if index < 0 or index >= self.shape[axis_i] :
+                    raise IndexError("ERROR: Index [" + str(key[axis_i]) + "] out of bounds for axis " + str(axis_i) + " with size " + str(self.shape[axis_i]))
+                lowRcz.append(index); highNonInclRcz.append(index + 1); stepsRcz.append(1); axesToSqueeze.append(axis_i)
+
+        region = self._readRegion(lowRcz, highNonInclRcz)[::stepsRcz[0], ::stepsRcz[1], ::stepsRcz[2]]
+        if len(axesToSqueeze) > 0 :
+            region = np.squeeze(region, axis=tuple(axesToSqueeze))
+        return region
+
+    def __array__(self, dtype=None) :
+        img = self._readRegion([0,0,0], list(self.shape))
+        return img if dtype is None else img.astype(dtype)
+
+    def close(self) :
+        if self._fileIn is not None :
+            self._fileIn.close()
+            self._fileIn = None
+        self._chunksKept = {}; self._orderOfUseOfChunksKept = []
+
+
+class StackOfVolumes(object):
+    # Behaves like a 4D array (channels, r, c, z) for the indexing done by the segment extraction, without loading the volumes.
+    # stack[channel_i] gives the volume of a channel. stack[:, slices...] reads only the requested region of every channel.
+
+    def __init__(self, listOfVolumes) :
+        self._volumes = listOfVolumes
+        self.shape = (len(listOfVolumes),) + tuple(listOfVolumes[0].shape)
+        self.ndim = 4
+        self.dtype = listOfVolumes[0].dtype
+
+    def __len__(self) :
+        return len(self._volumes)
+
+    def getVolumes(self) :
+        return self._volumes
+
+    def __getitem__(self, key) :
+        if not isinstance(key, tuple) :
+            return self._volumes[key] if not isinstance(key, slice) else StackOfVolumes(self._volumes[key])
+        keyOfChannels = key[0]; keyOfSpace = key[1:]
+        if isinstance(keyOfChannels, slice) :
+            return np.stack([ volume[keyOfSpace] for volume in self._volumes[keyOfChannels] ], axis=0)
+        return self._volumes[keyOfChannels][keyOfSpace]
+
+    def __array__(self, dtype=None) :
+        stack = np.stack([ np.asarray(volume) for volume in self._volumes ], axis=0)
+        return stack if dtype is None else stack.astype(dtype)
@@ -8,15 +8,29 @@
 from __future__ import absolute_import, division
 
 import os
+import glob
+import gzip
+import hashlib
 import nibabel as nib
 import numpy as np
 
+from deepmedicMT.image.chunkedVolume import isChunkedVolumeFile, ChunkedVolume, saveVolumeAsChunked, DEFAULT_CHUNK_SHAPE
 
-def loadVolume(filepath):
+
+def loadVolume(filepath, decodedVolumesCacheFolder=None):
     # Loads the image specified by filepath.
     # Returns a 3D np array.
     # The image can be 2D, but will be returned as 3D, with dimensions =[x, y, 1]
     # It can also be 4D, of shape [x,y,z,1], and will be returned as 3D. If it's 4D with 4th dimension > 1, assertion will be raised. 
+    # decodedVolumesCacheFolder: If given, the decoded array is kept there as .npy and later loads are memory-mapped from it (read-only).
+    if decodedVolumesCacheFolder is not None :
+        return loadVolumeThroughDecodedCache(filepath, decodedVolumesCacheFolder)
+    if isChunkedVolumeFile(filepath) : # Stored already as 3D. Read all of it.
+        chunkedVolume = ChunkedVolume(filepath)
+        img = np.asarray(chunkedVolume)
+        chunkedVolume.close()
+        return img
+    
     proxy = nib.load(filepath)
     img = proxy.get_data()
     proxy.uncache()
@@ -32,35 +46,142 @@ def loadVolume(filepath):
     return img
 
 
+#=========== Cache of decoded volumes, to avoid inflating the same .nii.gz every subepoch =============
+def getFilepathOfDecodedVolumeInCache(filepath, decodedVolumesCacheFolder) :
+    # The name of the entry is: [hash of the abs path]_[hash of modification time and size].npy
+    # If the source file changes, its mtime/size change and so does the name of the entry. Thus the old entry is never read again.
+    absFilepath = os.path.abspath(filepath)
+    statOfSource = os.stat(absFilepath)
+    keyOfPath = hashlib.sha1(absFilepath.encode("utf-8")).hexdigest()[:16]
+    keyOfVersion = hashlib.sha1( (repr(statOfSource.st_mtime) + "_" + str(statOfSource.st_size)).encode("utf-8") ).hexdigest()[:16]
+    return os.path.join(decodedVolumesCacheFolder, keyOfPath + "_" + keyOfVersion + ".npy")
+
+
+def getCompactDtypeForDecodedVolume(img) :
+    # Intensities are kept as float32. Labels and masks that fit are kept as uint8.
+    if img.dtype.kind == 'f' :
+        return np.dtype(np.float32)
+    elif img.dtype.kind in ['i','u','b'] and img.size > 0 and np.min(img) >= 0 and np.max(img) <= 255 :
+        return np.dtype(np.uint8)
+    else :
+        return img.dtype
+    
+    
+def loadVolumeThroughDecodedCache(filepath, decodedVolumesCacheFolder) :
+    filepathInCache = getFilepathOfDecodedVolumeInCache(filepath, decodedVolumesCacheFolder)
+    if os.path.isfile(filepathInCache) :
+        try :
+            return np.load(filepathInCache, mmap_mode='r')
+        except (IOError, ValueError) : # Corrupted entry. Decode again and overwrite it below.
+            pass
+        
+    img = loadVolume(filepath)
+    img = np.ascontiguousarray(img, dtype=getCompactDtypeForDecodedVolume(img))
+    
+    if not os.path.isdir(decodedVolumesCacheFolder) :
+        try :
+            os.makedirs(decodedVolumesCacheFolder)
+        except OSError : # Created in the meantime by another sampling process.
+            pass
+    # Remove stale entries of the same source file (previous mtime/size).
+    prefixOfEntriesOfSource = os.path.basename(filepathInCache).split("_")[0]
+    for filepathOfStaleEntry in glob.glob(os.path.join(decodedVolumesCacheFolder, prefixOfEntriesOfSource + "_*.npy")) :
+        if filepathOfStaleEntry != filepathInCache and ".tmp" not in filepathOfStaleEntry :
+            try :
+                os.remove(filepathOfStaleEntry)
+            except OSError :
+                pass
+    # Write to a temporary file and rename, so that parallel samplers never read a half-written entry.
+    filepathTemp = filepathInCache[:-4] + ".tmp" + str(os.getpid()) + ".npy"
+    np.save(filepathTemp, img)
+    os.rename(filepathTemp, filepathInCache)
+    
+    return np.load(filepathInCache, mmap_mode='r')
+
+
+def getAffineAndZoomsOfVolume(filepath) :
+    # The original image may be a NIFTI or a chunked volume (.cvol), which keeps the affine and zooms of the NIFTI it was made from.
+    if isChunkedVolumeFile(filepath) :
+        chunkedVolume = ChunkedVolume(filepath)
+        affine = chunkedVolume.affine if chunkedVolume.affine is not None else np.eye(4)
+        zooms = chunkedVolume.zooms if chunkedVolume.zooms is not None else [1.0]*3
+        return (affine, tuple(zooms))
+    proxy = nib.load(filepath)
+    affine = proxy.affine
+    zooms = proxy.header.get_zooms()
+    proxy.uncache()
+    return (affine, zooms)
+
+
+def getShapeOfVolume(filepath) :
+    # 3D shape, as loadVolume() would return it, read from the header only.
+    if isChunkedVolumeFile(filepath) :
+        chunkedVolume = ChunkedVolume(filepath)
+        shape = tuple(chunkedVolume.shape)
+        chunkedVolume.close()
+        return shape
+    shape = tuple(nib.load(filepath).shape)
+    return shape + (1,) if len(shape) == 2 else shape[:3]
+
+
+def convertVolumeToChunked(filepathSource, filepathTarget, chunkShape=None, compressionLevel=1) :
+    # Converts a NIFTI (or any file loadVolume reads) to the chunked format. Returns the shape of the volume.
+    img = loadVolume(filepathSource)
+    (affine, zooms) = getAffineAndZoomsOfVolume(filepathSource)
+    chunkShape = chunkShape if chunkShape is not None else DEFAULT_CHUNK_SHAPE
+    saveVolumeAsChunked(img, filepathTarget, affine, zooms[:3], chunkShape, compressionLevel)
+    return img.shape
+
+
+def writeImgToNii(imgToSave, filepathTarget, affine, zooms, npDtype = np.dtype(np.float32), compressOutput=True, gzipLevel=None) :
+    # Writes the image with the given affine and voxel-sizes. Returns the final filepath.
+    # compressOutput: If True, saved as .nii.gz, otherwise as .nii. Any of the two extensions in filepathTarget is replaced.
+    # gzipLevel: 1 (fastest) to 9 (smallest). If None, nibabel's default is used.
+    # npDtype: If integer and imgToSave is float (eg uint8 for probability maps), nibabel quantises the data, and stores...
+    # ... the scaling in the header's scl_slope/scl_inter. Readers (nibabel's get_fdata()) apply it back.
+    newLabelImg = nib.Nifti1Image(imgToSave, affine)
+    newLabelImg.set_data_dtype(npDtype)
+    
+    dimsImgToSave = len(imgToSave.shape)
+    newZooms = list(zooms[:dimsImgToSave])
+    if len(newZooms) < dimsImgToSave : #Eg if original image was 3D, but I need to save a multi-channel image.
+        newZooms = newZooms + [1.0]*(dimsImgToSave - len(newZooms))
+    newLabelImg.header.set_zooms(newZooms)
+    
+    filepathTarget = os.path.abspath(filepathTarget)
+    for extension in [".nii.gz", ".nii"] :
+        if filepathTarget.endswith(extension) :
+            filepathTarget = filepathTarget[:-len(extension)]
+            break
+    filepathTarget = filepathTarget + (".nii.gz" if compressOutput else ".nii")
+    
+    if compressOutput and gzipLevel is not None :
+        with gzip.GzipFile(filepathTarget, "wb", compresslevel=gzipLevel) as fileOut :
+            newLabelImg.to_file_map( nib.Nifti1Image.make_file_map({"image": fileOut}) )
+    else :
+        nib.save(newLabelImg, filepathTarget)
+    return filepathTarget
+
+
 #This is the generic function.
 def saveImgToNiiWithOriginalHdr(imgToSave,
                                     filepathTarget,
                                     filepathOriginToCopyHeader,
                                     npDtype = np.dtype(np.float32),
-                                    log=None) :
+                                    log=None,
+                                    writer=None) :
     # imgToSave: 3d np array.
     # filepathTarget: filepath where to save.
     # filepathOriginToCopyHeader: original image, where to copy the header over to the target image.
+    # writer: If given (an AsyncImageWriter), the image is queued and written in the background. imgToSave should not be modified afterwards.
+    if writer is not None :
+        writer.submit(imgToSave, filepathTarget, filepathOriginToCopyHeader, npDtype)
+        return
     
     # Load original image.
-    proxy_origin = nib.load(filepathOriginToCopyHeader)
-    hdr_origin = proxy_origin.header
-    affine_origin = proxy_origin.affine
-    proxy_origin.uncache()
-    
-    newLabelImg = nib.Nifti1Image(imgToSave, affine_origin)
-    newLabelImg.set_data_dtype(npDtype)
-    
-    dimsImgToSave = len(imgToSave.shape)
-    newZooms = list(hdr_origin.get_zooms()[:dimsImgToSave])
-    if len(newZooms) < dimsImgToSave : #Eg if original image was 3D, but I need to save a multi-channel image.
-        newZooms = newZooms + [1.0]*(dimsImgToSave - len(newZooms))
-    newLabelImg.header.set_zooms(newZooms)
+    (affine_origin, zooms_origin) = getAffineAndZoomsOfVolume(filepathOriginToCopyHeader)
     
-    filepathTarget = os.path.abspath(filepathTarget)
-    if not filepathTarget.endswith(".nii.gz") :
-        filepathTarget = filepathTarget + ".nii.gz"
-    nib.save(newLabelImg, filepathTarget)
+    filepathTarget = writeImgToNii(imgToSave, filepathTarget, affine_origin, zooms_origin, npDtype)
     
     if log!=None :
         log.print3("Image saved at: " + str(filepathTarget))
@@ -75,7 +196,8 @@ def savePredImgToNiiWithOriginalHdr(labelImageCreatedByPredictions,
                                                    case_i, #the index (in the list of filepathnames) of the current image segmented.
                                                    suffixToAdd = "",
                                                    npDtype = np.dtype(np.float32),
-                                                   log=None) :
+                                                   log=None,
+                                                   writer=None) :
     
     #give as arguments the list of the patient filepaths and the index of the currently segmented image, so that ...
     #... I can get the header, affine RAS trans etc from it and copy it for the new image.
@@ -98,7 +220,8 @@ def savePredImgToNiiWithOriginalHdr(labelImageCreatedByPredictions,
                                 filepathTarget,
                                 filepathOriginToCopyHeader,
                                 npDtype,
-                                log)
+                                log,
+                                writer)
 
 
 
@@ -111,7 +234,8 @@ def saveFmImgToNiiWithOriginalHdr(  fmImageCreatedByVisualisation,
                                                         index_of_typeOfPathway_to_visualize,
                                                         index_of_layer_in_pathway_to_visualize,
                                                         index_of_FM_in_pathway_to_visualize,
-                                                        log=None) : #the index (in the list of filepathnames) of the current image segmented :
+                                                        log=None,
+                                                        writer=None) : #the index (in the list of filepathnames) of the current image segmented :
     #give as arguments the list of the patient filepaths and the index of the currently segmented image, so that ...
     #... I can get the header, affine RAS trans etc from it and copy it for the new image.
     
@@ -138,7 +262,8 @@ def saveFmImgToNiiWithOriginalHdr(  fmImageCreatedByVisualisation,
                                 filepathTarget,
                                 filepathOriginToCopyHeader,
                                 np.dtype(np.float32),
-                                log)
+                                log,
+                                writer)
 
 
 
@@ -146,7 +271,8 @@ def save4DImgWithAllFmsToNiiWithOriginalHdr(multidimImageWithAllVisualisedFms,
                                             listOfNamesToGiveToFmVisualisationsIfSaving,
                                             listOfFilepathsToEachChannelOfEachPatient,
                                             image_i,
-                                            log=None) : #the index (in the list of filepathnames) of the current image segmented :
+                                            log=None,
+                                            writer=None) : #the index (in the list of filepathnames) of the current image segmented :
     #give as arguments the list of the patient filepaths and the index of the currently segmented image, so that ...
     #... I can get the header, affine RAS trans etc from it and copy it for the new image.
     
@@ -169,6 +295,7 @@ def save4DImgWithAllFmsToNiiWithOriginalHdr(multidimImageWithAllVisualisedFms,
                                 filepathTarget,
                                 filepathOriginToCopyHeader,
                                 np.dtype(np.float32),
-                                log)
+                                log,
+                                writer)
     
     
\ No newline at end of file
@@ -7,8 +7,12 @@
 
 from __future__ import absolute_import, division
 
+import itertools
 import numpy as np
 
+SLICE_ALL = slice(None)
+SLICE_TO_FLIP = slice(None, None, -1)
+
 
 def reflectImageArrayIfNeeded(reflectFlags, imageArray) :
     stepsForReflectionPerDimension = [-1 if reflectFlags[0] else 1, -1 if reflectFlags[1] else 1, -1 if reflectFlags[2] else 1]
@@ -35,11 +39,18 @@ def calculateTheZeroIntensityOf3dImage(image3d) :
 def padCnnInputs(array1, cnnReceptiveField, imagePartDimensions) : #Works for 2D as well I think.
     # array1: the loaded volume. Not segments.
     # imagePartDimensions: The size of image segments that the cnn gets. So that we calculate the pad that will go to the side of the volume.
-    cnnReceptiveFieldArray = np.asarray(cnnReceptiveField, dtype="int16")
-    array1Dimensions = np.asarray(array1.shape,dtype="int16")
     if len(array1.shape) != 3 :
         print("ERROR! Given array in padCnnInputs() was expected of 3-dimensions, but was passed an array of dimensions: ", array1.shape,", Exiting!")
         exit(1)
+    tupleOfPaddingPerAxes = getPaddingForCnnInputs(array1.shape, cnnReceptiveField, imagePartDimensions)
+    #Very poor design because channels/gt/bmask etc are all getting back a different padding? tupleOfPaddingPerAxes is returned in order for unpad to know.
+    return [np.lib.pad(array1, tupleOfPaddingPerAxes, 'reflect' ), tupleOfPaddingPerAxes]
+
+
+def getPaddingForCnnInputs(shapeOfVolume, cnnReceptiveField, imagePartDimensions) :
+    # Returns ( (padLeftR, padRightR), (padLeftC,padRightC), (padLeftZ,padRightZ)), as used by padCnnInputs() and ReflectPaddedVolume.
+    cnnReceptiveFieldArray = np.asarray(cnnReceptiveField, dtype="int16")
+    array1Dimensions = np.asarray(shapeOfVolume,dtype="int16")
     #paddingValue = (array1[0,0,0] + array1[-1,0,0] + array1[0,-1,0] + array1[-1,-1,0] + array1[0,0,-1] + array1[-1,0,-1] + array1[0,-1,-1] + array1[-1,-1,-1]) / 8.0
     #Calculate how much padding needed to fully infer the original array1, taking only the receptive field in account.
     paddingAtLeftPerAxis = (cnnReceptiveFieldArray - 1) // 2
@@ -48,9 +59,158 @@ def padCnnInputs(array1, cnnReceptiveField, imagePartDimensions) : #Works for 2D
     paddingFurtherToTheRightNeededForSegment = np.maximum(0, np.asarray(imagePartDimensions,dtype="int16")-(array1Dimensions+paddingAtLeftPerAxis+paddingAtRightPerAxis))
     paddingAtRightPerAxis += paddingFurtherToTheRightNeededForSegment
     
-    tupleOfPaddingPerAxes = ( (paddingAtLeftPerAxis[0],paddingAtRightPerAxis[0]), (paddingAtLeftPerAxis[1],paddingAtRightPerAxis[1]), (paddingAtLeftPerAxis[2],paddingAtRightPerAxis[2]))
-    #Very poor design because channels/gt/bmask etc are all getting back a different padding? tupleOfPaddingPerAxes is returned in order for unpad to know.
-    return [np.lib.pad(array1, tupleOfPaddingPerAxes, 'reflect' ), tupleOfPaddingPerAxes]
+    return ( (paddingAtLeftPerAxis[0],paddingAtRightPerAxis[0]), (paddingAtLeftPerAxis[1],paddingAtRightPerAxis[1]), (paddingAtLeftPerAxis[2],paddingAtRightPerAxis[2]))
+
+
+class ReflectPaddedVolume(object):
+    # A reflected (optionally) and reflect-padded view of a 3D volume, without copying the volume.
+    # Slicing it gives the same as slicing reflectImageArrayIfNeeded() and then padCnnInputs() of the volume, but only the requested segment is created.
+    # Indices in the padding are mapped to the volume on the fly, as np.lib.pad(..., 'reflect') does (mirror without repeating the edge).
+    # The volume can be a numpy array (or memory-map) or a ChunkedVolume. Only basic slicing with positive steps is asked from it.
+    # Slicing returns numpy arrays, so unpadCnnOutputs() etc work on it as on a padded array.
+    
+    def __init__(self, volume, tupleOfPaddingPerAxes=((0,0),(0,0),(0,0)), reflectFlags=(0,0,0)) :
+        self._volume = volume
+        self._paddingAtLeftPerAxis = [ int(tupleOfPaddingPerAxes[axis_i][0]) for axis_i in range(3) ]
+        self._reflectFlags = [ bool(reflectFlags[axis_i]) for axis_i in range(3) ]
+        self.shape = tuple([ int(volume.shape[axis_i] + tupleOfPaddingPerAxes[axis_i][0] + tupleOfPaddingPerAxes[axis_i][1]) for axis_i in range(3) ])
+        self.dtype = volume.dtype
+        self.ndim = 3
+        
+    def __len__(self) :
+        return self.shape[0]
+    
+    def _getIndicesInVolume(self, indicesInPadded, axis_i) :
+        sizeOfVolume = self._volume.shape[axis_i]
+        indicesInVolume = np.asarray(indicesInPadded, dtype="int64") - self._paddingAtLeftPerAxis[axis_i]
+        if sizeOfVolume == 1 :
+            indicesInVolume = np.zeros(indicesInVolume.shape, dtype="int64")
+        else : # Reflection without repeating the edge is periodic, with period 2*(size-1).
+            periodOfReflection = 2 * (sizeOfVolume - 1)
+            indicesInVolume = np.mod(indicesInVolume, periodOfReflection)
+            indicesInVolume = np.where(indicesInVolume >= sizeOfVolume, periodOfReflection - indicesInVolume, indicesInVolume)
+        if self._reflectFlags[axis_i] :
+            indicesInVolume = sizeOfVolume - 1 - indicesInVolume
+        return indicesInVolume
+    
+    def __getitem__(self, key) :
+        if not isinstance(key, tuple) :
+            key = (key,)
+        if Ellipsis in key :
+            indexOfEllipsis = key.index(Ellipsis)
+            key = key[:indexOfEllipsis] + (slice(None),)*(3 - len(key) + 1) + key[indexOfEllipsis+1:]
+        key = key + (slice(None),)*(3 - len(key))
+        
+        indicesInVolumePerAxis = []; axesToSqueeze = []
+        for axis_i in range(3) :
+            if isinstance(key[axis_i], slice) :
+                indicesInPadded = np.arange(*key[axis_i].indices(self.shape[axis_i]))
+            else : # integer
+                index = int(key[axis_i])
+                index = index + self.shape[axis_i] if index < 0 else index
+                if index < 0 or index >= self.shape[axis_i] :
+                    raise IndexError("ERROR: Index [" + str(key[axis_i]) + "] out of bounds for axis " + str(axis_i) + " with size " + str(self.shape[axis_i]))
+                indicesInPadded = np.asarray([index])
+                axesToSqueeze.append(axis_i)
+            indicesInVolumePerAxis.append(self._getIndicesInVolume(indicesInPadded, axis_i))
+        
+        if min([ len(indices) for indices in indicesInVolumePerAxis ]) == 0 :
+            return np.zeros([ len(indices) for indices in indicesInVolumePerAxis ], dtype=self.dtype)
+        
+        # Read the bounding box of the needed voxels, then pick them from it. Slices are used when possible, to avoid copies.
+        lowPerAxis = [ int(indices.min()) for indices in indicesInVolumePerAxis ]
+        highNonInclPerAxis = [ int(indices.max()) + 1 for indices in indicesInVolumePerAxis ]
+        region = self._volume[lowPerAxis[0]:highNonInclPerAxis[0], lowPerAxis[1]:highNonInclPerAxis[1], lowPerAxis[2]:highNonInclPerAxis[2]]
+        slicesOrIndicesPerAxis = []; needsFancyIndexing = False
+        for axis_i in range(3) :
+            indicesInRegion = indicesInVolumePerAxis[axis_i] - lowPerAxis[axis_i]
+            stepOfIndices = int(indicesInRegion[1] - indicesInRegion[0]) if len(indicesInRegion) > 1 else 1
+            if stepOfIndices != 0 and np.all(np.diff(indicesInRegion) == stepOfIndices) :
+                stop = int(indicesInRegion[-1]) + (1 if stepOfIndices > 0 else -1)
+                slicesOrIndicesPerAxis.append( slice(int(indicesInRegion[0]), stop if stop >= 0 else None, stepOfIndices) )
+            else : # Crosses the border of the volume.
+                slicesOrIndicesPerAxis.append(indicesInRegion)
+                needsFancyIndexing = True
+        if needsFancyIndexing :
+            indicesPerAxis = [ np.arange(region.shape[axis_i])[slicesOrIndicesPerAxis[axis_i]] for axis_i in range(3) ]
+            segment = region[np.ix_(*indicesPerAxis)]
+        else :
+            segment = region[tuple(slicesOrIndicesPerAxis)]
+        if len(axesToSqueeze) > 0 :
+            segment = np.squeeze(segment, axis=tuple(axesToSqueeze))
+        return segment
+    
+    def getPlanToReadSlices(self, slicesPerAxis) :
+        # How to copy self[slicesPerAxis] (3 slices with positive steps, as when extracting segments) from the volume with basic slicing only.
+        # Per axis, runs of ( slice of the output, slice of the volume, flip ). Along an axis where the slice is within the volume, this is one run,...
+        # ... the voxels sliced from the volume directly (flipped, if reflected). Index maps are only made for axes where it reaches into the padding,...
+        # ... split into the runs where the mapped voxels are equally spaced. Returns the pieces [ (slices of the output, slices of the volume, slices to flip) ]...
+        # ... of all combinations of runs: One piece for a region within the volume. Same for all volumes of the same shape, padding and reflection.
+        runsPerAxis = []
+        for axis_i in range(3) :
+            (start, stop, step) = slicesPerAxis[axis_i].indices(self.shape[axis_i])
+            numberOfVoxels = len(range(start, stop, step))
+            sizeOfVolume = self._volume.shape[axis_i]
+            lowInVolume = start - self._paddingAtLeftPerAxis[axis_i]
+            lastInVolume = lowInVolume + (numberOfVoxels - 1) * step
+            if numberOfVoxels > 0 and lowInVolume >= 0 and lastInVolume < sizeOfVolume :
+                if self._reflectFlags[axis_i] :
+                    (lowInVolume, lastInVolume) = (sizeOfVolume - 1 - lastInVolume, sizeOfVolume - 1 - lowInVolume)
+                runsPerAxis.append( [ (slice(0, numberOfVoxels), slice(lowInVolume, lastInVolume + 1, step), self._reflectFlags[axis_i]) ] )
+            else : # Reaches into the padding.
+                runsPerAxis.append( self._getRunsOfIndices( self._getIndicesInVolume(np.arange(start, stop, step), axis_i).tolist() ) )
+        return [ ( tuple([ run[0] for run in runs ]), tuple([ run[1] for run in runs ]), tuple([ SLICE_TO_FLIP if run[2] else SLICE_ALL for run in runs ]) )
+                 for runs in itertools.product(*runsPerAxis) ]
+    
+    def _getRunsOfIndices(self, indices) :
+        runs = []; first = 0
+        while first < len(indices) :
+            last = first
+            stepOfRun = indices[first+1] - indices[first] if first + 1 < len(indices) else 0
+            if stepOfRun != 0 :
+                while last + 1 < len(indices) and indices[last+1] - indices[last] == stepOfRun :
+                    last += 1
+            (low, high) = (min(indices[first], indices[last]), max(indices[first], indices[last]))
+            runs.append( (slice(first, last + 1), slice(low, high + 1, max(abs(stepOfRun), 1)), indices[last] < indices[first]) )
+            first = last + 1
+        return runs
+    
+    def getPlansToReadRegions(self, lowOfRegions, shapeOfRegions, stepPerAxis) :
+        # getPlanToReadSlices() of many regions at once. Region i takes shapeOfRegions[i] voxels from lowOfRegions[i], every step-th (arrays (N, 3)).
+        # Regions within the volume (most segments) are planned together, with arrays. Only those reaching into the padding are planned one by one.
+        lowOfRegions = np.asarray(lowOfRegions, dtype="int64"); shapeOfRegions = np.asarray(shapeOfRegions, dtype="int64")
+        stepPerAxis = np.asarray(stepPerAxis, dtype="int64")
+        sizeOfVolumePerAxis = np.asarray(self._volume.shape, dtype="int64")
+        lowInVolume = lowOfRegions - np.asarray(self._paddingAtLeftPerAxis, dtype="int64")
+        lastInVolume = lowInVolume + (shapeOfRegions - 1) * stepPerAxis
+        isInVolume = np.all( (lowInVolume >= 0) & (lastInVolume < sizeOfVolumePerAxis) & (shapeOfRegions > 0), axis=1 )
+        reflectFlags = np.asarray(self._reflectFlags)
+        (lowInVolume, lastInVolume) = ( np.where(reflectFlags, sizeOfVolumePerAxis - 1 - lastInVolume, lowInVolume),
+                                        np.where(reflectFlags, sizeOfVolumePerAxis - 1 - lowInVolume, lastInVolume) )
+        slicesToFlip = tuple([ SLICE_TO_FLIP if self._reflectFlags[axis_i] else SLICE_ALL for axis_i in range(3) ])
+        stepPerAxis = stepPerAxis.tolist()
+        plans = []
+        for (isIn, low, last, shape) in zip(isInVolume.tolist(), lowInVolume.tolist(), lastInVolume.tolist(), shapeOfRegions.tolist()) :
+            if isIn :
+                plans.append( [ ( (SLICE_ALL, SLICE_ALL, SLICE_ALL),
+                                  (slice(low[0], last[0] + 1, stepPerAxis[0]), slice(low[1], last[1] + 1, stepPerAxis[1]), slice(low[2], last[2] + 1, stepPerAxis[2])),
+                                  slicesToFlip ) ] )
+            else :
+                plans.append( None )
+        for region_i in np.flatnonzero(~isInVolume) :
+            plans[region_i] = self.getPlanToReadSlices( tuple([ slice(int(lowOfRegions[region_i, axis_i]),
+                                                                      int(lowOfRegions[region_i, axis_i] + (shapeOfRegions[region_i, axis_i] - 1) * stepPerAxis[axis_i] + 1),
+                                                                      stepPerAxis[axis_i]) for axis_i in range(3) ]) )
+        return plans
+    
+    def copyWithPlan(self, planToReadSlices, out) :
+        # out[...] = self[slicesPerAxis], given the plan of getPlanToReadSlices(slicesPerAxis) of this or a volume of the same geometry.
+        for (slicesOfOut, slicesOfVolume, slicesToFlip) in planToReadSlices :
+            out[slicesOfOut] = self._volume[slicesOfVolume][slicesToFlip]
+    
+    def __array__(self, dtype=None) :
+        volume = self[:, :, :]
+        return volume if dtype is None else volume.astype(dtype)
 
 
 #In the 3 first axes. Which means it can take a 4-dim image.
@@ -0,0 +1,86 @@
+# Copyright (c) 2016, Konstantinos Kamnitsas
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the BSD license. See the accompanying LICENSE file
+# or read the terms at https://opensource.org/licenses/BSD-3-Clause.
+
+from __future__ import absolute_import, print_function, division
+
+import numpy as np
+
+PYRAMID_STRIDED = "strided"
+PYRAMID_AVERAGED = "averaged"
+
+
+class SubsampledPyramid(object):
+    # Downsampled copies of the channels of a case, one per subsampling factor of the subsampled pathways. Built once per case, when loaded.
+    # The input of a subsampled pathway takes every f-th voxel (per axis) of the image, starting from a voxel that depends on the segment.
+    # So for each factor, the channels are split into the f^3 strided copies image[:, pr::fr, pc::fc, pz::fz] ("phases"), one per possible start.
+    # Voxel i of an axis is then voxel i//f of phase i%f. The voxels of a segment of the pathway are neighbours in a small volume,...
+    # ... instead of being f voxels apart in the full one. Together, the phases of a factor take as much memory as the channels.
+    # typeOfPyramid:
+    # > PYRAMID_STRIDED: The phases hold the voxels of the image. Segments are exactly the same as taken from the image.
+    # > PYRAMID_AVERAGED: Each voxel is first replaced by the mean of the f^3 voxels of the area it is the "central" voxel of (as subsampling assumes).
+    #   The subsampled pathways then see a low-pass version of the image, rather than every f-th voxel. Changes the input, opt-in.
+
+    def __init__(self, channels, subSamplingFactors, typeOfPyramid=PYRAMID_STRIDED) :
+        # channels: array (channels, r, c, z), as loaded (reflected/padded). Chunked channels are read whole for this.
+        # subSamplingFactors: list of [fr, fc, fz], one per subsampled pathway. The same factor is built once.
+        channels = np.asarray(channels)
+        self.shape = channels.shape
+        self.dtype = channels.dtype
+        self._phasesPerFactor = {} # tuple(factor) -> array (fr, fc, fz, channels, ceil(r/fr), ceil(c/fc), ceil(z/fz))
+        for subSamplingFactor in subSamplingFactors :
+            factor = tuple([ int(f) for f in subSamplingFactor ])
+            if factor in self._phasesPerFactor :
+                continue
+            channelsToSplit = channels if typeOfPyramid == PYRAMID_STRIDED else averageOverAreasOfSubsampling(channels, factor)
+            self._phasesPerFactor[factor] = splitToPhases(channelsToSplit, factor)
+        self.nbytes = sum([ phases.nbytes for phases in self._phasesPerFactor.values() ])
+
+    def readSlices(self, subSamplingFactor, slicesPerAxis) :
+        # Same as channels[:, slicesPerAxis] of the channels, for slices within the image with step equal to the factor. Returns (channels, dimR, dimC, dimZ).
+        # The voxels start, start+f, ... of an axis are the neighbouring voxels start//f, start//f + 1, ... of phase start%f. So a view of one phase.
+        phases = self._phasesPerFactor[ tuple([ int(f) for f in subSamplingFactor ]) ]
+        phasePerAxis = []; slicesInPhasePerAxis = []
+        for axis_i in range(3) :
+            (start, stop, step) = slicesPerAxis[axis_i].indices(self.shape[1+axis_i])
+            numberOfVoxels = len(range(start, stop, step))
+            phasePerAxis.append(start % step)
+            slicesInPhasePerAxis.append( slice(start // step, start // step + numberOfVoxels) )
+        return phases[ tuple(phasePerAxis) + (slice(None),) + tuple(slicesInPhasePerAxis) ]
+
+
+def splitToPhases(channels, subSamplingFactor) :
+    # Returns array (fr, fc, fz, channels, ceil(r/fr), ceil(c/fc), ceil(z/fz)). Entries past the end of shorter phases are never read, left 0.
+    (fr, fc, fz) = subSamplingFactor
+    shapeOfPhase = [ -(-channels.shape[1+axis_i] // subSamplingFactor[axis_i]) for axis_i in range(3) ]
+    phases = np.zeros( [fr, fc, fz, channels.shape[0]] + shapeOfPhase, dtype=channels.dtype )
+    for pr in range(fr) :
+        for pc in range(fc) :
+            for pz in range(fz) :
+                phase = channels[:, pr::fr, pc::fc, pz::fz]
+                phases[pr, pc, pz, :, :phase.shape[1], :phase.shape[2], :phase.shape[3]] = phase
+    return phases
+
+
+def averageOverAreasOfSubsampling(channels, subSamplingFactor) :
+    # Each voxel becomes the mean of the f-long window (per axis) that it is the "central" voxel of.
+    # The central voxel is 1 closer to the beginning if f is even, as in extraction of segments. Edge voxels are repeated out of the image.
+    averaged = np.asarray(channels, dtype="float32")
+    for axis_i in range(3) :
+        factor = subSamplingFactor[axis_i]
+        if factor == 1 :
+            continue
+        toCentralVoxelOfAnAveragedArea = factor//2 if factor%2==1 else (factor//2 - 1)
+        padding = [ (0,0) ] * 4
+        padding[1+axis_i] = (toCentralVoxelOfAnAveragedArea, factor - 1 - toCentralVoxelOfAnAveragedArea)
+        padded = np.lib.pad(averaged, padding, 'edge')
+        cumulative = np.cumsum(padded, axis=1+axis_i, dtype="float64")
+        cumulative = np.concatenate( [ np.zeros_like(np.take(cumulative, [0], axis=1+axis_i)), cumulative ], axis=1+axis_i )
+        sizeOfAxis = averaged.shape[1+axis_i]
+        averaged = ( ( np.take(cumulative, np.arange(factor, factor + sizeOfAxis), axis=1+axis_i) - \
+                       np.take(cumulative, np.arange(0, sizeOfAxis), axis=1+axis_i) ) / factor ).astype("float32")
+    return averaged.astype(channels.dtype, copy=False)
+
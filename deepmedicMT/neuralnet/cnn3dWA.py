@@ -184,6 +184,7 @@ class Cnn3d(object):
         
         self._ops_main['train']['cost'] = total_cost
         self._ops_main['train']['list_rp_rn_tp_tn'] = self.finalTargetLayer.getRpRnTpTnForTrain0OrVal1(y_gt,self.batchSize["train"], 0)
+        self._ops_main['train']['cost_per_segment'] = self.finalTargetLayer.getCostPerSegmentForTrain(y_gt, self.batchSize["train"]) # Fetched only for the HardExampleMap.
         self._ops_main['train']['updates_grouped_op'] = updates_grouped_op
         
         self._feeds_main['train']['x'] = self._inp_x['train']['x']
@@ -508,6 +508,16 @@ class SoftmaxLayer(TargetLayer):
             
         return returnedListWithNumberOfRpRnTpTnForEachClass
     
+    def getCostPerSegmentForTrain(self, y, batchSize):
+        # Cross-entropy of each labeled segment of the training batch (the first batchSize//2), averaged over its voxels. Not weighted per class.
+        # Returns a vector with a float per segment. Fetched to update the HardExampleMap.
+        # param y: y = T.itensor4('y'). Dimensions [batchSize//2, r, c, z]
+        label_index = batchSize // 2
+        p_y_given_x_labeled = self.p_y_given_x_train[:label_index, :, :, :, :]
+        y_one_hot = tf.one_hot( indices=y, depth=tf.shape(p_y_given_x_labeled)[1], axis=1, dtype="float32" )
+        log_p_y_of_gt = tf.reduce_sum( tf.log(p_y_given_x_labeled + 1e-6) * y_one_hot, axis=1 ) # [batchSize//2, r, c, z]
+        return - tf.reduce_mean( log_p_y_of_gt, axis=[1, 2, 3] )
+    
     def predictionProbabilities(self) :
         return self.p_y_given_x_test
     
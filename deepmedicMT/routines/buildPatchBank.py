@@ -0,0 +1,158 @@
+# Copyright (c) 2016, Konstantinos Kamnitsas
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the BSD license. See the accompanying LICENSE file
+# or read the terms at https://opensource.org/licenses/BSD-3-Clause.
+
+from __future__ import absolute_import, print_function, division
+
+import time
+
+from deepmedicMT.neuralnet.wrappers import CnnWrapperForSampling
+from deepmedicMT.dataManagement.sampling import getSampledDataAndLabelsForSubepoch, getTDSampledDataAndLabelsForSubepoch
+from deepmedicMT.dataManagement.extractionPlan import ExtractionPlan
+from deepmedicMT.dataManagement.patchBank import PatchBankWriter
+from deepmedicMT.dataManagement.samplerRng import SamplerRNG, STREAM_TRAIN, STREAM_TRAIN_UNLABELED, STREAM_UNLABELED_POOL
+from deepmedicMT.dataManagement.unlabeledPool import make_windows_of_unlabeled_pool
+
+
+# Samples training subepochs as do_training() would, and writes each in a shard of a patch bank. See deepMedicBuildPatchBank.
+# The random streams are the ones of the first training subepochs of a session with the same seedOfSampling.
+def do_build_patch_bank(cnn3d,
+                        folderOfPatchBank,
+                        numberOfSubepochsToBank,
+                        # Arguments from TrainSessionParameters.get_args_for_patch_bank():
+                        log,
+                        listOfFilepathsToEachChannelOfEachPatientTraining,
+                        DDlistOfFilepathsToEachChannelOfEachPatientTraining,
+                        listOfFilepathsToGtLabelsOfEachPatientTraining,
+                        DDlistOfFilepathsToGtLabelsOfEachPatientTraining,
+                        providedWeightMapsToSampleForEachCategoryTraining,
+                        forEachSamplingCategory_aListOfFilepathsToWeightMapsOfEachPatientTraining,
+                        providedRoiMaskForTrainingBool,
+                        DDprovidedRoiMaskForTrainingBool,
+                        listOfFilepathsToRoiMaskOfEachPatientTraining,
+                        DDlistOfFilepathsToRoiMaskOfEachPatientTraining,
+                        maxNumSubjectsLoadedPerSubepoch,
+                        imagePartsLoadedInGpuPerSubepoch,
+                        samplingTypeInstanceTraining,
+                        padInputImagesBool,
+                        doIntAugm_shiftMuStd_multiMuStd,
+                        reflectImageWithHalfProbDuringTraining,
+                        useSameSubChannelsAsSingleScale,
+                        listOfFilepathsToEachSubsampledChannelOfEachPatientTraining,
+                        run_input_checks,
+                        decodedVolumesCacheFolder,
+                        numThreadsForLoadingFilesOfCase,
+                        subjectCacheSizeGB,
+                        dtypeOfIntensities,
+                        filepathOfManifest,
+                        typeOfSubsampledPyramid,
+                        num_parallel_proc,
+                        seedOfSampling,
+                        numberOfSubepochsToCoverUnlabeledPool,
+                        memoryBudgetGBOfUnlabeledWindow,
+                        affineAugmentationOfSegments
+                        ) :
+    start_time = time.time()
+    cnn3dWrapper = CnnWrapperForSampling(cnn3d)
+    extractionPlan = ExtractionPlan(cnn3dWrapper, "train")
+    numOfInpChannelsForPrimaryPath = len(listOfFilepathsToEachChannelOfEachPatientTraining[0])
+    patchBankWriter = PatchBankWriter(folderOfPatchBank,
+                                      extractionPlan.getShapesOfSegmentPerPathway(numOfInpChannelsForPrimaryPath),
+                                      extractionPlan.shapeOfLabelsOfSegment,
+                                      dtypeOfIntensities)
+    if patchBankWriter.get_number_of_shards() > 0 :
+        log.print3("PATCH BANK: Adding to the [" + str(patchBankWriter.get_number_of_shards()) + "] shards already in [" + str(folderOfPatchBank) + "].")
+
+    samplerRngOfSession = SamplerRNG(seedOfSampling)
+    windowsOfUnlabeledPool = make_windows_of_unlabeled_pool(log, DDlistOfFilepathsToEachChannelOfEachPatientTraining, numberOfSubepochsToCoverUnlabeledPool, maxNumSubjectsLoadedPerSubepoch,
+                                                            memoryBudgetGBOfUnlabeledWindow, dtypeOfIntensities, samplerRngOfSession.spawn(STREAM_UNLABELED_POOL))
+
+    for subepoch in range(numberOfSubepochsToBank) :
+        log.print3("************* Sampling subepoch #" + str(subepoch) + "/" + str(numberOfSubepochsToBank) + " for the patch bank *************")
+        start_subepoch_time = time.time()
+        [channsOfSegmentsForSubepPerPathwayTrain,
+        labelsForCentralOfSegmentsForSubepTrain] = getSampledDataAndLabelsForSubepoch(log,
+                                                                "train",
+                                                                run_input_checks,
+                                                                cnn3dWrapper,
+                                                                maxNumSubjectsLoadedPerSubepoch,
+                                                                imagePartsLoadedInGpuPerSubepoch,
+                                                                samplingTypeInstanceTraining,
+
+                                                                listOfFilepathsToEachChannelOfEachPatientTraining,
+
+                                                                listOfFilepathsToGtLabelsOfEachPatientTraining,
+
+                                                                providedRoiMaskForTrainingBool,
+                                                                listOfFilepathsToRoiMaskOfEachPatientTraining,
+
+                                                                providedWeightMapsToSampleForEachCategoryTraining,
+                                                                forEachSamplingCategory_aListOfFilepathsToWeightMapsOfEachPatientTraining,
+
+                                                                useSameSubChannelsAsSingleScale,
+
+                                                                listOfFilepathsToEachSubsampledChannelOfEachPatientTraining,
+
+                                                                padInputImagesBool,
+                                                                doIntAugm_shiftMuStd_multiMuStd,
+                                                                reflectImageWithHalfProbDuringTraining,
+
+                                                                decodedVolumesCacheFolder = decodedVolumesCacheFolder,
+                                                                numThreadsForLoading = numThreadsForLoadingFilesOfCase,
+                                                                subjectCacheSizeGB = subjectCacheSizeGB,
+                                                                dtypeOfIntensities = dtypeOfIntensities,
+                                                                filepathOfManifest = filepathOfManifest,
+                                                                typeOfSubsampledPyramid = typeOfSubsampledPyramid,
+                                                                num_parallel_proc = num_parallel_proc,
+                                                                samplerRng = samplerRngOfSession.spawn_next(STREAM_TRAIN),
+                                                                affineAugmentationPrms = affineAugmentationOfSegments
+                                                                )
+        [TDchannsOfSegmentsForSubepPerPathwayTrain,
+        _] = getTDSampledDataAndLabelsForSubepoch(log,
+                                                                "train",
+                                                                run_input_checks,
+                                                                cnn3dWrapper,
+                                                                maxNumSubjectsLoadedPerSubepoch,
+                                                                imagePartsLoadedInGpuPerSubepoch,
+                                                                samplingTypeInstanceTraining,
+
+                                                                DDlistOfFilepathsToEachChannelOfEachPatientTraining,
+
+                                                                DDlistOfFilepathsToGtLabelsOfEachPatientTraining,
+
+                                                                DDprovidedRoiMaskForTrainingBool,
+                                                                DDlistOfFilepathsToRoiMaskOfEachPatientTraining,
+
+                                                                False,
+                                                                "placeholder",
+
+                                                                useSameSubChannelsAsSingleScale,
+
+                                                                listOfFilepathsToEachSubsampledChannelOfEachPatientTraining,
+
+                                                                padInputImagesBool,
+                                                                doIntAugm_shiftMuStd_multiMuStd,
+                                                                reflectImageWithHalfProbDuringTraining,
+
+                                                                decodedVolumesCacheFolder = decodedVolumesCacheFolder,
+                                                                numThreadsForLoading = numThreadsForLoadingFilesOfCase,
+                                                                subjectCacheSizeGB = subjectCacheSizeGB,
+                                                                dtypeOfIntensities = dtypeOfIntensities,
+                                                                filepathOfManifest = filepathOfManifest,
+                                                                typeOfSubsampledPyramid = typeOfSubsampledPyramid,
+                                                                num_parallel_proc = num_parallel_proc,
+                                                                samplerRng = samplerRngOfSession.spawn_next(STREAM_TRAIN_UNLABELED),
+                                                                indicesOfCasesOfWindow = windowsOfUnlabeledPool.next_window(),
+                                                                affineAugmentationPrms = affineAugmentationOfSegments
+                                                                )
+        patchBankWriter.write_shard(channsOfSegmentsForSubepPerPathwayTrain, labelsForCentralOfSegmentsForSubepTrain, TDchannsOfSegmentsForSubepPerPathwayTrain)
+        log.print3("PATCH BANK: Wrote shard #" + str(patchBankWriter.get_number_of_shards() - 1) + " with [" + str(len(labelsForCentralOfSegmentsForSubepTrain)) + "] labeled and [" +\
+                   str(len(TDchannsOfSegmentsForSubepPerPathwayTrain[0])) + "] unlabeled segments. TIMING: " + str(time.time() - start_subepoch_time) + "(s)")
+
+    windowsOfUnlabeledPool.report_and_reset_coverage(log, 0)
+    log.print3("PATCH BANK: Finished. The bank at [" + str(folderOfPatchBank) + "] has [" + str(patchBankWriter.get_number_of_shards()) + "] shards. "+\
+               "TIMING: Building it took " + str(time.time() - start_time) + "(s)")
+
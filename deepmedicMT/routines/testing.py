@@ -14,8 +14,11 @@ import math
 from deepmedicMT.logging.accuracyMonitor import AccuracyOfEpochMonitorSegmentation
 from deepmedicMT.dataManagement.sampling import load_imgs_of_single_case
 from deepmedicMT.dataManagement.sampling import getCoordsOfAllSegmentsOfAnImage
-from deepmedicMT.dataManagement.sampling import extractDataOfSegmentsUsingSampledSliceCoords
+from deepmedicMT.dataManagement.sampling import extractDataOfSegmentsUsingSampledSliceCoords, make_subsampled_pyramid_of_case
+from deepmedicMT.dataManagement.extractionPlan import ExtractionPlan, getIntensitiesOfZeroOfChannels
+from deepmedicMT.dataManagement.manifest import get_manifest_of_process
 from deepmedicMT.image.io import savePredImgToNiiWithOriginalHdr, saveFmImgToNiiWithOriginalHdr, save4DImgWithAllFmsToNiiWithOriginalHdr
+from deepmedicMT.image.asyncWriter import AsyncImageWriter
 from deepmedicMT.image.processing import unpadCnnOutputs
 
 from deepmedicMT.neuralnet.pathwayTypes import PathwayTypes as pt
@@ -50,7 +53,16 @@ def performInferenceOnWholeVolumes(
                             saveIndividualFmImagesForVisualisation,
                             saveMultidimensionalImageWithAllFms,
                             indicesOfFmsToVisualisePerPathwayTypeAndPerLayer,#NOTE: saveIndividualFmImagesForVisualisation should contain an entry per pathwayType, even if just []. If not [], the list should contain one entry per layer of the pathway, even if just []. The layer entries, if not [], they should have to integers, lower and upper FM to visualise. Excluding the highest index.
-                            listOfNamesToGiveToFmVisualisationsIfSaving
+                            listOfNamesToGiveToFmVisualisationsIfSaving,
+                            
+                            numThreadsForWritingOutputs = 2, # Outputs are written in the background, while the next subject is segmented.
+                            #--------Format of the output images---------
+                            compressOutputImages = True, # False: .nii instead of .nii.gz
+                            gzipLevelOfOutputImages = None, # 1-9. None: nibabel's default.
+                            saveProbMapsAsUint8 = False, # Quantise prob maps to uint8, with the scaling in the header's scl_slope/scl_inter.
+                            
+                            filepathOfManifest = None, # Dataset manifest. If given, GT is checked and ROI is bounded from the records of the cases.
+                            typeOfSubsampledPyramid = None # None, "strided" or "averaged". Downsampled copies of the channels of each case for the subsampled pathways.
                             ) :
     validation_or_testing_str = "Validation" if val_or_test == "val" else "Testing"
     log.print3("###########################################################################################################")
@@ -81,6 +93,10 @@ def performInferenceOnWholeVolumes(
     
     rczHalfRecFieldCnn = [ (recFieldCnn[i]-1)//2 for i in range(3) ]
     
+    manifest = get_manifest_of_process(filepathOfManifest)
+    extractionPlan = ExtractionPlan(cnn3d, "test") # Shapes and offsets of the segments of each pathway. Once, rather than per segment.
+    outputWriter = AsyncImageWriter(log, numThreads=numThreadsForWritingOutputs, compressOutput=compressOutputImages, gzipLevel=gzipLevelOfOutputImages)
+    
     #Find the total number of feature maps that will be created:
     #NOTE: saveIndividualFmImagesForVisualisation should contain an entry per pathwayType, even if just []. If not [], the list should contain one entry per layer of the pathway, even if just []. The layer entries, if not [], they should have to integers, lower and upper FM to visualise.
     if saveIndividualFmImagesForVisualisation or saveMultidimensionalImageWithAllFms:
@@ -100,6 +116,11 @@ def performInferenceOnWholeVolumes(
         log.print3("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
         log.print3("~~~~~~~~~~~~~~~~~~~~ Segmenting subject with index #"+str(image_i)+" ~~~~~~~~~~~~~~~~~~~~")
         
+        recordOfCase = manifest.get_record_of_case( listOfFilepathsToEachChannelOfEachPatient[image_i],
+                                                    listOfFilepathsToGtLabelsOfEachPatient[image_i] if providedGtLabelsBool else None,
+                                                    listOfFilepathsToRoiMaskFastInfOfEachPatient[image_i] if providedRoiMaskForFastInfBool else None,
+                                                    log ) if manifest is not None else None
+        
         #load the image channels in cpu
         
         [imageChannels, #a nparray(channels,dim0,dim1,dim2)
@@ -134,9 +155,12 @@ def performInferenceOnWholeVolumes(
                                     cnnReceptiveField = recFieldCnn, # only used if padInputsBool
                                     dimsOfPrimeSegmentRcz = cnn3d.pathways[0].getShapeOfInput("test")[2:], # only used if padInputsBool
                                     
-                                    reflectImageWithHalfProb = [0,0,0]
+                                    reflectImageWithHalfProb = [0,0,0],
+                                    recordOfCase = recordOfCase
                                     )
         niiDimensions = list(imageChannels[0].shape)
+        intensitiesOfZeroOfSubsampledChannels = getIntensitiesOfZeroOfChannels(allSubsampledChannelsOfPatientInNpArray) # To fill out of the image. Once per case.
+        subsampledPyramid = make_subsampled_pyramid_of_case(extractionPlan, allSubsampledChannelsOfPatientInNpArray, typeOfSubsampledPyramid)
         #The predicted probability-maps for the whole volume, one per class. Will be constructed by stitching together the predictions from each segment.
         predProbMapsPerClass = np.zeros([NUMBER_OF_CLASSES]+niiDimensions, dtype = "float32")
         #create the big array that will hold all the fms (for feature extraction, to save as a big multi-dim image).
@@ -149,7 +173,8 @@ def performInferenceOnWholeVolumes(
                                                                         strideOfSegmentsPerDimInVoxels=strideOfImagePartsPerDimensionInVoxels,
                                                                         batch_size = batch_size,
                                                                         channelsOfImageNpArray = imageChannels,#chans,niiDims
-                                                                        roiMask = roiMask
+                                                                        roiMask = roiMask,
+                                                                        boundingBoxOfRoi = get_bounding_box_of_roi_from_record(recordOfCase, tupleOfPaddingPerAxesLeftRight) if providedRoiMaskForFastInfBool else None
                                                                         )
         log.print3("Starting to segment each image-part by calling the cnn.cnnTestModel(i). This part takes a few mins per volume...")
         
@@ -167,14 +192,15 @@ def performInferenceOnWholeVolumes(
             if batch_i%printProgressStep == 0:
                 log.print3("Processed "+str(batch_i*batch_size)+"/"+str(number_of_batches*batch_size)+" Segments.")
                 
-            # Extract the data for the segments of this batch. ( I could modularize extractDataOfASegmentFromImagesUsingSampledSliceCoords() of training and use it here as well. )
+            # Extract the data for the segments of this batch. ( I could modularize extractDataOfSegmentsFromImagesUsingSampledCentres() of training and use it here as well. )
             start_extract_time = time.time()
             sliceCoordsOfSegmentsInBatch = sliceCoordsOfSegmentsInImage[ batch_i*batch_size : (batch_i+1)*batch_size ]
-            [channsOfSegmentsPerPath] = extractDataOfSegmentsUsingSampledSliceCoords(cnn3d=cnn3d,
+            [channsOfSegmentsPerPath] = extractDataOfSegmentsUsingSampledSliceCoords(extractionPlan=extractionPlan,
                                                                                     sliceCoordsOfSegmentsToExtract=sliceCoordsOfSegmentsInBatch,
                                                                                     channelsOfImageNpArray=imageChannels,#chans,niiDims
                                                                                     channelsOfSubsampledImageNpArray=allSubsampledChannelsOfPatientInNpArray,
-                                                                                    recFieldCnn=recFieldCnn
+                                                                                    intensitiesOfZeroOfSubsampledChannels=intensitiesOfZeroOfSubsampledChannels,
+                                                                                    subsampledPyramid=subsampledPyramid
                                                                                     )
             end_extract_time = time.time()
             extractTimePerSubject += end_extract_time - start_extract_time
@@ -326,12 +352,13 @@ def performInferenceOnWholeVolumes(
                                             image_i,
                                             suffixToAdd,
                                             npDtypeForPredictedImage,
-                                            log
+                                            log,
+                                            writer=outputWriter
                                             )
         #== saving probability maps ==
         for class_i in range(0, NUMBER_OF_CLASSES) :
             if (len(savePredictionImagesSegmentationAndProbMapsList[1]) >= class_i + 1) and (savePredictionImagesSegmentationAndProbMapsList[1][class_i] == True) : #save predicted probMap for class
-                npDtypeForPredictedImage = np.dtype(np.float32)
+                npDtypeForPredictedImage = np.dtype(np.uint8) if saveProbMapsAsUint8 else np.dtype(np.float32)
                 suffixToAdd = "_ProbMapClass" + str(class_i)
                 #Save the image. Pass the filename paths of the normal image so that I can dublicate the header info, eg RAS transformation.
                 predProbMapClassI = predProbMapsPerClass[class_i,:,:,:]
@@ -343,7 +370,8 @@ def performInferenceOnWholeVolumes(
                                                 image_i,
                                                 suffixToAdd,
                                                 npDtypeForPredictedImage,
-                                                log
+                                                log,
+                                                writer=outputWriter
                                                 )
         #== saving feature maps ==
         if saveIndividualFmImagesForVisualisation :
@@ -366,7 +394,8 @@ def performInferenceOnWholeVolumes(
                                                                 pathway_i,
                                                                 layer_i,
                                                                 fmActualNumber,
-                                                                log
+                                                                log,
+                                                                writer=outputWriter
                                                                 )
                                 currentIndexInTheMultidimensionalImageWithAllToBeVisualisedFmsArray += 1
         if saveMultidimensionalImageWithAllFms :
@@ -378,7 +407,8 @@ def performInferenceOnWholeVolumes(
                                                     listOfNamesToGiveToFmVisualisationsIfSaving,
                                                     listOfFilepathsToEachChannelOfEachPatient,
                                                     image_i,
-                                                    log )
+                                                    log,
+                                                    writer=outputWriter )
         #================= FINISHED SAVING RESULTS ====================
         
         #================= EVALUATE DSC FOR EACH SUBJECT ========================
@@ -412,6 +442,9 @@ def performInferenceOnWholeVolumes(
             printExplanationsAboutDice(log)
             
     #================= Loops for all patients have finished. Now lets just report the average DSC over all the processed patients. ====================
+    log.print3("Waiting for the background writing of the output images to finish...")
+    outputWriter.close() # Raises here if writing of any output failed.
+    
     if providedGtLabelsBool and total_number_of_images>0 : # Ground Truth was provided for calculation of DSC. Do DSC calculation.
         log.print3("+++++++++++++++++++++++++++++++ Segmentation of all subjects finished +++++++++++++++++++++++++++++++++++")
         log.print3("+++++++++++++++++++++ Reporting Average Segmentation Metrics over all subjects ++++++++++++++++++++++++++")
@@ -429,6 +462,14 @@ def performInferenceOnWholeVolumes(
     log.print3("###########################################################################################################")
 
 
+def get_bounding_box_of_roi_from_record(recordOfCase, tupleOfPaddingPerAxesLeftRight) :
+    # The ROI's bounding box in the record of the manifest, shifted by the padding. None if not available.
+    if recordOfCase is None or recordOfCase["roi_bbox"] is None :
+        return None
+    return [ [ recordOfCase["roi_bbox"][axis_i][0] + tupleOfPaddingPerAxesLeftRight[axis_i][0],
+               recordOfCase["roi_bbox"][axis_i][1] + tupleOfPaddingPerAxesLeftRight[axis_i][0] ] for axis_i in range(3) ]
+
+
 def calculateDiceCoefficient(predictedBinaryLabels, groundTruthBinaryLabels) :
     unionCorrectlyPredicted = predictedBinaryLabels * groundTruthBinaryLabels
     numberOfTruePositives = np.sum(unionCorrectlyPredicted)
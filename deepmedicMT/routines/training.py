@@ -9,12 +9,19 @@ from __future__ import absolute_import, print_function, division
 
 import sys
 import time
-import pp
+import atexit
 import numpy as np
 
 from deepmedicMT.logging.accuracyMonitor import AccuracyOfEpochMonitorSegmentation
 from deepmedicMT.neuralnet.wrappers import CnnWrapperForSampling
-from deepmedicMT.dataManagement.sampling import getSampledDataAndLabelsForSubepoch, getTDSampledDataAndLabelsForSubepoch
+from deepmedicMT.dataManagement.sampling import getSampledDataAndLabelsForSubepoch, getTDSampledDataAndLabelsForSubepoch, terminate_sampling_pool_of_process, remove_files_of_shared_memory_of_process
+from deepmedicMT.dataManagement.subjectStore import SubjectStore, get_all_filepaths_of_cases
+from deepmedicMT.dataManagement.streamingSampler import StreamOfBatches
+from deepmedicMT.dataManagement.samplerRng import SamplerRNG, STREAM_TRAIN, STREAM_TRAIN_UNLABELED, STREAM_VAL, STREAM_STREAMING, STREAM_UNLABELED_POOL
+from deepmedicMT.dataManagement.unlabeledPool import make_windows_of_unlabeled_pool
+from deepmedicMT.dataManagement.patchBank import PatchBank
+from deepmedicMT.dataManagement.extractionPlan import ExtractionPlan
+from deepmedicMT.dataManagement.hardExamples import HardExampleMap
 from deepmedicMT.routines.testing import performInferenceOnWholeVolumes
 
 from deepmedicMT.logging.utils import datetimeNowAsStr
@@ -55,7 +62,10 @@ def doTrainOrValidationOnBatchesAndReturnMeanAccuraciesOfSubepoch(log,
                                                                 TDchannsOfSegmentsForSubepPerPathway,
                                                                 labelsForCentralOfSegmentsForSubep,
                                                                 TDlabelsForCentralOfSegmentsForSubep,
-                                                                doIntAugm_shiftMuStd_multiMuStd) :
+                                                                doIntAugm_shiftMuStd_multiMuStd,
+                                                                streamOfBatches=None, # StreamOfBatches. If given, training batches are popped from it, instead of the arrays of the subepoch.
+                                                                hardExampleMap=None, # HardExampleMap. If given, it is updated with the cost of each labeled segment of every training batch.
+                                                                originsOfSegmentsForSubep=None) : # Array (segments, 4), where each labeled segment was sampled. Required with the hardExampleMap.
     """
     Returned array is of dimensions [NumberOfClasses x 6]
     For each class: [meanAccuracyOfSubepoch, meanAccuracyOnPositivesOfSubepoch, meanAccuracyOnNegativesOfSubepoch, meanDiceOfSubepoch, meanCostOfSubepoch]
@@ -70,7 +80,7 @@ def doTrainOrValidationOnBatchesAndReturnMeanAccuraciesOfSubepoch(log,
     arrayWithNumbersOfPerClassRpRnTpTnInSubepoch = np.zeros([ cnn3d.num_classes, 4 ], dtype="int32")
     TarrayWithNumbersOfPerClassRpRnTpTnInSubepoch = np.zeros([ cnn3d.num_classes, 4 ], dtype="int32")
 
-    numOfChannels = channsOfSegmentsForSubepPerPathway[0][0].shape[0]
+    numOfChannels = channsOfSegmentsForSubepPerPathway[0][0].shape[0] if streamOfBatches is None else cnn3d.pathways[0].getShapeOfInput("train")[1]
     #log.print3(str(numOfChannels) + str(channsOfSegmentsForSubepPerPathway[0][0].shape))
     noise_add_1, noise_mtply_1 = generate_noise(doIntAugm_shiftMuStd_multiMuStd, numOfChannels)
     noise_add_2, noise_mtply_2 = generate_noise(doIntAugm_shiftMuStd_multiMuStd, numOfChannels)
@@ -86,6 +96,8 @@ def doTrainOrValidationOnBatchesAndReturnMeanAccuraciesOfSubepoch(log,
             #ops_to_fetch['cost'] is total_cost setup in cnn3d.py
 
             list_of_ops = ops_to_fetch['list_rp_rn_tp_tn'] + ops_to_fetchT['list_rp_rn_tp_tn'] + [ ops_to_fetch['cost'] ] + [ ops_to_fetch['updates_grouped_op'] ]
+            if hardExampleMap is not None : # Last, so that it is popped before the rest is read as without it.
+                list_of_ops = list_of_ops + [ ops_to_fetch['cost_per_segment'] ]
             
             ##====================================================================================##
             index_to_data_for_batch_min_seg = batch_i * (cnn3d.batchSize["train"] // 2)
@@ -94,6 +106,13 @@ def doTrainOrValidationOnBatchesAndReturnMeanAccuraciesOfSubepoch(log,
 
             index_to_data_for_batch_min_adv = batch_i * (cnn3d.batchSize["train"] // 2)
             index_to_data_for_batch_max_adv = (batch_i+1) * (cnn3d.batchSize["train"] // 2)
+            
+            if streamOfBatches is None :
+                channsOfBatchPerPathway = [ channels[index_to_data_for_batch_min_seg : index_to_data_for_batch_max_seg] for channels in channsOfSegmentsForSubepPerPathway ]
+                TDchannsOfBatchPerPathway = [ channels[index_to_data_for_batch_min_adv : index_to_data_for_batch_max_adv] for channels in TDchannsOfSegmentsForSubepPerPathway ]
+                labelsOfBatch = labelsForCentralOfSegmentsForSubep[ index_to_data_for_batch_min_seg : index_to_data_for_batch_max_seg ]
+            else :
+                [channsOfBatchPerPathway, TDchannsOfBatchPerPathway, labelsOfBatch] = streamOfBatches.get_batch()
             ##====================================================================================##
             feeds = cnn3d.get_main_feeds('train')
 
@@ -101,7 +120,7 @@ def doTrainOrValidationOnBatchesAndReturnMeanAccuraciesOfSubepoch(log,
             
             ##=================================labeled segs from S, unlabeled segs from T==================================================##
             # the structure of segments in each subepoch , is a list whose length is the number of pathways, each element is a list(length is number of segments for this subepoch), inside the second list, each element is a tensor, the dimension is four, with shape [numOfChannels, patchSizeDimension1, patchSize2, patchSize3] It is like: [[tensors], [], [], []]
-            thisBatchAlldata = np.concatenate((channsOfSegmentsForSubepPerPathway[0][index_to_data_for_batch_min_seg : index_to_data_for_batch_max_seg], TDchannsOfSegmentsForSubepPerPathway[0][index_to_data_for_batch_min_adv : index_to_data_for_batch_max_adv]), axis=0)
+            thisBatchAlldata = np.concatenate((channsOfBatchPerPathway[0], TDchannsOfBatchPerPathway[0]), axis=0)
                 
             thisBatchAlldata_for_stu = (thisBatchAlldata + noise_add_1) * noise_mtply_1
             thisBatchAlldata_for_tch = (thisBatchAlldata + noise_add_2) * noise_mtply_2
@@ -114,17 +133,20 @@ def doTrainOrValidationOnBatchesAndReturnMeanAccuraciesOfSubepoch(log,
             ##=====================================================================================##
             #feed data into the subsampled pathway
             for subsPath_i in range(cnn3d.numSubsPaths) :
-                subsAlldata = np.concatenate((channsOfSegmentsForSubepPerPathway[ subsPath_i+1 ][ index_to_data_for_batch_min_seg : index_to_data_for_batch_max_seg ], TDchannsOfSegmentsForSubepPerPathway[subsPath_i+1][index_to_data_for_batch_min_adv : index_to_data_for_batch_max_adv]), axis=0)
+                subsAlldata = np.concatenate((channsOfBatchPerPathway[ subsPath_i+1 ], TDchannsOfBatchPerPathway[ subsPath_i+1 ]), axis=0)
                 feeds_dict.update( { feeds['x_sub_'+str(subsPath_i)]: (subsAlldata + noise_add_1) * noise_mtply_1 } )
                 feeds_dict.update( { feedsT['x_sub_'+str(subsPath_i)]: (subsAlldata + noise_add_2) * noise_mtply_2 } )
                 
             
-            feeds_dict.update( { feeds['y_gt'] : labelsForCentralOfSegmentsForSubep[ index_to_data_for_batch_min_seg : index_to_data_for_batch_max_seg ] } )
-            feeds_dict.update( { feedsT['y_gt'] : labelsForCentralOfSegmentsForSubep[ index_to_data_for_batch_min_seg : index_to_data_for_batch_max_seg ] } )
+            feeds_dict.update( { feeds['y_gt'] : labelsOfBatch } )
+            feeds_dict.update( { feedsT['y_gt'] : labelsOfBatch } )
             
             #===================================Train Here========================================#
 
             results_from_train = sessionTf.run( fetches=list_of_ops, feed_dict=feeds_dict )
+            if hardExampleMap is not None :
+                costPerSegmentOfBatch = results_from_train.pop()
+                hardExampleMap.update(originsOfSegmentsForSubep[ index_to_data_for_batch_min_seg : index_to_data_for_batch_max_seg ], costPerSegmentOfBatch)
             
             ##======================================Report Acurracy!!!!===============================#
             
@@ -297,7 +319,27 @@ def do_training(sessionTf,
                 listOfNamesToGiveToFmVisualisationsIfSaving,
                 
                 #-------- Others --------
-                run_input_checks
+                run_input_checks,
+                
+                #-------- Data Loading --------
+                decodedVolumesCacheFolder,
+                useSharedMemorySubjectStore,
+                numThreadsForLoadingFilesOfCase,
+                subjectCacheSizeGB,
+                dtypeOfIntensities,
+                filepathOfManifest,
+                typeOfSubsampledPyramid,
+                numProcessesOfStreamingSampler,
+                depthOfQueueOfBatches,
+                num_parallel_proc,
+                seedOfSampling,
+                numberOfSubepochsToCoverUnlabeledPool,
+                memoryBudgetGBOfUnlabeledWindow,
+                affineAugmentationOfSegments,
+                patchBankFolder,
+                fractionOfHardExampleSegments,
+                sizeOfCellsOfHardExampleMap,
+                momentumOfHardExampleMap
                 ):
     
     start_training_time = time.time()
@@ -305,9 +347,20 @@ def do_training(sessionTf,
     #This is because the parallel process used to load theano again. And created problems in the GPU when cnmem is used. Not sure this is needed with Tensorflow. Probably.
     cnn3dWrapper = CnnWrapperForSampling(cnn3d) 
     
+    # Volumes of the subjects, loaded once in shared memory and shared by the labeled/unlabeled/validation samplers.
+    if useSharedMemorySubjectStore :
+        subjectStore = SubjectStore(decodedVolumesCacheFolder)
+        allFilepathsInSubjectStore = get_all_filepaths_of_cases(listOfFilepathsToEachChannelOfEachPatientTraining, DDlistOfFilepathsToEachChannelOfEachPatientTraining, listOfFilepathsToEachChannelOfEachPatientValidation,
+                                                                listOfFilepathsToGtLabelsOfEachPatientTraining, DDlistOfFilepathsToGtLabelsOfEachPatientTraining, listOfFilepathsToGtLabelsOfEachPatientValidationOnSamplesAndDsc,
+                                                                listOfFilepathsToRoiMaskOfEachPatientTraining, DDlistOfFilepathsToRoiMaskOfEachPatientTraining, listOfFilepathsToRoiMaskOfEachPatientValidation,
+                                                                forEachSamplingCategory_aListOfFilepathsToWeightMapsOfEachPatientTraining, forEachSamplingCategory_aListOfFilepathsToWeightMapsOfEachPatientValidation)
+        atexit.register(subjectStore.unlink_all, allFilepathsInSubjectStore) # Free the shared memory even if training crashes.
+    else :
+        subjectStore = None
+    
     #---------To run PARALLEL the extraction of parts for the next subepoch---
-    ppservers = () # tuple of all parallel python servers to connect with
-    job_server = pp.Server(ncpus=1, ppservers=ppservers) # Creates jobserver with automatically detected number of workers
+    # The samplers are called with inBackground=True. Their jobs run in the sampling pool of this process, while it trains. See SamplingOfSubepoch.
+    atexit.register(remove_files_of_shared_memory_of_process) # The buffers of subepochs sampled but never collected, if training crashes.
     
     ##======================================================================##
 
@@ -336,7 +389,17 @@ def do_training(sessionTf,
                                     
                                     padInputImagesBool,
                                     doIntAugm_shiftMuStd_multiMuStd,
-                                    reflectImageWithHalfProbDuringTraining
+                                    reflectImageWithHalfProbDuringTraining,
+                                    
+                                    decodedVolumesCacheFolder,
+                                    subjectStore,
+                                    numThreadsForLoadingFilesOfCase,
+                                    subjectCacheSizeGB,
+                                    dtypeOfIntensities,
+                                    filepathOfManifest,
+                                    typeOfSubsampledPyramid,
+                                    num_parallel_proc,
+                                    affineAugmentationOfSegments
                                     )
     ##========================================================================================##
     TDtupleWithParametersForTraining = (log,
@@ -364,7 +427,17 @@ def do_training(sessionTf,
                                     
                                     padInputImagesBool,
                                     doIntAugm_shiftMuStd_multiMuStd,
-                                    reflectImageWithHalfProbDuringTraining
+                                    reflectImageWithHalfProbDuringTraining,
+                                    
+                                    decodedVolumesCacheFolder,
+                                    subjectStore,
+                                    numThreadsForLoadingFilesOfCase,
+                                    subjectCacheSizeGB,
+                                    dtypeOfIntensities,
+                                    filepathOfManifest,
+                                    typeOfSubsampledPyramid,
+                                    num_parallel_proc,
+                                    affineAugmentationOfSegments
                                     )
 
    
@@ -394,16 +467,59 @@ def do_training(sessionTf,
                                     
                                     padInputImagesBool,
                                     [0, -1,-1,-1], #don't perform intensity-augmentation during validation.
-                                    [0,0,0] #don't perform reflection-augmentation during validation.
+                                    [0,0,0], #don't perform reflection-augmentation during validation.
+                                    
+                                    decodedVolumesCacheFolder,
+                                    subjectStore,
+                                    numThreadsForLoadingFilesOfCase,
+                                    subjectCacheSizeGB,
+                                    dtypeOfIntensities,
+                                    filepathOfManifest,
+                                    typeOfSubsampledPyramid,
+                                    num_parallel_proc,
+                                    affineAugmentationOfSegments
                                     )
     
-    tupleWithLocalFunctionsThatWillBeCalledByTheMainJob = ( )
-    tupleWithModulesToImportWhichAreUsedByTheJobFunctions = ( "from __future__ import absolute_import, print_function, division",
-                "time", "numpy as np", "from deepmedicMT.dataManagement.sampling import *" )
-    boolItIsTheVeryFirstSubepochOfThisProcess = True #to know so that in the very first I sequencially load the data for it.
+    model_num_epochs_trained = trainer.get_num_epochs_trained_tfv().eval(session=sessionTf)
+    
+    # Random streams of the samplers. The n-th call of each sampler gets the same stream in every run with the same seed, whichever process runs it.
+    # The SamplerRNG of each call is appended to the tuples of arguments (or given as kwarg) when the call is made. Not seeded if seedOfSampling is None.
+    # Keyed by the epoch training starts from, so that a resumed session, or the next stage of scheduleOfSegmentsTrain, does not replay the same streams.
+    samplerRngOfSession = SamplerRNG(seedOfSampling, keyOfStream=(int(model_num_epochs_trained),))
+    
+    # The unlabeled cases are sampled in windows, that cover all of them once every numberOfWindowsPerPass subepochs.
+    windowsOfUnlabeledPool = make_windows_of_unlabeled_pool(log, DDlistOfFilepathsToEachChannelOfEachPatientTraining, numberOfSubepochsToCoverUnlabeledPool, maxNumSubjectsLoadedPerSubepoch,
+                                                            memoryBudgetGBOfUnlabeledWindow, dtypeOfIntensities, samplerRngOfSession.spawn(STREAM_UNLABELED_POOL))
+    
+    boolItIsTheVeryFirstSubepochOfThisProcess = True #to know so that in the very first I wait for the data of it, as nothing was submitted before.
     #------End for parallel------
     
-    model_num_epochs_trained = trainer.get_num_epochs_trained_tfv().eval(session=sessionTf)
+    # Streaming: Training batches are sampled continuously by other processes, instead of per subepoch by the parallel job above (still used for validation).
+    if numProcessesOfStreamingSampler > 0 :
+        streamOfBatches = StreamOfBatches(log, numProcessesOfStreamingSampler, depthOfQueueOfBatches, cnn3d.batchSize["train"] // 2,
+                                          tupleWithParametersForTraining, TDtupleWithParametersForTraining, samplerRngOfSession.spawn(STREAM_STREAMING))
+        streamOfBatches.start()
+        atexit.register(streamOfBatches.stop)
+    else :
+        streamOfBatches = None
+    
+    # Patch bank: Training segments are replayed from the shards of a bank made by deepMedicBuildPatchBank, instead of sampled (validation still samples).
+    if patchBankFolder is not None :
+        patchBank = PatchBank(patchBankFolder)
+        extractionPlanOfTraining = ExtractionPlan(cnn3dWrapper, "train")
+        patchBank.check_shapes_of_segments(extractionPlanOfTraining.getShapesOfSegmentPerPathway(len(listOfFilepathsToEachChannelOfEachPatientTraining[0])),
+                                           extractionPlanOfTraining.shapeOfLabelsOfSegment)
+        log.print3("PATCH BANK: Training segments are read from the [" + str(patchBank.get_number_of_shards()) + "] shards of the bank at [" + str(patchBankFolder) + "], instead of sampled.")
+    else :
+        patchBank = None
+    
+    # Hard examples: A fraction of the training segments is centred where the cost of the previous segments was high. See HardExampleMap.
+    if fractionOfHardExampleSegments > 0 :
+        hardExampleMap = HardExampleMap(log, fractionOfHardExampleSegments, sizeOfCellsOfHardExampleMap, momentumOfHardExampleMap)
+    else :
+        hardExampleMap = None
+    originsOfSegmentsForSubepTrain = None
+    
     while model_num_epochs_trained < n_epochs :
         epoch = model_num_epochs_trained
         trainingAccuracyMonitorForEpoch = AccuracyOfEpochMonitorSegmentation(log, 0, model_num_epochs_trained, cnn3d.num_classes, number_of_subepochs)
@@ -449,14 +565,26 @@ def do_training(sessionTf,
                                                                         
                                                                         padInputImagesBool,
                                                                         doIntAugm_shiftMuStd_multiMuStd=[False,[],[]],
-                                                                        reflectImageWithHalfProbDuringTraining = [0,0,0]
-                                                                        )
+                                                                        reflectImageWithHalfProbDuringTraining = [0,0,0],
+                                                                        
+                                                                        decodedVolumesCacheFolder = decodedVolumesCacheFolder,
+                                                                        subjectStore = subjectStore,
+                                                                        numThreadsForLoading = numThreadsForLoadingFilesOfCase,
+                                                                        subjectCacheSizeGB = subjectCacheSizeGB,
+                                                                        dtypeOfIntensities = dtypeOfIntensities,
+                                                                        filepathOfManifest = filepathOfManifest,
+                                                                        typeOfSubsampledPyramid = typeOfSubsampledPyramid,
+                                                                        num_parallel_proc = num_parallel_proc,
+                                                                        samplerRng = samplerRngOfSession.spawn_next(STREAM_VAL),
+                                                                        affineAugmentationPrms = affineAugmentationOfSegments,
+                                                                        inBackground = True # Also the first, so that the cases are loaded in the sampling pool, where they are cached.
+                                                                        ).get()
                     boolItIsTheVeryFirstSubepochOfThisProcess = False
 
                     
                 else : #It was done in parallel with the training of the previous epoch, just grab the results...
                     [channsOfSegmentsForSubepPerPathwayVal,
-                    labelsForCentralOfSegmentsForSubepVal] = parallelJobToGetDataForNextValidation() #fromParallelProcessing that had started from last loop when it was submitted.
+                    labelsForCentralOfSegmentsForSubepVal] = parallelJobToGetDataForNextValidation.get() #fromParallelProcessing that had started from last loop when it was submitted.
 
 
                 # Below is computed with number of extracted samples, in case I dont manage to extract as many as I wanted initially.
@@ -464,17 +592,12 @@ def do_training(sessionTf,
                 
                 
                 #------------------------SUBMIT PARALLEL JOB TO GET TRAINING DATA FOR NEXT TRAINING-----------------
-                #submit the parallel job
-                log.print3("PARALLEL: Before Validation in subepoch #" +str(subepoch) + ", the parallel job for extracting Segments for the next Training is submitted.")
-                parallelJobToGetDataForNextTraining = job_server.submit(getSampledDataAndLabelsForSubepoch, #local function to call and execute in parallel.
-                                                                        tupleWithParametersForTraining, #tuple with the arguments required
-                                                                        tupleWithLocalFunctionsThatWillBeCalledByTheMainJob, #tuple of local functions that I need to call
-                                                                        tupleWithModulesToImportWhichAreUsedByTheJobFunctions) #tuple of the external modules that I need, of which I am calling functions (not the mods of the ext-functions).
-                ##============================================================================================================================##
-                TDparallelJobToGetDataForNextTraining = job_server.submit(getTDSampledDataAndLabelsForSubepoch, #local function to call and execute in parallel.
-                                                                        TDtupleWithParametersForTraining, #tuple with the arguments required
-                                                                        tupleWithLocalFunctionsThatWillBeCalledByTheMainJob, 
-                                                                        tupleWithModulesToImportWhichAreUsedByTheJobFunctions) 
+                if streamOfBatches is None and patchBank is None : # Else, the streaming sampler keeps sampling training batches, or they are read from the bank.
+                    #submit the parallel job
+                    log.print3("PARALLEL: Before Validation in subepoch #" +str(subepoch) + ", the parallel job for extracting Segments for the next Training is submitted.")
+                    parallelJobToGetDataForNextTraining = getSampledDataAndLabelsForSubepoch(*(tupleWithParametersForTraining + (samplerRngOfSession.spawn_next(STREAM_TRAIN), hardExampleMap)), inBackground=True) # Returns at once. The jobs run in the sampling pool, while this process goes on.
+                    ##============================================================================================================================##
+                    TDparallelJobToGetDataForNextTraining = getTDSampledDataAndLabelsForSubepoch(*(TDtupleWithParametersForTraining + (samplerRngOfSession.spawn_next(STREAM_TRAIN_UNLABELED), windowsOfUnlabeledPool.next_window())), inBackground=True)
 
                 
                 ##=========================================================================================================================##
@@ -502,9 +625,18 @@ def do_training(sessionTf,
             
             
             #-------------------------GET DATA FOR THIS SUBEPOCH's TRAINING---------------------------------
-            if (not performValidationOnSamplesDuringTrainingProcessBool) and boolItIsTheVeryFirstSubepochOfThisProcess :                    
+            if streamOfBatches is not None : # Batches are popped from the stream, while training.
+                channsOfSegmentsForSubepPerPathwayTrain = None; labelsForCentralOfSegmentsForSubepTrain = None
+                TDchannsOfSegmentsForSubepPerPathwayTrain = None; TDlabelsForCentralOfSegmentsForSubepTrain = None
+                
+            elif patchBank is not None : # Memory-mapped. Batches are read from the disk while training.
                 [channsOfSegmentsForSubepPerPathwayTrain,
-                labelsForCentralOfSegmentsForSubepTrain] = getSampledDataAndLabelsForSubepoch(log,
+                labelsForCentralOfSegmentsForSubepTrain,
+                TDchannsOfSegmentsForSubepPerPathwayTrain] = patchBank.get_next_shard(log)
+                TDlabelsForCentralOfSegmentsForSubepTrain = None # No GT labels for the unlabeled cases.
+                
+            elif (not performValidationOnSamplesDuringTrainingProcessBool) and boolItIsTheVeryFirstSubepochOfThisProcess :                    
+                resultsOfSamplingTrain = getSampledDataAndLabelsForSubepoch(log,
                                                                         "train",
                                                                         run_input_checks,
                                                                         cnn3dWrapper,
@@ -528,8 +660,24 @@ def do_training(sessionTf,
                                                                         
                                                                         padInputImagesBool,
                                                                         doIntAugm_shiftMuStd_multiMuStd,
-                                                                        reflectImageWithHalfProbDuringTraining
-                                                                        )
+                                                                        reflectImageWithHalfProbDuringTraining,
+                                                                        
+                                                                        decodedVolumesCacheFolder = decodedVolumesCacheFolder,
+                                                                        subjectStore = subjectStore,
+                                                                        numThreadsForLoading = numThreadsForLoadingFilesOfCase,
+                                                                        subjectCacheSizeGB = subjectCacheSizeGB,
+                                                                        dtypeOfIntensities = dtypeOfIntensities,
+                                                                        filepathOfManifest = filepathOfManifest,
+                                                                        typeOfSubsampledPyramid = typeOfSubsampledPyramid,
+                                                                        num_parallel_proc = num_parallel_proc,
+                                                                        samplerRng = samplerRngOfSession.spawn_next(STREAM_TRAIN),
+                                                                        affineAugmentationPrms = affineAugmentationOfSegments,
+                                                                        hardExampleMap = hardExampleMap,
+                                                                        inBackground = True
+                                                                        ).get()
+                [channsOfSegmentsForSubepPerPathwayTrain,
+                labelsForCentralOfSegmentsForSubepTrain] = resultsOfSamplingTrain[:2]
+                originsOfSegmentsForSubepTrain = resultsOfSamplingTrain[2] if hardExampleMap is not None else None
                 boolItIsTheVeryFirstSubepochOfThisProcess = False
                 ##==============================================================================================================================##
                 
@@ -540,7 +688,7 @@ def do_training(sessionTf,
                                                                         "train",
                                                                         run_input_checks,
                                                                         cnn3dWrapper,
-                                                                        50,#maxNumSubjectsLoadedPerSubepoch
+                                                                        maxNumSubjectsLoadedPerSubepoch,
                                                                         imagePartsLoadedInGpuPerSubepoch,
                                                                         samplingTypeInstanceTraining,
                                                                         
@@ -560,46 +708,55 @@ def do_training(sessionTf,
                                                                         
                                                                         padInputImagesBool,
                                                                         doIntAugm_shiftMuStd_multiMuStd,
-                                                                        reflectImageWithHalfProbDuringTraining
-                                                                        )
+                                                                        reflectImageWithHalfProbDuringTraining,
+                                                                        
+                                                                        decodedVolumesCacheFolder = decodedVolumesCacheFolder,
+                                                                        subjectStore = subjectStore,
+                                                                        numThreadsForLoading = numThreadsForLoadingFilesOfCase,
+                                                                        subjectCacheSizeGB = subjectCacheSizeGB,
+                                                                        dtypeOfIntensities = dtypeOfIntensities,
+                                                                        filepathOfManifest = filepathOfManifest,
+                                                                        typeOfSubsampledPyramid = typeOfSubsampledPyramid,
+                                                                        num_parallel_proc = num_parallel_proc,
+                                                                        samplerRng = samplerRngOfSession.spawn_next(STREAM_TRAIN_UNLABELED),
+                                                                        indicesOfCasesOfWindow = windowsOfUnlabeledPool.next_window(),
+                                                                        affineAugmentationPrms = affineAugmentationOfSegments,
+                                                                        inBackground = True
+                                                                        ).get()
 
 
             ##===================================================================================================================================##
             else :
                 #It was done in parallel with the validation (or with previous training iteration, in case I am not performing validation).
+                resultsOfSamplingTrain = parallelJobToGetDataForNextTraining.get() #fromParallelProcessing that had started from last loop when it was submitted.
                 [channsOfSegmentsForSubepPerPathwayTrain,
-                labelsForCentralOfSegmentsForSubepTrain] = parallelJobToGetDataForNextTraining() #fromParallelProcessing that had started from last loop when it was submitted.
+                labelsForCentralOfSegmentsForSubepTrain] = resultsOfSamplingTrain[:2]
+                originsOfSegmentsForSubepTrain = resultsOfSamplingTrain[2] if hardExampleMap is not None else None
 
                 ##==================================================================##
                 [TDchannsOfSegmentsForSubepPerPathwayTrain,
-                TDlabelsForCentralOfSegmentsForSubepTrain] = TDparallelJobToGetDataForNextTraining()
+                TDlabelsForCentralOfSegmentsForSubepTrain] = TDparallelJobToGetDataForNextTraining.get()
 
                 ##================================================================================##
             
-            numberOfBatchesTraining = (len(channsOfSegmentsForSubepPerPathwayTrain[0]) * 2) // cnn3d.batchSize["train"] #Computed with number of extracted samples, in case I dont manage to extract as many as I wanted initially.
+            if streamOfBatches is not None : # As many batches as a subepoch would give.
+                numberOfBatchesTraining = (imagePartsLoadedInGpuPerSubepoch * 2) // cnn3d.batchSize["train"]
+            else :
+                numberOfBatchesTraining = (len(channsOfSegmentsForSubepPerPathwayTrain[0]) * 2) // cnn3d.batchSize["train"] #Computed with number of extracted samples, in case I dont manage to extract as many as I wanted initially.
             
             
             #------------------------SUBMIT PARALLEL JOB TO GET VALIDATION/TRAINING DATA (if val is/not performed) FOR NEXT SUBEPOCH-----------------
             if performValidationOnSamplesDuringTrainingProcessBool :
                 #submit the parallel job
                 log.print3("PARALLEL: Before Training in subepoch #" +str(subepoch) + ", submitting the parallel job for extracting Segments for the next Validation.")
-                parallelJobToGetDataForNextValidation = job_server.submit(getSampledDataAndLabelsForSubepoch, #local function to call and execute in parallel.
-                                                                            tupleWithParametersForValidation, #tuple with the arguments required
-                                                                            tupleWithLocalFunctionsThatWillBeCalledByTheMainJob, #tuple of local functions that I need to call
-                                                                            tupleWithModulesToImportWhichAreUsedByTheJobFunctions) #tuple of the external modules that I need, of which I am calling functions (not the mods of the ext-functions).
+                parallelJobToGetDataForNextValidation = getSampledDataAndLabelsForSubepoch(*(tupleWithParametersForValidation + (samplerRngOfSession.spawn_next(STREAM_VAL),)), inBackground=True) # Returns at once. The jobs run in the sampling pool, while this process goes on.
                 
 
-            else : #extract in parallel the samples for the next subepoch's training.
+            elif streamOfBatches is None and patchBank is None : #extract in parallel the samples for the next subepoch's training.
                 log.print3("PARALLEL: Before Training in subepoch #" +str(subepoch) + ", submitting the parallel job for extracting Segments for the next Training.")
-                parallelJobToGetDataForNextTraining = job_server.submit(getSampledDataAndLabelsForSubepoch, #local function to call and execute in parallel.
-                                                                            tupleWithParametersForTraining, #tuple with the arguments required
-                                                                            tupleWithLocalFunctionsThatWillBeCalledByTheMainJob, #tuple of local functions that I need to call
-                                                                            tupleWithModulesToImportWhichAreUsedByTheJobFunctions) #tuple of the external modules that I need, of which I am calling
+                parallelJobToGetDataForNextTraining = getSampledDataAndLabelsForSubepoch(*(tupleWithParametersForTraining + (samplerRngOfSession.spawn_next(STREAM_TRAIN), hardExampleMap)), inBackground=True)
                 ##===================================================================================================================================================##
-                TDparallelJobToGetDataForNextTraining = job_server.submit(getTDSampledDataAndLabelsForSubepoch, #local function to call and execute in parallel.
-                                                                            TDtupleWithParametersForTraining, #tuple with the arguments required
-                                                                            tupleWithLocalFunctionsThatWillBeCalledByTheMainJob, #tuple of local functions that I need to call
-                                                                            tupleWithModulesToImportWhichAreUsedByTheJobFunctions)
+                TDparallelJobToGetDataForNextTraining = getTDSampledDataAndLabelsForSubepoch(*(TDtupleWithParametersForTraining + (samplerRngOfSession.spawn_next(STREAM_TRAIN_UNLABELED), windowsOfUnlabeledPool.next_window())), inBackground=True)
 
                
                 ##=====================================================================================================================================================##
@@ -619,7 +776,10 @@ def do_training(sessionTf,
                                                                         TDchannsOfSegmentsForSubepPerPathwayTrain,
                                                                         labelsForCentralOfSegmentsForSubepTrain,
                                                                         TDlabelsForCentralOfSegmentsForSubepTrain,
-                                                                        doIntAugm_shiftMuStd_multiMuStd)
+                                                                        doIntAugm_shiftMuStd_multiMuStd,
+                                                                        streamOfBatches,
+                                                                        hardExampleMap,
+                                                                        originsOfSegmentsForSubepTrain)
 
             trainer.run_updates_end_of_subep(log, sessionTf)
             #trainerT.run_updates_end_of_subep(log, sessionTf)
@@ -627,6 +787,8 @@ def do_training(sessionTf,
             end_trainingForSubepoch_time = time.time()
             #log.print3("Num of stable samples and stabilization loss. " + str(trainer._num) + str(trainer._stab_loss))
             log.print3("TIMING: Training on the batches of this subepoch #" + str(subepoch) + " took time: "+str(end_trainingForSubepoch_time-start_trainingForSubepoch_time)+"(s)")
+            if streamOfBatches is not None :
+                log.print3("TIMING: Of which, waiting for the streaming sampler to give batches took time: "+str(streamOfBatches.get_and_reset_time_waited_for_batches())+"(s)")
             
         log.print3("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~" )
         log.print3("~~~~~~~~~~~~~~~~~~ Epoch #" + str(epoch) + " finished. Reporting Accuracy over whole epoch. ~~~~~~~~~~~~~~~~~~" )
@@ -644,6 +806,10 @@ def do_training(sessionTf,
         model_num_epochs_trained = trainer.get_num_epochs_trained_tfv().eval(session=sessionTf)
         
         del trainingAccuracyMonitorForEpoch; del validationAccuracyMonitorForEpoch;
+        if streamOfBatches is None and patchBank is None :
+            windowsOfUnlabeledPool.report_and_reset_coverage(log, epoch)
+        if hardExampleMap is not None :
+            hardExampleMap.report_and_reset_stats(log, epoch)
         #================== Everything for epoch has finished. =======================
         
         log.print3("SAVING: Epoch #"+str(epoch)+" finished. Saving CNN model.")
@@ -686,9 +852,19 @@ def do_training(sessionTf,
                                     saveIndividualFmImagesForVisualisation=saveIndividualFmImagesForVisualisation,
                                     saveMultidimensionalImageWithAllFms=saveMultidimensionalImageWithAllFms,
                                     indicesOfFmsToVisualisePerPathwayTypeAndPerLayer=indicesOfFmsToVisualisePerPathwayTypeAndPerLayer,
-                                    listOfNamesToGiveToFmVisualisationsIfSaving=listOfNamesToGiveToFmVisualisationsIfSaving
+                                    listOfNamesToGiveToFmVisualisationsIfSaving=listOfNamesToGiveToFmVisualisationsIfSaving,
+                                    
+                                    filepathOfManifest=filepathOfManifest,
+                                    typeOfSubsampledPyramid=typeOfSubsampledPyramid
                                     )
         
+    if streamOfBatches is not None :
+        streamOfBatches.stop()
+    if subjectStore is not None :
+        subjectStore.unlink_all(allFilepathsInSubjectStore)
+    terminate_sampling_pool_of_process() # Each stage of a schedule calls do_training(), so do not leave its processes behind.
+    remove_files_of_shared_memory_of_process() # Of the samplings submitted for a next subepoch, never collected.
+        
     end_training_time = time.time()
     log.print3("TIMING: Training process took time: "+str(end_training_time-start_training_time)+"(s)")
     log.print3("The whole do_training() function has finished.")
\ No newline at end of file
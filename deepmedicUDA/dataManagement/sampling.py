@@ -11,6 +11,10 @@ import time
 import numpy as np
 import math
 import random
+import signal
+import traceback
+import collections
+import multiprocessing
 
 from deepmedicUDA.image.io import loadVolume
 from deepmedicUDA.image.processing import reflectImageArrayIfNeeded, calculateTheZeroIntensityOf3dImage, padCnnInputs
@@ -23,10 +27,14 @@ class Checks(object):
 # getSampledDataAndLabelsForSubepoch
 #    get_random_ind_of_cases_to_train_subep
 #    getNumberOfSegmentsToExtractPerCategoryFromEachSubject
-#    load_imgs_of_single_case
-#    sampleImageParts
-#    extractDataOfASegmentFromImagesUsingSampledSliceCoords
-#        getImagePartFromSubsampledImageForTraining
+#    submit_sampling_jobs (if in the processes of get_sampling_pool_of_process)
+# finishSampledDataAndLabelsForSubepoch (at once, or by SamplingOfSubepoch.get(), if inBackground)
+#    run_sampling_jobs (sequentially, or collecting the jobs submitted to the pool)
+#        load_subj_and_get_samples (one job per case)
+#            load_imgs_of_single_case
+#            sampleImageParts
+#            extractDataOfASegmentFromImagesUsingSampledSliceCoords
+#                getImagePartFromSubsampledImageForTraining
 #    shuffleTheSegmentsForThisSubepoch
 
 # Main sampling process during training. Executed in parallel while training on a batch on the GPU.
@@ -53,9 +61,11 @@ def getSampledDataAndLabelsForSubepoch(log,
                                         
                                         padInputImagesBool,
                                         doIntAugm_shiftMuStd_multiMuStd,
-                                        reflectImageWithHalfProbDuringTraining
+                                        reflectImageWithHalfProbDuringTraining,
+                                        num_parallel_proc=0, # Processes that sample from the cases in parallel. 0 for sequentially.
+                                        inBackground=False # If True, returns a SamplingOfSubepoch at once. The cases are sampled in the sampling pool meanwhile.
                                         ):
-    start_getAllImageParts_time = time.clock()
+    numberOfProcesses = get_number_of_sampling_processes(num_parallel_proc, inBackground)
     
     training_or_validation_str = "Training" if train_or_val == "train" else "Validation"
     Checks.run_input_checks = run_input_checks
@@ -70,124 +80,42 @@ def getSampledDataAndLabelsForSubepoch(log,
     log.print3("Out of [" + str(total_number_of_subjects) + "] subjects given for [" + training_or_validation_str + "], it was specified to extract Segments from maximum [" + str(maxNumSubjectsLoadedPerSubepoch) + "] per subepoch.")
     log.print3("Shuffled indices of subjects that were randomly chosen: "+str(randomIndicesList_for_gpu))
     
-    #This is x. Will end up with dimensions: numberOfPathwaysThatTakeInput, partImagesLoadedPerSubepoch, channels, r,c,z, but flattened.
-    imagePartsChannelsToLoadOnGpuForSubepochPerPathway = [ [] for i in range(cnn3d.getNumPathwaysThatRequireInput()) ]
-    gtLabelsForTheCentralPredictedPartOfSegmentsInGpUForSubepoch = [] # Labels only for the central/predicted part of segments.
     numOfSubjectsLoadingThisSubepochForSampling = len(randomIndicesList_for_gpu) #Can be different than maxNumSubjectsLoadedPerSubepoch, cause of available images number.
     
-    dimsOfPrimeSegmentRcz=cnn3d.pathways[0].getShapeOfInput(train_or_val)[2:]
-    
     # This is to separate each sampling category (fore/background, uniform, full-image, weighted-classes)
-    stringsPerCategoryToSample = samplingTypeInstance.getStringsPerCategoryToSample()
-    numberOfCategoriesToSample = samplingTypeInstance.getNumberOfCategoriesToSample()
     percentOfSamplesPerCategoryToSample = samplingTypeInstance.getPercentOfSamplesPerCategoryToSample()
     arrayNumberOfSegmentsToExtractPerSamplingCategoryAndSubject = getNumberOfSegmentsToExtractPerCategoryFromEachSubject(numberOfImagePartsToLoadInGpuPerSubepoch,
                                                                                                                         percentOfSamplesPerCategoryToSample,
                                                                                                                         numOfSubjectsLoadingThisSubepochForSampling)
-    numOfInpChannelsForPrimaryPath = len(listOfFilepathsToEachChannelOfEachPatient[0])
     
     log.print3("SAMPLING: Starting iterations to extract Segments from each subject for next " + training_or_validation_str + "...")
     
-    for index_for_vector_with_images_on_gpu in range(0, numOfSubjectsLoadingThisSubepochForSampling) :
-        log.print3("SAMPLING: Going to load the images and extract segments from the subject #" + str(index_for_vector_with_images_on_gpu + 1) + "/" +str(numOfSubjectsLoadingThisSubepochForSampling))
-        
-        [allChannelsOfPatientInNpArray, #a nparray(channels,dim0,dim1,dim2)
-        gtLabelsImage,
-        roiMask,
-        arrayWithWeightMapsWhereToSampleForEachCategory, #can be returned "placeholderNothing" if it's testing phase or not "provided weighted maps". In this case, I will sample from GT/ROI.
-        allSubsampledChannelsOfPatientInNpArray,  #a nparray(channels,dim0,dim1,dim2)
-        tupleOfPaddingPerAxesLeftRight #( (padLeftR, padRightR), (padLeftC,padRightC), (padLeftZ,padRightZ)). All 0s when no padding.
-        ] = load_imgs_of_single_case(
-                                        log,
-                                        train_or_val,
-                                        
-                                        randomIndicesList_for_gpu[index_for_vector_with_images_on_gpu],
-                                        
-                                        listOfFilepathsToEachChannelOfEachPatient,
-                                        
-                                        providedGtLabelsBool=True, # If this getTheArr function is called (training), gtLabels should already been provided.
-                                        listOfFilepathsToGtLabelsOfEachPatient=listOfFilepathsToGtLabelsOfEachPatientTrainOrVal, 
-                                        num_classes = cnn3d.num_classes,
-                                        
-                                        providedWeightMapsToSampleForEachCategory = providedWeightMapsToSampleForEachCategory, # Says if weightMaps are provided. If true, must provide all. Placeholder in testing.
-                                        forEachSamplingCategory_aListOfFilepathsToWeightMapsOfEachPatient = forEachSamplingCategory_aListOfFilepathsToWeightMapsOfEachPatient, # Placeholder in testing.
-                                        
-                                        providedRoiMaskBool = providedRoiMaskBool,
-                                        listOfFilepathsToRoiMaskOfEachPatient = listOfFilepathsToRoiMaskOfEachPatient,
-                                        
-                                        useSameSubChannelsAsSingleScale=useSameSubChannelsAsSingleScale,
-                                        
-                                        usingSubsampledPathways=cnn3d.numSubsPaths > 0,
-                                        listOfFilepathsToEachSubsampledChannelOfEachPatient=listOfFilepathsToEachSubsampledChannelOfEachPatient,
-                                        
-                                        padInputImagesBool=padInputImagesBool,
-                                        cnnReceptiveField=cnn3d.recFieldCnn, # only used if padInputsBool
-                                        dimsOfPrimeSegmentRcz=dimsOfPrimeSegmentRcz, # only used if padInputsBool
-                                        
-                                        reflectImageWithHalfProb = reflectImageWithHalfProbDuringTraining
-                                    )
-        log.print3("DEBUG: Index of this case in the original user-defined list of subjects: " + str(randomIndicesList_for_gpu[index_for_vector_with_images_on_gpu]))
-        log.print3("Images for subject loaded.")
-        
-        dimensionsOfImageChannel = allChannelsOfPatientInNpArray[0].shape
-        finalWeightMapsToSampleFromPerCategoryForSubject = samplingTypeInstance.logicDecidingAndGivingFinalSamplingMapsForEachCategory(
-                                                                                                providedWeightMapsToSampleForEachCategory,
-                                                                                                arrayWithWeightMapsWhereToSampleForEachCategory,
-                                                                                                
-                                                                                                True, #providedGtLabelsBool. True both for training and for validation. Prerequisite from user-interface.
-                                                                                                gtLabelsImage,
-                                                                                                
-                                                                                                providedRoiMaskBool,
-                                                                                                roiMask,
-                                                                                                
-                                                                                                dimensionsOfImageChannel)
-        #THE number of imageParts in memory per subepoch does not need to be constant. The batch_size does.
-        #But I could have less batches per subepoch if some images dont have lesions I guess. Anyway.
-        
-        for cat_i in range(numberOfCategoriesToSample) :
-            catString = stringsPerCategoryToSample[cat_i]
-            numOfSegmsToExtractForThisCatFromThisSubject = arrayNumberOfSegmentsToExtractPerSamplingCategoryAndSubject[cat_i][index_for_vector_with_images_on_gpu]
-            finalWeightMapToSampleFromForThisCat = finalWeightMapsToSampleFromPerCategoryForSubject[cat_i]
-            
-            # Check if the weight map is fully-zeros. In this case, don't call the sampling function, just continue.
-            # Note that this way, the data loaded on GPU will not be as much as I initially wanted. Thus calculate number-of-batches from this actual number of extracted segments.
-            if np.sum(finalWeightMapToSampleFromForThisCat>0) == 0 :
-                log.print3("WARN: The sampling mask/map was found just zeros! No [" + catString + "] image parts were sampled for this subject!")
-                continue
-            
-            log.print3("From subject #"+str(index_for_vector_with_images_on_gpu)+", sampling that many segments of Category [" + catString + "] : " + str(numOfSegmsToExtractForThisCatFromThisSubject) )
-            imagePartsSampled = sampleImageParts(log = log,
-                                                numOfSegmentsToExtractForThisSubject = numOfSegmsToExtractForThisCatFromThisSubject,
-                                                dimsOfSegmentRcz = dimsOfPrimeSegmentRcz,
-                                                dimensionsOfImageChannel = dimensionsOfImageChannel, #image dimensions for this subject. All images should have the same.
-                                                weightMapToSampleFrom=finalWeightMapToSampleFromForThisCat)
-            log.print3("Finished sampling segments of Category [" + catString + "]. Number sampled: " + str( len(imagePartsSampled[0][0]) ) )
-            
-            # Use the just sampled coordinates of slices to actually extract the segments (data) from the subject's images. 
-            for image_part_i in range(len(imagePartsSampled[0][0])) :
-                coordsOfCentralVoxelOfThisImPart = imagePartsSampled[0][:,image_part_i]
-                #sliceCoordsOfThisImagePart = imagePartsSampled[1][:,image_part_i,:] #[0] is the central voxel coords.
-                
-                [ channelsForThisImagePartPerPathway,
-                gtLabelsForTheCentralClassifiedPartOfThisImagePart # used to be gtLabelsForThisImagePart, before extracting only for the central voxels.
-                ] = extractDataOfASegmentFromImagesUsingSampledSliceCoords(
-                                                                        train_or_val,
-                                                                        
-                                                                        cnn3d,
-                                                                        
-                                                                        coordsOfCentralVoxelOfThisImPart,
-                                                                        numOfInpChannelsForPrimaryPath,
-                                                                        
-                                                                        allChannelsOfPatientInNpArray,
-                                                                        allSubsampledChannelsOfPatientInNpArray,
-                                                                        gtLabelsImage,
-                                                                        
-                                                                        # Intensity Augmentation
-                                                                        doIntAugm_shiftMuStd_multiMuStd
-                                                                        )
-                for pathway_i in range(cnn3d.getNumPathwaysThatRequireInput()) :
-                    imagePartsChannelsToLoadOnGpuForSubepochPerPathway[pathway_i].append(channelsForThisImagePartPerPathway[pathway_i])
-                gtLabelsForTheCentralPredictedPartOfSegmentsInGpUForSubepoch.append(gtLabelsForTheCentralClassifiedPartOfThisImagePart)
+    # One job per case: load it and extract its segments. In the sampling pool if numberOfProcesses > 0.
+    argsOfSamplingJob = [log, train_or_val, run_input_checks, cnn3d, samplingTypeInstance,
+                        randomIndicesList_for_gpu, arrayNumberOfSegmentsToExtractPerSamplingCategoryAndSubject,
+                        listOfFilepathsToEachChannelOfEachPatient, listOfFilepathsToGtLabelsOfEachPatientTrainOrVal,
+                        providedRoiMaskBool, listOfFilepathsToRoiMaskOfEachPatient,
+                        providedWeightMapsToSampleForEachCategory, forEachSamplingCategory_aListOfFilepathsToWeightMapsOfEachPatient,
+                        useSameSubChannelsAsSingleScale, listOfFilepathsToEachSubsampledChannelOfEachPatient,
+                        padInputImagesBool, doIntAugm_shiftMuStd_multiMuStd, reflectImageWithHalfProbDuringTraining,
+                        True] # extractGtLabels
+    jobsInPool = submit_sampling_jobs(log, numberOfProcesses, argsOfSamplingJob, numOfSubjectsLoadingThisSubepochForSampling) if numberOfProcesses > 0 else None
+    argsToFinish = [log, train_or_val, numberOfProcesses, argsOfSamplingJob, numOfSubjectsLoadingThisSubepochForSampling, jobsInPool, cnn3d.getNumPathwaysThatRequireInput()]
+    if inBackground :
+        return SamplingOfSubepoch(finishSampledDataAndLabelsForSubepoch, argsToFinish)
+    return finishSampledDataAndLabelsForSubepoch(*argsToFinish)
+
+
+def finishSampledDataAndLabelsForSubepoch(log, train_or_val, numberOfProcesses, argsOfSamplingJob, numberOfJobs, jobsInPool, numberOfPathwaysThatRequireInput) :
+    # Second part of getSampledDataAndLabelsForSubepoch(), once its jobs are submitted. Runs or collects them, and returns the shuffled segments.
+    start_getAllImageParts_time = time.clock()
+    training_or_validation_str = "Training" if train_or_val == "train" else "Validation"
+    
+    #This is x. Will end up with dimensions: numberOfPathwaysThatTakeInput, partImagesLoadedPerSubepoch, channels, r,c,z, but flattened.
+    imagePartsChannelsToLoadOnGpuForSubepochPerPathway = [ [] for i in range(numberOfPathwaysThatRequireInput) ]
+    gtLabelsForTheCentralPredictedPartOfSegmentsInGpUForSubepoch = [] # Labels only for the central/predicted part of segments.
+    run_sampling_jobs(log, numberOfProcesses, argsOfSamplingJob, numberOfJobs,
+                      imagePartsChannelsToLoadOnGpuForSubepochPerPathway, gtLabelsForTheCentralPredictedPartOfSegmentsInGpUForSubepoch, jobsInPool)
                 
     #I need to shuffle them, together imageParts and lesionParts!
     [imagePartsChannelsToLoadOnGpuForSubepochPerPathway,
@@ -228,9 +156,11 @@ def getTDSampledDataAndLabelsForSubepoch(log,
                                         
                                         padInputImagesBool,
                                         doIntAugm_shiftMuStd_multiMuStd,
-                                        reflectImageWithHalfProbDuringTraining
+                                        reflectImageWithHalfProbDuringTraining,
+                                        num_parallel_proc=0, # Processes that sample from the cases in parallel. 0 for sequentially.
+                                        inBackground=False # If True, returns a SamplingOfSubepoch at once. The cases are sampled in the sampling pool meanwhile.
                                         ):
-    start_getAllImageParts_time = time.clock()
+    numberOfProcesses = get_number_of_sampling_processes(num_parallel_proc, inBackground)
     
     training_or_validation_str = "Training" if train_or_val == "train" else "Validation"
     Checks.run_input_checks = run_input_checks
@@ -245,124 +175,42 @@ def getTDSampledDataAndLabelsForSubepoch(log,
     log.print3("Out of [" + str(total_number_of_subjects) + "] subjects given for [" + training_or_validation_str + "], it was specified to extract Segments from maximum [" + str(maxNumSubjectsLoadedPerSubepoch) + "] per subepoch.")
     log.print3("Shuffled indices of subjects that were randomly chosen: "+str(randomIndicesList_for_gpu))
     
-    #This is x. Will end up with dimensions: numberOfPathwaysThatTakeInput, partImagesLoadedPerSubepoch, channels, r,c,z, but flattened.
-    imagePartsChannelsToLoadOnGpuForSubepochPerPathway = [ [] for i in range(cnn3d.getNumPathwaysThatRequireInput()) ]
-    gtLabelsForTheCentralPredictedPartOfSegmentsInGpUForSubepoch = [] # Labels only for the central/predicted part of segments.
     numOfSubjectsLoadingThisSubepochForSampling = len(randomIndicesList_for_gpu) #Can be different than maxNumSubjectsLoadedPerSubepoch, cause of available images number.
     
-    dimsOfPrimeSegmentRcz=cnn3d.pathways[0].getShapeOfInput(train_or_val)[2:]
-    
     # This is to separate each sampling category (fore/background, uniform, full-image, weighted-classes)
-    stringsPerCategoryToSample = samplingTypeInstance.getStringsPerCategoryToSample()
-    numberOfCategoriesToSample = samplingTypeInstance.getNumberOfCategoriesToSample()
     percentOfSamplesPerCategoryToSample = samplingTypeInstance.getPercentOfSamplesPerCategoryToSample()
     arrayNumberOfSegmentsToExtractPerSamplingCategoryAndSubject = getNumberOfSegmentsToExtractPerCategoryFromEachSubject(numberOfImagePartsToLoadInGpuPerSubepoch,
                                                                                                                         percentOfSamplesPerCategoryToSample,
                                                                                                                         numOfSubjectsLoadingThisSubepochForSampling)
-    numOfInpChannelsForPrimaryPath = len(listOfFilepathsToEachChannelOfEachPatient[0])
     
     log.print3("SAMPLINGTD: Starting iterations to extract Segments from each subject for next " + training_or_validation_str + "...")
     
-    for index_for_vector_with_images_on_gpu in range(0, numOfSubjectsLoadingThisSubepochForSampling) :
-        log.print3("SAMPLINGTD: Going to load the images and extract segments from the subject #" + str(index_for_vector_with_images_on_gpu + 1) + "/" +str(numOfSubjectsLoadingThisSubepochForSampling))
-        
-        [allChannelsOfPatientInNpArray, #a nparray(channels,dim0,dim1,dim2)
-        gtLabelsImage,
-        roiMask,
-        arrayWithWeightMapsWhereToSampleForEachCategory, #can be returned "placeholderNothing" if it's testing phase or not "provided weighted maps". In this case, I will sample from GT/ROI.
-        allSubsampledChannelsOfPatientInNpArray,  #a nparray(channels,dim0,dim1,dim2)
-        tupleOfPaddingPerAxesLeftRight #( (padLeftR, padRightR), (padLeftC,padRightC), (padLeftZ,padRightZ)). All 0s when no padding.
-        ] = load_imgs_of_single_case(
-                                        log,
-                                        train_or_val,
-                                        
-                                        randomIndicesList_for_gpu[index_for_vector_with_images_on_gpu],
-                                        
-                                        listOfFilepathsToEachChannelOfEachPatient,
-                                        
-                                        providedGtLabelsBool=True, # If this getTheArr function is called (training), gtLabels should already been provided.
-                                        listOfFilepathsToGtLabelsOfEachPatient=listOfFilepathsToGtLabelsOfEachPatientTrainOrVal, 
-                                        num_classes = cnn3d.num_classes,
-                                        
-                                        providedWeightMapsToSampleForEachCategory = providedWeightMapsToSampleForEachCategory, # Says if weightMaps are provided. If true, must provide all. Placeholder in testing.
-                                        forEachSamplingCategory_aListOfFilepathsToWeightMapsOfEachPatient = forEachSamplingCategory_aListOfFilepathsToWeightMapsOfEachPatient, # Placeholder in testing.
-                                        
-                                        providedRoiMaskBool = providedRoiMaskBool,
-                                        listOfFilepathsToRoiMaskOfEachPatient = listOfFilepathsToRoiMaskOfEachPatient,
-                                        
-                                        useSameSubChannelsAsSingleScale=useSameSubChannelsAsSingleScale,
-                                        
-                                        usingSubsampledPathways=cnn3d.numSubsPaths > 0,
-                                        listOfFilepathsToEachSubsampledChannelOfEachPatient=listOfFilepathsToEachSubsampledChannelOfEachPatient,
-                                        
-                                        padInputImagesBool=padInputImagesBool,
-                                        cnnReceptiveField=cnn3d.recFieldCnn, # only used if padInputsBool
-                                        dimsOfPrimeSegmentRcz=dimsOfPrimeSegmentRcz, # only used if padInputsBool
-                                        
-                                        reflectImageWithHalfProb = reflectImageWithHalfProbDuringTraining
-                                    )
-        log.print3("DEBUG: Index of this case in the original user-defined list of subjects: " + str(randomIndicesList_for_gpu[index_for_vector_with_images_on_gpu]))
-        log.print3("Images for subject loaded.")
-        
-        dimensionsOfImageChannel = allChannelsOfPatientInNpArray[0].shape
-        finalWeightMapsToSampleFromPerCategoryForSubject = samplingTypeInstance.logicDecidingAndGivingFinalSamplingMapsForEachCategory(
-                                                                                                providedWeightMapsToSampleForEachCategory,
-                                                                                                arrayWithWeightMapsWhereToSampleForEachCategory,
-                                                                                                
-                                                                                                True, #providedGtLabelsBool. True both for training and for validation. Prerequisite from user-interface.
-                                                                                                gtLabelsImage,
-                                                                                                
-                                                                                                providedRoiMaskBool,
-                                                                                                roiMask,
-                                                                                                
-                                                                                                dimensionsOfImageChannel)
-        #THE number of imageParts in memory per subepoch does not need to be constant. The batch_size does.
-        #But I could have less batches per subepoch if some images dont have lesions I guess. Anyway.
-        
-        for cat_i in range(numberOfCategoriesToSample) :
-            catString = stringsPerCategoryToSample[cat_i]
-            numOfSegmsToExtractForThisCatFromThisSubject = arrayNumberOfSegmentsToExtractPerSamplingCategoryAndSubject[cat_i][index_for_vector_with_images_on_gpu]
-            finalWeightMapToSampleFromForThisCat = finalWeightMapsToSampleFromPerCategoryForSubject[cat_i]
-            
-            # Check if the weight map is fully-zeros. In this case, don't call the sampling function, just continue.
-            # Note that this way, the data loaded on GPU will not be as much as I initially wanted. Thus calculate number-of-batches from this actual number of extracted segments.
-            if np.sum(finalWeightMapToSampleFromForThisCat>0) == 0 :
-                log.print3("WARN: The sampling mask/map was found just zeros! No [" + catString + "] image parts were sampled for this subject!")
-                continue
-            
-            log.print3("From subject #"+str(index_for_vector_with_images_on_gpu)+", sampling that many segments of Category [" + catString + "] : " + str(numOfSegmsToExtractForThisCatFromThisSubject) )
-            imagePartsSampled = sampleImageParts(log = log,
-                                                numOfSegmentsToExtractForThisSubject = numOfSegmsToExtractForThisCatFromThisSubject,
-                                                dimsOfSegmentRcz = dimsOfPrimeSegmentRcz,
-                                                dimensionsOfImageChannel = dimensionsOfImageChannel, #image dimensions for this subject. All images should have the same.
-                                                weightMapToSampleFrom=finalWeightMapToSampleFromForThisCat)
-            log.print3("Finished sampling segments of Category [" + catString + "]. Number sampled: " + str( len(imagePartsSampled[0][0]) ) )
-            
-            # Use the just sampled coordinates of slices to actually extract the segments (data) from the subject's images. 
-            for image_part_i in range(len(imagePartsSampled[0][0])) :
-                coordsOfCentralVoxelOfThisImPart = imagePartsSampled[0][:,image_part_i]
-                #sliceCoordsOfThisImagePart = imagePartsSampled[1][:,image_part_i,:] #[0] is the central voxel coords.
-                
-                [ channelsForThisImagePartPerPathway,
-                gtLabelsForTheCentralClassifiedPartOfThisImagePart # used to be gtLabelsForThisImagePart, before extracting only for the central voxels.
-                ] = extractTDDataOfASegmentFromImagesUsingSampledSliceCoords(
-                                                                        train_or_val,
-                                                                        
-                                                                        cnn3d,
-                                                                        
-                                                                        coordsOfCentralVoxelOfThisImPart,
-                                                                        numOfInpChannelsForPrimaryPath,
-                                                                        
-                                                                        allChannelsOfPatientInNpArray,
-                                                                        allSubsampledChannelsOfPatientInNpArray,
-                                                                        gtLabelsImage,
-                                                                        
-                                                                        # Intensity Augmentation
-                                                                        doIntAugm_shiftMuStd_multiMuStd
-                                                                        )
-                for pathway_i in range(cnn3d.getNumPathwaysThatRequireInput()) :
-                    imagePartsChannelsToLoadOnGpuForSubepochPerPathway[pathway_i].append(channelsForThisImagePartPerPathway[pathway_i])
-                gtLabelsForTheCentralPredictedPartOfSegmentsInGpUForSubepoch.append(gtLabelsForTheCentralClassifiedPartOfThisImagePart)
+    # One job per case: load it and extract its segments. In the sampling pool if numberOfProcesses > 0.
+    argsOfSamplingJob = [log, train_or_val, run_input_checks, cnn3d, samplingTypeInstance,
+                        randomIndicesList_for_gpu, arrayNumberOfSegmentsToExtractPerSamplingCategoryAndSubject,
+                        listOfFilepathsToEachChannelOfEachPatient, listOfFilepathsToGtLabelsOfEachPatientTrainOrVal,
+                        providedRoiMaskBool, listOfFilepathsToRoiMaskOfEachPatient,
+                        providedWeightMapsToSampleForEachCategory, forEachSamplingCategory_aListOfFilepathsToWeightMapsOfEachPatient,
+                        useSameSubChannelsAsSingleScale, listOfFilepathsToEachSubsampledChannelOfEachPatient,
+                        padInputImagesBool, doIntAugm_shiftMuStd_multiMuStd, reflectImageWithHalfProbDuringTraining,
+                        False] # extractGtLabels. No GT labels for the unlabeled (target domain) cases.
+    jobsInPool = submit_sampling_jobs(log, numberOfProcesses, argsOfSamplingJob, numOfSubjectsLoadingThisSubepochForSampling) if numberOfProcesses > 0 else None
+    argsToFinish = [log, train_or_val, numberOfProcesses, argsOfSamplingJob, numOfSubjectsLoadingThisSubepochForSampling, jobsInPool, cnn3d.getNumPathwaysThatRequireInput()]
+    if inBackground :
+        return SamplingOfSubepoch(finishTDSampledDataAndLabelsForSubepoch, argsToFinish)
+    return finishTDSampledDataAndLabelsForSubepoch(*argsToFinish)
+
+
+def finishTDSampledDataAndLabelsForSubepoch(log, train_or_val, numberOfProcesses, argsOfSamplingJob, numberOfJobs, jobsInPool, numberOfPathwaysThatRequireInput) :
+    # Second part of getTDSampledDataAndLabelsForSubepoch(), once its jobs are submitted. Runs or collects them, and returns the shuffled segments.
+    start_getAllImageParts_time = time.clock()
+    training_or_validation_str = "Training" if train_or_val == "train" else "Validation"
+    
+    #This is x. Will end up with dimensions: numberOfPathwaysThatTakeInput, partImagesLoadedPerSubepoch, channels, r,c,z, but flattened.
+    imagePartsChannelsToLoadOnGpuForSubepochPerPathway = [ [] for i in range(numberOfPathwaysThatRequireInput) ]
+    gtLabelsForTheCentralPredictedPartOfSegmentsInGpUForSubepoch = [] # Labels only for the central/predicted part of segments.
+    run_sampling_jobs(log, numberOfProcesses, argsOfSamplingJob, numberOfJobs,
+                      imagePartsChannelsToLoadOnGpuForSubepochPerPathway, gtLabelsForTheCentralPredictedPartOfSegmentsInGpUForSubepoch, jobsInPool)
                 
     #I need to shuffle them, together imageParts and lesionParts!
     [imagePartsChannelsToLoadOnGpuForSubepochPerPathway,
@@ -380,6 +228,239 @@ def getTDSampledDataAndLabelsForSubepoch(log,
 
 
 
+TIMEOUT_OF_SAMPLING_JOB_SECS = 600 # In case a process of the pool never started the job (happens in py3). The job is then resubmitted.
+
+def get_number_of_sampling_processes(num_parallel_proc, inBackground) :
+    # Processes of the sampling pool that run the jobs of a call of a sampler. 0 for sequentially, in the calling process. At least 1 in the background.
+    return max(num_parallel_proc, 1) if inBackground else num_parallel_proc
+
+class SamplingOfSubepoch(object):
+    # Returned by the samplers when called with inBackground=True, by the training process. Their jobs were submitted to its sampling pool, and run...
+    # ... while it trains on the previous subepoch. get() waits for them and returns what the sampler returns otherwise. Call it once.
+    def __init__(self, functionToFinish, argsOfFunctionToFinish) :
+        self._functionToFinish = functionToFinish
+        self._argsOfFunctionToFinish = argsOfFunctionToFinish
+        
+    def get(self) :
+        return self._functionToFinish(*self._argsOfFunctionToFinish)
+    
+def submit_sampling_jobs(log, numberOfProcesses, argsOfSamplingJob, numberOfJobs, jobsToSubmit=None) :
+    # Submits load_subj_and_get_samples() for each of jobsToSubmit (default all) to the sampling pool of this process. Returns immediately.
+    # Returns [generation of the pool, OrderedDict job_i -> AsyncResult], for run_sampling_jobs() to collect them.
+    workerPool = get_sampling_pool_of_process(log, numberOfProcesses)
+    jobs = collections.OrderedDict()
+    for job_i in (jobsToSubmit if jobsToSubmit is not None else range(numberOfJobs)) :
+        jobs[job_i] = workerPool.apply_async( load_subj_and_get_samples, [job_i] + argsOfSamplingJob )
+    return [_generationOfSamplingPool, jobs]
+
+def run_sampling_jobs(log, numberOfProcesses, argsOfSamplingJob, numberOfJobs, imagePartsChannelsToLoadOnGpuForSubepochPerPathway, gtLabelsForTheCentralPredictedPartOfSegmentsInGpUForSubepoch, jobsInPool=None) :
+    # Runs load_subj_and_get_samples() for each case of the subepoch and appends its segments to the given lists (per pathway, and of labels).
+    # numberOfProcesses <= 0: Sequentially, in this process. Otherwise in the sampling pool of this process, so that cases are loaded and sampled in parallel.
+    # jobsInPool: As returned by submit_sampling_jobs(), if the jobs were submitted earlier. They are resubmitted if the pool was restarted since.
+    jobsToDo = list(range(numberOfJobs))
+    if numberOfProcesses <= 0 :
+        for job_i in jobsToDo :
+            (channelsOfSegmentsPerPathway, gtLabelsOfSegments) = load_subj_and_get_samples( *([job_i] + argsOfSamplingJob) )
+            for pathway_i in range(len(imagePartsChannelsToLoadOnGpuForSubepochPerPathway)) :
+                imagePartsChannelsToLoadOnGpuForSubepochPerPathway[pathway_i] += channelsOfSegmentsPerPathway[pathway_i]
+            gtLabelsForTheCentralPredictedPartOfSegmentsInGpUForSubepoch += gtLabelsOfSegments
+        return
+    
+    while len(jobsToDo) > 0 :
+        try :
+            if jobsInPool is None or jobsInPool[0] != _generationOfSamplingPool : # Not submitted, or the pool was restarted after a timeout, maybe by another call.
+                jobsInPool = submit_sampling_jobs(log, numberOfProcesses, argsOfSamplingJob, numberOfJobs, jobsToDo)
+            jobs = jobsInPool[1]
+            for job_i in list(jobsToDo) : # Copy, as jobs are removed while looping.
+                try :
+                    (channelsOfSegmentsPerPathway, gtLabelsOfSegments) = jobs[job_i].get(timeout=TIMEOUT_OF_SAMPLING_JOB_SECS)
+                except multiprocessing.TimeoutError :
+                    log.print3("WARN: MULTIPROC: Sampling job #" + str(job_i) + " did not return within " + str(TIMEOUT_OF_SAMPLING_JOB_SECS) + " secs. "+\
+                               "Restarting the sampling processes and resubmitting the [" + str(len(jobsToDo)) + "] remaining jobs.")
+                    terminate_sampling_pool_of_process()
+                    break
+                for pathway_i in range(len(imagePartsChannelsToLoadOnGpuForSubepochPerPathway)) :
+                    imagePartsChannelsToLoadOnGpuForSubepochPerPathway[pathway_i] += channelsOfSegmentsPerPathway[pathway_i]
+                gtLabelsForTheCentralPredictedPartOfSegmentsInGpUForSubepoch += gtLabelsOfSegments
+                jobsToDo.remove(job_i)
+        except (Exception, KeyboardInterrupt) :
+            log.print3("ERROR: MULTIPROC: Caught exception while sampling in parallel processes:\n" + traceback.format_exc())
+            terminate_sampling_pool_of_process()
+            raise
+            
+            
+# One pool of sampling processes per process that runs the samplers (the training process, or the main process).
+# Kept across subepochs, rather than spawning processes for every subepoch. Recreated if a job times out.
+# The generation changes whenever the pool does, so that jobs submitted to a previous pool, in the background, are resubmitted.
+_samplingPoolOfProcess = None
+_numProcessesOfSamplingPool = 0
+_generationOfSamplingPool = 0
+
+def get_sampling_pool_of_process(log, num_parallel_proc) :
+    global _samplingPoolOfProcess, _numProcessesOfSamplingPool, _generationOfSamplingPool
+    numWorkers = min(num_parallel_proc, multiprocessing.cpu_count())
+    if _samplingPoolOfProcess is None or _numProcessesOfSamplingPool != numWorkers :
+        terminate_sampling_pool_of_process()
+        log.print3("MULTIPROC: Number of CPUs detected: " + str(multiprocessing.cpu_count()) + ". Requested to use max: [" + str(num_parallel_proc) + "]. "+\
+                   "Spawning [" + str(numWorkers) + "] processes to load cases and sample.")
+        _samplingPoolOfProcess = multiprocessing.Pool(processes=numWorkers, initializer=init_sampling_proc)
+        _numProcessesOfSamplingPool = numWorkers
+        _generationOfSamplingPool += 1
+    return _samplingPoolOfProcess
+
+def terminate_sampling_pool_of_process() :
+    global _samplingPoolOfProcess, _numProcessesOfSamplingPool, _generationOfSamplingPool
+    if _samplingPoolOfProcess is not None :
+        _samplingPoolOfProcess.terminate() # Also stops processes that hang. close() does not.
+        _samplingPoolOfProcess.join()
+        _generationOfSamplingPool += 1
+    _samplingPoolOfProcess = None
+    _numProcessesOfSamplingPool = 0
+
+def init_sampling_proc() :
+    # Children ignore KeyboardInterrupt (SIGINT). The parent handles it and terminates the pool.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Forked processes start with the random state of the parent. Reseed, otherwise all sample the same segments/augmentations.
+    np.random.seed()
+    random.seed()
+
+
+def load_subj_and_get_samples(job_i,
+                            log,
+                            train_or_val,
+                            run_input_checks,
+                            cnn3d,
+                            samplingTypeInstance,
+                            indicesOfCasesForSubepoch,
+                            arrayNumberOfSegmentsToExtractPerSamplingCategoryAndSubject,
+                            
+                            listOfFilepathsToEachChannelOfEachPatient,
+                            listOfFilepathsToGtLabelsOfEachPatientTrainOrVal,
+                            providedRoiMaskBool,
+                            listOfFilepathsToRoiMaskOfEachPatient,
+                            providedWeightMapsToSampleForEachCategory,
+                            forEachSamplingCategory_aListOfFilepathsToWeightMapsOfEachPatient,
+                            useSameSubChannelsAsSingleScale,
+                            listOfFilepathsToEachSubsampledChannelOfEachPatient,
+                            
+                            padInputImagesBool,
+                            doIntAugm_shiftMuStd_multiMuStd,
+                            reflectImageWithHalfProbDuringTraining,
+                            extractGtLabels # False for the unlabeled (target domain) cases.
+                            ) :
+    # Loads the case of job_i of the subepoch and extracts its segments, for every sampling category. Run in this process, or in one of the sampling pool.
+    # Returns ( [list of segments per pathway], list of labels of the segments ("placeholder" if not extractGtLabels) ).
+    Checks.run_input_checks = run_input_checks
+    dimsOfPrimeSegmentRcz = cnn3d.pathways[0].getShapeOfInput(train_or_val)[2:]
+    stringsPerCategoryToSample = samplingTypeInstance.getStringsPerCategoryToSample()
+    numberOfCategoriesToSample = samplingTypeInstance.getNumberOfCategoriesToSample()
+    numOfInpChannelsForPrimaryPath = len(listOfFilepathsToEachChannelOfEachPatient[0])
+    extractDataOfASegment = extractDataOfASegmentFromImagesUsingSampledSliceCoords if extractGtLabels else extractTDDataOfASegmentFromImagesUsingSampledSliceCoords
+    channelsOfSegmentsPerPathway = [ [] for i in range(cnn3d.getNumPathwaysThatRequireInput()) ]
+    gtLabelsOfSegments = []
+    
+    log.print3("SAMPLING: Job #" + str(job_i) + ": Going to load the images and extract segments from the subject #" + str(job_i + 1) + "/" +str(len(indicesOfCasesForSubepoch)))
+    
+    [allChannelsOfPatientInNpArray, #a nparray(channels,dim0,dim1,dim2)
+    gtLabelsImage,
+    roiMask,
+    arrayWithWeightMapsWhereToSampleForEachCategory, #can be returned "placeholderNothing" if it's testing phase or not "provided weighted maps". In this case, I will sample from GT/ROI.
+    allSubsampledChannelsOfPatientInNpArray,  #a nparray(channels,dim0,dim1,dim2)
+    tupleOfPaddingPerAxesLeftRight #( (padLeftR, padRightR), (padLeftC,padRightC), (padLeftZ,padRightZ)). All 0s when no padding.
+    ] = load_imgs_of_single_case(
+                                    log,
+                                    train_or_val,
+                                    
+                                    indicesOfCasesForSubepoch[job_i],
+                                    
+                                    listOfFilepathsToEachChannelOfEachPatient,
+                                    
+                                    providedGtLabelsBool=True, # If this getTheArr function is called (training), gtLabels should already been provided.
+                                    listOfFilepathsToGtLabelsOfEachPatient=listOfFilepathsToGtLabelsOfEachPatientTrainOrVal, 
+                                    num_classes = cnn3d.num_classes,
+                                    
+                                    providedWeightMapsToSampleForEachCategory = providedWeightMapsToSampleForEachCategory, # Says if weightMaps are provided. If true, must provide all. Placeholder in testing.
+                                    forEachSamplingCategory_aListOfFilepathsToWeightMapsOfEachPatient = forEachSamplingCategory_aListOfFilepathsToWeightMapsOfEachPatient, # Placeholder in testing.
+                                    
+                                    providedRoiMaskBool = providedRoiMaskBool,
+                                    listOfFilepathsToRoiMaskOfEachPatient = listOfFilepathsToRoiMaskOfEachPatient,
+                                    
+                                    useSameSubChannelsAsSingleScale=useSameSubChannelsAsSingleScale,
+                                    
+                                    usingSubsampledPathways=cnn3d.numSubsPaths > 0,
+                                    listOfFilepathsToEachSubsampledChannelOfEachPatient=listOfFilepathsToEachSubsampledChannelOfEachPatient,
+                                    
+                                    padInputImagesBool=padInputImagesBool,
+                                    cnnReceptiveField=cnn3d.recFieldCnn, # only used if padInputsBool
+                                    dimsOfPrimeSegmentRcz=dimsOfPrimeSegmentRcz, # only used if padInputsBool
+                                    
+                                    reflectImageWithHalfProb = reflectImageWithHalfProbDuringTraining
+                                )
+    log.print3("DEBUG: Index of this case in the original user-defined list of subjects: " + str(indicesOfCasesForSubepoch[job_i]))
+    log.print3("Images for subject loaded.")
+    
+    dimensionsOfImageChannel = allChannelsOfPatientInNpArray[0].shape
+    finalWeightMapsToSampleFromPerCategoryForSubject = samplingTypeInstance.logicDecidingAndGivingFinalSamplingMapsForEachCategory(
+                                                                                            providedWeightMapsToSampleForEachCategory,
+                                                                                            arrayWithWeightMapsWhereToSampleForEachCategory,
+                                                                                            
+                                                                                            True, #providedGtLabelsBool. True both for training and for validation. Prerequisite from user-interface.
+                                                                                            gtLabelsImage,
+                                                                                            
+                                                                                            providedRoiMaskBool,
+                                                                                            roiMask,
+                                                                                            
+                                                                                            dimensionsOfImageChannel)
+    #THE number of imageParts in memory per subepoch does not need to be constant. The batch_size does.
+    #But I could have less batches per subepoch if some images dont have lesions I guess. Anyway.
+    
+    for cat_i in range(numberOfCategoriesToSample) :
+        catString = stringsPerCategoryToSample[cat_i]
+        numOfSegmsToExtractForThisCatFromThisSubject = arrayNumberOfSegmentsToExtractPerSamplingCategoryAndSubject[cat_i][job_i]
+        finalWeightMapToSampleFromForThisCat = finalWeightMapsToSampleFromPerCategoryForSubject[cat_i]
+        
+        # Check if the weight map is fully-zeros. In this case, don't call the sampling function, just continue.
+        # Note that this way, the data loaded on GPU will not be as much as I initially wanted. Thus calculate number-of-batches from this actual number of extracted segments.
+        if np.sum(finalWeightMapToSampleFromForThisCat>0) == 0 :
+            log.print3("WARN: The sampling mask/map was found just zeros! No [" + catString + "] image parts were sampled for this subject!")
+            continue
+        
+        log.print3("From subject #"+str(job_i)+", sampling that many segments of Category [" + catString + "] : " + str(numOfSegmsToExtractForThisCatFromThisSubject) )
+        imagePartsSampled = sampleImageParts(log = log,
+                                            numOfSegmentsToExtractForThisSubject = numOfSegmsToExtractForThisCatFromThisSubject,
+                                            dimsOfSegmentRcz = dimsOfPrimeSegmentRcz,
+                                            dimensionsOfImageChannel = dimensionsOfImageChannel, #image dimensions for this subject. All images should have the same.
+                                            weightMapToSampleFrom=finalWeightMapToSampleFromForThisCat)
+        log.print3("Finished sampling segments of Category [" + catString + "]. Number sampled: " + str( len(imagePartsSampled[0][0]) ) )
+        
+        # Use the just sampled coordinates of slices to actually extract the segments (data) from the subject's images. 
+        for image_part_i in range(len(imagePartsSampled[0][0])) :
+            coordsOfCentralVoxelOfThisImPart = imagePartsSampled[0][:,image_part_i]
+            #sliceCoordsOfThisImagePart = imagePartsSampled[1][:,image_part_i,:] #[0] is the central voxel coords.
+            
+            [ channelsForThisImagePartPerPathway,
+            gtLabelsForTheCentralClassifiedPartOfThisImagePart # used to be gtLabelsForThisImagePart, before extracting only for the central voxels.
+            ] = extractDataOfASegment(
+                                                                    train_or_val,
+                                                                    
+                                                                    cnn3d,
+                                                                    
+                                                                    coordsOfCentralVoxelOfThisImPart,
+                                                                    numOfInpChannelsForPrimaryPath,
+                                                                    
+                                                                    allChannelsOfPatientInNpArray,
+                                                                    allSubsampledChannelsOfPatientInNpArray,
+                                                                    gtLabelsImage,
+                                                                    
+                                                                    # Intensity Augmentation
+                                                                    doIntAugm_shiftMuStd_multiMuStd
+                                                                    )
+            for pathway_i in range(cnn3d.getNumPathwaysThatRequireInput()) :
+                channelsOfSegmentsPerPathway[pathway_i].append(channelsForThisImagePartPerPathway[pathway_i])
+            gtLabelsOfSegments.append(gtLabelsForTheCentralClassifiedPartOfThisImagePart)
+    return (channelsOfSegmentsPerPathway, gtLabelsOfSegments)
+
+
     
 def get_random_ind_of_cases_to_train_subep(total_number_of_subjects, 
                                             max_subjects_on_gpu_for_subepoch, 
@@ -118,6 +118,7 @@ class TrainConfig(Config):
     #========= GENERICS =========
     PAD_INPUT = "padInputImagesBool"
     RUN_INP_CHECKS = "run_input_checks"
+    NUM_PARALLEL_PROC = "num_parallel_proc"
     
     SNUM = "NumofSdomainImagesForBadv"
 
@@ -99,6 +99,9 @@ class TrainSessionParameters(object) :
     @staticmethod
     def errorRequireMomNonNorm0Norm1() :
         print("ERROR: The parameter \"momNonNorm0orNormalized1\" must be given 0 or 1. Omit for default. Exiting!"); exit(1)
+    @staticmethod
+    def errorRequireNumParallelProc() :
+        print("ERROR: The parameter \"num_parallel_proc\" must be an integer >= 0. Omit for default (0, sequential sampling). Exiting!"); exit(1)
         
     # Deprecated :
     @staticmethod
@@ -342,6 +345,10 @@ class TrainSessionParameters(object) :
         self.numberOfCasesTrain = len(self.channelsFilepathsTrain)
         self.numberOfCasesVal = len(self.channelsFilepathsVal)
         self.run_input_checks = cfg[cfg.RUN_INP_CHECKS] if cfg[cfg.RUN_INP_CHECKS] is not None else True
+        # Processes that load the cases of a subepoch and sample from them in parallel, one job per case. 0 samples them sequentially.
+        self.num_parallel_proc = cfg[cfg.NUM_PARALLEL_PROC] if cfg[cfg.NUM_PARALLEL_PROC] is not None else 0
+        if not isinstance(self.num_parallel_proc, int) or self.num_parallel_proc < 0 :
+            self.errorRequireNumParallelProc()
         
         #HIDDENS, no config allowed for these at the moment:
         self.useSameSubChannelsAsSingleScale = True
@@ -534,6 +541,7 @@ class TrainSessionParameters(object) :
         
         logPrint("~~~~~~~~~~~~~~~~~~Other Generic Parameters~~~~~~~~~~~~~~~~")
         logPrint("Check whether input data has correct format (can slow down process) = " + str(self.run_input_checks))
+        logPrint("Number of parallel processes for sampling (0 for sequential) = " + str(self.num_parallel_proc))
         logPrint("~~Pre Processing~~")
         logPrint("Pad Input Images = " + str(self.padInputImagesBool))
         
@@ -608,7 +616,8 @@ class TrainSessionParameters(object) :
                 self.filepathsToSaveFeaturesForEachPatientVal,
                 
                 #-------- Others --------
-                self.run_input_checks
+                self.run_input_checks,
+                self.num_parallel_proc
                 ]
         return args
     